@@ -1,6 +1,6 @@
 from headers import *
 
-import sys, os, platform, time
+import sys, os, platform, pickle, time
 
 import numpy as np
 import random
@@ -79,8 +79,12 @@ def _log_it(logger, msg):
 
 
 class OraclePlanner(BasePlanner):
-    def __init__(self, motion):
+    def __init__(self, motion, plan_table=None):
+        """
+        plan_table: when not None, an OptimalPlanTable memoizing the optimal plans (see HRL/plan_table.py)
+        """
         super(OraclePlanner, self).__init__(motion)
+        self.plan_table = plan_table
 
     def learn(self):
         pass
@@ -95,7 +99,7 @@ class OraclePlanner(BasePlanner):
             return target  # already there, directly go
 
         try:
-            plan = self.task.get_optimal_plan()
+            plan = self.plan_table.get_plan(self.task) if self.plan_table is not None else self.task.get_optimal_plan()
             tar = plan[0][0]
             assert tar in combined_target_list
             next_id = combined_target_index[tar]
@@ -133,7 +137,10 @@ class VoidPlanner(BasePlanner):
 
 class GraphPlanner(BasePlanner):
     def __init__(self, motion):
-        super(GraphPlanner, self).__init__(motion)
+        if motion is not None:
+            super(GraphPlanner, self).__init__(motion)
+        else:  # parameter-only graph, e.g., for reducing the counts from parallel workers
+            self.motion = self.task = self.env = None
         #self.task = motion.task
         #self.env = self.task.env
         #self.motion = motion
@@ -212,80 +219,148 @@ class GraphPlanner(BasePlanner):
         -- total steps will be 56 * n_trials * max_allowed_steps
         -- sum up: 56 * n_trials * max_allowed_steps * #houses
         -- default params on 200 houses -> 8,400,000 frames
+        -- use learn_counts() on shards of houses and set_counts() on the reduced counts to parallelize (see HRL/learn_graph.py)
+    checkpoint_dir: when not None, the counts of every house are stored in this folder and re-used when re-run
+    seed: when not None, the random seed is reset to (seed + house_offset + index) before each house,
+          so the counts of a house do not depend on how the houses are sharded
     """
-    def learn(self, n_trial=25, max_allowed_steps=30, eps=1e-4, logger=None):
-        self.cached_eps = eps
+    def learn(self, n_trial=25, max_allowed_steps=30, eps=1e-4, logger=None, checkpoint_dir=None, seed=None):
+        ts = time.time()
+        counts = self.learn_counts(n_trial, max_allowed_steps, logger=logger, checkpoint_dir=checkpoint_dir, seed=seed)
+        self.set_counts(counts, eps=eps, logger=logger)
+        dur = time.time() - ts
+        _log_it(logger, ("Training Done! Total Computation Time = %.4fs" % dur))
+
+    def learn_counts(self, n_trial=25, max_allowed_steps=30, logger=None, checkpoint_dir=None, seed=None, house_offset=0):
+        """
+        return the summed count matrices (cnt_rooms, pos_rooms, cnt_objs, pos_objs) over all the houses in self.env
+        """
         if hasattr(self.env, 'all_houses'):
             all_houses = self.env.all_houses
         else:
             all_houses = [self.env.house]
+        if (checkpoint_dir is not None) and (not os.path.exists(checkpoint_dir)):
+            os.makedirs(checkpoint_dir)
 
         # set hardness of the task to 0
         self.task.reset_hardness(hardness=0)
         # learning graph prior over rooms
-        cnt_rooms = np.zeros((n_rooms, n_rooms), dtype=np.int32)
-        cnt_objs = np.zeros((n_rooms, n_objects), dtype=np.int32)
-        pos_objs = np.zeros((n_rooms, n_objects), dtype=np.int32)
-        pos_rooms = np.zeros((n_rooms, n_rooms), dtype=np.int32)
+        counts = [np.zeros((n_rooms, n_rooms), dtype=np.int32),   # cnt_rooms
+                  np.zeros((n_rooms, n_rooms), dtype=np.int32),   # pos_rooms
+                  np.zeros((n_rooms, n_objects), dtype=np.int32), # cnt_objs
+                  np.zeros((n_rooms, n_objects), dtype=np.int32)] # pos_objs
 
         ts = time.time()
+        n_resumed = 0
         _log_it(logger, "House Enumerating & Sampling ... Total {} Houses...".format(len(all_houses)))
         for _i, house in enumerate(all_houses):
-            _log_it(logger, ">> House#{} ...".format(_i))
-            self.env.reset_house(house._id)
-            all_rooms = house.all_desired_roomTypes
-            all_objects = house.all_desired_targetObj
-            # check connectivity to indoor
-            indoor_id = n_rooms - 1
-            in_msk, out_msk = house.getRegionMaskForRoomMask(0)
-            if in_msk is not None: # has region indoor
-                for r in all_rooms:   # connect to other rooms
-                    r_id = combined_target_index[r]
-                    cnt_rooms[r_id,indoor_id] += 1
-                    cnt_rooms[indoor_id, r_id] += 1
-                    if out_msk[r_id] > 0:
-                        pos_rooms[r_id, indoor_id] += 1
-                        pos_rooms[indoor_id, r_id] += 1
-                for o in all_objects:  # connect to objects
-                    o_id = independent_object_index[o]
-                    o_pos = combined_target_index[o]
-                    cnt_objs[indoor_id, o_id] += 1
-                    if in_msk[o_pos] > 0:
-                        pos_objs[indoor_id, o_id] += 1
-            # check other normal room types
-            for r1 in all_rooms:
-                r1_id = combined_target_index[r1]
-                in_msk, out_msk = house.getRegionMaskForTarget(r1)
-                # connectivity towards other rooms
-                for r2 in all_rooms:
-                    if r1 == r2: continue
-                    r2_id = combined_target_index[r2]
-                    if out_msk[r2_id] > 0:
-                        pos_rooms[r1_id, r2_id] += 1
-                        cnt_rooms[r1_id, r2_id] += 1
-                    else:  # not connected closely, need to run exploration
-                        cnt_rooms[r1_id, r2_id] += n_trial
-                        n_pos = 0
-                        for _ in range(n_trial):
-                            cx, cy = house.getRandomLocation(r1)
-                            self.task.reset(target=r2, reset_house=False, birthplace=(cx, cy))
-                            D = self.motion.run(r2, max_allowed_steps)
-                            if D[-1][3] or any([(d[0][r2_id] > 0) for d in D]):
-                                n_pos += 1
-                        pos_rooms[r1_id, r2_id] += n_pos
-                # connecitivity towards objects
-                for o in all_objects:
-                    o_id = independent_object_index[o]
-                    o_pos = combined_target_index[o]
-                    cnt_objs[r1_id, o_id] += 1
-                    if in_msk[o_pos] > 0:
-                        pos_objs[r1_id, o_id] += 1
-
+            _log_it(logger, ">> House#{} ...".format(_i + house_offset))
+            house_counts = None
+            if checkpoint_dir is not None:
+                ckpt_file = os.path.join(checkpoint_dir, 'house_{}.pkl'.format(house._id))
+                house_counts = self._load_house_counts(ckpt_file, n_trial, max_allowed_steps)
+            if house_counts is not None:
+                n_resumed += 1
+                _log_it(logger, "  ---> counts loaded from <{}>".format(ckpt_file))
+            else:
+                if seed is not None:
+                    np.random.seed(seed + house_offset + _i)
+                    random.seed(seed + house_offset + _i)
+                if hasattr(all_houses, 'prefetch_index') and (_i + 1 < len(all_houses)):
+                    all_houses.prefetch_index(_i + 1)   # lazy houses, see house_provider.py
+                self.env.reset_house(house._id)
+                house_counts = self._learn_house(house, n_trial, max_allowed_steps)
+                if checkpoint_dir is not None:
+                    self._save_house_counts(ckpt_file, house_counts, n_trial, max_allowed_steps)
+            for c, h_c in zip(counts, house_counts):
+                c += h_c
             _log_it(logger, "  ---> %d / %d houses processed! time elapsed = %.4fs" % (_i+1, len(all_houses), time.time()-ts))
         dur = time.time() - ts
-        _log_it(logger, ("Sampling Done! Total Sampling Time Elapsed = %.4fs" % dur))
+        _log_it(logger, ("Sampling Done! Total Sampling Time Elapsed = %.4fs (%d houses resumed from checkpoints)" % (dur, n_resumed)))
+        return counts
+
+    def _load_house_counts(self, filename, n_trial, max_allowed_steps):
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        if (data['n_trial'] != n_trial) or (data['max_allowed_steps'] != max_allowed_steps):
+            print('[GraphPlanner] Checkpoint <{}> has different sampling params, re-computing!'.format(filename))
+            return None
+        return data['counts']
+
+    def _save_house_counts(self, filename, counts, n_trial, max_allowed_steps):
+        # write to a temporary file first, so a crash never leaves a partial checkpoint
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(dict(counts=counts, n_trial=n_trial, max_allowed_steps=max_allowed_steps), f)
+        os.replace(tmp_file, filename)
+
+    def _learn_house(self, house, n_trial, max_allowed_steps):
+        """
+        return the count matrices (cnt_rooms, pos_rooms, cnt_objs, pos_objs) of a single house
+        NOTE: self.env must have been reset to <house>
+        """
+        cnt_rooms = np.zeros((n_rooms, n_rooms), dtype=np.int32)
+        cnt_objs = np.zeros((n_rooms, n_objects), dtype=np.int32)
+        pos_objs = np.zeros((n_rooms, n_objects), dtype=np.int32)
+        pos_rooms = np.zeros((n_rooms, n_rooms), dtype=np.int32)
 
-        # compute all the MLE for graph parameters
+        all_rooms = house.all_desired_roomTypes
+        all_objects = house.all_desired_targetObj
+        # check connectivity to indoor
+        indoor_id = n_rooms - 1
+        in_msk, out_msk = house.getRegionMaskForRoomMask(0)
+        if in_msk is not None: # has region indoor
+            for r in all_rooms:   # connect to other rooms
+                r_id = combined_target_index[r]
+                cnt_rooms[r_id,indoor_id] += 1
+                cnt_rooms[indoor_id, r_id] += 1
+                if out_msk[r_id] > 0:
+                    pos_rooms[r_id, indoor_id] += 1
+                    pos_rooms[indoor_id, r_id] += 1
+            for o in all_objects:  # connect to objects
+                o_id = independent_object_index[o]
+                o_pos = combined_target_index[o]
+                cnt_objs[indoor_id, o_id] += 1
+                if in_msk[o_pos] > 0:
+                    pos_objs[indoor_id, o_id] += 1
+        # check other normal room types
+        for r1 in all_rooms:
+            r1_id = combined_target_index[r1]
+            in_msk, out_msk = house.getRegionMaskForTarget(r1)
+            # connectivity towards other rooms
+            for r2 in all_rooms:
+                if r1 == r2: continue
+                r2_id = combined_target_index[r2]
+                if out_msk[r2_id] > 0:
+                    pos_rooms[r1_id, r2_id] += 1
+                    cnt_rooms[r1_id, r2_id] += 1
+                else:  # not connected closely, need to run exploration
+                    cnt_rooms[r1_id, r2_id] += n_trial
+                    n_pos = 0
+                    for _ in range(n_trial):
+                        cx, cy = house.getRandomLocation(r1)
+                        self.task.reset(target=r2, reset_house=False, birthplace=(cx, cy))
+                        D = self.motion.run(r2, max_allowed_steps)
+                        if D[-1][3] or any([(d[0][r2_id] > 0) for d in D]):
+                            n_pos += 1
+                    pos_rooms[r1_id, r2_id] += n_pos
+            # connecitivity towards objects
+            for o in all_objects:
+                o_id = independent_object_index[o]
+                o_pos = combined_target_index[o]
+                cnt_objs[r1_id, o_id] += 1
+                if in_msk[o_pos] > 0:
+                    pos_objs[r1_id, o_id] += 1
+        return cnt_rooms, pos_rooms, cnt_objs, pos_objs
+
+    def set_counts(self, counts, eps=1e-4, logger=None):
+        """
+        compute all the MLE for graph parameters from the count matrices (cnt_rooms, pos_rooms, cnt_objs, pos_objs)
+        """
+        self.cached_eps = eps
+        cnt_rooms, pos_rooms, cnt_objs, pos_objs = counts
         _log_it(logger, "Computing Statistics and Parameters ...")
         for r1 in range(n_rooms):
             for r2 in range(r1+1, n_rooms):
@@ -300,8 +375,6 @@ class GraphPlanner(BasePlanner):
                     self.conn_objs[r1, o] = 0
                 else:
                     self.conn_objs[r1, o] = pos_objs[r1, o] / cnt_objs[r1, o]
-        dur = time.time() - ts
-        _log_it(logger, ("Training Done! Total Computation Time = %.4fs" % dur))
 
     def evolve(self):
         raise NotImplementedError()
@@ -311,28 +384,41 @@ class GraphPlanner(BasePlanner):
     Get Y = <n_total> noisy samples from X, <n_pos> are 1, <n_neg> are 0
     compute Pr[X = 1 | Y] = Pr[X=1, Y] / (Pr[X=1, Y] + Pr[X=0, Y]) = W_1 / (W_0 + W_1)
     """
+    def _posterior(self, prior, n_total, n_pos):
+        n_neg = n_total - n_pos
+        psi = self.params[2].astype(np.float64)
+        # compute Pr[X=0, Y]
+        lg_W_0 = np.log(np.maximum(1 - prior, 1e-10)) + np.log(1 - psi[0]) * n_neg + np.log(psi[0]) * n_pos
+        # compute Pr[X=1, Y]
+        lg_W_1 = np.log(np.maximum(prior, 1e-10)) + np.log(1 - psi[1]) * n_neg + np.log(psi[1]) * n_pos
+        max_lg = np.maximum(lg_W_0, lg_W_1)
+        W_0 = np.exp(lg_W_0 - max_lg)
+        W_1 = np.exp(lg_W_1 - max_lg)
+        # entries never observed keep the prior
+        return np.where(n_total > 0, W_1 / (W_1 + W_0), prior)
+
     def _update_graph(self, visit):
-        for entry in visit:
-            t, x, y = entry
-            n_total = self.stats_exp[t][x, y]
-            n_pos = self.stats_obs[t][x, y]
+        """
+        recompute the posterior of the entries in <visit> from the count arrays, vectorized over the entries
+        visit: set of (t, x, y), t = 0 for a pair of rooms (kept symmetric), t = 1 for a room and an object
+        NOTE: only the observed entries change, the others keep their posterior (the prior after reset())
+        """
+        if len(visit) == 0:
+            return
+        for t in range(2):
+            entries = [(x, y) for _t, x, y in visit if _t == t]
+            if len(entries) == 0:
+                continue
+            xs, ys = np.array(entries, dtype=np.int64).T
+            n_total = self.stats_exp[t][xs, ys]
+            n_pos = self.stats_obs[t][xs, ys]
             if t == 0:
-                n_total += self.stats_exp[t][y, x]
-                n_pos += self.stats_obs[t][y, x]
-            n_neg = n_total - n_pos
-            p = self.params[t][x, y]
-            # compute Pr[X=0, Y]
-            lg_W_0 = np.log(max(1 - p, 1e-10)) + np.log(1 - self.params[2][0]) * n_neg + np.log(self.params[2][0]) * n_pos
-            # compute Pr[X=1, Y]
-            lg_W_1 = np.log(max(p, 1e-10)) + np.log(1 - self.params[2][1]) * n_neg + np.log(self.params[2][1]) * n_pos
-            max_lg = max(lg_W_0, lg_W_1)
-            lg_W_0 -= max_lg
-            lg_W_1 -= max_lg
-            W_0 = np.exp(lg_W_0)
-            W_1 = np.exp(lg_W_1)
-            self.graph[t][x, y] = W_1 / (W_1 + W_0)
+                n_total = n_total + self.stats_exp[t][ys, xs]
+                n_pos = n_pos + self.stats_obs[t][ys, xs]
+            post = self._posterior(self.params[t][xs, ys].astype(np.float64), n_total, n_pos)
+            self.graph[t][xs, ys] = post
             if t == 0:
-                self.graph[t][y, x] = self.graph[t][x, y]
+                self.graph[t][ys, xs] = post
 
     def observe(self, exp_data, target):
         # execute sub-policy <target>, observe experiences <data>
@@ -370,66 +456,63 @@ class GraphPlanner(BasePlanner):
         for i in range(len(full_rooms)):
             for j in range(i + 1, len(full_rooms)):
                 visit.add((0, full_rooms[i], full_rooms[j]))
-                self.exp_rooms[i, j] += 1
-                self.obs_rooms[i, j] += 1
+                self.exp_rooms[full_rooms[i], full_rooms[j]] += 1
+                self.obs_rooms[full_rooms[i], full_rooms[j]] += 1
 
         # compute posterior
         self._update_graph(visit)
 
+    def _shortest_path(self, curr_rooms):
+        """
+        max-product shortest path over rooms from <curr_rooms>
+        vectorized Bellman-Ford relaxation: all the probabilities are at most 1, so n_rooms-1 rounds suffice
+        return opt_rooms (probability of the best path) and prev_rooms (predecessor on the best path)
+        """
+        opt_rooms = np.zeros(n_rooms, dtype=np.float32)
+        prev_rooms = np.ones(n_rooms, dtype=np.int32) * -1
+        opt_rooms[curr_rooms] = 1
+        col_idx = np.arange(n_rooms)
+        for _ in range(n_rooms - 1):
+            cand = opt_rooms[:, np.newaxis] * self.g_rooms   # [from, to]
+            best_from = np.argmax(cand, axis=0)
+            best_p = cand[best_from, col_idx]
+            flag = best_p > opt_rooms
+            if not np.any(flag): break
+            opt_rooms[flag] = best_p[flag]
+            prev_rooms[flag] = best_from[flag]
+        return opt_rooms, prev_rooms
+
     def plan(self, mask, target, return_list=False):
         # find shortest path towards target in self.graph
         target_id = combined_target_index[target]
         if mask[target_id] > 0:
             return target if not return_list else [target]  # already there, directly go
 
-        #print('[Graph] current house id = {}'.format(self.task.house._id))
-        #print('[Graph] start planning ... target = {}, id = {}, mask = {}'.format(target, target_id, mask))
+        curr_rooms = _get_room_index_from_mask(mask)
+        full_plan = self._compute_plan(curr_rooms, target, target_id)
+        return full_plan[0] if not return_list else full_plan
 
+    def _compute_plan(self, curr_rooms, target, target_id):
         # shortest path planning
-        curr_rooms = _get_room_index_from_mask(mask)
-        opt_rooms = np.zeros(n_rooms, dtype=np.float32)
-        prev_rooms = np.ones(n_rooms, dtype=np.int32) * -1
-        for r in curr_rooms:
-            opt_rooms[r] = 1
-        visit = set()
-        # shorest path over rooms
-        for _ in range(n_rooms):
-            sl_r = -1
-            for i in range(n_rooms):
-                if i not in visit:
-                    if (sl_r < 0) or (opt_rooms[i] > opt_rooms[sl_r]): sl_r = i
-            if sl_r < 0:
-                break
-            visit.add(sl_r)
-            for i in range(n_rooms):
-                if i in visit: continue
-                cur_p = opt_rooms[sl_r] * self.g_rooms[sl_r, i]
-                if cur_p > opt_rooms[i]:
-                    opt_rooms[i] = cur_p
-                    prev_rooms[i] = sl_r
-        #print('[Graph] SSP Done!')
+        opt_rooms, prev_rooms = self._shortest_path(curr_rooms)
         full_plan = []
         if target in ALLOWED_OBJECT_TARGET_INDEX:   # object target
             full_plan.append(target)
             object_id = independent_object_index[target]
-            tar_room = -1
-            best_p = 0
-            for r in range(n_rooms - 1):   # exclude <indoor>
-                if all_graph_rooms_names[r] in self.excluded_targets: continue
-                curr_p = opt_rooms[r] * self.g_objs[r, object_id]
-                if (tar_room < 0) or (best_p < curr_p):
-                    best_p = curr_p
-                    tar_room = r
+            # exclude <indoor>
+            allowed = np.array([(all_graph_rooms_names[r] not in self.excluded_targets) for r in range(n_rooms - 1)])
+            if np.any(allowed):
+                curr_p = opt_rooms[:n_rooms-1] * self.g_objs[:n_rooms-1, object_id]
+                curr_p[~allowed] = -1
+                tar_room = int(np.argmax(curr_p))
+            else:
+                tar_room = -1
         else:  #  room target
             tar_room = target_id
         # need to reach room <tar_room>
-        #print('[Graph] curr_rooms = {}'.format(curr_rooms))
-        #print('[Graph] opt_rooms = {}'.format(opt_rooms))
-        #print('[Graph] prev_rooms = {}'.format(prev_rooms))
-        #print('[Graph] Target Room ID = {}, Type = {}, Probability = {}'.format(tar_room, all_graph_rooms_names[tar_room], opt_rooms[tar_room]))
         ptr = tar_room
         if ptr in curr_rooms: # we should directly execute target
-            return target if not return_list else [target]
+            return [target]
         ptr_name = all_graph_rooms_names[ptr]
         if ptr_name not in self.excluded_targets:
             full_plan.append(ptr_name)
@@ -437,18 +520,15 @@ class GraphPlanner(BasePlanner):
             assert prev_rooms[ptr] > -1, '[BayesGraph.plan] Currently Target Room is {}, however it is not reachable!!!! curr house id = {}'.format(combined_target_list[ptr], self.task.house._id)
         except Exception as e:
             print(e)
-            return target
-        #print('[Graph] Fetching SSP Path ...')
+            return [target]
         while prev_rooms[ptr] not in curr_rooms:
             ptr = prev_rooms[ptr]
             ptr_name = all_graph_rooms_names[ptr]
             if ptr_name not in self.excluded_targets:
                 full_plan.append(ptr_name)
-            #print('[Graph] --> add ptr = {}, prev = {}'.format(all_graph_rooms_names[ptr], prev_rooms[ptr]))
             assert prev_rooms[ptr] > -1
         full_plan.reverse()
-        #print('[Graph] Done! Path = {}'.format(full_plan))
-        return full_plan[0] if not return_list else full_plan
+        return full_plan
 
     def reset(self):
         self.g_rooms[...] = self.conn_rooms
@@ -1,6 +1,8 @@
 from headers import *
 import common
 import utils
+import returns
+import checkpoint
 
 import sys, os, platform, time
 
@@ -109,6 +111,7 @@ def _log_it(logger, msg):
 
 
 def load_policy(policy, filename):
+    checkpoint.wait(filename)
     if os.path.exists(filename):
         policy.load_state_dict(torch.load(filename, map_location=lambda storage, loc: storage))
     else:
@@ -122,7 +125,7 @@ def save_policy(policy, save_dir, name="RNNPlanner", version=""):
         save_dir += '/'
     try:
         filename = save_dir + name + version + '.pkl'
-        torch.save(policy.state_dict(), filename)
+        checkpoint.save(policy.state_dict(), filename)
     except Exception as e:
         print('[RNNController.save] fail to save model <{}>! Err = {}... Saving Skipped ...'.format(filename, e), file=sys.stderr)
 
@@ -254,15 +257,9 @@ class RNNPlanner(BasePlanner):
         P = P[:, :seq_len, :]  # remove last one
         # compute accumulative Reward
         V_data = V.data
-        cur_r = V_data[:, seq_len]
+        R = returns.discounted_returns(Rew, Done, self.gamma, bootstrap=V_data[:, seq_len])
         V = V[:, :seq_len]
         V_data = V_data[:, :seq_len]
-        R_list = []
-        for t in range(seq_len - 1, -1, -1):
-            cur_r = Rew[:, t] + self.gamma * Done[:, t] * cur_r
-            R_list.append(cur_r)
-        R_list.reverse()
-        R = torch.stack(R_list, dim=1)
         # Advantage Normalization
         Adv = (R - V_data) * Mask  # advantage
         avg_val = Adv.sum() / n_samples
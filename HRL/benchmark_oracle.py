@@ -0,0 +1,121 @@
+from headers import *
+import common
+import utils
+
+import sys, os, platform, json, argparse, time
+
+import numpy as np
+import random
+
+from HRL.semantic_oracle import SemanticOracle, OracleFunction
+
+"""
+Per-Step Latency Benchmark of the Semantic Oracle
+  --> the agent takes random discrete actions in a house and OracleFunction.get() is timed per step
+  --> modes: <list> (rebuild and upload the whole frame stack every step),
+             <cache> (device-resident FrameStackCache), <fused> (cache + fused classifiers)
+  --> rendering of the observation is NOT counted; rendering of the panoramic views is counted
+"""
+
+
+def run_benchmark(args, task, oracle, device_cache, n_steps, n_warmup):
+    oracle_func = OracleFunction(oracle, threshold=args['semantic_threshold'], device_cache=device_cache)
+    set_seed(args['seed'])
+    task.reset()
+    oracle_func.reset()
+    step_time = []
+    for t in range(n_warmup + n_steps):
+        if (t > 0) and (t % args['episode_len'] == 0):
+            task.reset()
+            oracle_func.reset()
+        task.step(np.random.randint(common.n_discrete_actions))
+        ts = time.time()
+        oracle_func.get(task)
+        if common.use_cuda: torch.cuda.synchronize()
+        if t >= n_warmup:
+            step_time.append(time.time() - ts)
+    return np.array(step_time)
+
+
+def set_seed(seed):
+    np.random.seed(seed)
+    random.seed(seed)
+    torch.manual_seed(seed)
+    if common.use_cuda:
+        torch.cuda.manual_seed(seed)
+
+
+def benchmark(args):
+    common.process_observation_shape('rnn', args['resolution'],
+                                     segmentation_input=args['segmentation_input'],
+                                     depth_input=args['depth_input'],
+                                     history_frame_len=1)
+    task = common.create_env(args['house'],
+                             depth_input=args['depth_input'],
+                             segment_input=args['segmentation_input'],
+                             genRoomTypeMap=False,
+                             cacheAllTarget=True,
+                             render_device=args['render_gpu'],
+                             use_discrete_action=True,
+                             include_object_target=args['object_target'])
+
+    if args['semantic_gpu'] is None:
+        args['semantic_gpu'] = common.get_gpus_for_rendering()[0]
+    all_modes = args['modes'].split(',')
+    oracles = dict()
+    if ('list' in all_modes) or ('cache' in all_modes):
+        oracles['serial'] = SemanticOracle(model_dir=args['semantic_dir'], model_device=args['semantic_gpu'],
+                                           include_object=args['object_target'])
+    if 'fused' in all_modes:
+        oracles['fused'] = SemanticOracle(model_dir=args['semantic_dir'], model_device=args['semantic_gpu'],
+                                          include_object=args['object_target'], fused=True)
+
+    print('>>> Semantic Oracle Benchmark: house = {}, steps = {} (warmup = {})'.format(args['house'], args['steps'], args['warmup']))
+    results = dict()
+    for mode in all_modes:
+        assert mode in ['list', 'cache', 'fused'], 'Invalid mode <{}>'.format(mode)
+        oracle = oracles['fused'] if mode == 'fused' else oracles['serial']
+        step_time = run_benchmark(args, task, oracle, device_cache=(mode != 'list'),
+                                  n_steps=args['steps'], n_warmup=args['warmup'])
+        results[mode] = step_time
+        print('  --> Mode <%s>: Mean = %.3f ms, Median = %.3f ms, P90 = %.3f ms per step'
+              % (mode, np.mean(step_time) * 1000, np.median(step_time) * 1000, np.percentile(step_time, 90) * 1000))
+    if ('list' in results) and (len(results) > 1):
+        base = np.mean(results['list'])
+        for mode in results:
+            if mode == 'list': continue
+            print('  --> Speedup of <%s> over <list> = %.2fx' % (mode, base / np.mean(results[mode])))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Latency Benchmark for the Semantic Oracle")
+    parser.add_argument("--env-set", choices=['small', 'train', 'test', 'color'], default='small')
+    parser.add_argument("--house", type=int, default=0, help="house ID")
+    parser.add_argument("--render-gpu", type=int, help="gpu id for rendering the environment")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--segmentation-input", choices=['none', 'index', 'color', 'joint'], default='none')
+    parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'], default='normal')
+    parser.add_argument("--depth-input", dest='depth_input', action='store_true')
+    parser.set_defaults(depth_input=False)
+    parser.add_argument("--include-object-target", dest='object_target', action='store_true')
+    parser.set_defaults(object_target=False)
+    # Semantic Classifiers
+    parser.add_argument('--semantic-dir', type=str, required=True,
+                        help='[SEMANTIC] root folder containing all semantic classifiers; or the path to the dictionary file')
+    parser.add_argument('--semantic-threshold', type=float, default=0.85, help='[SEMANTIC] threshold for semantic labels')
+    parser.add_argument("--semantic-gpu", type=int, help="[SEMANTIC] gpu id for running semantic classifier")
+    # Benchmark
+    parser.add_argument("--modes", type=str, default='list,cache,fused',
+                        help="comma separated list of modes in <list>, <cache>, <fused>")
+    parser.add_argument("--steps", type=int, default=500, help="number of timed steps per mode")
+    parser.add_argument("--warmup", type=int, default=20, help="number of untimed warmup steps per mode")
+    parser.add_argument("--episode-len", type=int, default=100, help="reset the house every <episode-len> steps")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    common.set_house_IDs(cmd_args.env_set, ensure_kitchen=False)
+    print('>> Environment Set = <%s>, Total %d Houses!' % (cmd_args.env_set, len(common.all_houseIDs)))
+    benchmark(cmd_args.__dict__)
@@ -0,0 +1,90 @@
+from headers import *
+import common
+import utils
+
+import sys, os, argparse, time
+
+import numpy as np
+
+from HRL.plan_table import OptimalPlanTable
+
+"""
+Offline Builder of the Optimal-Plan Tables
+  --> for every house, resets the task to each walkable grid cell and each target (see OptimalPlanTable.build),
+      so eval_HRL.py and eval_motion.py with the same --plan-table-dir never pay the plan search
+  --> houses can be split over several processes with --house-range, the tables of a house are merged under a file lock
+NOTE:
+  --> the task must support get_optimal_plan()
+"""
+
+
+def build_table(args):
+    common.process_observation_shape('rnn', args['resolution'],
+                                     segmentation_input='none',
+                                     depth_input=False,
+                                     history_frame_len=1)
+    logger = utils.MyLogger(args['table_dir'], True, filename='table_log.txt')
+    plan_table = OptimalPlanTable(args['table_dir'], logger=logger)
+    if args['house'] >= 0:
+        house_range = [args['house']]
+    else:
+        house_range = list(range(min(-args['house'], len(common.all_houseIDs))))
+    if args['house_range'] is not None:
+        lo, hi = [int(v) for v in args['house_range'].split(',')]
+        house_range = [i for i in house_range if lo <= i < hi]
+    ts = time.time()
+    for i in house_range:
+        task = common.create_env(i, render_device=args['render_gpu'],
+                                 reward_type='none',
+                                 cacheAllTarget=True,
+                                 use_discrete_action=True,
+                                 include_object_target=args['object_target'],
+                                 include_outdoor_target=args['outdoor_target'],
+                                 segment_input='none', depth_input=False,
+                                 synthetic_env=args['synthetic_env'])
+        house_id = task.house._id
+        targets = list(task.house.all_desired_roomTypes)
+        if not args['outdoor_target']:
+            targets = [t for t in targets if t != 'outdoor']
+        if args['object_target']:
+            targets += task.house.all_desired_targetObj
+        dt = time.time()
+        n_new = plan_table.build(task, targets)
+        plan_table.save()
+        logger.print('>> House#{} <{}>: {} targets, {} new entries, time = {:.3f}s'.format(
+            i, house_id, len(targets), n_new, time.time() - dt))
+        del task
+    logger.print(plan_table.stats_string())
+    logger.print('>> Done! Total Time Elapsed = %.4fs' % (time.time() - ts))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Build the Optimal-Plan Tables Offline")
+    parser.add_argument("--env-set", choices=['small', 'train', 'test', 'color'], default='small')
+    parser.add_argument("--house", type=int, default=-20, help="house ID; when negative, the first |house| houses")
+    parser.add_argument("--house-range", type=str,
+                        help="comma separated [lo, hi) of the house IDs built by this process, e.g., 0,10")
+    parser.add_argument("--render-gpu", type=int, help="gpu id for rendering the environment")
+    parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'], default='tiny',
+                        help="resolution of visual input, irrelevant to the tables, default tiny")
+    parser.add_argument("--include-object-target", dest='object_target', action='store_true',
+                        help="when set, also build the plans towards the object targets")
+    parser.set_defaults(object_target=False)
+    parser.add_argument("--no-outdoor-target", dest='outdoor_target', action='store_false',
+                        help="when set, skip the plans towards the outdoor target")
+    parser.set_defaults(outdoor_target=True)
+    parser.add_argument("--synthetic-env", dest='synthetic_env', action='store_true',
+                        help="when set, build the tables of the synthetic stand-in environment (see synthetic_env.py)")
+    parser.set_defaults(synthetic_env=False)
+    parser.add_argument("--table-dir", type=str, default='./_plan_table_', help="output directory of the tables")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    common.set_house_IDs(cmd_args.env_set, ensure_kitchen=False)
+    print('>> Environment Set = <%s>, Total %d Houses!' % (cmd_args.env_set, len(common.all_houseIDs)))
+    common.ensure_object_targets(cmd_args.object_target)
+    if not os.path.exists(cmd_args.table_dir):
+        os.makedirs(cmd_args.table_dir)
+    build_table(cmd_args.__dict__)
@@ -1,16 +1,20 @@
 from headers import *
 import common
 import utils
+import profiler
 
 import sys, os, platform, pickle, json, argparse, time
 
 import numpy as np
 import random
 
+from birthplace_index import BirthplaceIndex, reset_with_plan_quota
+from HRL.plan_table import OptimalPlanTable
 from HRL.eval_motion import create_motion
 from HRL.BayesGraph import GraphPlanner, OraclePlanner, VoidPlanner
 from HRL.RNNController import RNNPlanner
 from HRL.semantic_oracle import SemanticOracle, OracleFunction
+from HRL.parallel_eval import evaluate_sharded
 
 
 def set_seed(seed):
@@ -23,7 +27,11 @@ def proc_info(info):
                 dist=info['dist'])
 
 
-def evaluate(args, data_saver=None):
+def evaluate(args, data_saver=None, iter_range=None, timing=None):
+    """
+    iter_range: (it_lo, it_hi), only run episodes in this range; default all the <max_iters> episodes
+    timing: when a dict is given, accumulated mask/plan/motion time (in seconds) will be stored
+    """
 
     args['segment_input'] = args['segmentation_input']
 
@@ -66,7 +74,11 @@ def evaluate(args, data_saver=None):
                             include_object_target=args['object_target'] and (fixed_target != 'any-room'),
                             include_outdoor_target=args['outdoor_target'],
                             discrete_angle=True,
-                            min_birthplace_grids=args['min_birthplace_grids'])
+                            min_birthplace_grids=args['min_birthplace_grids'],
+                            render_cache_size=args['render_cache_size'],
+                            max_resident_houses=args['max_resident_houses'],
+                            prefetch_house=args['house_prefetch'],
+                            synthetic_env=args['synthetic_env'])
 
     if (fixed_target is not None) and (fixed_target != 'any-room') and (fixed_target != 'any-object'):
         task.reset_target(fixed_target)
@@ -87,9 +99,11 @@ def evaluate(args, data_saver=None):
         print('Loading Semantic Oracle from dir <{}>...'.format(args['semantic_dir']))
         if args['semantic_gpu'] is None:
             args['semantic_gpu'] = common.get_gpus_for_rendering()[0]
-        oracle = SemanticOracle(model_dir=args['semantic_dir'], model_device=args['semantic_gpu'], include_object=args['object_target'])
+        oracle = SemanticOracle(model_dir=args['semantic_dir'], model_device=args['semantic_gpu'], include_object=args['object_target'],
+                                fused=args['semantic_fused'])
         oracle_func = OracleFunction(oracle, threshold=args['semantic_threshold'],
-                                    filter_steps=args['semantic_filter_steps'], batched_size=args['semantic_batch_size'])
+                                    filter_steps=args['semantic_filter_steps'], batched_size=args['semantic_batch_size'],
+                                    device_cache=args['semantic_device_cache'])
     else:
         oracle_func = None
 
@@ -99,13 +113,18 @@ def evaluate(args, data_saver=None):
         motion.set_skilled_rate(args['random_motion_skill'])
     flag_interrupt = args['interruptive_motion']
 
+    # optimal plan table, for the oracle planner and --plan-dist-iters
+    plan_table = None
+    if ('plan_table_dir' in args) and (args['plan_table_dir'] is not None):
+        plan_table = OptimalPlanTable(args['plan_table_dir'], logger=logger)
+
     # create planner
     graph = None
     max_motion_steps = args['n_exp_steps']
     if (args['planner'] == None) or (args['planner'] == 'void'):
         graph = VoidPlanner(motion)
     elif args['planner'] == 'oracle':
-        graph = OraclePlanner(motion)
+        graph = OraclePlanner(motion, plan_table=plan_table)
     elif args['planner'] == 'rnn':
         #assert False, 'Currently only support Graph-planner'
         graph = RNNPlanner(motion, args['planner_units'], args['planner_filename'], oracle_func=oracle_func)
@@ -132,25 +151,35 @@ def evaluate(args, data_saver=None):
     max_episode_len = args['max_episode_len']
 
     plan_req = args['plan_dist_iters'] if 'plan_dist_iters' in args else None
+    birthplace_index = None
+    if (plan_req is not None) and ('birthplace_index_dir' in args) and (args['birthplace_index_dir'] is not None):
+        birthplace_index = BirthplaceIndex(args['birthplace_index_dir'], n_samples=args['birthplace_index_samples'], logger=logger)
 
     ####################
-    accu_plan_time = 0
-    accu_exe_time = 0
-    accu_mask_time = 0
+    # mask/plan/motion times are always reported, so the profiler is always on in evaluation
+    if not profiler.is_enabled():
+        profiler.enable()
+    base_time = dict([(k, profiler.total(k)) for k in ['mask', 'plan', 'motion']])
+    accu_time = lambda k: profiler.total(k) - base_time[k]
     ####################
 
-    for it in range(args['max_iters']):
+    it_lo, it_hi = iter_range if iter_range is not None else (0, args['max_iters'])
+    for it in range(it_lo, it_hi):
 
-        if (it > 0) and (backup_rate > 0) and (it % backup_rate == 0) and (data_saver is not None):
+        if (it > it_lo) and (backup_rate > 0) and (it % backup_rate == 0) and (data_saver is not None):
             data_saver.save(episode_stats, ep_id=it)
+            if plan_table is not None:
+                plan_table.save()
 
         cur_infos = []
         motion.reset()
         set_seed(seed + it + 1)  # reset seed
-        if plan_req is not None:
+        if (plan_req is not None) and (birthplace_index is not None):
+            reset_with_plan_quota(task, birthplace_index, plan_req, fixed_target)
+        elif plan_req is not None:
             while True:
                 task.reset(target=fixed_target)
-                m = len(task.get_optimal_plan())
+                m = len(plan_table.get_plan(task) if plan_table is not None else task.get_optimal_plan())
                 if (m in plan_req) and plan_req[m] > 0:
                     break
             plan_req[m] -= 1
@@ -183,21 +212,18 @@ def evaluate(args, data_saver=None):
                 graph_target = task.get_current_target()
             else:
                 # TODO #####################
-                tt = time.time()
-                mask_feat = oracle_func.get(task) if oracle_func is not None else task.get_feature_mask()
-                accu_mask_time += time.time() - tt
-                tt = time.time()
-                graph_target = graph.plan(mask_feat, task_target)
-                accu_plan_time += time.time() - tt
+                with profiler.span('mask'):
+                    mask_feat = oracle_func.get(task) if oracle_func is not None else task.get_feature_mask()
+                with profiler.span('plan'):
+                    graph_target = graph.plan(mask_feat, task_target)
                 ################################
             graph_target_id = common.target_instruction_dict[graph_target]
             allowed_steps = min(max_episode_len - episode_step, max_motion_steps)
 
             ###############
             # TODO
-            tt = time.time()
-            motion_data = motion.run(graph_target, allowed_steps)
-            accu_exe_time += time.time() -tt
+            with profiler.span('motion'):
+                motion_data = motion.run(graph_target, allowed_steps)
 
             cur_stats['plan'].append((graph_target, len(motion_data), (motion_data[-1][0][graph_target_id] > 0)))
 
@@ -215,9 +241,8 @@ def evaluate(args, data_saver=None):
 
             # update graph
             ## TODO ############
-            tt = time.time()
-            graph.observe(motion_data, graph_target)
-            accu_plan_time += time.time() - tt
+            with profiler.span('plan'):
+                graph.observe(motion_data, graph_target)
 
             episode_step += len(motion_data)
 
@@ -233,13 +258,14 @@ def evaluate(args, data_saver=None):
         if store_history:
             cur_stats['infos'] = cur_infos
         episode_stats.append(cur_stats)
+        logger.log('episode', step=it, **utils.scalar_items(cur_stats))
 
         dur = time.time() - elap
         logger.print('Episode#%d, Elapsed = %.3f min' % (it+1, dur/60))
         #TODO #################
-        logger.print(' >>> Mask Time = %.4f min' % (accu_mask_time / 60))
-        logger.print(' >>> Plan Time = %.4f min' % (accu_plan_time / 60))
-        logger.print(' >>> Motion Time = %.4f min' % (accu_exe_time / 60))
+        logger.print(' >>> Mask Time = %.4f min' % (accu_time('mask') / 60))
+        logger.print(' >>> Plan Time = %.4f min' % (accu_time('plan') / 60))
+        logger.print(' >>> Motion Time = %.4f min' % (accu_time('motion') / 60))
         if args['multi_target']:
             logger.print('  ---> Target Room = {}'.format(cur_stats['target']))
         logger.print('  ---> Total Samples = {}'.format(t))
@@ -251,6 +277,30 @@ def evaluate(args, data_saver=None):
         logger.print('  ---> Birth-place Meters = %.4f (optstep = %d)' % (cur_stats['meters'], cur_stats['optstep']))
         logger.print('  ---> Planner Results = {}'.format(cur_stats['plan']))
 
+    print_final_stats(logger, episode_stats, args['multi_target'])
+    if task._render_cache is not None:
+        logger.print(task._render_cache.stats_string())
+    if getattr(task, '_house_provider', None) is not None:
+        logger.print(task._house_provider.stats_string())
+    if plan_table is not None:
+        plan_table.save()
+        logger.print(plan_table.stats_string())
+
+    profiler.report(logger)
+    if ('profile_trace' in args) and (args['profile_trace'] is not None):
+        profiler.export_chrome_trace(args['profile_trace'])
+
+    if timing is not None:
+        timing['mask'] = accu_time('mask')
+        timing['plan'] = accu_time('plan')
+        timing['motion'] = accu_time('motion')
+
+    return episode_stats
+
+
+def print_final_stats(logger, episode_stats, multi_target):
+    episode_success = [float(s['success'] > 0) for s in episode_stats]
+    episode_good = [float(s['good'] > 0) for s in episode_stats]
     logger.print('######## Final Stats ###########')
     logger.print('Success Rate = %.3f' % np.mean(episode_success))
     logger.print('> Avg Ep-Length per Success = %.3f' % np.mean([s['length'] for s in episode_stats if s['success'] > 0]))
@@ -258,7 +308,7 @@ def evaluate(args, data_saver=None):
     logger.print('Reaching Target Rate = %.3f' % np.mean(episode_good))
     logger.print('> Avg Ep-Length per Target Reach = %.3f' % np.mean([s['length'] for s in episode_stats if s['good'] > 0]))
     logger.print('> Avg Birth-Meters per Target Reach = %.3f' % np.mean([s['meters'] for s in episode_stats if s['good'] > 0]))
-    if args['multi_target']:
+    if multi_target:
         all_targets = list(set([s['target'] for s in episode_stats]))
         for tar in all_targets:
             n = sum([1.0 for s in episode_stats if s['target'] == tar])
@@ -273,8 +323,6 @@ def evaluate(args, data_saver=None):
             logger.print('>>>>> Multi-Target <%s>: Rate = %.3f (n=%d), Good = %.3f (AvgLen=%.3f; Mts=%.3f), Succ = %.3f (AvgLen=%.3f; Mts=%.3f)'
                 % (tar, n / len(episode_stats), n, np.mean(good), good_len, good_mts, np.mean(succ), succ_len, succ_mts))
 
-    return episode_stats
-
 
 def parse_args():
     parser = argparse.ArgumentParser("Evaluation Locomotion for 3D House Navigation")
@@ -285,6 +333,16 @@ def parse_args():
     parser.add_argument("--env-set", choices=['small', 'train', 'test', 'color'], default='small')
     parser.add_argument("--house", type=int, default=0, help="house ID")
     parser.add_argument("--render-gpu", type=int, help="gpu id for rendering the environment")
+    parser.add_argument("--render-cache-size", type=int, default=0,
+                        help="when positive, cache this many rendered frames in a LRU cache (see render_cache.py)")
+    parser.add_argument("--max-resident-houses", type=int, default=0,
+                        help="when positive, houses are loaded on first use and at most this many houses stay in memory (see house_provider.py)")
+    parser.add_argument("--no-house-prefetch", dest='house_prefetch', action='store_false',
+                        help="when set, do not load the house of the next episode in the background (only with --max-resident-houses)")
+    parser.set_defaults(house_prefetch=True)
+    parser.add_argument("--synthetic-env", dest='synthetic_env', action='store_true',
+                        help="when set, evaluate in the synthetic stand-in environment (see synthetic_env.py)")
+    parser.set_defaults(synthetic_env=False)
     parser.add_argument("--seed", type=int, default=0, help="random seed")
     parser.add_argument("--hardness", type=float, help="real number from 0 to 1, indicating the hardness of the environment")
     parser.add_argument("--max-birthplace-steps", type=int, help="int, the maximum steps required from birthplace to target")
@@ -342,6 +400,12 @@ def parse_args():
     ######################
     parser.add_argument("--plan-dist-iters", type=str,
                         help="Required iterations for each plan-distance birthplaces. In the format of Dist1:Number1,Dist2:Number2,...")
+    parser.add_argument("--birthplace-index-dir", type=str,
+                        help="when set with --plan-dist-iters, birthplaces are drawn from the per-house birthplace index in this folder (see birthplace_index.py)")
+    parser.add_argument("--plan-table-dir", type=str,
+                        help="when set, optimal plans are memoized in per-house tables in this folder (see HRL/plan_table.py)")
+    parser.add_argument("--birthplace-index-samples", type=int, default=2000,
+                        help="number of task resets sampled to index a house, only with --birthplace-index-dir")
     # RNN Parameters
     parser.add_argument("--rnn-units", type=int,
                         help="[RNN-Only] number of units in an RNN cell")
@@ -362,15 +426,28 @@ def parse_args():
     parser.add_argument('--semantic-filter-steps', type=int, help="[SEMANTIC] filter steps (default, None)")
     parser.add_argument("--semantic-gpu", type=int, help="[SEMANTIC] gpu id for running semantic classifier")
     parser.add_argument("--semantic-batch-size", type=int, help="[SEMANTIC] group --batch-size of frames for fast semantic computation")
+    parser.add_argument("--semantic-fused", dest='semantic_fused', action='store_true',
+                        help="[SEMANTIC] when set, fuse classifiers sharing the same architecture and compute all targets in a single forward pass")
+    parser.set_defaults(semantic_fused=False)
+    parser.add_argument("--semantic-device-cache", dest='semantic_device_cache', action='store_true',
+                        help="[SEMANTIC] when set, keep recent frames in a device-side ring buffer and upload only the newest frame per step")
+    parser.set_defaults(semantic_device_cache=False)
     parser.add_argument("--force-semantic-done", dest="force_oracle_done", action='store_true',
                         help="When flag set, agent will terminate its episode based on the semantic classifier.")
     parser.set_defaults(force_oracle_done=False)
     ##########################################
     # Checkpointing
     parser.add_argument("--backup-rate", type=int, default=0, help="when set > 0, store all the evaluation results every --backup-rate steps.")
+    # Parallel Evaluation
+    parser.add_argument("--n-eval-proc", type=int, default=1,
+                        help="when set > 1, split the episodes into --n-eval-proc shards evaluated by a process pool. --backup-rate is ignored.")
     parser.add_argument("--log-dir", type=str, default="./log/eval", help="directory in which logs eval stats")
     parser.add_argument("--warmstart", type=str, help="file to load the policy model")
     parser.add_argument("--warmstart-dict", type=str, help="arg dict the policy model, only effective when --motion rnn")
+    # Profiling
+    parser.add_argument("--profile-trace", type=str,
+                        help="write every timed span (mask, plan, motion, render ...) to this file in the Chrome trace format. "
+                             "With --n-eval-proc > 1, every shard writes its own file with the suffix <.shard_id>")
     return parser.parse_args()
 
 
@@ -430,6 +507,8 @@ if __name__ == '__main__':
             raise e
 
     dict_args = args.__dict__
+    if args.profile_trace is not None:
+        profiler.enable(trace=True)
 
 
     class DataSaver:
@@ -454,7 +533,12 @@ if __name__ == '__main__':
                 print('  >> Done!')
 
 
-    episode_stats = evaluate(dict_args, DataSaver(args))
+    if args.n_eval_proc > 1:
+        merged_logger = utils.MyLogger(args.log_dir, True, filename='merged_progress.txt')
+        episode_stats, _ = evaluate_sharded(evaluate, dict_args, args.n_eval_proc, logger=merged_logger)
+        print_final_stats(merged_logger, episode_stats, args.multi_target)
+    else:
+        episode_stats = evaluate(dict_args, DataSaver(args))
 
     if args.store_history:
         filename = args.log_dir
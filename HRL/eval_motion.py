@@ -7,12 +7,15 @@ import sys, os, platform, pickle, json, argparse, time
 import numpy as np
 import random
 
+from birthplace_index import BirthplaceIndex, reset_with_plan_quota
+from HRL.plan_table import OptimalPlanTable
 from HRL.fake_motion import FakeMotion
 from HRL.rnn_motion import RNNMotion
 from HRL.random_motion import RandomMotion
 from HRL.mixture_motion import MixMotion, create_mixture_motion_trainer_dict
 
 from HRL.semantic_oracle import SemanticOracle, OracleFunction
+from HRL.parallel_eval import evaluate_sharded
 
 
 def create_motion(args, task, oracle_func=None):
@@ -72,7 +75,11 @@ def proc_info(info):
                 dist=info['dist'])
 
 
-def evaluate(args):
+def evaluate(args, iter_range=None, timing=None):
+    """
+    iter_range: (it_lo, it_hi), only run episodes in this range; default all the <max_iters> episodes
+    timing: when a dict is given, accumulated motion time (in seconds) will be stored
+    """
 
     elap = time.time()
 
@@ -112,7 +119,12 @@ def evaluate(args):
                             include_object_target=args['object_target'] and (fixed_target != 'any-room'),
                             include_outdoor_target=args['outdoor_target'],
                             discrete_angle=True,
-                            min_birthplace_grids=args['min_birthplace_grids'])
+                            min_birthplace_grids=args['min_birthplace_grids'],
+                            render_cache_size=args['render_cache_size'],
+                            max_resident_houses=args['max_resident_houses'],
+                            prefetch_house=args['house_prefetch'],
+                            reward_type=('none' if args['atlas_dir'] is not None else 'new'),
+                            atlas_dir=args['atlas_dir'])
 
     if (fixed_target is not None) and (fixed_target != 'any-room') and (fixed_target != 'any-object'):
         task.reset_target(fixed_target)
@@ -128,8 +140,10 @@ def evaluate(args):
         print('Loading Semantic Oracle from dir <{}>...'.format(args['semantic_dir']))
         if args['semantic_gpu'] is None:
             args['semantic_gpu'] = common.get_gpus_for_rendering()[0]
-        oracle = SemanticOracle(model_dir=args['semantic_dir'], model_device=args['semantic_gpu'], include_object=args['object_target'])
-        oracle_func = OracleFunction(oracle, threshold=args['semantic_threshold'], filter_steps=args['semantic_filter_steps'])
+        oracle = SemanticOracle(model_dir=args['semantic_dir'], model_device=args['semantic_gpu'], include_object=args['object_target'],
+                                fused=args['semantic_fused'])
+        oracle_func = OracleFunction(oracle, threshold=args['semantic_threshold'], filter_steps=args['semantic_filter_steps'],
+                                     device_cache=args['semantic_device_cache'])
     else:
         oracle_func = None
 
@@ -147,15 +161,26 @@ def evaluate(args):
     max_episode_len = args['max_episode_len']
 
     plan_req = args['plan_dist_iters'] if 'plan_dist_iters' in args else None
+    plan_table = None
+    if ('plan_table_dir' in args) and (args['plan_table_dir'] is not None):
+        plan_table = OptimalPlanTable(args['plan_table_dir'], logger=logger)
+    birthplace_index = None
+    if (plan_req is not None) and ('birthplace_index_dir' in args) and (args['birthplace_index_dir'] is not None):
+        birthplace_index = BirthplaceIndex(args['birthplace_index_dir'], n_samples=args['birthplace_index_samples'], logger=logger)
 
-    for it in range(args['max_iters']):
+    accu_exe_time = 0
+
+    it_lo, it_hi = iter_range if iter_range is not None else (0, args['max_iters'])
+    for it in range(it_lo, it_hi):
         cur_infos = []
         motion.reset()
         set_seed(seed + it + 1)  # reset seed
-        if plan_req is not None:
+        if (plan_req is not None) and (birthplace_index is not None):
+            reset_with_plan_quota(task, birthplace_index, plan_req, fixed_target)
+        elif plan_req is not None:
             while True:
                 task.reset(target=fixed_target)
-                m = len(task.get_optimal_plan())
+                m = len(plan_table.get_plan(task) if plan_table is not None else task.get_optimal_plan())
                 if (m in plan_req) and plan_req[m] > 0:
                     break
             plan_req[m] -= 1
@@ -175,11 +200,13 @@ def evaluate(args):
         if store_history:
             cur_infos.append(proc_info(task.info))
 
+        tt = time.time()
         if args['temperature'] is not None:
             ep_data = motion.run(task.get_current_target(), max_episode_len,
                                  temperature=args['temperature'])
         else:
             ep_data = motion.run(task.get_current_target(), max_episode_len)
+        accu_exe_time += time.time() - tt
 
         for dat in ep_data:
             info = dat[4]
@@ -202,6 +229,7 @@ def evaluate(args):
         if store_history:
             cur_stats['infos'] = cur_infos
         episode_stats.append(cur_stats)
+        logger.log('episode', step=it, **utils.scalar_items(cur_stats))
 
         dur = time.time() - elap
         logger.print('Episode#%d, Elapsed = %.3f min' % (it+1, dur/60))
@@ -215,6 +243,24 @@ def evaluate(args):
         logger.print('  ---> Best Distance = %d' % cur_stats['best_dist'])
         logger.print('  ---> Birth-place Distance = %d' % cur_stats['optstep'])
 
+    print_final_stats(logger, episode_stats, args['multi_target'])
+    if task._render_cache is not None:
+        logger.print(task._render_cache.stats_string())
+    if getattr(task, '_house_provider', None) is not None:
+        logger.print(task._house_provider.stats_string())
+    if plan_table is not None:
+        plan_table.save()
+        logger.print(plan_table.stats_string())
+
+    if timing is not None:
+        timing['motion'] = accu_exe_time
+
+    return episode_stats
+
+
+def print_final_stats(logger, episode_stats, multi_target):
+    episode_success = [float(s['success'] > 0) for s in episode_stats]
+    episode_good = [float(s['good'] > 0) for s in episode_stats]
     logger.print('######## Final Stats ###########')
     logger.print('Success Rate = %.3f' % np.mean(episode_success))
     logger.print('> Avg Ep-Length per Success = %.3f' % np.mean([s['length'] for s in episode_stats if s['success'] > 0]))
@@ -222,7 +268,7 @@ def evaluate(args):
     logger.print('Reaching Target Rate = %.3f' % np.mean(episode_good))
     logger.print('> Avg Ep-Length per Target Reach = %.3f' % np.mean([s['length'] for s in episode_stats if s['good'] > 0]))
     logger.print('> Avg Birth-Meters per Target Reach = %.3f' % np.mean([s['meters'] for s in episode_stats if s['good'] > 0]))
-    if args['multi_target']:
+    if multi_target:
         all_targets = list(set([s['target'] for s in episode_stats]))
         for tar in all_targets:
             n = sum([1.0 for s in episode_stats if s['target'] == tar])
@@ -238,8 +284,6 @@ def evaluate(args):
                 '>>>>> Multi-Target <%s>: Rate = %.3f (n=%d), Good = %.3f (AvgLen=%.3f; Mts=%.3f), Succ = %.3f (AvgLen=%.3f; Mts=%.3f)'
                 % (tar, n/len(episode_stats), n, np.mean(good), good_len, good_mts, np.mean(succ), succ_len, succ_mts))
 
-    return episode_stats
-
 
 def parse_args():
     parser = argparse.ArgumentParser("Evaluation Locomotion for 3D House Navigation")
@@ -250,6 +294,15 @@ def parse_args():
     parser.add_argument("--env-set", choices=['small', 'train', 'test', 'color'], default='small')
     parser.add_argument("--house", type=int, default=0, help="house ID")
     parser.add_argument("--render-gpu", type=int, help="gpu id for rendering the environment")
+    parser.add_argument("--render-cache-size", type=int, default=0,
+                        help="when positive, cache this many rendered frames in a LRU cache (see render_cache.py)")
+    parser.add_argument("--max-resident-houses", type=int, default=0,
+                        help="when positive, houses are loaded on first use and at most this many houses stay in memory (see house_provider.py)")
+    parser.add_argument("--no-house-prefetch", dest='house_prefetch', action='store_false',
+                        help="when set, do not load the house of the next episode in the background (only with --max-resident-houses)")
+    parser.set_defaults(house_prefetch=True)
+    parser.add_argument("--atlas-dir", type=str,
+                        help="when set, serve pre-rendered frames from this atlas folder (see build_atlas.py) without any renderer")
     parser.add_argument("--seed", type=int, default=0, help="random seed")
     parser.add_argument("--hardness", type=float, help="real number from 0 to 1, indicating the hardness of the environment")
     parser.add_argument("--max-birthplace-steps", type=int, help="int, the maximum steps required from birthplace to target")
@@ -303,6 +356,12 @@ def parse_args():
     ######################
     parser.add_argument("--plan-dist-iters", type=str,
                         help="Required iterations for each plan-distance birthplaces. In the format of Dist1:Number1,Dist2:Number2,...")
+    parser.add_argument("--birthplace-index-dir", type=str,
+                        help="when set with --plan-dist-iters, birthplaces are drawn from the per-house birthplace index in this folder (see birthplace_index.py)")
+    parser.add_argument("--plan-table-dir", type=str,
+                        help="when set, optimal plans are memoized in per-house tables in this folder (see HRL/plan_table.py)")
+    parser.add_argument("--birthplace-index-samples", type=int, default=2000,
+                        help="number of task resets sampled to index a house, only with --birthplace-index-dir")
     # RNN Parameters
     parser.add_argument("--rnn-units", type=int,
                         help="[RNN-Only] number of units in an RNN cell")
@@ -316,6 +375,12 @@ def parse_args():
     parser.add_argument('--semantic-threshold', type=float, default=0.85, help='[SEMANTIC] threshold for semantic labels. None: probability')
     parser.add_argument('--semantic-filter-steps', type=int, help="[SEMANTIC] filter steps (default, None)")
     parser.add_argument("--semantic-gpu", type=int, help="[SEMANTIC] gpu id for running semantic classifier")
+    parser.add_argument("--semantic-fused", dest='semantic_fused', action='store_true',
+                        help="[SEMANTIC] when set, fuse classifiers sharing the same architecture and compute all targets in a single forward pass")
+    parser.set_defaults(semantic_fused=False)
+    parser.add_argument("--semantic-device-cache", dest='semantic_device_cache', action='store_true',
+                        help="[SEMANTIC] when set, keep recent frames in a device-side ring buffer and upload only the newest frame per step")
+    parser.set_defaults(semantic_device_cache=False)
     parser.add_argument("--force-semantic-done", dest="force_oracle_done", action='store_true',
                         help="When flag set, agent will terminate its episode based on the semantic classifier.")
     parser.set_defaults(force_oracle_done=False)
@@ -324,6 +389,9 @@ def parse_args():
     parser.add_argument("--log-dir", type=str, default="./log/eval", help="directory in which logs eval stats")
     parser.add_argument("--warmstart", type=str, help="file to load the policy model")
     parser.add_argument("--warmstart-dict", type=str, help="arg dict the policy model, only effective when --motion rnn")
+    # Parallel Evaluation
+    parser.add_argument("--n-eval-proc", type=int, default=1,
+                        help="when set > 1, split the episodes into --n-eval-proc shards evaluated by a process pool")
     # Other
     parser.add_argument("--temperature", type=float, help="temperature for executing motion; only effective when --motion rnn/mixture")
     return parser.parse_args()
@@ -383,7 +451,12 @@ if __name__ == '__main__':
 
     dict_args = args.__dict__
 
-    episode_stats = evaluate(dict_args)
+    if args.n_eval_proc > 1:
+        merged_logger = utils.MyLogger(args.log_dir, True, filename='merged_progress.txt')
+        episode_stats, _ = evaluate_sharded(evaluate, dict_args, args.n_eval_proc, logger=merged_logger)
+        print_final_stats(merged_logger, episode_stats, args.multi_target)
+    else:
+        episode_stats = evaluate(dict_args)
 
     if args.store_history:
         filename = args.log_dir
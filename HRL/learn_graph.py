@@ -2,10 +2,11 @@ from headers import *
 import common
 import utils
 
-import sys, os, platform, pickle, json, argparse, time
+import sys, os, platform, pickle, json, argparse, time, copy
 
 import numpy as np
 import random
+import multiprocessing as mp
 
 from HRL.eval_motion import create_motion
 from HRL.BayesGraph import GraphPlanner
@@ -16,17 +17,8 @@ def set_seed(seed):
     np.random.seed(seed)
 
 
-def learn_graph(args):
-
-    elap = time.time()
-
-    # Do not need to log detailed computation stats
-    common.debugger = utils.FakeLogger()
-
-    common.ensure_object_targets(True)
-
-    set_seed(args['seed'])
-    task = common.create_env(args['house'], task_name=args['task_name'], false_rate=args['false_rate'],
+def create_task_and_motion(args, house):
+    task = common.create_env(house, task_name=args['task_name'], false_rate=args['false_rate'],
                              success_measure=args['success_measure'],
                              depth_input=args['depth_input'],
                              target_mask_input=args['target_mask_input'],
@@ -36,16 +28,85 @@ def learn_graph(args):
                              use_discrete_action=True,
                              include_object_target=True,
                              include_outdoor_target=True,
-                             discrete_angle=True)
+                             discrete_angle=True,
+                             max_resident_houses=args['max_resident_houses'])
 
     # create motion
     __graph_warmstart = args['warmstart']
     args['warmstart'] = args['motion_warmstart']
     motion = create_motion(args, task)
-
-    # create graph
     args['warmstart'] = __graph_warmstart
+    return task, motion
+
+
+def get_checkpoint_dir(args):
+    if args['checkpoint_dir'] is not None:
+        return args['checkpoint_dir']
+    return os.path.join(args['save_dir'], 'house_counts')
+
+
+def _learn_shard(args, shard_id, house_range):
+    """
+    worker of the parallel learning, return the count matrices of the houses in [house_range[0], house_range[1])
+    """
+    args = copy.deepcopy(args)
+    common.debugger = utils.FakeLogger()
+    common.ensure_object_targets(True)
+    if args['render_gpu'] is None:
+        all_gpus = common.get_gpus_for_rendering()
+        args['render_gpu'] = all_gpus[shard_id % len(all_gpus)]
+    task, motion = create_task_and_motion(args, house_range)
     graph = GraphPlanner(motion)
+    logger = utils.MyLogger(os.path.join(args['save_dir'], 'shard_{}'.format(shard_id)), True)
+    logger.print('> Shard#{}: Houses [{}, {})'.format(shard_id, house_range[0], house_range[1]))
+    return graph.learn_counts(n_trial=args['n_trials'], max_allowed_steps=args['max_exp_steps'], logger=logger,
+                              checkpoint_dir=get_checkpoint_dir(args), seed=args['seed'], house_offset=house_range[0])
+
+
+def learn_counts_parallel(args, n_proc, logger):
+    """
+    shard the first |args['house']| houses across <n_proc> workers and sum up the count matrices
+    """
+    n_house = min(-args['house'], len(common.all_houseIDs))
+    n_proc = min(n_proc, n_house)
+    shards = []
+    lo = 0
+    for i in range(n_proc):
+        hi = lo + n_house // n_proc + int(i < n_house % n_proc)
+        shards.append((lo, hi))
+        lo = hi
+    logger.print('> Parallel Learning: Total {} Houses over {} Workers, Shards = {}'.format(n_house, n_proc, shards))
+    ts = time.time()
+    # fork before any renderer is created in the master process
+    ctx = mp.get_context('fork')
+    with ctx.Pool(n_proc) as pool:
+        results = pool.starmap(_learn_shard, [(args, i, rg) for i, rg in enumerate(shards)])
+    counts = [np.sum([r[k] for r in results], axis=0).astype(np.int32) for k in range(4)]
+    logger.print('> Parallel Sampling Done! Time Elapsed = %.4fs' % (time.time() - ts))
+    return counts
+
+
+def learn_graph(args):
+
+    elap = time.time()
+
+    # Do not need to log detailed computation stats
+    common.debugger = utils.FakeLogger()
+
+    common.ensure_object_targets(True)
+
+    set_seed(args['seed'])
+
+    flag_parallel = (args['n_proc'] > 1) and (args['house'] < 0)
+    if (args['n_proc'] > 1) and not flag_parallel:
+        print('[Warning] --n-proc > 1 requires a multi-house environment (--house < 0)! Fall back to serial learning.')
+
+    if flag_parallel:  # houses are loaded in the workers
+        graph = GraphPlanner(None)
+    else:
+        task, motion = create_task_and_motion(args, args['house'])
+        # create graph
+        graph = GraphPlanner(motion)
 
     # logger
     logger = utils.MyLogger(args['save_dir'], True)
@@ -54,6 +115,7 @@ def learn_graph(args):
     logger.print("> Graph Eps = {}".format(args['graph_eps']))
     logger.print("> N_Trials = {}".format(args['n_trials']))
     logger.print("> Max Exploration Steps = {}".format(args['max_exp_steps']))
+    logger.print("> Checkpoint Dir = {}".format(get_checkpoint_dir(args)))
 
     # Graph Building
     logger.print('Start Graph Building ...')
@@ -67,7 +129,12 @@ def learn_graph(args):
 
     train_mode = args['training_mode']
     if train_mode in ['mle', 'joint']:
-        graph.learn(n_trial=args['n_trials'], max_allowed_steps=args['max_exp_steps'], eps=args['graph_eps'], logger=logger)
+        if flag_parallel:
+            counts = learn_counts_parallel(args, args['n_proc'], logger)
+            graph.set_counts(counts, eps=args['graph_eps'], logger=logger)
+        else:
+            graph.learn(n_trial=args['n_trials'], max_allowed_steps=args['max_exp_steps'], eps=args['graph_eps'], logger=logger,
+                        checkpoint_dir=get_checkpoint_dir(args), seed=args['seed'])
 
     if train_mode in ['evolution', 'joint']:
         graph.evolve()   # TODO: not implemented yet
@@ -75,6 +142,7 @@ def learn_graph(args):
     logger.print('######## Final Stats ###########')
     graph._show_prior_room(logger=logger)
     graph._show_prior_object(logger=logger)
+    logger.print('Total Time Elapsed = %.4fs' % (time.time() - elap))
     return graph
 
 
@@ -87,6 +155,8 @@ def parse_args():
     parser.add_argument("--env-set", choices=['small', 'train', 'test', 'color'], default='small')
     parser.add_argument("--house", type=int, default=0, help="house ID")
     parser.add_argument("--render-gpu", type=int, help="gpu id for rendering the environment")
+    parser.add_argument("--max-resident-houses", type=int, default=0,
+                        help="when positive, houses are loaded on first use and at most this many houses stay in memory (see house_provider.py)")
     parser.add_argument("--seed", type=int, default=0, help="random seed")
     parser.add_argument("--hardness", type=float, help="real number from 0 to 1, indicating the hardness of the environment")
     parser.add_argument("--max-birthplace-steps", type=int, help="int, the maximum steps required from birthplace to target")
@@ -132,6 +202,11 @@ def parse_args():
     # Checkpointing
     parser.add_argument("--save-dir", type=str, default="./_graph_", help="directory in which graph parameters and logs will be stored")
     parser.add_argument("--warmstart", type=str, help="file to load a pre-trained graph")
+    parser.add_argument("--checkpoint-dir", type=str,
+                        help="directory for the per-house counts, re-used when the learning is resumed. default <save-dir>/house_counts")
+    # Parallel
+    parser.add_argument("--n-proc", type=int, default=1,
+                        help="number of worker processes, each learning a contiguous shard of houses. Only effective when --house < 0")
     return parser.parse_args()
 
 
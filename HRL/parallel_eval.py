@@ -0,0 +1,105 @@
+import common
+import metrics
+
+import sys, os, time, copy
+
+import numpy as np
+import multiprocessing as mp
+
+"""
+Sharded Evaluation over a Process Pool
+  --> the episode range [0, max_iters) is split into <n_proc> contiguous shards
+  --> every worker builds its own env/motion/planner by calling <eval_func> on its shard
+  --> episode #it is always seeded with (seed + it + 1), so a shard reproduces exactly
+      the same episodes as the serial evaluation (except for --plan-dist-iters, whose
+      quota is split across shards)
+  --> results are merged in shard order, so the merged <episode_stats> is deterministic
+"""
+
+
+def split_episode_range(max_iters, n_shard, plan_req=None):
+    """
+    return a list of (it_lo, it_hi, shard_plan_req)
+      when plan_req is not None, the quota of every plan length is split evenly
+      and the episode range of each shard is sized by its own total quota
+    """
+    shards = []
+    if plan_req is not None:
+        it_lo = 0
+        for i in range(n_shard):
+            cur_req = dict()
+            for m, cnt in plan_req.items():
+                c = cnt // n_shard + int(i < cnt % n_shard)
+                if c > 0: cur_req[m] = c
+            n = sum(cur_req.values())
+            if n == 0: continue
+            shards.append((it_lo, it_lo + n, cur_req))
+            it_lo += n
+    else:
+        base = max_iters // n_shard
+        it_lo = 0
+        for i in range(n_shard):
+            n = base + int(i < max_iters % n_shard)
+            if n == 0: continue
+            shards.append((it_lo, it_lo + n, None))
+            it_lo += n
+    return shards
+
+
+def _run_shard(eval_func, args, shard_id, it_lo, it_hi, plan_req):
+    args = copy.deepcopy(args)
+    log_dir = args['log_dir']
+    if log_dir[-1] != '/': log_dir += '/'
+    args['log_dir'] = log_dir + 'shard_{}'.format(shard_id)
+    if not os.path.exists(args['log_dir']):
+        os.makedirs(args['log_dir'])
+    if args['plan_dist_iters'] is not None:
+        args['plan_dist_iters'] = plan_req
+    if 'backup_rate' in args:
+        args['backup_rate'] = 0  # backups are only supported by the serial evaluation
+    if ('profile_trace' in args) and (args['profile_trace'] is not None):
+        args['profile_trace'] = args['profile_trace'] + '.shard_{}'.format(shard_id)
+    if args['render_gpu'] is None:
+        all_gpus = common.get_gpus_for_rendering()
+        args['render_gpu'] = all_gpus[shard_id % len(all_gpus)]
+    timing = dict()
+    ts = time.time()
+    episode_stats = eval_func(args, iter_range=(it_lo, it_hi), timing=timing)
+    timing['total'] = time.time() - ts
+    metrics.flush_all()  # pool workers are terminated without running atexit
+    return episode_stats, timing
+
+
+def evaluate_sharded(eval_func, args, n_proc, logger=None):
+    """
+    eval_func: evaluate(args, iter_range=None, timing=None) in HRL/eval_HRL.py or HRL/eval_motion.py
+    n_proc: number of worker processes
+    return merged episode_stats and the per-shard timing dicts
+    """
+    plan_req = args['plan_dist_iters'] if ('plan_dist_iters' in args) else None
+    shards = split_episode_range(args['max_iters'], n_proc, plan_req)
+    _print = print if logger is None else logger.print
+    _print('[ParallelEval] Total <{}> Episodes Split into <{}> Shards ...'.format(shards[-1][1], len(shards)))
+    for i, (lo, hi, req) in enumerate(shards):
+        _print('  --> Shard#{}: Episode [{}, {}), Plan-Req = {}'.format(i, lo, hi, req))
+
+    ts = time.time()
+    # fork before any renderer or cuda context is created in the master process
+    ctx = mp.get_context('fork')
+    with ctx.Pool(len(shards)) as pool:
+        results = pool.starmap(_run_shard, [(eval_func, args, i, lo, hi, req)
+                                            for i, (lo, hi, req) in enumerate(shards)])
+    wall_time = time.time() - ts
+
+    episode_stats = []
+    all_timing = []
+    for stats, timing in results:
+        episode_stats += stats
+        all_timing.append(timing)
+
+    _print('[ParallelEval] Done! Wall-Clock Time = %.4f min' % (wall_time / 60))
+    for key in ['mask', 'plan', 'motion', 'total']:
+        vals = [t[key] for t in all_timing if key in t]
+        if len(vals) == 0: continue
+        _print(' >>> %s Time: Sum = %.4f min, Max-Shard = %.4f min' % (key.capitalize(), np.sum(vals) / 60, np.max(vals) / 60))
+    return episode_stats, all_timing
@@ -0,0 +1,141 @@
+import os, time, pickle, fcntl
+
+import numpy as np
+
+"""
+Cached Optimal-Plan Table
+  --> task.get_optimal_plan() searches the shortest room/object sequence from the agent location,
+      OptimalPlanTable memoizes it per house as (target, grid cell) -> plan
+  --> a plan [(name, steps), ...] is stored integer-coded as an int32 array of shape [len, 2],
+      names are coded by a vocabulary kept with the table
+  --> tables are loaded lazily per house from <table_dir>/<houseID>.pkl, new entries are
+      merged into the file by save(), so later runs (and parallel shards) no longer pay the search
+  --> build() fills the table of a house exhaustively, resetting the task to every walkable grid cell via
+      task.reset(target, reset_house=False, birthplace=(x, y)), see HRL/build_plan_table.py
+  --> save() merges under a file lock per house, so parallel shards never drop each other's entries
+"""
+
+
+class OptimalPlanTable(object):
+    def __init__(self, table_dir=None, logger=None):
+        """
+        table_dir: folder of the per-house tables, None for an in-memory table only
+        """
+        self.table_dir = table_dir
+        self.logger = logger
+        self.names = []
+        self.name_index = dict()
+        self._tables = dict()  # houseID -> {(target_code, gx, gy) -> np.array([len, 2], int32)}
+        self._dirty = set()
+        self.n_hit = 0
+        self.n_miss = 0
+        if (table_dir is not None) and (not os.path.exists(table_dir)):
+            os.makedirs(table_dir, exist_ok=True)
+
+    def _code(self, name):
+        if name not in self.name_index:
+            self.name_index[name] = len(self.names)
+            self.names.append(name)
+        return self.name_index[name]
+
+    def _table_file(self, house_id):
+        return os.path.join(self.table_dir, '{}.pkl'.format(house_id))
+
+    def _read_file(self, house_id):
+        # return the table of the house on disk, re-coded with our vocabulary
+        filename = self._table_file(house_id)
+        if not os.path.isfile(filename):
+            return dict()
+        with open(filename, 'rb') as f:
+            data = pickle.load(f)
+        recode = np.array([self._code(n) for n in data['names']], dtype=np.int32)
+        table = dict()
+        for (t, gx, gy), plan in data['table'].items():
+            plan = plan.copy()
+            plan[:, 0] = recode[plan[:, 0]]
+            table[(int(recode[t]), gx, gy)] = plan
+        return table
+
+    def _get_table(self, house_id):
+        if house_id not in self._tables:
+            self._tables[house_id] = self._read_file(house_id) if self.table_dir is not None else dict()
+        return self._tables[house_id]
+
+    def get_plan(self, task):
+        """
+        return the optimal plan [(name, steps), ...] of the task at the current location
+        """
+        table = self._get_table(task.house._id)
+        gx, gy = task.info['grid']
+        key = (self._code(task.get_current_target()), int(gx), int(gy))
+        plan = table.get(key, None)
+        if plan is None:
+            self.n_miss += 1
+            plan = np.array([[self._code(n), s] for n, s in task.get_optimal_plan()], dtype=np.int32).reshape((-1, 2))
+            table[key] = plan
+            self._dirty.add(task.house._id)
+        else:
+            self.n_hit += 1
+        return [(self.names[c], int(s)) for c, s in plan]
+
+    def build(self, task, targets=None):
+        """
+        compute the optimal plans of the current house of the task from all the walkable grid cells
+          targets: default all the room and object targets of the house
+        return the number of new entries
+        """
+        assert hasattr(task, 'get_optimal_plan'), '[OptimalPlanTable] the task does not support get_optimal_plan()!'
+        house = task.house
+        if targets is None:
+            targets = house.all_desired_roomTypes + house.all_desired_targetObj
+        cells = walkable_cells(house)
+        n_miss = self.n_miss
+        for t in targets:
+            for x, y in cells:
+                task.reset(target=t, reset_house=False, birthplace=(x, y))
+                if task.info['dist'] < 0:  # target unreachable from the cell
+                    continue
+                self.get_plan(task)
+        return self.n_miss - n_miss
+
+    def save(self):
+        """
+        merge the new entries into the table files
+        """
+        if self.table_dir is None:
+            return
+        ts = time.time()
+        for house_id in self._dirty:
+            # the read-merge-write is serialized with the other processes sharing the folder
+            with open(self._table_file(house_id) + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    table = self._read_file(house_id)
+                    table.update(self._tables[house_id])
+                    self._tables[house_id] = table
+                    tmp_file = self._table_file(house_id) + '.tmp%d' % os.getpid()
+                    with open(tmp_file, 'wb') as f:
+                        pickle.dump(dict(names=self.names, table=table), f)
+                    os.replace(tmp_file, self._table_file(house_id))
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        if (self.logger is not None) and (len(self._dirty) > 0):
+            self.logger.print('[OptimalPlanTable] %d house tables saved, time = %.3fs' % (len(self._dirty), time.time() - ts))
+        self._dirty = set()
+
+    def stats_string(self):
+        n_query = max(1, self.n_hit + self.n_miss)
+        return '[OptimalPlanTable] #houses = %d, #entries = %d, hit rate = %.3f (%d / %d)' \
+               % (len(self._tables), sum([len(t) for t in self._tables.values()]), self.n_hit / n_query, self.n_hit, n_query)
+
+
+def walkable_cells(house):
+    """
+    return the (x, y) centers of the walkable grid cells of the house
+      --> atlas and synthetic houses: the lattice nodes
+      --> House3D houses: every grid cell passing house.canMove()
+    """
+    if hasattr(house, 'n_node'):
+        return [house.to_coor(n) for n in range(house.n_node)]
+    n_grid = house.to_grid(house.L_hi, house.L_hi)[0] + 1
+    return [house.to_coor(gx, gy, True) for gx in range(n_grid) for gy in range(n_grid) if house.canMove(gx, gy)]
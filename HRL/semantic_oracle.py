@@ -34,7 +34,9 @@ def create_policy(args, observation_shape, n_class):
                           multi_label=False,
                           dropout_rate=args['dropout_rate'],
                           stack_frame=args['stack_frame'],
-                          self_attention_dim=args['self_attention_dim'])
+                          self_attention_dim=args['self_attention_dim'],
+                          index_input=(args['segment_input'] == 'index'),
+                          index_embed_dim=(args['index_embed_dim'] if 'index_embed_dim' in args else None))
     if common.use_cuda:
         if 'train_gpu' in args:
             train_gpus = args['train_gpu']
@@ -55,8 +57,110 @@ def create_trainer(args, n_class):
     return trainer
 ###############################
 
+class FrameStackCache(object):
+    """
+    Device-resident buffers of the normalized input frames of a SemanticOracle
+      --> every step only the newest frame is uploaded (as uint8) and normalized in place on device
+      --> the ring stores every frame twice (at slot p and p+stack_frame), so the recent <stack_frame> frames
+          are always the contiguous slice [p+1, p+1+stack_frame) and can be fed without re-stacking
+      --> panoramic views all change once the agent moves, so they are copied into a preallocated buffer
+    one buffer is kept for each input normalization (see SemanticOracle._input_mode)
+    """
+    def __init__(self, oracle):
+        self.oracle = oracle
+        self.stack_frame = oracle.has_stack_frame or 1
+        self.pano_stack = oracle.pano_stack
+        self._frame_modes = []
+        self._pano_modes = []
+        for trainer in oracle.classifiers:
+            mode = oracle._input_mode(trainer)
+            if trainer.panoramic:
+                if mode not in self._pano_modes: self._pano_modes.append(mode)
+            else:
+                if mode not in self._frame_modes: self._frame_modes.append(mode)
+        self._ring = dict()
+        self._pano = dict()
+        self._u8_frame = None
+        self._u8_pano = None
+        self.reset()
+
+    def reset(self):
+        self._pos = -1
+        for mode in self._ring:
+            self._ring[mode].fill_(self._zero_value(mode))
+
+    def _zero_value(self, mode):
+        # normalized value of an all-zero frame, see SemanticTrainer._create_gpu_tensor
+        return -1.0 if mode == 'color' else 0.0
+
+    def _normalize_(self, t, mode):
+        if mode == 'depth':
+            t /= 256.0
+        elif mode == 'color':
+            t.sub_(128.0).div_(128.0)
+        return t
+
+    def _upload_u8(self, buf, np_frames):
+        # np_frames: [k, n, m, channel], uint8
+        cpu_tensor = torch.from_numpy(np.ascontiguousarray(np_frames))
+        if (buf is None) or (buf.size() != cpu_tensor.size()):
+            buf = ByteTensor(*cpu_tensor.size())
+        buf.copy_(cpu_tensor)
+        return buf
+
+    def push(self, cur_obs, pano_frames=None):
+        """
+        cur_obs: the current frame, [n, m, channel] or [1, n, m, channel]
+        pano_frames: a list of <pano_stack> frames, the panoramic view
+        """
+        if len(self._frame_modes) > 0:
+            if len(cur_obs.shape) == 4: cur_obs = cur_obs[0]
+            S = self.stack_frame
+            self._u8_frame = self._upload_u8(self._u8_frame, cur_obs[np.newaxis, ...])
+            src = self._u8_frame.permute(0, 3, 1, 2)
+            self._pos = (self._pos + 1) % S
+            p = self._pos
+            for mode in self._frame_modes:
+                if (mode not in self._ring) or (self._ring[mode].size()[1:] != src.size()[1:]):
+                    self._ring[mode] = FloatTensor(2 * S, *src.size()[1:]).fill_(self._zero_value(mode))
+                ring = self._ring[mode]
+                cur = ring[p:p+1]
+                cur.copy_(src)
+                self._normalize_(cur, mode)
+                if S > 1:
+                    ring[p+S:p+S+1].copy_(cur)
+        if pano_frames is not None:
+            assert len(pano_frames) == self.pano_stack
+            self._u8_pano = self._upload_u8(self._u8_pano, np.stack(pano_frames))
+            src = self._u8_pano.permute(0, 3, 1, 2)
+            for mode in self._pano_modes:
+                if (mode not in self._pano) or (self._pano[mode].size() != src.size()):
+                    self._pano[mode] = FloatTensor(*src.size())
+                self._normalize_(self._pano[mode].copy_(src), mode)
+
+    def get_input(self, trainer):
+        """
+        return the input Variable for the classifier of <trainer>
+        """
+        mode = self.oracle._input_mode(trainer)
+        if trainer.panoramic:
+            t = self._pano[mode].unsqueeze(0)  # [1, pano_stack, channel, n, m]
+        else:
+            S, p = self.stack_frame, self._pos
+            last = p + S if S > 1 else p
+            if trainer.stack_frame:
+                t = self._ring[mode][last-S+1:last+1].unsqueeze(0)  # [1, stack_frame, channel, n, m]
+            else:
+                t = self._ring[mode][last:last+1]  # [1, channel, n, m]
+        return Variable(t, volatile=True)
+
+
 class OracleFunction(object):
-    def __init__(self, oracle, threshold=0.5, filter_steps=None, batched_size=None):
+    def __init__(self, oracle, threshold=0.5, filter_steps=None, batched_size=None, device_cache=False):
+        """
+        device_cache: when True, recent frames are kept in a FrameStackCache on device and only the newest
+                      frame is uploaded every step (only used by get(), not by the batched_* interface)
+        """
         self.oracle = oracle
         self.n_target = oracle.n_target
         self.threshold = threshold
@@ -71,25 +175,36 @@ class OracleFunction(object):
         self.pano_stack_frame = oracle.pano_stack
         self._step_cnt = 0
         self._frame_stack = None if self.stack_frame is None else [None] * self.stack_frame
+        self._cache = FrameStackCache(oracle) if device_cache else None
     
     def reset(self):
         self._step_cnt = 0
-        self._filter_cnt[:] = 0
+        if self._filter_cnt is not None:
+            self._filter_cnt[:] = 0
         self._frame_stack = None if self.stack_frame is None else [None] * self.stack_frame
+        if self._cache is not None:
+            self._cache.reset()
 
     def get(self, task, return_current_prob=False):
         # get recent frames
         cur_obs = task._cached_obs
-        if self.stack_frame is None:
+        # get panoramic frames
+        pano_frames = None if not self.flag_panoramic else task._render_panoramic(n_frames=self.pano_stack_frame)
+        if self._cache is not None:
+            self._cache.push(cur_obs, pano_frames)
+            recent_frames = None
+        elif self.stack_frame is None:
             recent_frames = cur_obs
         else:
             self._frame_stack = self._frame_stack[1:] + [cur_obs]
             recent_frames = self._frame_stack
-        # get panoramic frames
-        pano_frames = None if not self.flag_panoramic else task._render_panoramic(n_frames=self.pano_stack_frame)
 
         # compute mask feature
-        if return_current_prob:
+        if self._cache is not None:
+            cur_prob = self.oracle.get_mask_feature_cached(self._cache, threshold=None)
+            cur_mask = self.oracle.to_binary(cur_prob, threshold=self.threshold)
+            if not return_current_prob: cur_prob = None
+        elif return_current_prob:
             cur_prob = self.oracle.get_mask_feature(recent_frames, pano_frames, threshold=None)
             cur_mask = self.oracle.to_binary(cur_prob, threshold=self.threshold)
         else:
@@ -157,7 +272,12 @@ class OracleFunction(object):
 
 
 class SemanticOracle(object):
-    def __init__(self, model_dir, model_device=None, include_object=False):
+    def __init__(self, model_dir, model_device=None, include_object=False, fused=False):
+        """
+        fused: when True, classifiers sharing the same architecture and input are fused into a single
+               FusedCNNClassifier, so that all the target probabilities are computed by one forward pass
+               and copied back to cpu in one transfer
+        """
         self.allowed_targets = ALLOWED_TARGET_ROOM_TYPES
         if include_object: self.allowed_targets = self.allowed_targets + ALLOWED_OBJECT_TARGET_TYPES
         self.n_target = len(self.allowed_targets)
@@ -209,7 +329,70 @@ class SemanticOracle(object):
             self.has_stack_frame = None
         if self.has_panoramic:
             assert self.pano_stack is not None
+        self.fused_groups = None
+        if fused:
+            self._build_fused_groups(model_device[0])
         print('[SemanticOracle] Successfully Launched trainers for target <{}>'.format(self.allowed_targets))
+
+    def _input_mode(self, trainer):
+        # see SemanticTrainer._create_gpu_tensor
+        args = trainer.args
+        if args['segment_input'] == 'index':
+            return 'index'
+        if args['depth_input'] or ('attentive' in args['model_name']):
+            return 'depth'
+        return 'color'
+
+    def _build_fused_groups(self, device):
+        """
+        group classifiers by (input, architecture) and fuse each group
+        self.fused_groups: a list of (fused_model, trainer_of_the_first_member, target_indices)
+        """
+        groups = dict()
+        for i, trainer in enumerate(self.classifiers):
+            m = trainer.policy
+            key = (trainer.panoramic, trainer.stack_frame, self._input_mode(trainer),
+                   tuple(m.hiddens), tuple(m.kernel_sizes), tuple(m.strides),
+                   tuple(l.out_features for l in m.linear_layers),
+                   m.attention_dim, m.multi_label, m.bc_layers[0] is not None)
+            if key not in groups: groups[key] = []
+            groups[key].append(i)
+        self.fused_groups = []
+        for key in sorted(groups.keys(), key=lambda k: groups[k][0]):
+            idx = groups[key]
+            fused_model = common.FusedCNNClassifier([self.classifiers[i].policy for i in idx])
+            if common.use_cuda:
+                fused_model.cuda(device=device)
+            self.fused_groups.append((fused_model, self.classifiers[idx[0]], idx))
+        # permutation from the concatenated group outputs to the target order
+        perm = np.argsort(np.concatenate([np.array(idx) for _, _, idx in self.fused_groups]))
+        self._fused_perm = torch.from_numpy(perm).type(LongTensor)
+        print('[SemanticOracle] Fused <{}> classifiers into <{}> group(s): {}'.format(
+            self.n_target, len(self.fused_groups), [[self.allowed_targets[i] for i in idx] for _, _, idx in self.fused_groups]))
+
+    def _fused_forward(self, np_frame, np_pano, take_last_frame=False):
+        """
+        run all the fused groups and return the probability of the positive label, np.array [batch, n_target]
+        """
+        var_frame = var_last_frame = var_pano = None
+        all_prob = []
+        for fused_model, trainer, _ in self.fused_groups:
+            if trainer.panoramic:
+                if var_pano is None:
+                    var_pano = trainer._create_gpu_tensor(np_pano, return_variable=True, volatile=True)
+                inp = var_pano
+            elif (trainer.stack_frame is None) and take_last_frame:
+                if var_last_frame is None:
+                    var_last_frame = trainer._create_gpu_tensor(np_frame[:, -1, ...], return_variable=True, volatile=True)
+                inp = var_last_frame
+            else:
+                if var_frame is None:
+                    var_frame = trainer._create_gpu_tensor(np_frame, return_variable=True, volatile=True)
+                inp = var_frame
+            all_prob.append(fused_model(inp).data[:, :, 0])  # [batch, group_size]
+        prob = torch.cat(all_prob, dim=1) if len(all_prob) > 1 else all_prob[0]
+        prob = torch.index_select(prob, 1, self._fused_perm)
+        return prob.cpu().numpy()  # the only device-to-host transfer
     
     @property
     def targets(self):
@@ -248,6 +431,12 @@ class SemanticOracle(object):
             assert not self.has_panoramic
             np_pano = None
 
+        if self.fused_groups is not None:
+            prob = self._fused_forward(np_frame, np_pano, take_last_frame=isinstance(recent_frames, list))[0]
+            if threshold is not None:
+                return (prob > threshold).astype(np.uint8)
+            return prob.astype(np.float)
+
         ret = np.zeros(self.n_target, dtype=(np.uint8 if threshold is not None else np.float))
         for i, trainer in enumerate(self.classifiers):
             if trainer.panoramic:
@@ -269,6 +458,25 @@ class SemanticOracle(object):
                 ret[i] = prob[0]
         return ret
     
+    def get_mask_feature_cached(self, cache, threshold=None):
+        """
+        cache: a FrameStackCache with the recent frames already pushed
+        threshold: when not None, return a np.array with binary signals; otherwise return a list of float number
+        """
+        all_prob = []
+        if self.fused_groups is not None:
+            for fused_model, trainer, _ in self.fused_groups:
+                all_prob.append(fused_model(cache.get_input(trainer)).data[:, :, 0])
+            prob = torch.index_select(torch.cat(all_prob, dim=1), 1, self._fused_perm)
+        else:
+            for trainer in self.classifiers:
+                all_prob.append(trainer.action(cache.get_input(trainer), input_tensor=True)[:, 0:1])
+            prob = torch.cat(all_prob, dim=1)
+        prob = prob.cpu().numpy()[0]  # the only device-to-host transfer
+        if threshold is not None:
+            return (prob > threshold).astype(np.uint8)
+        return prob.astype(np.float)
+
     def batched_get_mask_feature(self, batched_frames=None, batched_pano=None, threshold=None):
         """
         batched_frames: a list of stacked frames
@@ -281,6 +489,12 @@ class SemanticOracle(object):
         var_pano = None
         var_frame = None
 
+        if self.fused_groups is not None:
+            prob = self._fused_forward(np_frame, np_pano)
+            if threshold is not None:
+                return (prob > threshold).astype(np.uint8)
+            return prob.astype(np.float)
+
         ret = np.zeros((batch_size, self.n_target), dtype=(np.uint8 if threshold is not None else np.float))
         for i, trainer in enumerate(self.classifiers):
             if trainer.panoramic:
@@ -292,9 +506,9 @@ class SemanticOracle(object):
                     var_frame = trainer._create_gpu_tensor(np_frame, return_variable=True, volatile=True)
                 prob = trainer.action(var_frame, return_numpy=True, input_tensor=True)[:, 0]
             if threshold is not None:
-                ret[:, i] = (prob[0] > threshold)
+                ret[:, i] = (prob > threshold)
             else:
-                ret[:, i] = prob[0]
+                ret[:, i] = prob
         return ret
 
     def to_binary(self, probs, threshold):
@@ -0,0 +1,437 @@
+import sys, os, json, time
+
+import numpy as np
+import random
+
+import House3D.roomnav as RN
+from House3D.roomnav import n_discrete_actions, discrete_actions, discrete_angle_delta_value
+from House3D.house import ALLOWED_TARGET_ROOM_TYPES, ALLOWED_OBJECT_TARGET_TYPES
+
+"""
+Pre-Rendered House Atlas
+  --> build_house_atlas() places the agent on every walkable node of a regular lattice
+      (spacing = atlas_spacing_ratio * move_sensitivity) at every discrete yaw, and stores the rendered rgb, depth,
+      semantic frames, the feature mask, the target insight bits, the grid distance to every target and
+      the walkable map of the house grid into <atlas_dir>/<houseID>/*.npy
+  --> AtlasRoomNavTask serves the same surface as RoomNavTask (reset/step/info/get_feature_mask/_cached_obs ...)
+      from the memory-mapped atlas files, so no renderer (and no OpenGL context) is needed
+NOTE:
+  --> the agent keeps a continuous position and moves exactly as in RoomNavTask: a move is a collision (the agent stays)
+      iff the grid cell of the new position is not walkable; the observation, the feature mask and the distance
+      are the ones of the nearest lattice node, so they are exact when the agent is on a node
+      (with the default spacing, always for moves along the axes)
+  --> observation = [rgb or semantic] (+ depth channel 0), or [rgb, semantic] (+ depth) for the joint signal
+  --> only the <see> success measure (the target is in the feature mask and in sight) and the <none> reward type
+      (success reward, collision and time penalties, with the constants of House3D.roomnav) are supported,
+      the other success measures and the shaped rewards need the distance field of RoomNavTask
+"""
+
+combined_target_list = ALLOWED_TARGET_ROOM_TYPES + ALLOWED_OBJECT_TARGET_TYPES
+combined_target_index = dict()
+for i, t in enumerate(combined_target_list):
+    combined_target_index[t] = i
+
+atlas_frame_files = ['rgb', 'depth', 'semantic']
+atlas_spacing_ratio = 0.2   # the largest ratio dividing the displacements (1 and 0.4) of all discrete moves
+insight_n_pixel = 50
+
+
+def _count_color_pixels(obs_seg, color_list):
+    cnt = 0
+    for c in color_list:
+        cnt += np.sum(np.all(obs_seg == c, axis=2))
+    return cnt
+
+
+def build_house_atlas(task, atlas_dir, n_yaw=None, spacing=None, logger=None):
+    """
+    task: a RoomNavTask over a single house with cacheAllTarget=True (see common.create_env)
+    atlas_dir: root folder of the atlas, files are stored in <atlas_dir>/<houseID>/
+    n_yaw: number of discrete yaws, default task.discrete_angle
+    spacing: lattice spacing in meters, default atlas_spacing_ratio * task.move_sensitivity
+    """
+    _print = print if logger is None else logger.print
+    env = task.env
+    house = env.house
+    if n_yaw is None: n_yaw = task.discrete_angle
+    if spacing is None: spacing = atlas_spacing_ratio * task.move_sensitivity
+    assert n_yaw is not None, '[Atlas] <n_yaw> must be specified for tasks with continuous angles!'
+    save_dir = os.path.join(atlas_dir, house._id)
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+
+    # walkable map of the house grid
+    ts = time.time()
+    n_grid = house.to_grid(house.L_hi, house.L_hi)[0] + 1
+    movable = np.zeros((n_grid, n_grid), dtype=np.uint8)
+    for gx in range(n_grid):
+        for gy in range(n_grid):
+            movable[gx, gy] = house.canMove(gx, gy)
+
+    # walkable lattice nodes
+    coors = np.arange(house.L_lo + house.grid_det / 2, house.L_hi, spacing)   # nodes at grid cell centers
+    lattice = np.ones((len(coors), len(coors)), dtype=np.int32) * -1
+    nodes = []
+    for i, x in enumerate(coors):
+        for j, y in enumerate(coors):
+            gx, gy = house.to_grid(x, y)
+            if house.canMove(gx, gy):
+                lattice[i, j] = len(nodes)
+                nodes.append((i, j, gx, gy))
+    n_node = len(nodes)
+    assert n_node > 0, '[Atlas] No walkable node found in house <{}>!'.format(house._id)
+    _print('[Atlas] House <{}>: {} walkable nodes x {} yaws (spacing = {})'.format(house._id, n_node, n_yaw, spacing))
+    grids = np.array([(gx, gy) for _, _, gx, gy in nodes], dtype=np.int32)
+
+    # distance to targets
+    all_targets = [t for t in combined_target_list
+                   if (t in house.all_desired_roomTypes) or (t in house.all_desired_targetObj)]
+    dist = np.zeros((len(all_targets), n_node), dtype=np.int32)
+    for k, t in enumerate(all_targets):
+        for n, (gx, gy) in enumerate(grids):
+            dist[k, n] = house.targetDist(t, gx, gy)
+
+    # frames, masks and insight bits
+    frames = dict()
+    masks = None
+    insight = np.zeros((n_node, n_yaw, len(all_targets)), dtype=np.uint8)
+    for n, (i, j, _, _) in enumerate(nodes):
+        for r in range(n_yaw):
+            env.reset(x=coors[i], y=coors[j], yaw=r * 360.0 / n_yaw)
+            cur = dict(rgb=env.render(mode='rgb'),
+                       depth=env.render(mode='depth')[..., 0:1],
+                       semantic=env.render(mode='semantic'))
+            for key in atlas_frame_files:
+                if key not in frames:
+                    frames[key] = np.lib.format.open_memmap(os.path.join(save_dir, key + '.npy'), mode='w+',
+                                                            dtype=cur[key].dtype, shape=(n_node, n_yaw) + cur[key].shape)
+                frames[key][n, r] = cur[key]
+            mask = task.get_feature_mask()
+            if masks is None:
+                masks = np.zeros((n_node, n_yaw, len(mask)), dtype=np.uint8)
+            masks[n, r] = mask
+            for k, t in enumerate(all_targets):
+                insight[n, r, k] = (_count_color_pixels(cur['semantic'], task.room_target_object[t]) >= insight_n_pixel)
+        if (n + 1) % 100 == 0:
+            _print('  --> %d / %d nodes rendered, time elapsed = %.2fs' % (n + 1, n_node, time.time() - ts))
+    for key in atlas_frame_files:
+        frames[key].flush()
+    np.save(os.path.join(save_dir, 'lattice.npy'), lattice)
+    np.save(os.path.join(save_dir, 'grids.npy'), grids)
+    np.save(os.path.join(save_dir, 'dist.npy'), dist)
+    np.save(os.path.join(save_dir, 'mask.npy'), masks)
+    np.save(os.path.join(save_dir, 'insight.npy'), insight)
+    np.save(os.path.join(save_dir, 'movable.npy'), movable)
+    meta = dict(house_id=house._id, n_node=n_node, n_yaw=n_yaw, spacing=float(spacing),
+                coor_lo=float(coors[0]), n_lattice=len(coors), targets=all_targets,
+                L_lo=float(house.L_lo), grid_det=float(house.grid_det),
+                all_desired_roomTypes=list(house.all_desired_roomTypes),
+                all_desired_targetObj=list(house.all_desired_targetObj),
+                grid_per_step=float(spacing / house.grid_det),
+                move_sensitivity=float(task.move_sensitivity), rot_sensitivity=float(task.rot_sensitivity))
+    with open(os.path.join(save_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    _print('[Atlas] House <{}> Done! Time Elapsed = %.2fs'.format(house._id) % (time.time() - ts))
+    return save_dir
+
+
+def nearest_node(house, x, y):
+    """
+    the walkable lattice node of <house> nearest to the position (x, y), -1 if none of the 3x3 lattice points around is walkable
+    """
+    fi = (x - house.coor_lo) / house.spacing
+    fj = (y - house.coor_lo) / house.spacing
+    i, j = int(round(fi)), int(round(fj))
+    n, m = house.lattice.shape
+    if (0 <= i < n) and (0 <= j < m) and (house.lattice[i, j] >= 0):
+        return house.lattice[i, j]
+    ret, ret_d = -1, None
+    for a in range(i - 1, i + 2):
+        for b in range(j - 1, j + 2):
+            if (0 <= a < n) and (0 <= b < m) and (house.lattice[a, b] >= 0):
+                d = (a - fi) ** 2 + (b - fj) ** 2
+                if (ret_d is None) or (d < ret_d):
+                    ret, ret_d = house.lattice[a, b], d
+    return ret
+
+
+def can_move(house, x, y):
+    """
+    whether the grid cell of the position (x, y) is walkable, i.e., House.canMove of the grid
+    """
+    gx, gy = house.to_grid(x, y)
+    return (gx >= 0) and (gy >= 0) and (gx < house.movable.shape[0]) and (gy < house.movable.shape[1]) \
+        and (house.movable[gx, gy] > 0)
+
+
+class AtlasHouse(object):
+    """
+    read-only view of a house atlas, all the arrays are memory-mapped
+    """
+    def __init__(self, house_dir):
+        meta_file = os.path.join(house_dir, 'meta.json')
+        assert os.path.exists(meta_file), '[AtlasHouse] meta file <{}> not found!'.format(meta_file)
+        with open(meta_file, 'r') as f:
+            self.meta = meta = json.load(f)
+        assert 'grid_det' in meta, '[AtlasHouse] atlas <{}> has no walkable map, re-build it with build_atlas.py!'.format(house_dir)
+        self._id = meta['house_id']
+        self.n_node = meta['n_node']
+        self.n_yaw = meta['n_yaw']
+        self.spacing = meta['spacing']
+        self.coor_lo = meta['coor_lo']
+        self.L_lo = meta['L_lo']
+        self.grid_det = meta['grid_det']
+        self.all_desired_roomTypes = meta['all_desired_roomTypes']
+        self.all_desired_targetObj = meta['all_desired_targetObj']
+        self.targets = meta['targets']
+        self.target_index = dict([(t, k) for k, t in enumerate(self.targets)])
+        self.lattice = np.load(os.path.join(house_dir, 'lattice.npy'))
+        self.grids = np.load(os.path.join(house_dir, 'grids.npy'))
+        self.dist = np.load(os.path.join(house_dir, 'dist.npy'))
+        self.mask = np.load(os.path.join(house_dir, 'mask.npy'), mmap_mode='r')
+        self.insight = np.load(os.path.join(house_dir, 'insight.npy'), mmap_mode='r')
+        self.movable = np.load(os.path.join(house_dir, 'movable.npy'), mmap_mode='r')
+        self.frames = dict()
+        for key in atlas_frame_files:
+            self.frames[key] = np.load(os.path.join(house_dir, key + '.npy'), mmap_mode='r')
+        self.nodes = np.argwhere(self.lattice >= 0)
+        self.nodes = self.nodes[np.argsort(self.lattice[self.nodes[:, 0], self.nodes[:, 1]])]   # node index -> (i, j)
+
+    def to_coor(self, node):
+        i, j = self.nodes[node]
+        return self.coor_lo + i * self.spacing, self.coor_lo + j * self.spacing
+
+    def to_grid(self, x, y):
+        return int((x - self.L_lo) // self.grid_det), int((y - self.L_lo) // self.grid_det)
+
+    def targetDist(self, target, gx, gy):
+        # distance of the node closest to grid (gx, gy)
+        if target not in self.target_index:
+            return -1
+        node = np.argmin(np.sum(np.abs(self.grids - np.array([gx, gy])), axis=1))
+        return self.dist[self.target_index[target], node]
+
+
+class AtlasRoomNavTask(object):
+    def __init__(self, house_dirs,
+                 segment_input=False, joint_visual_signal=False, depth_signal=False,
+                 max_steps=-1, success_measure='see', reward_type='none', reward_silence=0,
+                 include_object_target=False, include_outdoor_target=True,
+                 hardness=None, max_birthplace_steps=None, min_birth_grid_dist=0):
+        """
+        house_dirs: a list of atlas folders (<atlas_dir>/<houseID>), one house is selected per reset
+            an entry can also be a house object with the same interface as AtlasHouse (see synthetic_env.py)
+        """
+        assert success_measure == 'see', '[AtlasRoomNavTask] only <see> success measure is supported!'
+        assert reward_type == 'none', \
+            '[AtlasRoomNavTask] only <none> reward type is supported, <{}> needs the House3D RoomNavTask!'.format(reward_type)
+        assert reward_silence == 0, '[AtlasRoomNavTask] reward silence is not supported!'
+        self.all_houses = [AtlasHouse(d) if isinstance(d, str) else d for d in house_dirs]
+        self.house = self.all_houses[0]
+        self.env = self   # motions access task.env.house/info/render
+        self.segment_input = segment_input
+        self.joint_visual_signal = joint_visual_signal
+        self.depth_signal = depth_signal
+        self.max_steps = max_steps
+        self.success_measure = success_measure
+        self.reward_type = reward_type
+        self.include_object_target = include_object_target
+        self.include_outdoor_target = include_outdoor_target
+        self.hardness = hardness
+        self.max_birthplace_steps = max_birthplace_steps
+        self.min_birth_grid_dist = min_birth_grid_dist
+        self.discrete_angle = self.house.n_yaw
+        self.move_sensitivity = self.house.meta['move_sensitivity']
+        self.rot_sensitivity = self.house.meta['rot_sensitivity']
+        self.succSeeSteps = 1
+        self.room_target_object = None   # insight bits are pre-computed in the atlas, see is_target_insight()
+        self._node = 0
+        self._loc = self.house.to_coor(0)   # continuous position, self._node is the nearest lattice node
+        self._yaw_ind = 0
+        self.collision_flag = False
+        self._target = None
+        self._step_cnt = 0
+        self._pending_rot = 0
+        self._cached_obs = None
+        self._render_cache = None   # no renderer, see common.create_env
+
+    ######################
+    # House3D.Environment
+    ######################
+    def reset_house(self, house_id):
+        for h in self.all_houses:
+            if h._id == house_id:
+                self.house = h
+                return
+        assert False, '[AtlasRoomNavTask] house <{}> not found in the atlas!'.format(house_id)
+
+    def rotate(self, deg):
+        # NOTE: the yaw index is maintained by the caller (see random_motion.py),
+        #       the rotation only affects the direction of the next move_forward()
+        self._pending_rot += deg
+
+    def move_forward(self, dist_fwd, dist_hor=0):
+        yaw_ind = self._yaw_ind + int(round(self._pending_rot * self.house.n_yaw / 360.0))
+        self._pending_rot = 0
+        return self._move(dist_fwd, dist_hor, yaw_ind)
+
+    def render(self, mode='rgb'):
+        key = 'rgb' if mode not in atlas_frame_files else mode
+        return np.array(self.house.frames[key][self._node, self._yaw_ind])
+
+    def _gen_obs(self, node=None, yaw_ind=None):
+        if node is None: node = self._node
+        if yaw_ind is None: yaw_ind = self._yaw_ind
+        frames = self.house.frames
+        if self.joint_visual_signal:
+            sig = [frames['rgb'][node, yaw_ind], frames['semantic'][node, yaw_ind]]
+        else:
+            sig = [frames['semantic' if self.segment_input else 'rgb'][node, yaw_ind]]
+        if self.depth_signal:
+            sig.append(frames['depth'][node, yaw_ind])
+        return np.concatenate(sig, axis=-1) if len(sig) > 1 else np.array(sig[0])
+
+    def _render_panoramic(self, n_frames=4):
+        step = self.house.n_yaw // n_frames
+        return [self._gen_obs(yaw_ind=(self._yaw_ind + k * step) % self.house.n_yaw) for k in range(n_frames)]
+
+    def _fetch_cached_segmentation(self):
+        return self.render(mode='semantic')
+
+    ######################
+    # RoomNavTask
+    ######################
+    def get_current_target(self):
+        return self._target
+
+    def _target_dist(self, node=None):
+        if node is None: node = self._node
+        return self.house.dist[self.house.target_index[self._target], node]
+
+    def reset_target(self, target):
+        self._target = target
+
+    def reset_hardness(self, hardness=None, max_birthplace_steps=None):
+        self.hardness = hardness
+        self.max_birthplace_steps = max_birthplace_steps
+
+    def _allowed_targets(self):
+        ret = [t for t in self.house.all_desired_roomTypes if (t != 'outdoor') or self.include_outdoor_target]
+        if self.include_object_target:
+            ret += self.house.all_desired_targetObj
+        return ret
+
+    def _sample_birthplace(self):
+        dist = self.house.dist[self.house.target_index[self._target]]
+        valid = (dist > self.min_birth_grid_dist)
+        if self.hardness is not None:
+            valid &= (dist <= self.hardness * np.max(dist))
+        if self.max_birthplace_steps is not None:
+            valid &= (dist <= self.max_birthplace_steps * self.house.meta['grid_per_step'])
+        candidates = np.nonzero(valid)[0]
+        if len(candidates) == 0:
+            candidates = np.nonzero(dist >= 0)[0]
+        return np.random.choice(candidates)
+
+    def reset(self, target=None, reset_house=True, birthplace=None):
+        if reset_house and (len(self.all_houses) > 1):
+            self.house = random.choice(self.all_houses)
+        if target is None:
+            target = random.choice(self._allowed_targets())
+        assert target in self.house.target_index, '[AtlasRoomNavTask] target <{}> not in house <{}>!'.format(target, self.house._id)
+        self._target = target
+        if birthplace is not None:
+            self._node = nearest_node(self.house, *birthplace)
+            assert (self._node >= 0) and can_move(self.house, *birthplace), \
+                '[AtlasRoomNavTask] birthplace {} is not walkable!'.format(birthplace)
+            self._loc = tuple(birthplace)
+        else:
+            self._node = self._sample_birthplace()
+            self._loc = self.house.to_coor(self._node)
+        self._yaw_ind = np.random.randint(self.house.n_yaw)
+        self._step_cnt = 0
+        self.collision_flag = False
+        self._pending_rot = 0
+        self._cached_obs = self._gen_obs()
+        return self._cached_obs
+
+    def _is_success(self):
+        target_id = combined_target_index[self._target]
+        if self.house.mask[self._node, self._yaw_ind, target_id] == 0:
+            return False
+        return self.house.insight[self._node, self._yaw_ind, self.house.target_index[self._target]] > 0
+
+    def is_target_insight(self, target_name=None):
+        """
+        the pre-computed insight bit of <target_name> at the current node and yaw (see BaseMotion._is_insight)
+        NOTE: the bits are computed with <insight_n_pixel> pixels when building the atlas
+        """
+        if target_name is None: target_name = self._target
+        if target_name not in self.house.target_index:
+            return False
+        return self.house.insight[self._node, self._yaw_ind, self.house.target_index[target_name]] > 0
+
+    def _move(self, move_fwd, move_hor, yaw_ind):
+        """
+        move_fwd, move_hor in meters along the front and the right of the camera at <yaw_ind>
+        return False on collision, then the agent stays
+        """
+        yaw = np.deg2rad(yaw_ind * 360.0 / self.house.n_yaw)
+        x, y = self._loc
+        nx = x + move_fwd * np.cos(yaw) - move_hor * np.sin(yaw)
+        ny = y + move_fwd * np.sin(yaw) + move_hor * np.cos(yaw)
+        if not can_move(self.house, nx, ny):
+            return False
+        node = nearest_node(self.house, nx, ny)
+        if node < 0:
+            return False
+        self._loc = (nx, ny)
+        self._node = node
+        return True
+
+    def _reward(self, success):
+        # reward type <none>: the constants are read at every step, so the reward shaping flags apply (see common.py)
+        if success:
+            return RN.success_reward
+        reward = -RN.time_penalty_reward
+        if self.collision_flag:
+            reward -= RN.collision_penalty_reward
+        return reward
+
+    def step(self, action):
+        det_fwd, det_hor, det_rot = discrete_actions[action]
+        self._yaw_ind = (self._yaw_ind + discrete_angle_delta_value[action] + self.house.n_yaw) % self.house.n_yaw
+        self.collision_flag = False
+        if (det_fwd != 0) or (det_hor != 0):
+            self.collision_flag = not self._move(det_fwd * self.move_sensitivity, det_hor * self.move_sensitivity,
+                                                 self._yaw_ind)
+        self._step_cnt += 1
+        done = self._is_success()
+        reward = self._reward(done)
+        if (self.max_steps > 0) and (self._step_cnt >= self.max_steps):
+            done = True
+        self._cached_obs = self._gen_obs()
+        return self._cached_obs, reward, done, self.info
+
+    def get_feature_mask(self):
+        return np.array(self.house.mask[self._node, self._yaw_ind])
+
+    def set_state(self, state):
+        self._node = nearest_node(self.house, *state['loc'])
+        assert self._node >= 0, '[AtlasRoomNavTask] location {} is not walkable!'.format(state['loc'])
+        self._loc = tuple(state['loc'])
+        self._yaw_ind = int(round(state['yaw'] * self.house.n_yaw / 360.0)) % self.house.n_yaw
+        self._cached_obs = self._gen_obs()
+
+    @property
+    def info(self):
+        x, y = self._loc
+        dist = self._target_dist() if self._target is not None else -1
+        max_dist = max(1, np.max(self.house.dist[self.house.target_index[self._target]])) if self._target is not None else 1
+        grid_per_step = self.house.meta['grid_per_step']
+        return dict(loc=(x, y), yaw=self._yaw_ind * 360.0 / self.house.n_yaw,
+                    grid=self.house.to_grid(x, y),
+                    dist=dist, scaled_dist=dist / max_dist,
+                    meters=dist * self.house.spacing / grid_per_step,
+                    optsteps=int(np.ceil(dist / grid_per_step)),
+                    target_room=self._target)
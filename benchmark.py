@@ -0,0 +1,317 @@
+from headers import *
+import common
+import utils
+
+import sys, os, json, argparse, time, runpy, subprocess, tempfile, traceback
+import multiprocessing
+
+import numpy as np
+
+"""
+End-to-End Throughput Benchmark on the Synthetic Environment
+  --> every entry point runs its own __main__ with --synthetic-env and a small budget in a separate process:
+        zmq_train: zmq_train.train (A3C with ZMQ simulators)
+        train: train.train (DQN with a CNN policy)
+        eval: eval.evaluate (NOP trainer with a random policy)
+        eval_HRL: HRL/eval_HRL.evaluate (graph planner with random motion)
+  --> stages are timed by wrapping the methods of all the env/trainer/motion/planner classes,
+      nested calls of the same stage (e.g., super().update()) are only timed once
+  --> reports steps/s, updates/s (updates that returned stats) and the latency of every stage,
+      throughput is measured over the loop time, i.e., from the first to the last timed call
+  --> before the entry points, check_moves() asserts that every non-rotation action can change the agent state
+      of the synthetic environment, so the numbers are not measured on an agent that stalls
+NOTE:
+  --> for zmq_train, env.step runs in the simulator processes and is not timed,
+      steps are the actions sent by the master
+"""
+
+entry_scripts = dict(zmq_train='zmq_train.py', train='train.py', eval='eval.py', eval_HRL='HRL/eval_HRL.py')
+all_entries = ['zmq_train', 'train', 'eval', 'eval_HRL']
+
+
+def _all_subclasses(cls):
+    ret = [cls]
+    for c in cls.__subclasses__():
+        ret += _all_subclasses(c)
+    return ret
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.stats = dict()
+        self.counters = dict(steps=0, updates=0)
+        self.t_first = None
+        self.t_last = None
+        self._depth = dict()
+
+    def wrap(self, cls, method, stage, post=None):
+        """
+        post: post(obj, ret) called after each outermost call, ret is None when an exception is raised
+        """
+        if method not in cls.__dict__:
+            return
+        func = cls.__dict__[method]
+        if stage not in self.stats:
+            self.stats[stage] = []
+            self._depth[stage] = 0
+        timer = self
+
+        def timed_func(obj, *args, **kwargs):
+            if timer._depth[stage] > 0:
+                return func(obj, *args, **kwargs)
+            timer._depth[stage] += 1
+            ret = None
+            ts = time.time()
+            if timer.t_first is None: timer.t_first = ts
+            try:
+                ret = func(obj, *args, **kwargs)
+                return ret
+            finally:
+                if common.use_cuda: torch.cuda.synchronize()
+                timer.t_last = time.time()
+                timer.stats[stage].append(timer.t_last - ts)
+                timer._depth[stage] -= 1
+                if post is not None: post(obj, ret)
+        setattr(cls, method, timed_func)
+
+    def install(self):
+        import zmq_train   # register zmq trainers
+        import HRL.eval_HRL   # register motions and planners
+        from zmq_trainer.zmq_util import ZMQMaster
+        from HRL.semantic_oracle import OracleFunction
+        from atlas_env import AtlasRoomNavTask
+
+        def _count_step(obj, ret):
+            self.counters['steps'] += 1
+        def _count_update(obj, ret):
+            if ret is not None: self.counters['updates'] += 1
+        def _zmq_counters(obj, ret):
+            self.counters['steps'] = obj.cnt
+            self.counters['updates'] = obj.train_cnt
+
+        self.wrap(AtlasRoomNavTask, 'reset', 'env.reset')
+        self.wrap(AtlasRoomNavTask, 'step', 'env.step', post=_count_step)
+        for cls in _all_subclasses(AgentTrainer):
+            self.wrap(cls, 'action', 'trainer.action')
+            self.wrap(cls, 'update', 'trainer.update', post=_count_update)
+        for cls in _all_subclasses(BaseMotion):
+            self.wrap(cls, 'run', 'motion.run')
+        for cls in _all_subclasses(BasePlanner):
+            self.wrap(cls, 'plan', 'planner.plan')
+        self.wrap(OracleFunction, 'get', 'oracle.get')
+        self.wrap(ZMQMaster, '_batched_simulate', 'zmq.simulate')
+        self.wrap(ZMQMaster, '_perform_train', 'zmq.train', post=_zmq_counters)
+
+    def summary(self):
+        loop_time = (self.t_last - self.t_first) if self.t_first is not None else 0
+        ret = dict(loop_time=loop_time, steps=self.counters['steps'], updates=self.counters['updates'],
+                   steps_per_sec=self.counters['steps'] / max(loop_time, 1e-10),
+                   updates_per_sec=self.counters['updates'] / max(loop_time, 1e-10),
+                   stages=dict())
+        for stage, dat in self.stats.items():
+            if len(dat) == 0: continue
+            dat = np.array(dat)
+            ret['stages'][stage] = dict(n=len(dat), mean_ms=float(np.mean(dat) * 1000),
+                                        median_ms=float(np.median(dat) * 1000),
+                                        p90_ms=float(np.percentile(dat, 90) * 1000),
+                                        total_sec=float(np.sum(dat)))
+        return ret
+
+
+def get_entry_argv(entry, args, work_dir):
+    argv = ['--synthetic-env', '--seed', '0', '--multi-target', '--hardness', '0.95',
+            '--segmentation-input', args['segmentation_input'], '--resolution', args['resolution'],
+            '--max-episode-len', str(args['episode_len']),
+            '--rnn-units', str(args['rnn_units'])]
+    if args['depth_input']:
+        argv.append('--depth-input')
+    log_dir = os.path.join(work_dir, 'log')
+    save_dir = os.path.join(work_dir, 'model')
+    if entry in ['zmq_train', 'train']:
+        argv += ['--reward-type', 'none']
+    if entry == 'zmq_train':
+        argv += ['--job-name', 'benchmark%d' % os.getpid(),
+                 '--n-house', str(args['n_house']), '--n-proc', str(args['n_proc']),
+                 '--batch-size', str(args['n_proc']), '--t-max', str(args['t_max']),
+                 '--max-iters', str(args['updates']),
+                 '--report-rate', str(args['updates'] + 1), '--save-rate', str(args['updates'] + 1),
+                 '--eval-rate', str(int(1e9)),
+                 '--save-dir', save_dir, '--log-dir', log_dir]
+    elif entry == 'train':
+        argv += ['--house', str(-args['n_house']), '--algo', 'dqn', '--model', 'cnn',
+                 '--batch-size', str(args['batch_size']), '--replay-buffer-size', str(10000),
+                 '--max-iters', str(args['episodes']),
+                 '--report-rate', str(int(1e9)), '--save-rate', str(int(1e9)),
+                 '--save-dir', save_dir, '--log-dir', log_dir]
+    elif entry == 'eval':
+        argv += ['--house', str(-args['n_house']), '--algo', 'nop',
+                 '--max-iters', str(args['episodes']), '--log-dir', log_dir]
+    else:
+        argv += ['--house', str(-args['n_house']), '--motion', 'random', '--planner', 'graph',
+                 '--n-exp-steps', str(args['n_exp_steps']),
+                 '--max-iters', str(args['episodes']), '--log-dir', log_dir]
+    return argv
+
+
+def run_entry(entry, argv, result_file):
+    # executed in a child process, see benchmark()
+    timer = StageTimer()
+    timer.install()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), entry_scripts[entry])
+    sys.argv = [script] + argv
+    err = None
+    ts = time.time()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:   # ZMQMaster exits when all the iterations are finished
+        if e.code not in [None, 0]:
+            err = 'SystemExit({})'.format(e.code)
+    except Exception as e:
+        traceback.print_exc()
+        err = repr(e)
+    wall_time = time.time() - ts
+    for p in multiprocessing.active_children():
+        p.terminate()
+    ret = timer.summary()
+    ret['entry'] = entry
+    ret['wall_time'] = wall_time
+    ret['error'] = err
+    with open(result_file, 'w') as f:
+        json.dump(ret, f)
+
+
+def print_result(logger, res):
+    if res['error'] is not None:
+        logger.print('>>> [%s] FAILED! error = %s' % (res['entry'], res['error']))
+    logger.print('>>> [%s] wall = %.2fs, loop = %.2fs, steps = %d (%.2f steps/s), updates = %d (%.3f updates/s)'
+                 % (res['entry'], res['wall_time'], res['loop_time'], res['steps'], res['steps_per_sec'],
+                    res['updates'], res['updates_per_sec']))
+    for stage in sorted(res['stages'].keys()):
+        st = res['stages'][stage]
+        logger.print('   --> %-16s: n = %6d, mean = %8.3f ms, median = %8.3f ms, P90 = %8.3f ms, total = %.2fs'
+                     % (stage, st['n'], st['mean_ms'], st['median_ms'], st['p90_ms'], st['total_sec']))
+
+
+def check_moves(args, logger, n_trials=2000):
+    """
+    every action with a non-zero displacement must change the agent state of the synthetic environment,
+    and every move without collision must change the position
+    """
+    from House3D.roomnav import discrete_actions
+    from synthetic_env import SyntheticRoomNavTask
+    task = SyntheticRoomNavTask(list(range(args['n_house'])))
+    rng = np.random.RandomState(0)
+    move_actions = [a for a, (det_fwd, det_hor, _) in enumerate(discrete_actions) if (det_fwd != 0) or (det_hor != 0)]
+    n_moved = dict([(a, 0) for a in move_actions])
+    for _ in range(n_trials):
+        task.reset()
+        for a in move_actions:
+            task.set_state(dict(loc=task.house.to_coor(task._node), yaw=rng.randint(task.house.n_yaw) * 360.0 / task.house.n_yaw))
+            state = (task._loc, task._yaw_ind)
+            task.step(a)
+            moved = (task._loc, task._yaw_ind) != state
+            assert moved or task.collision_flag, 'action {} neither moved nor collided!'.format(a)
+            n_moved[a] += int(moved)
+    logger.print('>> Move Check: fraction of moves that changed the agent state (the rest collided) ...')
+    for a in move_actions:
+        logger.print('   --> action %2d %s: %.3f' % (a, discrete_actions[a], n_moved[a] / n_trials))
+        assert n_moved[a] > 0, 'action {} never changes the agent state!'.format(a)
+
+
+def check_insight(args, logger, n_trials=200, max_steps=100):
+    """
+    the <see> termination of the motions must agree with the success of the synthetic environment
+    """
+    from House3D.roomnav import discrete_actions
+    from synthetic_env import SyntheticRoomNavTask
+    task = SyntheticRoomNavTask(list(range(args['n_house'])))
+    motion = BaseMotion(task, None, term_measure='see')
+    rng = np.random.RandomState(0)
+    n_check = n_insight = 0
+    for _ in range(n_trials):
+        task.reset()
+        for _ in range(max_steps):
+            _, _, done, _ = task.step(rng.randint(len(discrete_actions)))
+            target = task.get_current_target()
+            flag = motion._is_success(common.target_instruction_dict[target], task.get_feature_mask(),
+                                      term_measure='see', target_name=target)
+            assert flag == task._is_success(), 'motion insight {} differs from the task success!'.format(flag)
+            n_check += 1
+            n_insight += int(flag)
+            if done: break
+    logger.print('>> Insight Check: %d states, %d with the target in sight' % (n_check, n_insight))
+
+
+def benchmark(args):
+    work_dir = args['work_dir'] or tempfile.mkdtemp(prefix='house_nav_benchmark_')
+    logger = utils.MyLogger(work_dir, True, filename='benchmark_log.txt')
+    check_moves(args, logger)
+    check_insight(args, logger)
+    entries = args['entries'].split(',')
+    results = []
+    for entry in entries:
+        assert entry in entry_scripts, 'Invalid entry <{}>'.format(entry)
+        entry_dir = os.path.join(work_dir, entry)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir)
+        result_file = os.path.join(entry_dir, 'result.json')
+        if os.path.exists(result_file):
+            os.remove(result_file)
+        cmd = [sys.executable, os.path.abspath(__file__), '--child-entry', entry, '--result-file', result_file,
+               '--child-argv', json.dumps(get_entry_argv(entry, args, entry_dir))]
+        logger.print('>> Running <{}> ...'.format(entry))
+        ts = time.time()
+        try:
+            subprocess.run(cmd, timeout=args['timeout'],
+                           stdout=None if args['verbose'] else subprocess.DEVNULL,
+                           stderr=None if args['verbose'] else subprocess.DEVNULL)
+        except subprocess.TimeoutExpired:
+            logger.print('   [Warning] <{}> timed out after {}s!'.format(entry, args['timeout']))
+        if os.path.exists(result_file):
+            with open(result_file, 'r') as f:
+                res = json.load(f)
+        else:
+            res = dict(entry=entry, wall_time=time.time() - ts, loop_time=0, steps=0, updates=0,
+                       steps_per_sec=0, updates_per_sec=0, stages=dict(), error='no result (crashed or timed out)')
+        print_result(logger, res)
+        results.append(res)
+    with open(os.path.join(work_dir, 'benchmark_results.json'), 'w') as f:
+        json.dump(results, f)
+    logger.print('>> Results saved to <{}>'.format(os.path.join(work_dir, 'benchmark_results.json')))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("End-to-End Throughput Benchmark on the Synthetic Environment")
+    parser.add_argument("--entries", type=str, default=','.join(all_entries),
+                        help="comma separated list of entry points in <zmq_train>, <train>, <eval>, <eval_HRL>")
+    parser.add_argument("--segmentation-input", choices=['none', 'color', 'joint'], default='none')
+    parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'], default='normal')
+    parser.add_argument("--depth-input", dest='depth_input', action='store_true')
+    parser.set_defaults(depth_input=False)
+    parser.add_argument("--n-house", type=int, default=4, help="number of synthetic houses")
+    parser.add_argument("--episode-len", type=int, default=30, help="maximum episode length")
+    parser.add_argument("--episodes", type=int, default=20, help="number of episodes for <train>, <eval> and <eval_HRL>")
+    parser.add_argument("--updates", type=int, default=20, help="number of updates for <zmq_train>")
+    parser.add_argument("--n-proc", type=int, default=4, help="[zmq_train] number of simulator processes, also the batch size")
+    parser.add_argument("--t-max", type=int, default=5, help="[zmq_train] number of time steps in each training batch")
+    parser.add_argument("--batch-size", type=int, default=32, help="[train] batch size")
+    parser.add_argument("--rnn-units", type=int, default=64, help="number of units in an RNN cell")
+    parser.add_argument("--n-exp-steps", type=int, default=10, help="[eval_HRL] maximum number of steps of a sub-policy")
+    parser.add_argument("--timeout", type=int, default=1800, help="timeout in seconds for each entry point")
+    parser.add_argument("--work-dir", type=str, help="folder for logs and results, default a temporary folder")
+    parser.add_argument("--verbose", dest='verbose', action='store_true', help="when set, show the outputs of the entry points")
+    parser.set_defaults(verbose=False)
+    # internal options for the child processes
+    parser.add_argument("--child-entry", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--child-argv", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", type=str, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    if cmd_args.child_entry is not None:
+        run_entry(cmd_args.child_entry, json.loads(cmd_args.child_argv), cmd_args.result_file)
+        os._exit(0)   # do not wait for the zmq sockets and the daemon threads
+    benchmark(cmd_args.__dict__)
@@ -0,0 +1,124 @@
+from headers import *
+import common
+import utils
+
+import sys, os, argparse, time
+
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+from policy.attentive_cnn_actor_critic import AttentiveJointCNNPolicyCritic
+
+"""
+Benchmark of Attention Masking in AttentiveJointCNNPolicyCritic (on CPU)
+  --> <loop>: the previous per-channel masking, slicing and stacking the channels one by one
+      <vectorized>: AttentiveJointCNNPolicyCritic._apply_attention, one broadcasted multiply over all the channels
+  --> checks that both produce the same masked input and the same forward outputs,
+      then reports the latency of the masking step and of a full forward
+"""
+
+
+def loop_attention(model, x, all_att_mask):
+    # reference: the per-channel implementation replaced by _apply_attention
+    batch_size = x.size(0)
+    batched_att_index = Variable(model.att_index.view(1, -1)).expand(batch_size, model.inp_shape[1] * model.inp_shape[2])
+    cur_inp_mask = None
+    att_x_slides = []
+    for c in range(model.inp_shape[0]):
+        c_i = c % model.att_chn
+        c_head = c // model.att_chn
+        if c_i == 0:
+            cur_att_mask = all_att_mask[:, c_head, :]
+            cur_inp_mask = torch.gather(cur_att_mask, 1, batched_att_index)
+            cur_inp_mask = cur_inp_mask.view(-1, model.inp_shape[1], model.inp_shape[2])
+        cur_slide = x[:, c, :, :]
+        if c_i >= model.att_focus:
+            att_x_slides.append(cur_slide)
+        else:
+            att_x_slides.append(cur_slide * cur_inp_mask)
+    return torch.stack(att_x_slides, dim=1)
+
+
+def create_model(args, inp_shape):
+    return AttentiveJointCNNPolicyCritic(inp_shape, common.action_shape,
+                                         cnn_hiddens=[64, 64, 128, 128],
+                                         linear_hiddens=[512],
+                                         policy_hiddens=[],
+                                         transform_hiddens=[],
+                                         critic_hiddens=[100, 32],
+                                         kernel_sizes=5, strides=2,
+                                         activation=F.relu,
+                                         use_batch_norm=False,
+                                         attention_dim=common.attention_resolution_dict[args.att_resolution],
+                                         shared_cnn=True,
+                                         attention_chn=args.frame_chn,
+                                         attention_skip=args.att_skip,
+                                         attention_hiddens=[128])
+
+
+def timeit(func, n_iter, warmup):
+    timing = []
+    for it in range(warmup + n_iter):
+        ts = time.time()
+        func()
+        if it >= warmup:
+            timing.append(time.time() - ts)
+    return np.array(timing) * 1000
+
+
+def benchmark(args):
+    common.debugger = utils.FakeLogger()
+    resolution = common.resolution_dict[args.resolution]
+    inp_shape = (args.frame_chn * args.history_frame_len, resolution[0], resolution[1])
+    model = create_model(args, inp_shape)
+    model.eval()
+    x = Variable(torch.rand(args.batch_size, *inp_shape), volatile=True)
+    mask = F.softmax(Variable(torch.randn(args.batch_size * model.att_heads, model.att_blocks), volatile=True))
+    mask = mask.view(args.batch_size, model.att_heads, model.att_blocks)
+
+    # equivalence
+    diff = torch.max(torch.abs(loop_attention(model, x, mask).data - model._apply_attention(x, mask).data))
+    print('>> Max |mask(loop) - mask(vectorized)| = %.3e' % diff)
+    out_vec = model(x, gumbel_noise=None).data
+    model._apply_attention = lambda _x, _m: loop_attention(model, _x, _m)
+    out_loop = model(x, gumbel_noise=None).data
+    del model._apply_attention
+    print('>> Max |forward(loop) - forward(vectorized)| = %.3e' % torch.max(torch.abs(out_vec - out_loop)))
+    assert diff == 0, 'vectorized attention must match the per-channel implementation'
+
+    print('>> Batch = %d, Input = %s, #heads = %d, #blocks = %d, skipped channels per frame = %d, torch threads = %d'
+          % (args.batch_size, inp_shape, model.att_heads, model.att_blocks, args.att_skip, torch.get_num_threads()))
+    for name, func in [('loop', lambda: loop_attention(model, x, mask)),
+                       ('vectorized', lambda: model._apply_attention(x, mask))]:
+        t = timeit(func, args.iters, args.warmup)
+        print('  masking  %-10s: mean = %.3fms, median = %.3fms, P90 = %.3fms' % (name, np.mean(t), np.median(t), np.percentile(t, 90)))
+    t_vec = timeit(lambda: model(x, gumbel_noise=None), args.iters, args.warmup)
+    model._apply_attention = lambda _x, _m: loop_attention(model, _x, _m)
+    t_loop = timeit(lambda: model(x, gumbel_noise=None), args.iters, args.warmup)
+    del model._apply_attention
+    for name, t in [('loop', t_loop), ('vectorized', t_vec)]:
+        print('  forward  %-10s: mean = %.3fms, median = %.3fms, P90 = %.3fms' % (name, np.mean(t), np.median(t), np.percentile(t, 90)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark of Attention Masking in AttentiveJointCNNPolicyCritic")
+    parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'], default='normal')
+    parser.add_argument("--att-resolution", choices=['normal', 'low', 'high', 'tiny', 'row', 'row_low', 'row_tiny'], default='normal')
+    parser.add_argument("--frame-chn", type=int, default=4, help="channels per frame, e.g., 4 for rgb + depth")
+    parser.add_argument("--att-skip", type=int, default=1, help="channels per frame skipped by the attention, e.g., 1 for depth")
+    parser.add_argument("--history-frame-len", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    np.random.seed(cmd_args.seed)
+    torch.manual_seed(cmd_args.seed)
+    benchmark(cmd_args)
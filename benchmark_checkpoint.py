@@ -0,0 +1,136 @@
+import checkpoint
+
+import sys, os, argparse, time, signal, shutil
+import multiprocessing as mp
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+"""
+Benchmark and Crash-Consistency Check of the Checkpoint Writer
+  --> stall: time spent in the training thread by a synchronous torch.save vs. checkpoint.CheckpointWriter.save
+      (snapshot only), and the time until the background write is done
+  --> crash: a child process saves the same path in a loop (every tensor filled with the save index) and is
+      killed with SIGKILL at a random time; the checkpoint must then load, and hold a single save index
+      (never a partial or mixed file), and the kept backups must hold strictly older indices
+"""
+
+
+def create_model(args):
+    layers = []
+    for _ in range(args.n_layers):
+        layers += [nn.Linear(args.hidden, args.hidden), nn.ReLU()]
+    model = nn.Sequential(*layers)
+    if args.cuda:
+        model.cuda()
+    return model
+
+
+def fill(model, v):
+    for p in model.parameters():
+        p.data.fill_(v)
+
+
+def saved_index(filename):
+    data = torch.load(filename, map_location=lambda storage, loc: storage)
+    vals = set()
+    for t in data.values():
+        vals.update(np.unique(t.cpu().numpy()).tolist())
+    assert len(vals) == 1, 'mixed checkpoint <{}>: values = {}'.format(filename, sorted(vals)[:10])
+    return int(vals.pop())
+
+
+def benchmark_stall(args, work_dir):
+    model = create_model(args)
+    n_param = sum([p.numel() for p in model.parameters()])
+    print('>> #params = %d (%.1f MB), CUDA = %s' % (n_param, n_param * 4 / 1e6, args.cuda))
+    writer = checkpoint.CheckpointWriter()
+    sync_t, async_t, write_t = [], [], []
+    for it in range(args.iters):
+        fill(model, it)
+        ts = time.time()
+        torch.save(model.state_dict(), os.path.join(work_dir, 'sync.pkl'))
+        sync_t.append(time.time() - ts)
+        ts = time.time()
+        assert writer.save(model.state_dict(), os.path.join(work_dir, 'async.pkl'))
+        async_t.append(time.time() - ts)
+        fill(model, -1)  # training goes on, must not change the snapshot
+        writer.wait()
+        write_t.append(time.time() - ts)
+        assert saved_index(os.path.join(work_dir, 'async.pkl')) == it
+    for name, t in [('torch.save (sync)', sync_t), ('writer.save (stall)', async_t), ('writer.save (until written)', write_t)]:
+        t = np.array(t) * 1000
+        print('  %-28s: mean = %.2fms, median = %.2fms, P90 = %.2fms' % (name, np.mean(t), np.median(t), np.percentile(t, 90)))
+    # overlapping saves of the same path are refused
+    fill(model, 0)
+    filename = os.path.join(work_dir, 'overlap.pkl')
+    results = [writer.save(model.state_dict(), filename) for _ in range(3)]
+    writer.wait()
+    print('  overlapping saves of the same path: accepted = {}'.format(results))
+    assert results[0]
+
+
+def _crash_child(args, filename, keep_last):
+    torch.manual_seed(0)
+    args.cuda = False
+    model = create_model(args)
+    writer = checkpoint.CheckpointWriter(keep_last=keep_last)
+    v = 1
+    while True:
+        if writer.is_pending(filename):
+            time.sleep(0.001)
+            continue
+        fill(model, v)
+        assert writer.save(model.state_dict(), filename)
+        v += 1
+
+
+def check_crash(args, work_dir):
+    rs = np.random.RandomState(args.seed)
+    ctx = mp.get_context('fork')
+    filename = os.path.join(work_dir, 'crash.pkl')
+    model = create_model(argparse.Namespace(n_layers=args.n_layers, hidden=args.hidden, cuda=False))
+    fill(model, 0)
+    checkpoint.write_atomic(model.state_dict(), filename, keep_last=args.keep_last)
+    last, n_new = 0, 0
+    for trial in range(args.crash_trials):
+        proc = ctx.Process(target=_crash_child, args=(args, filename, args.keep_last))
+        proc.start()
+        time.sleep(rs.uniform(0.05, args.max_crash_delay))
+        os.kill(proc.pid, signal.SIGKILL)
+        proc.join()
+        idx = saved_index(filename)  # must load and be consistent
+        backups = [saved_index('{}.{}'.format(filename, i)) for i in range(1, args.keep_last)
+                   if os.path.exists('{}.{}'.format(filename, i))]
+        assert all([b < idx for b in backups]), 'backups must be older: {} vs {}'.format(backups, idx)
+        n_new += int(idx != last)
+        last = idx
+    print('  crash-consistency: %d SIGKILL trials passed (%d with a new checkpoint), keep_last = %d'
+          % (args.crash_trials, n_new, args.keep_last))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark and Crash-Consistency Check of the Checkpoint Writer")
+    parser.add_argument("--n-layers", type=int, default=8)
+    parser.add_argument("--hidden", type=int, default=1024)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--crash-trials", type=int, default=20)
+    parser.add_argument("--max-crash-delay", type=float, default=1.0, help="seconds before the child is killed")
+    parser.add_argument("--keep-last", type=int, default=3)
+    parser.add_argument("--work-dir", type=str, default="./_checkpoint_benchmark_")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cuda", action='store_true', dest='cuda')
+    parser.set_defaults(cuda=False)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    if not os.path.exists(cmd_args.work_dir):
+        os.makedirs(cmd_args.work_dir)
+    try:
+        benchmark_stall(cmd_args, cmd_args.work_dir)
+        check_crash(cmd_args, cmd_args.work_dir)
+    finally:
+        shutil.rmtree(cmd_args.work_dir, ignore_errors=True)
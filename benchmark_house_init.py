@@ -0,0 +1,81 @@
+from headers import *
+import common
+
+import sys, os, argparse, time, tempfile, shutil
+
+import numpy as np
+
+"""
+Multi-House Initialization Benchmark
+  --> builds the first <n_house> houses of the environment set serially and with the worker pool
+      of common.create_houses_parallel, and reports the speedup
+  --> the rehydrated houses are checked against the serially built ones
+NOTE:
+  --> the speedup on the <train> set has not been measured yet, so common.house_init_workers stays 0 (serial)
+      by default; report the summary of this benchmark before enabling the pool by default
+"""
+
+
+def _compare_houses(h1, h2):
+    # return the names of house attributes that differ
+    diff = []
+    for key, val in h1.__dict__.items():
+        other = h2.__dict__.get(key, None)
+        if isinstance(val, np.ndarray):
+            if (not isinstance(other, np.ndarray)) or (val.shape != other.shape) or (not np.array_equal(val, other)):
+                diff.append(key)
+    return diff
+
+
+def benchmark(args):
+    house_ids = common.all_houseIDs[:args.n_house]
+    flags = (args.gen_room_type_map, args.cache_all_target, True)
+    print('>> Building {} Houses Serially ...'.format(len(house_ids)))
+    ts = time.time()
+    serial_houses = [common.create_house(h, *flags) for h in house_ids]
+    serial_time = time.time() - ts
+    print('  -> Serial Time = %.3fs' % serial_time)
+    results = []
+    for n_workers in map(int, args.workers.split(',')):
+        print('>> Building {} Houses with {} Workers ...'.format(len(house_ids), n_workers))
+        if args.use_store:
+            store_dir = tempfile.mkdtemp(prefix='house_store_')
+            common.set_house_store(store_dir)
+        ts = time.time()
+        houses = common.create_houses_parallel(house_ids, *flags, n_workers=n_workers)
+        dur = time.time() - ts
+        if args.use_store:
+            common.set_house_store(None)
+            shutil.rmtree(store_dir, ignore_errors=True)
+        n_diff = sum([len(_compare_houses(h1, h2)) > 0 for h1, h2 in zip(serial_houses, houses)])
+        print('  -> Parallel Time = %.3fs, Speedup = %.2fx, #Mismatched Houses = %d' % (dur, serial_time / dur, n_diff))
+        results.append((n_workers, dur, n_diff))
+        del houses
+    print('========== Summary (%d houses, env-set = %s) ==========' % (len(house_ids), args.env_set))
+    print('  serial        : %.3fs' % serial_time)
+    for n_workers, dur, n_diff in results:
+        print('  %2d workers    : %.3fs (%.2fx)%s' % (n_workers, dur, serial_time / dur,
+                                                   '' if n_diff == 0 else ' [%d mismatched houses]' % n_diff))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark of Parallel Multi-House Initialization")
+    parser.add_argument("--env-set", choices=['small', 'train', 'test', 'color'], default='train')
+    parser.add_argument("--n-house", type=int, default=32, help="number of houses to build")
+    parser.add_argument("--workers", type=str, default='2,4,8', help="comma separated numbers of workers to test")
+    parser.add_argument("--gen-room-type-map", dest='gen_room_type_map', action='store_true')
+    parser.set_defaults(gen_room_type_map=False)
+    parser.add_argument("--no-cache-all-target", dest='cache_all_target', action='store_false',
+                        help="when set, do not cache the maps of all targets")
+    parser.set_defaults(cache_all_target=True)
+    parser.add_argument("--use-store", dest='use_store', action='store_true',
+                        help="when set, workers write into a house map store (see house_store.py) instead of a temporary one")
+    parser.set_defaults(use_store=False)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    common.set_house_IDs(cmd_args.env_set)
+    print('>> Environment Set = <%s>, Total %d Houses!' % (cmd_args.env_set, len(common.all_houseIDs)))
+    benchmark(cmd_args)
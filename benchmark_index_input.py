@@ -0,0 +1,127 @@
+from headers import *
+import common
+import utils
+
+import sys, os, argparse, time
+
+import numpy as np
+
+from policy.rnn_discrete_actor_critic import DiscreteRNNPolicy
+
+"""
+Benchmark of Index Segmentation Input
+  --> compares three ways to feed index segmentation frames to DiscreteRNNPolicy:
+      <host>: one-hot float frames built on the host and uploaded (n_segmentation_mask float channels)
+      <scatter>: uint8 frames uploaded and scattered into a cached one-hot float tensor on the device
+                 (as AgentTrainer._process_frames)
+      <device>: uint8 frames uploaded and expanded inside the policy (see policy/index_embedding.py)
+  --> reports the host-to-device bytes per batch and the latency of upload + expansion + forward
+"""
+
+
+def create_policy(args, index_input):
+    model = DiscreteRNNPolicy(common.observation_shape, common.n_discrete_actions,
+                              conv_hiddens=[64, 64, 128, 128],
+                              kernel_sizes=5, strides=2,
+                              linear_hiddens=[256],
+                              policy_hiddens=[128, 64],
+                              critic_hiddens=[64, 32],
+                              rnn_units=args.rnn_units,
+                              index_input=index_input,
+                              index_embed_dim=args.index_embed_dim)
+    if use_cuda:
+        model.cuda()
+    model.eval()
+    return model
+
+
+def prepare_host(raw):
+    # raw: [batch, seq_len, n, m, 1] uint8
+    onehot = np.zeros(raw.shape[:4] + (n_segmentation_mask,), dtype=np.float32)
+    idx = raw[..., 0].astype(np.int64)
+    valid = idx < n_segmentation_mask
+    b, t, i, j = np.nonzero(valid)
+    onehot[b, t, i, j, idx[valid]] = 1
+    return torch.from_numpy(onehot).type(FloatTensor).permute(0, 1, 4, 2, 3).contiguous()
+
+
+def prepare_scatter(raw, cache):
+    batch, seq_len, n, m = raw.shape[:4]
+    if (cache.get('frames') is None) or (cache['frames'].size(0) != batch):
+        cache['frames'] = torch.zeros(batch, seq_len, n, m, n_segmentation_mask).type(FloatTensor)
+    frames = cache['frames']
+    frames.zero_()
+    indexes = torch.from_numpy(raw).type(ByteTensor)
+    src = (indexes < n_segmentation_mask).type(ByteTensor).type(FloatTensor)
+    frames.scatter_(-1, indexes.type(LongTensor), src)
+    return frames.permute(0, 1, 4, 2, 3).contiguous()
+
+
+def prepare_device(raw):
+    return torch.from_numpy(raw).type(ByteTensor).permute(0, 1, 4, 2, 3)
+
+
+def run(args, mode, model, raw, n_iter):
+    batch, seq_len = raw.shape[:2]
+    cache = dict()
+    hidden = model.get_zero_state(batch=batch, return_variable=True, volatile=True)
+    timing = []
+    for it in range(args.warmup + n_iter):
+        ts = time.time()
+        if mode == 'host':
+            x = prepare_host(raw)
+        elif mode == 'scatter':
+            x = prepare_scatter(raw, cache)
+        else:
+            x = prepare_device(raw)
+        model(Variable(x, volatile=True), hidden, return_value=False)
+        if use_cuda: torch.cuda.synchronize()
+        if it >= args.warmup:
+            timing.append(time.time() - ts)
+    return np.array(timing)
+
+
+def benchmark(args):
+    common.process_observation_shape('rnn', args.resolution,
+                                     segmentation_input='index',
+                                     depth_input=False,
+                                     history_frame_len=1)
+    n, m = common.observation_shape[1], common.observation_shape[2]
+    raw = np.random.randint(0, n_segmentation_mask + 1, size=(args.batch_size, args.seq_len, n, m, 1)).astype(np.uint8)
+    pixels = args.batch_size * args.seq_len * n * m
+    transfer = dict(host=pixels * n_segmentation_mask * 4, scatter=pixels, device=pixels)
+    models = dict(host=create_policy(args, False), scatter=None, device=create_policy(args, True))
+    models['scatter'] = models['host']
+    if args.index_embed_dim is None:
+        # identical weights, so the outputs must match
+        models['device'].load_state_dict(models['host'].state_dict())
+        h = models['host'].get_zero_state(batch=args.batch_size, return_variable=True, volatile=True)
+        out_host = models['host'](Variable(prepare_host(raw), volatile=True), h, return_value=False, return_logits=True)[0]
+        out_device = models['device'](Variable(prepare_device(raw), volatile=True), h, return_value=False, return_logits=True)[0]
+        print('>> Max |logits(host) - logits(device)| = %.3e' % torch.max(torch.abs(out_host.data - out_device.data)))
+    print('>> Batch = %d x %d frames of %d x %d, CUDA = %s, %s expansion' %
+          (args.batch_size, args.seq_len, n, m, use_cuda, 'one-hot' if args.index_embed_dim is None else 'embedding(%d)' % args.index_embed_dim))
+    for mode in ['host', 'scatter', 'device']:
+        t = run(args, mode, models[mode], raw, args.iters) * 1000
+        print('  %-8s: transfer = %8.1f KB / batch, latency mean = %.3fms, median = %.3fms, P90 = %.3fms'
+              % (mode, transfer[mode] / 1024.0, np.mean(t), np.median(t), np.percentile(t, 90)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark of Index Segmentation Input for DiscreteRNNPolicy")
+    parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'], default='normal')
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--seq-len", type=int, default=20, help="number of time steps per sample, e.g. --t-max of zmq_train")
+    parser.add_argument("--rnn-units", type=int, default=256)
+    parser.add_argument("--index-embed-dim", type=int, help="when set, benchmark a learned embedding instead of one-hot")
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    np.random.seed(cmd_args.seed)
+    torch.manual_seed(cmd_args.seed)
+    benchmark(cmd_args)
@@ -0,0 +1,152 @@
+import returns
+
+import sys, os, argparse, time
+
+import numpy as np
+import torch
+
+"""
+Equivalence Check and Benchmark of returns.py
+  --> compares returns.discounted_returns / gae / discount_with_dones against the python loops they replaced:
+        <a3c>: the loop of ZMQA3CTrainer.update (and ZMQAuxTaskTrainer.update)
+        <planner>: the loop of RNNPlanner._perform_train
+        <dones>: the previous utils.discount_with_dones
+        <gae>: the textbook GAE loop
+      with random done masks and lengths T on both sides of returns.scan_block, in float32 and float64
+  --> fails (assert) when the max difference, relative to the magnitude of the result, exceeds the tolerance
+  --> reports the latency of the loop and of the scan for the A3C setting
+"""
+
+
+def legacy_a3c_returns(rew, mask, gamma, nxt_val):
+    # ZMQA3CTrainer.update
+    t_max = rew.size(1)
+    R = []
+    cur_R = nxt_val.squeeze()  # [batch]
+    for t in range(t_max-1, -1, -1):
+        cur_mask = mask[:, t]
+        cur_R = rew[:, t] + gamma * cur_R * cur_mask
+        R.append(cur_R)
+    R.reverse()
+    return torch.stack(R, dim=1)  # [batch, t_max]
+
+
+def legacy_planner_returns(Rew, Done, gamma, V_data):
+    # RNNPlanner._perform_train, V_data: [batch, seq_len + 1]
+    seq_len = Rew.size(1)
+    cur_r = V_data[:, seq_len]
+    R_list = []
+    for t in range(seq_len - 1, -1, -1):
+        cur_r = Rew[:, t] + gamma * Done[:, t] * cur_r
+        R_list.append(cur_r)
+    R_list.reverse()
+    return torch.stack(R_list, dim=1)
+
+
+def legacy_discount_with_dones(rewards, dones, gamma):
+    # utils.discount_with_dones
+    discounted = []
+    r = 0
+    for reward, done in zip(rewards[::-1], dones[::-1]):
+        r = reward + gamma*r
+        r = r*(1.-done)
+        discounted.append(r)
+    return discounted[::-1]
+
+
+def legacy_gae(rew, values, next_value, mask, gamma, lam):
+    T = rew.size(1)
+    adv = []
+    cur_A = rew.new(rew.size(0)).zero_()
+    nxt_V = next_value.contiguous().view(-1)
+    for t in range(T - 1, -1, -1):
+        delta = rew[:, t] + gamma * mask[:, t] * nxt_V - values[:, t]
+        cur_A = delta + gamma * lam * mask[:, t] * cur_A
+        adv.append(cur_A)
+        nxt_V = values[:, t]
+    adv.reverse()
+    return torch.stack(adv, dim=1)
+
+
+def _check(name, ref, val, dtype, stats):
+    ref = np.asarray(ref, dtype=np.float64)
+    val = np.asarray(val, dtype=np.float64)
+    assert ref.shape == val.shape, '[{}] shape mismatch: {} vs {}'.format(name, ref.shape, val.shape)
+    err = np.max(np.abs(ref - val)) / (1.0 + np.max(np.abs(ref))) if ref.size > 0 else 0.0
+    tol = 1e-5 if dtype == np.float32 else 1e-12
+    assert err <= tol, '[{}] relative error {} > {} ({})'.format(name, err, tol, dtype)
+    stats[(name, dtype)] = max(stats.get((name, dtype), 0.0), err)
+
+
+def check_equivalence(args):
+    rs = np.random.RandomState(args.seed)
+    stats = dict()
+    lengths = [int(t) for t in args.lengths.split(',')]
+    n_case = 0
+    for dtype in [np.float32, np.float64]:
+        for T in lengths:
+            for batch in [1, args.batch]:
+                for p_done in [0.0, 0.05, 0.5]:
+                    gamma, lam = rs.uniform(0.9, 1.0), rs.uniform(0.8, 1.0)
+                    rew = torch.from_numpy(rs.randn(batch, T).astype(dtype))
+                    mask = torch.from_numpy((rs.rand(batch, T) >= p_done).astype(dtype))
+                    V_data = torch.from_numpy(rs.randn(batch, T + 1).astype(dtype))
+                    nxt_val = V_data[:, T:].contiguous()  # [batch, 1] as the output of the value head
+                    R = returns.discounted_returns(rew, mask, gamma, bootstrap=nxt_val)
+                    _check('a3c', legacy_a3c_returns(rew, mask, gamma, nxt_val).view(batch, T), R, dtype, stats)
+                    R = returns.discounted_returns(rew, mask, gamma, bootstrap=V_data[:, T])
+                    _check('planner', legacy_planner_returns(rew, mask, gamma, V_data), R, dtype, stats)
+                    A = returns.gae(rew, V_data[:, :T].contiguous(), nxt_val, mask, gamma, lam)
+                    _check('gae', legacy_gae(rew, V_data[:, :T], nxt_val, mask, gamma, lam), A, dtype, stats)
+                    # GAE with lambda = 1 is the A3C advantage R - V
+                    A = returns.gae(rew, V_data[:, :T].contiguous(), nxt_val, mask, gamma, 1.0)
+                    _check('gae(1)', legacy_a3c_returns(rew, mask, gamma, nxt_val).view(batch, T) - V_data[:, :T], A, dtype, stats)
+                    if (dtype == np.float64) and (batch == 1):  # numpy, float64 only
+                        r, d = rew.numpy()[0].tolist(), (1 - mask.numpy()[0]).tolist()
+                        _check('dones', legacy_discount_with_dones(r, d, gamma), returns.discount_with_dones(r, d, gamma),
+                               dtype, stats)
+                    n_case += 1
+    print('>> Equivalence: %d cases passed, T in %s, scan_block = %d' % (n_case, lengths, returns.scan_block))
+    for (name, dtype), err in sorted(stats.items(), key=lambda x: (x[0][0], x[0][1].__name__)):
+        print('  %-8s %-8s: max relative error = %.3e' % (name, dtype.__name__, err))
+
+
+def benchmark(args):
+    rs = np.random.RandomState(args.seed)
+    rew = torch.from_numpy(rs.randn(args.batch, args.t_max).astype(np.float32))
+    mask = torch.from_numpy((rs.rand(args.batch, args.t_max) > 0.05).astype(np.float32))
+    nxt_val = torch.from_numpy(rs.randn(args.batch, 1).astype(np.float32))
+    if args.cuda:
+        rew, mask, nxt_val = rew.cuda(), mask.cuda(), nxt_val.cuda()
+    print('>> Latency: batch = %d, t_max = %d, CUDA = %s' % (args.batch, args.t_max, args.cuda))
+    for name, func in [('loop', lambda: legacy_a3c_returns(rew, mask, 0.95, nxt_val)),
+                       ('scan', lambda: returns.discounted_returns(rew, mask, 0.95, bootstrap=nxt_val))]:
+        timing = []
+        for it in range(args.warmup + args.iters):
+            ts = time.time()
+            func()
+            if args.cuda: torch.cuda.synchronize()
+            if it >= args.warmup:
+                timing.append(time.time() - ts)
+        t = np.array(timing) * 1000
+        print('  %-4s: mean = %.3fms, median = %.3fms, P90 = %.3fms' % (name, np.mean(t), np.median(t), np.percentile(t, 90)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Equivalence Check and Benchmark of returns.py")
+    parser.add_argument("--lengths", type=str, default='1,2,7,20,127,128,129,255,256,257,300,600',
+                        help="comma separated sequence lengths T of the equivalence check")
+    parser.add_argument("--batch", type=int, default=16)
+    parser.add_argument("--t-max", type=int, default=20, help="sequence length of the latency benchmark")
+    parser.add_argument("--iters", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cuda", action='store_true', dest='cuda')
+    parser.set_defaults(cuda=False)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    check_equivalence(cmd_args)
+    benchmark(cmd_args)
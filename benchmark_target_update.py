@@ -0,0 +1,95 @@
+from headers import *
+import common
+import utils
+
+import sys, os, argparse, time
+
+import numpy as np
+
+from policy.rnn_discrete_actor_critic import DiscreteRNNPolicy
+
+"""
+Benchmark of Target Network Update
+  --> compares the soft update of a target network by
+      <state_dict>: rebuilding the state dict of the target and calling load_state_dict (the previous make_update_exp)
+      <in-place>: utils.TargetNetUpdater, in-place mul_/add_ over the pre-paired parameters and buffers
+  --> reports the latency per update and the max difference of the two results
+"""
+
+
+def legacy_update_exp(vals, target_vals, rate=1e-3):
+    target_dict = target_vals.state_dict()
+    val_dict = vals.state_dict()
+    for k in target_dict.keys():
+        target_dict[k] = target_dict[k] * (1 - rate) + rate * val_dict[k]
+    target_vals.load_state_dict(target_dict)
+
+
+def create_policy(args):
+    model = DiscreteRNNPolicy(common.observation_shape, common.n_discrete_actions,
+                              conv_hiddens=[64, 64, 128, 128],
+                              kernel_sizes=5, strides=2,
+                              linear_hiddens=[256],
+                              policy_hiddens=[128, 64],
+                              critic_hiddens=[64, 32],
+                              rnn_units=args.rnn_units)
+    if use_cuda:
+        model.cuda()
+    return model
+
+
+def run(update_func, n_iter, warmup):
+    timing = []
+    for it in range(warmup + n_iter):
+        ts = time.time()
+        update_func()
+        if use_cuda: torch.cuda.synchronize()
+        if it >= warmup:
+            timing.append(time.time() - ts)
+    return np.array(timing)
+
+
+def benchmark(args):
+    common.process_observation_shape('rnn', args.resolution,
+                                     segmentation_input='none',
+                                     depth_input=False,
+                                     history_frame_len=1)
+    net = create_policy(args)
+    target_a = create_policy(args)
+    target_a.load_state_dict(net.state_dict())
+    target_b = create_policy(args)
+    target_b.load_state_dict(net.state_dict())
+    # perturb the net so that the updates change the targets
+    for p in net.parameters():
+        p.data.add_(0.01, torch.randn(p.size()).type(type(p.data)))
+    updater = utils.TargetNetUpdater(net, target_b, rate=args.rate)
+
+    n_param = sum([p.numel() for p in net.parameters()])
+    print('>> Model = DiscreteRNNPolicy, #tensors = %d, #params = %d, CUDA = %s, rate = %g'
+          % (len(net.state_dict()), n_param, use_cuda, args.rate))
+    for name, func in [('state_dict', lambda: legacy_update_exp(net, target_a, rate=args.rate)),
+                       ('in-place', updater.update)]:
+        t = run(func, args.iters, args.warmup) * 1000
+        print('  %-10s: latency mean = %.3fms, median = %.3fms, P90 = %.3fms'
+              % (name, np.mean(t), np.median(t), np.percentile(t, 90)))
+    dict_a, dict_b = target_a.state_dict(), target_b.state_dict()
+    diff = max([torch.max(torch.abs(dict_a[k] - dict_b[k])) for k in dict_a.keys()])
+    print('>> Max |target(state_dict) - target(in-place)| = %.3e' % diff)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark of Target Network Update")
+    parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'], default='normal')
+    parser.add_argument("--rnn-units", type=int, default=256)
+    parser.add_argument("--rate", type=float, default=1e-3, help="soft update rate, i.e., --target-net-update-rate")
+    parser.add_argument("--iters", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    np.random.seed(cmd_args.seed)
+    torch.manual_seed(cmd_args.seed)
+    benchmark(cmd_args)
@@ -0,0 +1,97 @@
+from headers import *
+import common
+import utils
+
+import sys, os, argparse, time, random
+
+import numpy as np
+
+"""
+Benchmark of DDPG-Family Updates
+  --> measures updates/s of trainer.update() on a replay buffer of random frames,
+      with and without --reuse-trunk-feature (the trunk of the joint model runs once per batch in an update)
+  --> the trunk feature of the policy loss is reused by the critic loss, gradients are unchanged
+"""
+
+
+def create_args(cmd_args):
+    args = common.create_default_args(cmd_args.algo, cmd_args.model,
+                                      batch_size=cmd_args.batch_size,
+                                      use_batch_norm=cmd_args.use_batch_norm,
+                                      critic_penalty=0.001,
+                                      replay_buffer_size=cmd_args.buffer_size,
+                                      segmentation_input=cmd_args.segmentation_input,
+                                      resolution_level=cmd_args.resolution)
+    args['algo'] = cmd_args.algo
+    args['target_net_update_rate'] = None
+    args['target_net_update_freq'] = None
+    args['action_gating'] = False
+    args['residual_critic'] = False
+    args['multi_target'] = False
+    args['target_gating'] = False
+    args['att_shared_cnn'] = False
+    return args
+
+
+def fill_replay_buffer(trainer, args, seed):
+    rs = np.random.RandomState(seed)
+    frame_shape = (common.observation_shape[1], common.observation_shape[2], common.single_observation_shape[0])
+    n_frame = args['batch_size'] * args['episode_len'] + 1
+    for i in range(n_frame):
+        frame = rs.randint(0, 256, size=frame_shape).astype(np.uint8)
+        idx = trainer.process_observation(frame)
+        act = [np.eye(d, dtype=np.float32)[rs.randint(d)] for d in common.action_shape]
+        done = (i % args['episode_len'] == args['episode_len'] - 1)
+        trainer.process_experience(idx, act, rs.rand(), done, False, dict())
+
+
+def run(args, reuse, cmd_args):
+    args = dict(args)
+    args['reuse_trunk_feature'] = reuse
+    torch.manual_seed(cmd_args.seed)
+    trainer = common.create_trainer(args['algo'], args['model_name'], args)
+    fill_replay_buffer(trainer, args, cmd_args.seed)
+    timing = []
+    for it in range(cmd_args.warmup + cmd_args.iters):
+        trainer.sample_counter = args['update_freq']
+        np.random.seed(cmd_args.seed + it)  # same batches for both settings
+        random.seed(cmd_args.seed + it)     # the replay buffer samples with <random>
+        ts = time.time()
+        stats = trainer.update()
+        assert stats is not None, 'update skipped, the replay buffer is not large enough'
+        if it >= cmd_args.warmup:
+            timing.append(time.time() - ts)
+    return np.array(timing), stats
+
+
+def benchmark(cmd_args):
+    common.debugger = utils.FakeLogger()
+    args = create_args(cmd_args)
+    print('>> Algo = %s, Model = %s, Batch = %d, Observation = %s, CUDA = %s'
+          % (cmd_args.algo, cmd_args.model, cmd_args.batch_size, common.observation_shape, use_cuda))
+    for reuse in [False, True]:
+        t, stats = run(args, reuse, cmd_args)
+        print('  reuse_trunk_feature = %-5s: updates/s = %.3f, latency mean = %.2fms, median = %.2fms, P90 = %.2fms'
+              % (reuse, 1.0 / np.mean(t), np.mean(t) * 1000, np.median(t) * 1000, np.percentile(t, 90) * 1000))
+        print('      last update: ' + ', '.join(['%s = %.4f' % (k, stats[k]) for k in sorted(stats.keys())]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark of DDPG-Family Updates")
+    parser.add_argument("--algo", choices=['ddpg_joint'], default='ddpg_joint')
+    parser.add_argument("--model", choices=['cnn', 'attentive_cnn'], default='cnn')
+    parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'], default='normal')
+    parser.add_argument("--segmentation-input", choices=['none', 'index', 'color', 'joint'], default='none')
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--buffer-size", type=int, default=10000)
+    parser.add_argument("--batch-norm", action='store_true', dest='use_batch_norm')
+    parser.set_defaults(use_batch_norm=False)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    benchmark(cmd_args)
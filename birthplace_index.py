@@ -0,0 +1,181 @@
+import os, time, pickle, random
+
+import numpy as np
+
+"""
+Persisted Birthplace Index
+  --> per house, candidate birthplaces are grouped by strata (target, optimal plan length, optsteps)
+      and stored in <index_dir>/<houseID>.pkl, a house is indexed on its first use (or by build())
+      by sampling <n_samples> resets of the task, and loaded lazily afterwards
+  --> draw() samples a birthplace from the strata matching the given conditions, and reset_task() resets
+      the task to it via task.reset(target, reset_house=False, birthplace=(x, y)),
+      so an episode with a rare plan length or a small curriculum distance needs no rejection loop
+  --> the sampling settings (hardness, max_birthplace_steps, n_samples) are stored with each house,
+      a house indexed with different settings is re-indexed
+  --> with read_only=True (e.g., in the ZMQ simulators), houses are never indexed: a missing index file
+      or an index with different settings is an error, build the index offline with build_birthplace_index.py
+NOTE:
+  --> plan lengths are only indexed when the task supports get_optimal_plan(), otherwise plan length is -1
+"""
+
+
+class BirthplaceIndex(object):
+    def __init__(self, index_dir, n_samples=2000, max_birthplace_steps=None, logger=None, read_only=False):
+        """
+        index_dir: folder of the per-house index files
+        n_samples: number of task resets sampled to index a house
+        max_birthplace_steps: the max_birthplace_steps of the task while indexing a house, e.g., the final
+            curriculum distance; default None, the task settings are kept
+        read_only: when True, only load the existing index files and never index a house
+        """
+        self.index_dir = index_dir
+        self.n_samples = n_samples
+        self.max_birthplace_steps = max_birthplace_steps
+        self.logger = logger
+        self.read_only = read_only
+        self._houses = dict()  # houseID -> {target -> {(plan_len, optsteps) -> np.array([n, 2], float32)}}
+        if read_only:
+            assert os.path.isdir(index_dir), \
+                '[BirthplaceIndex] index folder <{}> not found! Build it with build_birthplace_index.py'.format(index_dir)
+        elif not os.path.exists(index_dir):
+            os.makedirs(index_dir, exist_ok=True)
+
+    def _log(self, msg):
+        if self.logger is not None:
+            self.logger.print(msg)
+        else:
+            print(msg)
+
+    def _settings(self, task):
+        max_steps = self.max_birthplace_steps if self.max_birthplace_steps is not None \
+            else getattr(task, 'max_birthplace_steps', None)
+        return dict(hardness=getattr(task, 'hardness', None), max_birthplace_steps=max_steps,
+                    n_samples=self.n_samples)
+
+    def _index_file(self, house_id):
+        return os.path.join(self.index_dir, '{}.pkl'.format(house_id))
+
+    def build(self, task, house_id):
+        """
+        index the house <house_id> by sampling task resets, the task is left in an arbitrary state
+        """
+        assert not self.read_only, '[BirthplaceIndex] cannot index house <{}> in read-only mode!'.format(house_id)
+        ts = time.time()
+        settings = self._settings(task)
+        if hasattr(task.env, 'all_houses'):
+            task.env.reset_house(house_id)
+        hardness, max_steps = getattr(task, 'hardness', None), getattr(task, 'max_birthplace_steps', None)
+        task.reset_hardness(settings['hardness'], max_birthplace_steps=settings['max_birthplace_steps'])
+        flag_plan = hasattr(task, 'get_optimal_plan')
+        strata = dict()
+        for _ in range(self.n_samples):
+            task.reset(reset_house=False)
+            info = task.info
+            target = task.get_current_target()
+            key = (len(task.get_optimal_plan()) if flag_plan else -1, info['optsteps'])
+            strata.setdefault(target, dict()).setdefault(key, set()).add(tuple(info['loc']))
+        task.reset_hardness(hardness, max_birthplace_steps=max_steps)
+        house_index = dict()
+        for target, target_strata in strata.items():
+            house_index[target] = dict([(key, np.array(sorted(locs), dtype=np.float32))
+                                        for key, locs in target_strata.items()])
+        tmp_file = self._index_file(house_id) + '.tmp%d' % os.getpid()
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(dict(index=house_index, settings=settings), f)
+        os.replace(tmp_file, self._index_file(house_id))
+        self._log('[BirthplaceIndex] House <%s> indexed: %d targets, %d strata, %d birthplaces, time = %.3fs'
+                  % (house_id, len(house_index), sum([len(s) for s in house_index.values()]),
+                     sum([len(b) for s in house_index.values() for b in s.values()]), time.time() - ts))
+        self._houses[house_id] = house_index
+        return house_index
+
+    def get(self, task, house_id=None):
+        """
+        return the index of the house (default the current house of the task), indexing it when necessary
+        """
+        if house_id is None:
+            house_id = task.house._id
+        if house_id in self._houses:
+            return self._houses[house_id]
+        filename = self._index_file(house_id)
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                data = pickle.load(f)
+            settings = self._settings(task)
+            if self.read_only:  # n_samples is a choice of the builder
+                del data['settings']['n_samples'], settings['n_samples']
+            if data['settings'] == settings:
+                self._houses[house_id] = data['index']
+                return data['index']
+            assert not self.read_only, \
+                '[BirthplaceIndex] index of house <{}> has settings {}, but {} is required! Re-build it with build_birthplace_index.py'.format(
+                    house_id, data['settings'], settings)
+            self._log('[BirthplaceIndex] Index of house <{}> has different settings, re-indexing!'.format(house_id))
+        assert not self.read_only, \
+            '[BirthplaceIndex] index file <{}> not found! Build it with build_birthplace_index.py'.format(filename)
+        return self.build(task, house_id)
+
+    def targets(self, task, house_id=None):
+        return list(self.get(task, house_id).keys())
+
+    def strata(self, task, target, house_id=None):
+        """
+        return the list of (plan_len, optsteps) with birthplaces for <target>
+        """
+        return list(self.get(task, house_id).get(target, dict()).keys())
+
+    def draw(self, task, target, house_id=None, plan_len=None, optsteps=None, max_optsteps=None):
+        """
+        draw a birthplace (x, y) uniformly from the strata of <target> matching the conditions, None when no candidates
+        """
+        keys = [k for k in self.strata(task, target, house_id)
+                if ((plan_len is None) or (k[0] == plan_len)) and ((optsteps is None) or (k[1] == optsteps))
+                and ((max_optsteps is None) or (k[1] <= max_optsteps))]
+        if len(keys) == 0:
+            return None
+        target_index = self.get(task, house_id)[target]
+        sizes = np.array([len(target_index[k]) for k in keys], dtype=np.float64)
+        key = keys[np.random.choice(len(keys), p=sizes / np.sum(sizes))]
+        x, y = target_index[key][np.random.randint(len(target_index[key]))]
+        return float(x), float(y)
+
+    def reset_task(self, task, target, house_id=None, **conditions):
+        """
+        reset the task with <target> at a birthplace drawn by draw(), return None when no candidates
+          --> conditions: plan_len, optsteps or max_optsteps, see draw()
+        """
+        if house_id is None:
+            house_id = task.house._id
+        loc = self.draw(task, target, house_id, **conditions)
+        if loc is None:
+            return None
+        if hasattr(task.env, 'all_houses') and (task.house._id != house_id):
+            task.env.reset_house(house_id)
+        return task.reset(target=target, reset_house=False, birthplace=loc)
+
+
+def missing_houses(index_dir, house_ids):
+    """
+    return the houses in <house_ids> without an index file in <index_dir>
+    """
+    return [h for h in house_ids if not os.path.isfile(os.path.join(index_dir, '{}.pkl'.format(h)))]
+
+
+def reset_with_plan_quota(task, index, plan_req, fixed_target=None):
+    """
+    reset the task to a birthplace whose optimal plan length still has quota in <plan_req>,
+    and return the plan length
+      --> the house and the target are selected by task.reset(), then the plan length is drawn
+          among the indexed ones with quota, in proportion to the quota
+    """
+    while True:
+        task.reset(target=fixed_target)
+        target = task.get_current_target()
+        avail = [m for m in set([k[0] for k in index.strata(task, target)]) if plan_req.get(m, 0) > 0]
+        if len(avail) > 0:
+            break
+    quota = np.array([plan_req[m] for m in avail], dtype=np.float64)
+    m = avail[np.random.choice(len(avail), p=quota / np.sum(quota))]
+    index.reset_task(task, target, plan_len=m)
+    plan_req[m] -= 1
+    return m
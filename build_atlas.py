@@ -0,0 +1,63 @@
+from headers import *
+import common
+import utils
+
+import sys, os, argparse, time
+
+import numpy as np
+
+from atlas_env import build_house_atlas
+
+
+def build_atlas(args):
+    common.process_observation_shape('rnn', args['resolution'],
+                                     segmentation_input='none',
+                                     depth_input=False,
+                                     history_frame_len=1)
+    logger = utils.MyLogger(args['atlas_dir'], True, filename='atlas_log.txt')
+    if args['house'] >= 0:
+        house_range = [args['house']]
+    else:
+        house_range = list(range(min(-args['house'], len(common.all_houseIDs))))
+    ts = time.time()
+    for i in house_range:
+        house_id = common.all_houseIDs[i]
+        if os.path.exists(os.path.join(args['atlas_dir'], house_id, 'meta.json')) and not args['overwrite']:
+            logger.print('>> House#{} <{}> already exists, skip!'.format(i, house_id))
+            continue
+        logger.print('>> Building Atlas for House#{} <{}> ...'.format(i, house_id))
+        task = common.create_env(i, render_device=args['render_gpu'],
+                                 cacheAllTarget=True,
+                                 use_discrete_action=True,
+                                 include_object_target=True,
+                                 include_outdoor_target=True,
+                                 discrete_angle=True)
+        build_house_atlas(task, args['atlas_dir'], n_yaw=args['n_yaw'], spacing=args['spacing'], logger=logger)
+        del task
+    logger.print('>> Done! Total Time Elapsed = %.4fs' % (time.time() - ts))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Pre-Render House Atlases for AtlasRoomNavTask")
+    parser.add_argument("--env-set", choices=['small', 'train', 'test', 'color'], default='small')
+    parser.add_argument("--house", type=int, default=-20, help="house ID; when negative, the first |house| houses")
+    parser.add_argument("--render-gpu", type=int, help="gpu id for rendering the environment")
+    parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'], default='normal',
+                        help="resolution of visual input, default normal=[120 * 90]")
+    parser.add_argument("--n-yaw", type=int, help="number of discrete yaws, default the discrete angles of the task")
+    parser.add_argument("--spacing", type=float, help="lattice spacing in meters, default atlas_env.atlas_spacing_ratio * the move sensitivity of the task")
+    parser.add_argument("--atlas-dir", type=str, default='./_atlas_', help="output directory of the atlas")
+    parser.add_argument("--overwrite", dest='overwrite', action='store_true',
+                        help="when set, re-build the atlas of houses that already exist")
+    parser.set_defaults(overwrite=False)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    common.set_house_IDs(cmd_args.env_set)
+    print('>> Environment Set = <%s>, Total %d Houses!' % (cmd_args.env_set, len(common.all_houseIDs)))
+    common.ensure_object_targets(True)
+    if not os.path.exists(cmd_args.atlas_dir):
+        os.makedirs(cmd_args.atlas_dir)
+    build_atlas(cmd_args.__dict__)
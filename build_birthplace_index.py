@@ -0,0 +1,94 @@
+from headers import *
+import common
+import utils
+
+import sys, os, argparse, time
+
+import numpy as np
+
+from birthplace_index import BirthplaceIndex
+
+"""
+Offline Builder of the Birthplace Index
+  --> indexes each house once (see birthplace_index.py), so that the ZMQ simulators only load the index read-only
+  --> the task settings (hardness, max_birthplace_steps, targets) must match the ones of the training run,
+      the simulators refuse an index built with different settings
+"""
+
+
+def build_index(args):
+    common.process_observation_shape('rnn', args['resolution'],
+                                     segmentation_input='none',
+                                     depth_input=False,
+                                     history_frame_len=1)
+    logger = utils.MyLogger(args['index_dir'], True, filename='index_log.txt')
+    index = BirthplaceIndex(args['index_dir'], n_samples=args['n_samples'],
+                            max_birthplace_steps=args['max_birthplace_steps'], logger=logger)
+    if args['house'] >= 0:
+        house_range = [args['house']]
+    else:
+        house_range = list(range(min(-args['house'], len(common.all_houseIDs))))
+    ts = time.time()
+    for i in house_range:
+        task = common.create_env(i, render_device=args['render_gpu'],
+                                 reward_type='none',
+                                 hardness=args['hardness'],
+                                 max_birthplace_steps=args['max_birthplace_steps'],
+                                 min_birthplace_grids=args['min_birthplace_grids'],
+                                 cacheAllTarget=args['multi_target'],
+                                 use_discrete_action=True,
+                                 include_object_target=args['object_target'],
+                                 include_outdoor_target=args['outdoor_target'],
+                                 segment_input='none', depth_input=False,
+                                 atlas_dir=args['atlas_dir'],
+                                 synthetic_env=args['synthetic_env'])
+        house_id = task.house._id
+        if os.path.exists(index._index_file(house_id)) and not args['overwrite']:
+            index.get(task, house_id)  # re-indexed when the settings differ
+            logger.print('>> House#{} <{}> already indexed, skip!'.format(i, house_id))
+        else:
+            logger.print('>> Indexing House#{} <{}> ...'.format(i, house_id))
+            index.build(task, house_id)
+        del task
+    logger.print('>> Done! Total Time Elapsed = %.4fs' % (time.time() - ts))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Build the Birthplace Index of the ZMQ Simulators Offline")
+    parser.add_argument("--env-set", choices=['small', 'train', 'test', 'color'], default='small')
+    parser.add_argument("--house", type=int, default=-20, help="house ID; when negative, the first |house| houses")
+    parser.add_argument("--render-gpu", type=int, help="gpu id for rendering the environment")
+    parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'], default='tiny',
+                        help="resolution of visual input, irrelevant to the index, default tiny")
+    parser.add_argument("--hardness", type=float, help="the --hardness of the training run")
+    parser.add_argument("--max-birthplace-steps", type=int, help="the --max-birthplace-steps of the training run")
+    parser.add_argument("--min-birthplace-grids", type=int, default=0, help="the --min-birthplace-grids of the training run")
+    parser.add_argument("--multi-target", dest='multi_target', action='store_true',
+                        help="the --multi-target of the training run")
+    parser.set_defaults(multi_target=False)
+    parser.add_argument("--include-object-target", dest='object_target', action='store_true',
+                        help="the --include-object-target of the training run")
+    parser.set_defaults(object_target=False)
+    parser.add_argument("--no-outdoor-target", dest='outdoor_target', action='store_false',
+                        help="the --no-outdoor-target of the training run")
+    parser.set_defaults(outdoor_target=True)
+    parser.add_argument("--atlas-dir", type=str, help="the --atlas-dir of the training run")
+    parser.add_argument("--synthetic-env", dest='synthetic_env', action='store_true',
+                        help="the --synthetic-env of the training run")
+    parser.set_defaults(synthetic_env=False)
+    parser.add_argument("--n-samples", type=int, default=2000, help="number of task resets sampled to index a house")
+    parser.add_argument("--index-dir", type=str, default='./_birthplace_index_', help="output directory of the index")
+    parser.add_argument("--overwrite", dest='overwrite', action='store_true',
+                        help="when set, re-index houses that already have an index file")
+    parser.set_defaults(overwrite=False)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    common.set_house_IDs(cmd_args.env_set, ensure_kitchen=(not cmd_args.multi_target))
+    print('>> Environment Set = <%s>, Total %d Houses!' % (cmd_args.env_set, len(common.all_houseIDs)))
+    common.ensure_object_targets(cmd_args.object_target)
+    if not os.path.exists(cmd_args.index_dir):
+        os.makedirs(cmd_args.index_dir)
+    build_index(cmd_args.__dict__)
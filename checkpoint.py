@@ -0,0 +1,178 @@
+import os, sys, copy, shutil, pickle, atexit, threading
+from collections import OrderedDict
+
+import torch
+
+"""
+Asynchronous Atomic Checkpoint Writer
+  --> save() snapshots the object to CPU memory in the calling thread (tensors are copied, the rest deep-copied),
+      then a background thread serializes it (torch.save or pickle) and fsyncs it
+  --> the file is written to <filename>.tmp and renamed to <filename> atomically, so after a crash
+      <filename> is either the previous or the new checkpoint, never a partial one (see benchmark_checkpoint.py)
+  --> with keep_last = N > 1, the previous N - 1 checkpoints of a path are kept as <filename>.1, ..., <filename>.<N-1>
+  --> a save to a path whose previous save is still pending is refused (returns False), saves to different paths queue up
+  --> all pending saves are written at exit, wait() blocks until they are done
+NOTE:
+  --> the module-level save()/wait() use a shared writer, configured by configure()
+"""
+
+
+def snapshot(obj):
+    """
+    copy of <obj> that is independent of the training state: tensors are copied to CPU
+    """
+    if torch.is_tensor(obj):
+        return obj.cpu() if obj.is_cuda else obj.clone()
+    if isinstance(obj, OrderedDict):
+        return OrderedDict([(k, snapshot(v)) for k, v in obj.items()])
+    if isinstance(obj, dict):
+        return dict([(k, snapshot(v)) for k, v in obj.items()])
+    if isinstance(obj, (list, tuple)):
+        return type(obj)([snapshot(v) for v in obj])
+    return copy.deepcopy(obj)
+
+
+def _fsync_dir(dirname):
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return  # e.g., not supported on this platform
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_atomic(obj, filename, use_torch=True, keep_last=1):
+    """
+    synchronous atomic write: serialize to <filename>.tmp, fsync, rotate the old checkpoints and rename
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        if use_torch:
+            torch.save(obj, f)
+        else:
+            pickle.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    if (keep_last > 1) and os.path.exists(filename):
+        for i in range(keep_last - 2, 0, -1):
+            src = '{}.{}'.format(filename, i)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(filename, i + 1))
+        # <filename> must exist at any time, so the backup is a link (or a copy) instead of a rename
+        link = filename + '.1.tmp'
+        if os.path.exists(link):
+            os.remove(link)
+        try:
+            os.link(filename, link)
+        except OSError:
+            shutil.copyfile(filename, link)
+        os.replace(link, filename + '.1')
+    os.replace(tmp, filename)
+    _fsync_dir(os.path.dirname(os.path.abspath(filename)))
+
+
+class CheckpointWriter(object):
+    def __init__(self, keep_last=1):
+        assert keep_last >= 1, '[CheckpointWriter] keep_last must be at least 1'
+        self.keep_last = keep_last
+        self.n_saved = 0
+        self.n_refused = 0
+        self.n_failed = 0
+        self._init_state()
+
+    def _init_state(self):
+        self._cond = threading.Condition()
+        self._queue = []
+        self._pending = set()  # paths queued or being written
+        self._thread = None
+
+    def save(self, obj, filename, use_torch=True):
+        """
+        obj: e.g., a state_dict or a list of state_dicts (use_torch=True), or any picklable data (use_torch=False)
+        return True if the save is queued, False if it is refused
+        """
+        with self._cond:
+            if filename in self._pending:
+                self.n_refused += 1
+                print('[CheckpointWriter] previous save of <{}> still pending! Saving Skipped ...'.format(filename), file=sys.stderr)
+                return False
+            self._pending.add(filename)
+        try:
+            data = snapshot(obj)
+        except Exception:
+            with self._cond:
+                self._pending.discard(filename)
+            raise
+        with self._cond:
+            self._queue.append((data, filename, use_torch))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._queue) == 0:
+                    self._cond.wait()
+                data, filename, use_torch = self._queue[0]
+            try:
+                write_atomic(data, filename, use_torch=use_torch, keep_last=self.keep_last)
+                self.n_saved += 1
+            except Exception as e:
+                self.n_failed += 1
+                print('[CheckpointWriter] fail to save model <{}>! Err = {}... Saving Skipped ...'.format(filename, e), file=sys.stderr)
+            with self._cond:
+                self._queue.pop(0)
+                self._pending.discard(filename)
+                self._cond.notify_all()
+
+    def is_pending(self, filename=None):
+        with self._cond:
+            return (len(self._pending) > 0) if filename is None else (filename in self._pending)
+
+    def wait(self, filename=None):
+        """
+        block until all the pending saves (or the pending save of <filename>) are written
+        """
+        with self._cond:
+            while (len(self._pending) > 0) if filename is None else (filename in self._pending):
+                self._cond.wait()
+
+
+_writer = None
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        _writer = CheckpointWriter()
+    return _writer
+
+
+def configure(keep_last=1):
+    get_writer().keep_last = keep_last
+
+
+def save(obj, filename, use_torch=True):
+    return get_writer().save(obj, filename, use_torch=use_torch)
+
+
+def wait(filename=None):
+    if _writer is not None:
+        _writer.wait(filename)
+
+
+def _reset_after_fork():
+    if _writer is not None:
+        _writer._init_state()  # the writer thread does not survive a fork
+
+
+atexit.register(wait)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -28,7 +28,7 @@ from policy.joint_cnn_actor_critic import JointCNNPolicyCritic as JointModel
 from policy.attentive_cnn_actor_critic import AttentiveJointCNNPolicyCritic as AttJointModel
 from policy.discrete_cnn_actor_critic import DiscreteCNNPolicyCritic as A2CModel
 from policy.qac_cnn_actor_critic import DiscreteCNNPolicyQFunc as QACModel
-from policy.cnn_classifier import CNNClassifier
+from policy.cnn_classifier import CNNClassifier, FusedCNNClassifier
 from trainer.pg import PolicyGradientTrainer as PGTrainer
 from trainer.nop import NOPTrainer
 from trainer.ddpg import DDPGTrainer
@@ -42,6 +42,11 @@ from trainer.dqn import DQNTrainer
 from trainer.semantic import SemanticTrainer
 
 from config import get_config, get_house_ids, get_house_targets
+from render_cache import RenderCache
+from atlas_env import AtlasRoomNavTask
+from synthetic_env import SyntheticRoomNavTask
+from house_provider import LazyHouseProvider
+import house_store
 
 house_ID_dict = get_house_ids()
 house_Targets_dict = get_house_targets()
@@ -49,7 +54,11 @@ all_houseIDs = house_ID_dict['small']
 all_houseTargets = house_Targets_dict['small']
 
 # only works for python 3.5
-flag_parallel_init = False # (sys.version_info[1] == 5)#("Ubuntu" in platform.platform())
+house_init_workers = 0  # size of the worker pool building multi-house environments, <= 1 for serial (default)
+house_init_timeout = 1800  # seconds to wait for a house from the worker pool before loading it serially
+house_store_dir = None  # when not None, houses are shared via a read-only map store (see house_store.py)
+render_api_created = False  # set once a renderer exists in this process, forking is unsafe afterwards
+preloaded_houses = dict()  # (houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor) -> House, see preload_houses()
 
 
 def set_house_IDs(partition='small', ensure_kitchen=False):
@@ -71,7 +80,13 @@ def filter_house_IDs_by_target(fixed_target):
     all_houseTargets = _new_all_houseTargets
 
 
-CFG = load_config('config.json')
+if os.path.isfile('config.json'):
+    CFG = load_config('config.json')
+else:
+    # no House3D assets, only the synthetic environment is available (see create_env(synthetic_env=True))
+    print('[Warning] <config.json> not found! Only the synthetic environment can be created!')
+    CFG = dict(prefix='', modelCategoryFile=None, colorFile=None, roomTargetFile=None,
+               objectTargetFile=None, modelObjectMap=None)
 prefix = CFG['prefix']
 csvFile = CFG['modelCategoryFile']
 colorFile = CFG['colorFile']
@@ -542,7 +557,42 @@ def create_trainer(algo, model, args):
     return trainer
 
 
+def set_house_store(store_dir):
+    global house_store_dir
+    house_store_dir = store_dir
+    if store_dir is not None:
+        print('>> House Map Store Enabled! Dir = <{}>'.format(store_dir))
+
+def preload_houses(indices, genRoomTypeMap=False, cacheAllTarget=False, includeOutdoor=True):
+    """
+    build the houses in the current process, processes forked afterwards inherit them copy-on-write
+    and create_house() returns the preloaded house instead of loading it again
+      --> with house_init_workers > 1, the houses are built by create_houses_parallel()
+    """
+    import time
+    ts = time.time()
+    print('Preloading {} Houses ...'.format(len(indices)))
+    house_ids = [all_houseIDs[k] for k in indices]
+    house_ids = [h for h in house_ids if (h, genRoomTypeMap, cacheAllTarget, includeOutdoor) not in preloaded_houses]
+    if (house_init_workers > 1) and (len(house_ids) > 1):
+        houses = create_houses_parallel(house_ids, genRoomTypeMap, cacheAllTarget, includeOutdoor)
+    else:
+        houses = [create_house(h, genRoomTypeMap, cacheAllTarget, includeOutdoor) for h in house_ids]
+    for houseID, house in zip(house_ids, houses):
+        preloaded_houses[(houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor)] = house
+    print('  >> Done! Time Elapsed = %.4f(s)' % (time.time() - ts))
+
 def create_house(houseID, genRoomTypeMap=False, cacheAllTarget=False, includeOutdoor=True):
+    key = (houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor)
+    if key in preloaded_houses:
+        return preloaded_houses[key]
+    if house_store_dir is not None:
+        return house_store.get_house(house_store_dir, houseID,
+                                     lambda: _create_house(houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor),
+                                     genRoomTypeMap, cacheAllTarget, includeOutdoor)
+    return _create_house(houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor)
+
+def _create_house(houseID, genRoomTypeMap=False, cacheAllTarget=False, includeOutdoor=True):
     objFile = prefix + houseID + '/house.obj'
     jsonFile = prefix + houseID + '/house.json'
     cachedFile = genCacheFile(houseID)
@@ -566,7 +616,64 @@ def create_house(houseID, genRoomTypeMap=False, cacheAllTarget=False, includeOut
         house.cache_all_target()
     return house
 
-def create_house_from_index(k, genRoomTypeMap=False, cacheAllTarget=False, includeOutdoor=True):
+def create_lazy_houses(house_ids, genRoomTypeMap=False, cacheAllTarget=False, includeOutdoor=True,
+                       max_resident=10, prefetch=True):
+    print('Lazy Multi-House Loading! Total Houses = {}, Max Resident Houses = {}, Prefetch = {}'.format(len(house_ids), max_resident, prefetch))
+    loader = lambda houseID: create_house(houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor=includeOutdoor)
+    return LazyHouseProvider(house_ids, loader, max_resident=max_resident, prefetch=prefetch)
+
+def _store_house_worker(store_dir, houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor):
+    builder = lambda: _create_house(houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor)
+    return house_store.store_house(store_dir, houseID, builder, genRoomTypeMap, cacheAllTarget, includeOutdoor)
+
+def create_houses_parallel(house_ids, genRoomTypeMap=False, cacheAllTarget=False, includeOutdoor=True, n_workers=None):
+    """
+    build houses with a bounded pool of workers
+      --> each worker builds a house and writes its maps into the house store (see house_store.py),
+          a temporary one when no store is set, the parent then rehydrates the house without re-parsing
+      --> a house whose worker fails (or times out) is loaded serially, so are all the houses when the pool fails
+      --> all the houses are loaded serially (with a warning) inside a daemonic process, which cannot have children,
+          and once a renderer exists in this process, since forking after the OpenGL context is created is unsafe
+    """
+    import tempfile, shutil
+    import multiprocessing
+    from multiprocessing import Pool
+    n_workers = min(n_workers or house_init_workers, len(house_ids))
+    reason = None
+    if multiprocessing.current_process().daemon:
+        reason = 'daemonic processes cannot have children'
+    elif render_api_created:
+        reason = 'a renderer already exists in this process'
+    if reason is not None:
+        print('[Warning] Parallel initialization disabled ({})! Load {} houses serially!'.format(reason, len(house_ids)))
+        return [create_house(h, genRoomTypeMap, cacheAllTarget, includeOutdoor) for h in house_ids]
+    store_dir = house_store_dir or tempfile.mkdtemp(prefix='house_init_')
+    mmap_mode = 'c' if house_store_dir is not None else None   # a temporary store is removed afterwards
+    ret_worlds = []
+    try:
+        with Pool(n_workers) as pool:
+            results = [pool.apply_async(_store_house_worker, (store_dir, h, genRoomTypeMap, cacheAllTarget, includeOutdoor))
+                       for h in house_ids]
+            for houseID, res in zip(house_ids, results):
+                try:
+                    ret_worlds.append(house_store.load_house(res.get(timeout=house_init_timeout), mmap_mode=mmap_mode))
+                except Exception as e:
+                    print('[Warning] Parallel initialization failed for house <{}>! Load it serially! e = {}'.format(houseID, e))
+                    ret_worlds.append(create_house(houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor))
+    except Exception as e:
+        print('[Warning] Parallel initialization failed! Load the remaining houses serially! e = {}'.format(e))
+        ret_worlds += [create_house(h, genRoomTypeMap, cacheAllTarget, includeOutdoor) for h in house_ids[len(ret_worlds):]]
+    finally:
+        if house_store_dir is None:
+            shutil.rmtree(store_dir, ignore_errors=True)
+    return ret_worlds
+
+def create_house_from_index(k, genRoomTypeMap=False, cacheAllTarget=False, includeOutdoor=True,
+                            max_resident_houses=0, prefetch_house=True):
+    """
+    max_resident_houses: only effective when k < 0, when positive, return a LazyHouseProvider (see house_provider.py)
+        keeping at most this many houses in memory
+    """
     if k >= 0:
         if k >= len(all_houseIDs):
             print('k={} exceeds total number of houses ({})! Randomly Choose One!'.format(k, len(all_houseIDs)))
@@ -580,17 +687,15 @@ def create_house_from_index(k, genRoomTypeMap=False, cacheAllTarget=False, inclu
         if k > len(all_houseIDs):
             print('  >> k={} exceeds total number of houses ({})! use all houses!'.format(k, len(all_houseIDs)))
             k = len(all_houseIDs)
+        if max_resident_houses > 0:
+            return create_lazy_houses(all_houseIDs[:k], genRoomTypeMap, cacheAllTarget, includeOutdoor,
+                                      max_resident=max_resident_houses, prefetch=prefetch_house)
         import time
         ts = time.time()
         print('Caching All Worlds ...')
         # use the first k houses
-        ret_worlds = []
-        if flag_parallel_init:
-            from multiprocessing import Pool
-            _args = [(all_houseIDs[j], genRoomTypeMap, cacheAllTarget, includeOutdoor) for j in range(k)]
-            #with Pool(min(50, k)) as pool:
-            with Pool(k) as pool:
-                ret_worlds = pool.starmap(create_house, _args)  # parallel version for initialization
+        if (house_init_workers > 1) and (k > 1):
+            ret_worlds = create_houses_parallel(all_houseIDs[:k], genRoomTypeMap, cacheAllTarget, includeOutdoor)
         else:
             ret_worlds = [create_house(all_houseIDs[j], genRoomTypeMap, cacheAllTarget, includeOutdoor) for j in range(k)]
         print('  >> Done! Time Elapsed = %.4f(s)' % (time.time() - ts))
@@ -617,7 +722,14 @@ def create_env(k=0,
                include_outdoor_target=True,
                min_birthplace_grids=1,
                cache_discrete_angles=False,
-               multithread_api=False):
+               multithread_api=False,
+               render_cache_size=0,
+               render_cache_key='exact',
+               atlas_dir=None,
+               synthetic_env=False,
+               max_resident_houses=0,
+               prefetch_house=True,
+               house_store_dir=None):
     """
     :param k: the index of house to generate
         when k < 0, it menas the first |k| houses from the environment set
@@ -651,28 +763,93 @@ def create_env(k=0,
     :param include_outdoor_target: default true, whether to include outdoor as targets
     :param cache_discrete_angles: default false, for DAgger
     :param multithread_api: whether to use thread safe renderer API
+    :param render_cache_size: when positive, rendered frames are cached in a LRU cache of this size (see render_cache.py)
+        the cache is accessible via task._render_cache
+    :param render_cache_key: 'exact' or 'grid', how the agent location is keyed in the render cache
+    :param atlas_dir: when not None, return an AtlasRoomNavTask serving pre-rendered frames from <atlas_dir>/<houseID>
+        (see atlas_env.py and build_atlas.py), no renderer will be created
+    :param synthetic_env: when True, return a SyntheticRoomNavTask over procedurally generated houses with noise frames
+        (see synthetic_env.py), neither House3D assets nor a renderer will be needed
+    :param max_resident_houses: only for multi-house environments, when positive, houses are loaded on first use
+        and at most this many houses stay in memory (see house_provider.py), the provider is accessible via task._house_provider
+    :param prefetch_house: when True (and max_resident_houses > 0), the house of the next episode is loaded in the background
+    :param house_store_dir: when not None, the maps of each house are built once and stored in this directory,
+        and all processes on the node attach to the memory-mapped maps read-only (see house_store.py)
     :return: a RoomNavTask environment instance
     """
-    if render_device is None:
-        render_device = get_gpus_for_rendering()[0]   # by default use the first gpu
+    global render_api_created
+    if synthetic_env:
+        if isinstance(k, tuple):
+            house_seeds = list(range(k[0], k[1]))
+        elif k >= 0:
+            house_seeds = [k]
+        else:
+            house_seeds = list(range(-k))
+        assert use_discrete_action and (segment_input != 'index'), \
+            '[create_env] SyntheticRoomNavTask only supports discrete actions and does not support index segmentation input!'
+        return SyntheticRoomNavTask(house_seeds, resolution=resolution,
+                                    segment_input=(segment_input not in [None, 'none']),
+                                    joint_visual_signal=(segment_input == 'joint'),
+                                    depth_signal=depth_input,
+                                    target_mask_signal=target_mask_input,
+                                    max_steps=max_steps, success_measure=success_measure,
+                                    reward_type=reward_type, reward_silence=reward_silence,
+                                    include_object_target=include_object_target,
+                                    include_outdoor_target=include_outdoor_target,
+                                    hardness=hardness, max_birthplace_steps=max_birthplace_steps,
+                                    min_birth_grid_dist=min_birthplace_grids)
+    if atlas_dir is not None:
+        if isinstance(k, tuple):
+            house_ids = [all_houseIDs[i] for i in range(k[0], k[1])]
+        elif k >= 0:
+            house_ids = [all_houseIDs[k % len(all_houseIDs)]]
+        else:
+            house_ids = all_houseIDs[:-k]
+        assert (not target_mask_input) and (segment_input != 'index'), \
+            '[create_env] AtlasRoomNavTask does not support target mask input or index segmentation input!'
+        return AtlasRoomNavTask([os.path.join(atlas_dir, h) for h in house_ids],
+                                segment_input=(segment_input not in [None, 'none']),
+                                joint_visual_signal=(segment_input == 'joint'),
+                                depth_signal=depth_input,
+                                max_steps=max_steps, success_measure=success_measure,
+                                reward_type=reward_type, reward_silence=reward_silence,
+                                include_object_target=include_object_target,
+                                include_outdoor_target=include_outdoor_target,
+                                hardness=hardness, max_birthplace_steps=max_birthplace_steps,
+                                min_birth_grid_dist=min_birthplace_grids)
     if segment_input is None:
         segment_input = 'none'
-    if multithread_api:
-        api = objrender.RenderAPIThread(w=resolution[0], h=resolution[1], device=render_device)
-    else:
-        api = objrender.RenderAPI(w=resolution[0], h=resolution[1], device=render_device)
     if cache_supervision:
         assert discrete_angle and use_discrete_action
         cacheAllTarget = True
+    if house_store_dir is not None:
+        set_house_store(house_store_dir)
+    # houses are built before the renderer, so the worker pool of create_houses_parallel never forks an OpenGL context
+    all_houses = house = None
     if isinstance(k, tuple):  # a range of houses
         assert (len(k) == 2) and (k[0] < k[1]) and (k[0] >= 0)
-        all_houses = [create_house_from_index(i, genRoomTypeMap, cacheAllTarget, include_outdoor_target) for i in range(k[0], k[1])]
-        env = MultiHouseEnv(api, all_houses, config=CFG)
+        if max_resident_houses > 0:
+            all_houses = create_lazy_houses([all_houseIDs[i] for i in range(k[0], k[1])], genRoomTypeMap, cacheAllTarget,
+                                            include_outdoor_target, max_resident=max_resident_houses, prefetch=prefetch_house)
+        else:
+            all_houses = create_houses_parallel(all_houseIDs[k[0]:k[1]], genRoomTypeMap, cacheAllTarget, include_outdoor_target) \
+                         if (house_init_workers > 1) and (k[1] - k[0] > 1) else \
+                         [create_house_from_index(i, genRoomTypeMap, cacheAllTarget, include_outdoor_target) for i in range(k[0], k[1])]
     elif k >= 0:
         house = create_house_from_index(k, genRoomTypeMap, cacheAllTarget, include_outdoor_target)
-        env = HouseEnv(api, house, config=CFG)
     else:  # multi-house environment
-        all_houses = create_house_from_index(k, genRoomTypeMap, cacheAllTarget, include_outdoor_target)
+        all_houses = create_house_from_index(k, genRoomTypeMap, cacheAllTarget, include_outdoor_target,
+                                             max_resident_houses=max_resident_houses, prefetch_house=prefetch_house)
+    if render_device is None:
+        render_device = get_gpus_for_rendering()[0]   # by default use the first gpu
+    render_api_created = True
+    if multithread_api:
+        api = objrender.RenderAPIThread(w=resolution[0], h=resolution[1], device=render_device)
+    else:
+        api = objrender.RenderAPI(w=resolution[0], h=resolution[1], device=render_device)
+    if house is not None:
+        env = HouseEnv(api, house, config=CFG)
+    else:
         env = MultiHouseEnv(api, all_houses, config=CFG)
     Task = RoomNavTask if task_name == 'roomnav' else ObjNavTask
     task = Task(env, reward_type=reward_type,
@@ -691,6 +868,21 @@ def create_env(k=0,
                 supervision_signal=cache_supervision,
                 min_birth_grid_dist=min_birthplace_grids,
                 cache_discrete_angles=cache_discrete_angles)
+    task._house_provider = None
+    if isinstance(all_houses, LazyHouseProvider):
+        task._house_provider = all_houses
+        _reset_house = env.reset_house
+        def reset_house(house_id=None):
+            # draw the house in advance, so the provider can prefetch the next one
+            if house_id is None:
+                house_id = all_houses.next_house_id()
+            return _reset_house(house_id)
+        env.reset_house = reset_house
+    task._render_cache = None
+    if render_cache_size > 0:
+        if not discrete_angle:
+            print('[Warning] Render cache is enabled with continuous angles! Frames will be keyed by the rounded yaw.')
+        task._render_cache = RenderCache(env, max_size=render_cache_size, key_mode=render_cache_key)
     return task
 
 
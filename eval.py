@@ -137,6 +137,7 @@ def evaluate_aux_pred(house, seed = 0,iters = 1000, max_episode_len = 10,
         if store_history:
             cur_stats['infos'] = cur_infos
         episode_stats.append(cur_stats)
+        logger.log('episode', step=it, **utils.scalar_items(cur_stats))
 
         dur = time.time() - elap
         logger.print('Episode#%d, Elapsed = %.3f min' % (it+1, dur/60))
@@ -177,7 +178,8 @@ def evaluate(house, seed = 0, render_device=None,
              resolution='normal', history_len=4,
              include_object_target=False, include_outdoor_target=True,
              aux_task=False, no_skip_connect=False, feed_forward=False,
-             greedy_execution=False, greedy_aux_pred=False):
+             greedy_execution=False, greedy_aux_pred=False,
+             synthetic_env=False, atlas_dir=None):
 
     assert not aux_task, 'Do not support Aux-Task now!'
 
@@ -226,7 +228,10 @@ def evaluate(house, seed = 0, render_device=None,
                             use_discrete_action=('dpg' not in algo),
                             include_object_target=include_object_target and (fixed_target != 'any-room'),
                             include_outdoor_target=include_outdoor_target,
-                            discrete_angle=True)
+                            discrete_angle=True,
+                            reward_type=('none' if atlas_dir is not None else 'new'),
+                            synthetic_env=synthetic_env,
+                            atlas_dir=atlas_dir)
 
     if (fixed_target is not None) and (fixed_target != 'any-room') and (fixed_target != 'any-object'):
         env.reset_target(fixed_target)
@@ -359,6 +364,7 @@ def evaluate(house, seed = 0, render_device=None,
         if store_history:
             cur_stats['infos'] = cur_infos
         episode_stats.append(cur_stats)
+        logger.log('episode', step=it, **utils.scalar_items(cur_stats))
 
         dur = time.time() - elap
         logger.print('Episode#%d, Elapsed = %.3f min' % (it+1, dur/60))
@@ -419,6 +425,11 @@ def parse_args():
     parser.add_argument("--env-set", choices=['small', 'train', 'test', 'color'], default='small')
     parser.add_argument("--house", type=int, default=0, help="house ID")
     parser.add_argument("--render-gpu", type=int, help="gpu id for rendering the environment")
+    parser.add_argument("--synthetic-env", dest='synthetic_env', action='store_true',
+                        help="when set, evaluate in the synthetic stand-in environment (see synthetic_env.py)")
+    parser.set_defaults(synthetic_env=False)
+    parser.add_argument("--atlas-dir", type=str,
+                        help="when set, evaluate with pre-rendered frames from this atlas folder (see build_atlas.py) without any renderer")
     parser.add_argument("--seed", type=int, default=0, help="random seed")
     parser.add_argument("--hardness", type=float, help="real number from 0 to 1, indicating the hardness of the environment")
     parser.add_argument("--max-birthplace-steps", type=int, help="int, the maximum steps required from birthplace to target")
@@ -562,7 +573,8 @@ if __name__ == '__main__':
                      include_outdoor_target=args.outdoor_target,
                      aux_task=args.aux_task, no_skip_connect=args.no_skip_connect, feed_forward=args.feed_forward,
                      greedy_execution=(args.greedy_execution and (args.algo == 'a3c')),
-                     greedy_aux_pred=(args.greedy_aux_pred and (args.algo == 'a3c') and args.aux_task))
+                     greedy_aux_pred=(args.greedy_aux_pred and (args.algo == 'a3c') and args.aux_task),
+                     synthetic_env=args.synthetic_env, atlas_dir=args.atlas_dir)
 
     if args.store_history:
         filename = args.log_dir
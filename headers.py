@@ -3,9 +3,10 @@ import pickle
 import numpy as np
 from config import get_config
 
-CFG = get_config()
-
-time_counter = [0,0,0,0]
+try:
+    CFG = get_config()
+except RuntimeError:
+    CFG = dict()  # no config.json, only the synthetic environment is available (see synthetic_env.py)
 
 n_segmentation_mask = 20  # including unknown, it is 21, we set unknown as 0
 
@@ -16,6 +17,8 @@ import House3D
 import torch
 from torch.autograd import Variable
 
+import checkpoint
+
 use_cuda = torch.cuda.is_available()
 if use_cuda:
     print('>>> CUDA used!!!')
@@ -107,13 +110,12 @@ class AgentTrainer(object):
         if save_dir[-1] != '/':
             save_dir += '/'
         try:
+            # snapshot now, serialized in the background (see checkpoint.py)
+            filename = save_dir + self.name + version + '.pkl'
             if target_dict_data is None:
-                filename = save_dir + self.name + version + '.pkl'
-                torch.save(self.policy.state_dict(), filename)
+                checkpoint.save(self.policy.state_dict(), filename)
             else:
-                filename = save_dir + self.name + version + '.pkl'
-                with open(filename, 'wb') as fp:
-                    pickle.dump(target_dict_data, fp)
+                checkpoint.save(target_dict_data, filename, use_torch=False)
         except Exception as e:
             print('[AgentTrainer.save] fail to save model <{}>! Err = {}... Saving Skipped ...'.format(filename, e), file=sys.stderr)
 
@@ -126,6 +128,7 @@ class AgentTrainer(object):
             if save_dir[-1] != '/':
                 save_dir += '/'
                 filename = save_dir + self.name + version + '.pkl'
+        checkpoint.wait(filename)
         if os.path.exists(filename):
             self.policy.load_state_dict(torch.load(filename, map_location=lambda storage, loc: storage))
         else:
@@ -135,6 +138,17 @@ class AgentTrainer(object):
         return False
 
 
+insight_rows_per_chunk = 16  # rows of the segmentation frame per early-exit check in BaseMotion._is_insight
+
+
+def pack_colors(img):
+    """
+    pack the colors of a HxWx3 uint8 image into a HxW uint32 key image
+    """
+    img = np.asarray(img)
+    return (img[..., 0].astype(np.uint32) << 16) | (img[..., 1].astype(np.uint32) << 8) | img[..., 2].astype(np.uint32)
+
+
 class BaseMotion(object):
     def __init__(self, task, trainer, pass_target=True, term_measure='mask', oracle_func=None):
         self.task = task
@@ -152,17 +166,39 @@ class BaseMotion(object):
     def _is_insight(self, target_name=None, obs_seg=None, n_pixel=50):
         if target_name is None:
             target_name = self.task.get_current_target()
+        if hasattr(self.task, 'is_target_insight'):
+            # atlas and synthetic tasks have no object colors, the insight bits are pre-computed
+            return self.task.is_target_insight(target_name)
         if obs_seg is None:
             obs_seg = self.env.render(mode='semantic')
-        object_color_list = self.task.room_target_object[target_name]
+        keys = self._get_target_color_keys(target_name)
+        if len(keys) == 0:
+            return False
+        # pack and count the target colors chunk by chunk, stop early when enough pixels are found
+        # NOTE: the packed frame is never cached, renderers may reuse the same buffer across frames
         _object_cnt = 0
-        for c in object_color_list:
-            cur_n = np.sum(np.all(obs_seg == c, axis=2))
-            _object_cnt += cur_n
+        for lo in range(0, obs_seg.shape[0], insight_rows_per_chunk):
+            chunk = pack_colors(obs_seg[lo: lo + insight_rows_per_chunk])
+            pos = np.searchsorted(keys, chunk)
+            pos[pos == len(keys)] = 0
+            _object_cnt += np.count_nonzero(keys[pos] == chunk)
             if _object_cnt >= n_pixel:
                 return True
         return False
 
+    def _get_target_color_keys(self, target_name):
+        # sorted packed colors of the target, re-computed when the color list of the task changes (e.g., a new house)
+        object_color_list = self.task.room_target_object[target_name]
+        if not hasattr(self, '_target_color_keys'):
+            self._target_color_keys = dict()
+        cached = self._target_color_keys.get(target_name, None)
+        if (cached is None) or (cached[0] is not object_color_list):
+            if len(object_color_list) > 0:
+                keys = np.unique(pack_colors(np.array(object_color_list, dtype=np.uint8).reshape((1, -1, 3))).ravel())
+            else:
+                keys = np.zeros(0, dtype=np.uint32)
+            cached = self._target_color_keys[target_name] = (object_color_list, keys)
+        return cached[1]
 
     def _is_success(self, target_id, mask=None, term_measure=None, is_stay=False, obs_seg=None, target_name=None):
         if mask is None: mask = self.task.get_feature_mask() if self._oracle_func is None else self._oracle_func(self.task)
@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from House3D import House
+
+"""
+Lazy Multi-House Provider
+  --> LazyHouseProvider replaces the eagerly built house list of MultiHouseEnv (see common.create_env)
+  --> it is a list of LazyHouse proxies: <_id> is available without loading the house,
+      any other attribute loads the house on first use
+  --> at most <max_resident> houses stay in memory, the least recently used house is evicted
+      (and re-loaded on its next use)
+  --> when prefetch is enabled, the house of the next env.reset_house() is drawn in advance and
+      loaded by a background thread while the current episode runs (see next_house_id());
+      a caller enumerating the houses can also prefetch the next one explicitly (see prefetch_index())
+"""
+
+
+class LazyHouse(object):
+    def __init__(self, house_id, provider):
+        self.__dict__['_id'] = house_id
+        self.__dict__['_provider'] = provider
+        self.__dict__['_house'] = None
+
+    @property
+    def __class__(self):
+        return House   # isinstance(h, House) holds for the proxy
+
+    def __getattr__(self, name):
+        # only called for attributes other than _id, _provider and _house
+        return getattr(self._provider.get_house(self), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._provider.get_house(self), name, value)
+
+
+class LazyHouseProvider(list):
+    def __init__(self, house_ids, loader, max_resident=10, prefetch=True):
+        """
+        house_ids: list of house ids
+        loader: loader(house_id) returns a House instance
+        max_resident: maximum number of houses in memory, at least 2 when prefetch is enabled
+        """
+        assert max_resident >= (2 if prefetch else 1), \
+            '[LazyHouseProvider] max_resident must be at least {} (prefetch = {})'.format(2 if prefetch else 1, prefetch)
+        super(LazyHouseProvider, self).__init__([LazyHouse(h, self) for h in house_ids])
+        self.loader = loader
+        self.max_resident = max_resident
+        self.prefetch = prefetch
+        self._lock = threading.Lock()
+        self._resident = OrderedDict()   # house_id -> LazyHouse, in LRU order
+        self._loading = dict()   # house_id -> threading.Event
+        self._next_idx = None
+        self.n_load = 0
+        self.n_evict = 0
+        self.load_time = 0.0
+
+    def get_house(self, proxy):
+        house = proxy.__dict__['_house']
+        if house is not None:
+            with self._lock:
+                if proxy._id in self._resident:
+                    self._resident.move_to_end(proxy._id)
+            return house
+        return self._load(proxy)
+
+    def _load(self, proxy):
+        house_id = proxy._id
+        with self._lock:
+            house = proxy.__dict__['_house']
+            if house is not None:   # loaded by another thread in the meantime
+                return house
+            event = self._loading.get(house_id, None)
+            is_owner = event is None
+            if is_owner:
+                event = self._loading[house_id] = threading.Event()
+        if not is_owner:
+            event.wait()
+            return self.get_house(proxy)
+        house = None
+        try:
+            ts = time.time()
+            house = self.loader(house_id)
+            dur = time.time() - ts
+        finally:
+            with self._lock:
+                del self._loading[house_id]
+                if house is not None:
+                    proxy.__dict__['_house'] = house
+                    self._resident[house_id] = proxy
+                    self.n_load += 1
+                    self.load_time += dur
+                    self._evict()
+            event.set()
+        return house
+
+    def _evict(self):
+        # lock must be held
+        while len(self._resident) > self.max_resident:
+            _, proxy = self._resident.popitem(last=False)
+            proxy.__dict__['_house'] = None
+            self.n_evict += 1
+
+    def _prefetch_worker(self, proxy):
+        try:
+            self.get_house(proxy)
+        except Exception as e:
+            print('[LazyHouseProvider] Warning: failed to prefetch house <{}>! e = {}'.format(proxy._id, e))
+
+    def prefetch_index(self, i):
+        # load the i-th house in a background thread
+        if self.prefetch:
+            threading.Thread(target=self._prefetch_worker, args=(self[i],), daemon=True).start()
+
+    def next_house_id(self):
+        """
+        return the id of the house for the next episode, and start prefetching the house after it
+        """
+        if self._next_idx is None:
+            self._next_idx = np.random.randint(len(self))
+        ret = self[self._next_idx]._id
+        with self._lock:
+            if ret in self._resident:
+                self._resident.move_to_end(ret)   # never evict the house to use by the prefetch
+        self._next_idx = np.random.randint(len(self))
+        self.prefetch_index(self._next_idx)
+        return ret
+
+    def stats_string(self):
+        return '[LazyHouseProvider] resident = %d / %d (total %d houses), #load = %d, #evict = %d, load time = %.2fs' \
+               % (len(self._resident), self.max_resident, len(self), self.n_load, self.n_evict, self.load_time)
@@ -0,0 +1,124 @@
+import os, time, pickle, shutil, fcntl
+
+import numpy as np
+
+"""
+Shared Read-Only House Map Store
+  --> the first process that needs a house builds it (see common.create_house) and writes it into
+      <store_dir>/<houseID>_<flags>/: every large numpy array of the house (obstacle/move maps,
+      the distance field, connected coordinates and region masks of every cached target ...) is stored as
+      a raw .npy file, and the rest of the house state goes into a small pickle with placeholders
+  --> all the other processes on the node attach to the store: the arrays are memory-mapped in
+      copy-on-write mode, so the pages are shared through the OS page cache and never parsed again,
+      and a process that writes to a map only gets a private copy of the touched pages
+  --> concurrent builders of the same house are serialized by a file lock, the entry is written
+      to a temporary folder and renamed, so a crash never leaves a partial entry
+"""
+
+min_shared_bytes = 1 << 16   # smaller arrays stay in the pickle
+store_meta_file = 'house.pkl'
+
+
+class _SharedArray(object):
+    def __init__(self, name):
+        self.name = name
+
+
+def _extract_arrays(obj, arrays):
+    if isinstance(obj, np.ndarray) and (obj.dtype != object) and (obj.nbytes >= min_shared_bytes):
+        name = 'arr_%d' % len(arrays)
+        arrays[name] = obj
+        return _SharedArray(name)
+    if isinstance(obj, dict):
+        return type(obj)([(k, _extract_arrays(v, arrays)) for k, v in obj.items()])
+    if isinstance(obj, list):
+        return [_extract_arrays(v, arrays) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple([_extract_arrays(v, arrays) for v in obj])
+    return obj
+
+
+def _restore_arrays(obj, entry_dir, mmap_mode):
+    if isinstance(obj, _SharedArray):
+        return np.load(os.path.join(entry_dir, obj.name + '.npy'), mmap_mode=mmap_mode)
+    if isinstance(obj, dict):
+        return type(obj)([(k, _restore_arrays(v, entry_dir, mmap_mode)) for k, v in obj.items()])
+    if isinstance(obj, list):
+        return [_restore_arrays(v, entry_dir, mmap_mode) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple([_restore_arrays(v, entry_dir, mmap_mode) for v in obj])
+    return obj
+
+
+def get_entry_dir(store_dir, houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor):
+    return os.path.join(store_dir, '%s_r%d_c%d_o%d' % (houseID, int(genRoomTypeMap), int(cacheAllTarget), int(includeOutdoor)))
+
+
+def save_house(house, entry_dir):
+    tmp_dir = entry_dir + '.tmp%d' % os.getpid()
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    arrays = dict()
+    state = _extract_arrays(dict(house.__dict__), arrays)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), np.ascontiguousarray(arr))
+    with open(os.path.join(tmp_dir, store_meta_file), 'wb') as f:
+        pickle.dump(dict(cls=house.__class__, state=state), f)
+    os.rename(tmp_dir, entry_dir)
+    return sum([arr.nbytes for arr in arrays.values()])
+
+
+def load_house(entry_dir, mmap_mode='c'):
+    """
+    mmap_mode: 'c' to attach to the stored maps copy-on-write, None to read them into memory
+    """
+    with open(os.path.join(entry_dir, store_meta_file), 'rb') as f:
+        data = pickle.load(f)
+    cls = data['cls']
+    house = cls.__new__(cls)
+    house.__dict__.update(_restore_arrays(data['state'], entry_dir, mmap_mode))
+    return house
+
+
+def _build_entry(store_dir, entry_dir, houseID, builder):
+    # build the house into <entry_dir> unless another process has done it, return the house built or None
+    ts = time.time()
+    os.makedirs(store_dir, exist_ok=True)
+    with open(entry_dir + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(os.path.join(entry_dir, store_meta_file)):
+                house = builder()
+                n_bytes = save_house(house, entry_dir)
+                print('[HouseStore] House <%s> built and stored (%.2f MB shared) in %.3fs'
+                      % (houseID, n_bytes / (1 << 20), time.time() - ts))
+                return house
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return None
+
+
+def store_house(store_dir, houseID, builder, genRoomTypeMap=False, cacheAllTarget=False, includeOutdoor=True):
+    """
+    make sure the house is in the store, return its entry folder
+    """
+    entry_dir = get_entry_dir(store_dir, houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor)
+    if not os.path.exists(os.path.join(entry_dir, store_meta_file)):
+        _build_entry(store_dir, entry_dir, houseID, builder)
+    return entry_dir
+
+
+def get_house(store_dir, houseID, builder, genRoomTypeMap=False, cacheAllTarget=False, includeOutdoor=True):
+    """
+    return the house from the store, builder() is called to build the house when it is not in the store yet
+    """
+    entry_dir = get_entry_dir(store_dir, houseID, genRoomTypeMap, cacheAllTarget, includeOutdoor)
+    ts = time.time()
+    if not os.path.exists(os.path.join(entry_dir, store_meta_file)):
+        house = _build_entry(store_dir, entry_dir, houseID, builder)
+        if house is not None:
+            return house
+    house = load_house(entry_dir)
+    print('[HouseStore] House <%s> attached in %.3fs' % (houseID, time.time() - ts))
+    return house
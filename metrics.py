@@ -0,0 +1,195 @@
+import os, sys, time, json, glob, atexit, threading, weakref
+import numpy as np
+
+"""
+Buffered Metrics Logging
+  --> AsyncWriter appends lines to a file from a background thread: write() only appends to an in-memory
+      batch, the batch is written once every <flush_interval> seconds (or when <max_pending> lines are pending)
+      with a single open/write, so logging costs no file open per message
+  --> with <max_bytes>, the file is rotated by size before a batch would exceed it:
+        <file> -> <file>.1 -> ... -> <file>.<backup_count>
+  --> all the writers are flushed at exit, and re-initialized in a forked child (the parent's pending lines are dropped)
+  --> MetricsSink writes typed records as json lines: {"kind": ..., "time": ..., "step": ..., <values>}
+  --> load_metrics() reads the records of a run (including the rotated files) into numpy arrays
+"""
+
+_writers = weakref.WeakSet()
+
+
+class AsyncWriter(object):
+    def __init__(self, filename, flush_interval=1.0, max_pending=10000, max_bytes=None, backup_count=5):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._init_state()
+        _writers.add(self)
+
+    def _init_state(self):
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()  # keeps the batches in order between the thread and flush()
+        self._pending = []
+        self._thread = None
+        self._stop = False
+
+    def write(self, line):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._pending.append(line)
+            if len(self._pending) >= self.max_pending:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if (not self._stop) and (len(self._pending) < self.max_pending):
+                    self._cond.wait(self.flush_interval)
+                stop = self._stop
+            self.flush()
+            if stop:
+                return
+
+    def flush(self):
+        with self._io_lock:
+            with self._cond:
+                lines, self._pending = self._pending, []
+            if len(lines) > 0:
+                self._write(lines)
+
+    def _write(self, lines):
+        data = ''.join(lines)
+        try:
+            if (self.max_bytes is not None) and os.path.exists(self.filename) and \
+               (os.path.getsize(self.filename) + len(data) > self.max_bytes):
+                self._rotate()
+            with open(self.filename, 'a') as f:
+                f.write(data)
+        except Exception as e:
+            print('[AsyncWriter] fail to write <{}>! Err = {}... {} Lines Dropped ...'.format(self.filename, e, len(lines)),
+                  file=sys.stderr)
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            src = '{}.{}'.format(self.filename, i)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(self.filename, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            thread = self._thread
+            self._cond.notify()
+        if (thread is not None) and thread.is_alive():
+            thread.join()
+        self.flush()
+        with self._cond:
+            self._thread = None
+            self._stop = False
+
+
+def flush_all():
+    """
+    write all the pending lines of all the writers, e.g., before a worker process is terminated
+    """
+    for w in list(_writers):
+        w.close()
+
+
+def _reset_after_fork():
+    for w in list(_writers):
+        w._init_state()
+
+
+atexit.register(flush_all)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _to_json(x):
+    if hasattr(x, 'tolist'):  # numpy scalars and arrays
+        return x.tolist()
+    return float(x)
+
+
+class MetricsSink(object):
+    def __init__(self, filename, **writer_args):
+        """
+        writer_args: flush_interval, max_pending, max_bytes, backup_count of AsyncWriter
+        """
+        self.filename = filename
+        self._writer = AsyncWriter(filename, **writer_args)
+
+    def log(self, kind, step=None, **values):
+        record = dict(kind=kind, time=time.time())
+        if step is not None:
+            record['step'] = step
+        record.update(values)
+        self._writer.write(json.dumps(record, default=_to_json) + '\n')
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+
+
+def _metrics_files(filename):
+    rotated = []
+    for f in glob.glob(glob.escape(filename) + '.*'):
+        suffix = f[len(filename) + 1:]
+        if suffix.isdigit():
+            rotated.append((int(suffix), f))
+    files = [f for _, f in sorted(rotated, reverse=True)]  # oldest first
+    if os.path.exists(filename):
+        files.append(filename)
+    return files
+
+
+def load_records(filename, kind=None):
+    """
+    return the list of records (dicts) in <filename> and its rotated files, oldest first
+    """
+    records = []
+    for f in _metrics_files(filename):
+        with open(f, 'r') as fp:
+            for line in fp:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue  # a line cut by a crash
+                if (kind is None) or (r.get('kind') == kind):
+                    records.append(r)
+    return records
+
+
+def load_metrics(filename, kind=None):
+    """
+    return dict: key -> np.array over the records of <kind> (all the records when None)
+      numeric keys are float arrays with nan for the missing entries, the other keys are object arrays
+    """
+    records = load_records(filename, kind)
+    keys = []
+    for r in records:
+        for k in r.keys():
+            if k not in keys:
+                keys.append(k)
+    ret = dict()
+    for k in keys:
+        vals = [r.get(k, None) for r in records]
+        if all([(v is None) or isinstance(v, (int, float)) for v in vals]):
+            ret[k] = np.array([np.nan if v is None else v for v in vals], dtype=np.float64)
+        else:
+            ret[k] = np.empty(len(vals), dtype=object)
+            for i, v in enumerate(vals):
+                ret[k][i] = v
+    return ret
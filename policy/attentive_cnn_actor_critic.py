@@ -74,8 +74,8 @@ class AttentiveJointCNNPolicyCritic(torch.nn.Module):
                 ind_y = (j // self.att_scale[2])
                 self.att_index[0, pos] = ind_x * self.att_shape[2] + ind_y
                 pos += 1
-        self.att_index = torch.from_numpy(self.att_index).type(LongTensor)
-        self.batched_att_index = None
+        self.att_index = torch.from_numpy(self.att_index).long().view(-1)  # attention block of each pixel
+        self._device_att_index = dict()
 
         assert ((len(self.cnn_hiddens) == len(self.kernel_sizes)) and (len(self.strides) == len(self.cnn_hiddens))), \
                 '[JointCNNPolicy] cnn_hiddens, kernel_sizes, strides must share the same length'
@@ -212,6 +212,31 @@ class AttentiveJointCNNPolicyCritic(torch.nn.Module):
                                     conv, x.data.norm(), x.data.var(), x.data.max(), x.data.min()), False)
         return x
 
+    def _get_att_index(self, x):
+        device = x.get_device() if x.is_cuda else -1
+        if device not in self._device_att_index:
+            self._device_att_index[device] = Variable(self.att_index.cuda(device) if device >= 0 else self.att_index)
+        return self._device_att_index[device]
+
+    def _apply_attention(self, x, all_att_mask):
+        """
+        mask the input frames with the attention of their heads, all the channels at once
+        x: [batch, att_heads * att_chn, n_row, n_col]
+        all_att_mask: [batch, att_heads, att_blocks]
+        the last <att_skip> channels of each frame are not masked
+        """
+        batch_size = x.size(0)
+        n_row, n_col = self.inp_shape[1], self.inp_shape[2]
+        # expand the block mask to pixels: [batch, att_heads, 1, n_row, n_col]
+        inp_mask = all_att_mask.index_select(2, self._get_att_index(x)).view(batch_size, self.att_heads, 1, n_row, n_col)
+        x = x.contiguous().view(batch_size, self.att_heads, self.att_chn, n_row, n_col)
+        if self.att_skip == 0:
+            att_x = x * inp_mask.expand_as(x)
+        else:
+            focus_x = x[:, :, :self.att_focus]
+            att_x = torch.cat([focus_x * inp_mask.expand_as(focus_x), x[:, :, self.att_focus:]], dim=2)
+        return att_x.view(batch_size, self.inp_shape[0], n_row, n_col)
+
     def _get_feature_dim(self, D_shape_in, conv_layers=None, bc_layers=None):
         bs = 1
         inp = Variable(torch.rand(bs, *D_shape_in))
@@ -235,15 +260,19 @@ class AttentiveJointCNNPolicyCritic(torch.nn.Module):
             logp = F.log_softmax(logits)
         return logits, prob, logp
 
-    def forward(self, x, action=None, gumbel_noise = 1.0, output_critic = True):
+    def forward(self, x, action=None, gumbel_noise = 1.0, output_critic = True, critic_feature=None,
+                return_critic_feature=False):
         """
         compute the forward pass of the model.
+        critic_feature: the critic feature returned by an earlier pass on the same batch with the same parameters,
+            when given, x is not used and only the critic is computed for <action>
+        return_critic_feature: when True (requires output_critic), return (critic, critic feature)
         return logits and the softmax prob w./w.o. gumbel noise
         """
+        if critic_feature is not None:
+            assert action is not None, '[AttentiveJointCNNPolicyCritic] <critic_feature> requires <action>'
+            return self._forward_critic(critic_feature, action)
         batch_size = x.size(0)
-        if (self.batched_att_index is None) or (self.batched_att_index.size(0) != batch_size):
-            self.batched_att_index = Variable(self.att_index)
-            self.batched_att_index = self.batched_att_index.expand(batch_size, self.inp_shape[1] * self.inp_shape[2])
         # att_feat: feature for manager to create attention mask
         self.att_feat = att_feat = self._forward_feature(x, self.att_conv_layers, self.att_bc_layers)
         att_feat = att_feat.view(-1, self.feat_size)
@@ -255,27 +284,16 @@ class AttentiveJointCNNPolicyCritic(torch.nn.Module):
             #common.debugger.print("------>[P] Forward of Actor Policy, Mid-Feature Norm = {}, Var = {}, Max = {}, Min = {}".format(
             #    att_feat.data.norm(), att_feat.data.var(), att_feat.data.max(), att_feat.data.min()), False)
         raw_feat = att_feat  # feature for computing critic
+        if output_critic and (action is not None):
+            # the critic of a given action only depends on the attention trunk
+            val = self._forward_critic(raw_feat, action)
+            return (val, raw_feat) if return_critic_feature else val
         # compute attention mask
         for l in self.att_linear_layers:
             att_feat = self.func(l(att_feat))  # att_feat: [batch, att_heads * att_blocks]
         att_feat = att_feat.view(-1, self.att_heads, self.att_blocks).view(-1, self.att_blocks)
         all_att_mask = F.softmax(att_feat).view(batch_size, self.att_heads, self.att_blocks)
-        cur_inp_mask = None
-        # compute mask for each channel in each input frame
-        att_x_slides = []
-        for c in range(self.inp_shape[0]):  # x.size(1)
-            c_i = c % self.att_chn
-            c_head = c // self.att_chn
-            if c_i == 0:
-                cur_att_mask = all_att_mask[:, c_head, :]  # [batch_size, att_blocks]
-                cur_inp_mask = torch.gather(cur_att_mask, 1, self.batched_att_index)  # [batch_size, inp_blocks]
-                cur_inp_mask = cur_inp_mask.view(-1, self.inp_shape[1], self.inp_shape[2])
-            cur_slide = x[:, c, :, :]
-            if c_i >= self.att_focus: # skipped channel, no need to attend
-                att_x_slides.append(cur_slide)
-            else:  # apply attention to input signal
-                att_x_slides.append(cur_slide * cur_inp_mask)
-        att_x = torch.stack(att_x_slides, dim=1)
+        att_x = self._apply_attention(x, all_att_mask)
 
         # compute forward phase for actor
         self.feat = feat = self._forward_feature(att_x, self.act_conv_layers, self.act_bc_layers)
@@ -305,10 +323,14 @@ class AttentiveJointCNNPolicyCritic(torch.nn.Module):
                 self.logp.append(_logp)
                 self.prob.append(_prob)
         if not output_critic:
+            assert not return_critic_feature, '[AttentiveJointCNNPolicyCritic] <return_critic_feature> requires <output_critic>'
             return self.prob
         if action is None:
             action = self.prob
+        val = self._forward_critic(raw_feat, action)
+        return (val, raw_feat) if return_critic_feature else val
 
+    def _forward_critic(self, raw_feat, action):
         if isinstance(action, list):
             action = torch.cat(action, dim=-1)  # concatenate actions
 
@@ -7,6 +7,7 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
+from policy.index_embedding import IndexFrameEmbedding
 
 class CNNClassifier(torch.nn.Module):
     def __init__(self, D_shape_in, n_class, hiddens, kernel_sizes=5, strides=2,
@@ -15,13 +16,23 @@ class CNNClassifier(torch.nn.Module):
                  multi_label=False,
                  dropout_rate=None,
                  stack_frame=None,
-                 self_attention_dim=None):
+                 self_attention_dim=None,
+                 index_input=False,
+                 index_embed_dim=None):
         """
         D_shape_in: tupe of two ints, the shape of input images
         n_class: a int for number of semantic classes
         hiddens, kernel_sizes, strides: either an int or a list of ints with the same length
+        index_input: when True, D_shape_in[0] must be n_segmentation_mask, and x in forward() has a single channel
+            of segmentation indices, which is expanded on the device (see policy/index_embedding.py)
+        index_embed_dim: None for one-hot expansion, o.w. the dimension of a learned embedding
         """
         super(CNNClassifier, self).__init__()
+        self.index_expansion = None
+        if index_input:
+            assert D_shape_in[0] == n_segmentation_mask, '[CNNClassifier] index input requires <{}> channels!'.format(n_segmentation_mask)
+            self.index_expansion = IndexFrameEmbedding(n_segmentation_mask, index_embed_dim)
+            D_shape_in = (self.index_expansion.out_dim, D_shape_in[1], D_shape_in[2])
         if isinstance(hiddens, int): hiddens = [hiddens]
         if isinstance(kernel_sizes, int): kernel_sizes = [kernel_sizes]
         if isinstance(strides, int): strides = [strides]
@@ -131,6 +142,8 @@ class CNNClassifier(torch.nn.Module):
         return logits and the softmax prob w./w.o. gumbel noise
         x: shape is [batch, channel, n, m] or [batch, stack_frames, channel, n, m]
         """
+        if self.index_expansion is not None:
+            x = self.index_expansion(x)
         batch_size = x.size(0)
         if self.stack_frame:
             assert len(x.size()) == 5
@@ -187,3 +200,135 @@ class CNNClassifier(torch.nn.Module):
             p = 1. / (1. + torch.exp(-logits))
             ret = p * torch.log(p + 1e-10) + (1 - p) * torch.log(1 - p + 1e-10)
         return ret
+
+
+class FusedCNNClassifier(torch.nn.Module):
+    """
+    Inference-only fusion of a group of CNNClassifiers sharing the same architecture
+      --> the first conv layer is a plain conv with (n_model * h) output channels
+      --> all the following conv layers are grouped convs (groups=n_model)
+      --> linear/attention layers are computed with batched matmul
+    A single forward pass returns the probabilities of all the classifiers.
+    NOTE: dropout is ignored and batch norm uses the running stats (i.e., eval mode)
+    """
+    def __init__(self, models):
+        super(FusedCNNClassifier, self).__init__()
+        assert len(models) > 0, '[FusedCNNClassifier] at least one classifier is required!'
+        m0 = models[0]
+        for m in models:
+            assert (m.hiddens == m0.hiddens) and (m.kernel_sizes == m0.kernel_sizes) and (m.strides == m0.strides), \
+                '[FusedCNNClassifier] all classifiers must share the same conv architecture!'
+            assert (m.stack_frame == m0.stack_frame) and (m.attention_dim == m0.attention_dim), \
+                '[FusedCNNClassifier] all classifiers must share the same stack_frame and attention_dim!'
+            assert (m.multi_label == m0.multi_label) and (m.out_dim == m0.out_dim) and (m.func == m0.func)
+            assert len(m.linear_layers) == len(m0.linear_layers)
+            assert ((m.index_expansion is None) == (m0.index_expansion is None)) and \
+                   ((m.index_expansion is None) or m.index_expansion.onehot), \
+                '[FusedCNNClassifier] index input is only supported with one-hot expansion!'
+        self.n_model = G = len(models)
+        self.out_dim = m0.out_dim
+        self.func = m0.func
+        self.multi_label = m0.multi_label
+        self.stack_frame = m0.stack_frame
+        self.attention_dim = m0.attention_dim
+        self.feat_size = m0.feat_size
+        self.avg_pool = m0.avg_pool
+        self.index_expansion = m0.index_expansion
+
+        # conv layers
+        self.conv_layers = []
+        self.bc_layers = []
+        flag_grouped = False
+        for i, conv in enumerate(m0.conv_layers):
+            if conv is None:  # max pooling layer
+                self.conv_layers.append(None)
+                self.bc_layers.append(m0.bc_layers[i])
+                setattr(self, 'max_pool%d'%i, self.bc_layers[-1])
+                continue
+            h = conv.out_channels
+            cur_conv = nn.Conv2d(conv.in_channels * (G if flag_grouped else 1), h * G,
+                                 kernel_size=conv.kernel_size, stride=conv.stride,
+                                 groups=(G if flag_grouped else 1))
+            cur_conv.weight.data.copy_(torch.cat([m.conv_layers[i].weight.data.cpu() for m in models], 0))
+            cur_conv.bias.data.copy_(torch.cat([m.conv_layers[i].bias.data.cpu() for m in models], 0))
+            self.conv_layers.append(cur_conv)
+            setattr(self, 'conv_layer%d'%i, cur_conv)
+            flag_grouped = True
+            bc = None
+            if m0.bc_layers[i] is not None:
+                for k, l in enumerate(m0.bc_layers[i]):
+                    if isinstance(l, nn.BatchNorm2d):
+                        bc = nn.BatchNorm2d(h * G, eps=l.eps)
+                        all_bc = [m.bc_layers[i][k] for m in models]
+                        bc.weight.data.copy_(torch.cat([b.weight.data.cpu() for b in all_bc], 0))
+                        bc.bias.data.copy_(torch.cat([b.bias.data.cpu() for b in all_bc], 0))
+                        bc.running_mean.copy_(torch.cat([b.running_mean.cpu() for b in all_bc], 0))
+                        bc.running_var.copy_(torch.cat([b.running_var.cpu() for b in all_bc], 0))
+                        setattr(self, 'bc_layer%d'%i, bc)
+            self.bc_layers.append(bc)
+
+        # attention layers, weights stored as [G, in_dim, out_dim]
+        if self.stack_frame and self.attention_dim:
+            self.att_trans_w, self.att_trans_b = self._stack_linear([m.att_trans for m in models])
+            self.att_proj_w, self.att_proj_b = self._stack_linear([m.att_proj for m in models])
+
+        # linear layers
+        self.linear_w = []
+        self.linear_b = []
+        for i in range(len(m0.linear_layers)):
+            w, b = self._stack_linear([m.linear_layers[i] for m in models])
+            setattr(self, 'linear_w%d'%i, w)
+            setattr(self, 'linear_b%d'%i, b)
+            self.linear_w.append(w)
+            self.linear_b.append(b)
+        self.eval()
+
+    def _stack_linear(self, layers):
+        w = torch.stack([l.weight.data.cpu().t() for l in layers], 0)  # [G, in, out]
+        b = torch.stack([l.bias.data.cpu() for l in layers], 0).unsqueeze(1)  # [G, 1, out]
+        return nn.Parameter(w, requires_grad=False), nn.Parameter(b, requires_grad=False)
+
+    def _batched_linear(self, x, w, b):
+        # x: [G, batch, in_dim]
+        return torch.bmm(x, w) + b
+
+    def forward(self, x, return_logits=False):
+        """
+        x: shape is [batch, channel, n, m] or [batch, stack_frames, channel, n, m]
+        return the probabilities (or logits) of all the classifiers, [batch, n_model, n_class]
+        """
+        G = self.n_model
+        if self.index_expansion is not None:
+            x = self.index_expansion(x)
+        batch_size = x.size(0)
+        if self.stack_frame:
+            assert len(x.size()) == 5
+            chn, n, m = x.size(2), x.size(3), x.size(4)
+            x = x.view(-1, chn, n, m)
+        for conv, bc in zip(self.conv_layers, self.bc_layers):
+            if conv is not None:
+                x = conv(x)
+            if bc is not None:
+                x = bc(x)
+            if conv is not None:
+                x = self.func(x)
+        feat = self.avg_pool(x).view(-1, G, self.feat_size).transpose(0, 1).contiguous()   # [G, batch * stack_frame, feat_size]
+        if self.stack_frame:
+            unpacked_feat = feat.view(G, batch_size, self.stack_frame, self.feat_size)
+            if self.attention_dim:
+                hidden = F.tanh(self._batched_linear(unpacked_feat.view(G, batch_size, -1), self.att_trans_w, self.att_trans_b))   # [G, batch, att_dim]
+                proj = self._batched_linear(feat, self.att_proj_w, self.att_proj_b).view(G, batch_size, self.stack_frame, self.attention_dim)
+                att_logits = torch.sum(proj * hidden.unsqueeze(2), dim=-1, keepdim=False)   # [G, batch, stack_frame]
+                weight = F.softmax(att_logits.view(-1, self.stack_frame), dim=-1).view(G, batch_size, self.stack_frame, 1)
+                feat = torch.sum(weight * unpacked_feat, dim=2, keepdim=False)   # [G, batch, feat_size]
+            else:
+                feat = torch.sum(unpacked_feat, dim=2, keepdim=False) / float(self.stack_frame)
+        for i, (w, b) in enumerate(zip(self.linear_w, self.linear_b)):
+            if i > 0:
+                feat = self.func(feat)
+            feat = self._batched_linear(feat, w, b)
+        feat = feat.transpose(0, 1).contiguous()   # [batch, G, n_class]
+        if return_logits: return feat
+        if self.multi_label:
+            return F.sigmoid(feat)
+        return F.softmax(feat.view(-1, self.out_dim), dim=-1).view(batch_size, G, self.out_dim)
@@ -0,0 +1,41 @@
+from headers import *
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+class IndexFrameEmbedding(torch.nn.Module):
+    def __init__(self, n_index=n_segmentation_mask, embed_dim=None):
+        """
+        expand uint8 index segmentation frames on the device
+        input: [..., 1, n_row, n_col], ByteTensor/LongTensor of segmentation indices
+        output: [..., out_dim, n_row, n_col], FloatTensor
+        embed_dim: when None, one-hot expansion with out_dim = n_index (same as AgentTrainer._process_frames)
+            otherwise a learned embedding with out_dim = embed_dim
+        indices >= n_index (unknown) are mapped to all-zero vectors
+        """
+        super(IndexFrameEmbedding, self).__init__()
+        self.n_index = n_index
+        self.onehot = embed_dim is None
+        self.out_dim = n_index if self.onehot else embed_dim
+        if self.onehot:
+            # the table is fixed and kept out of the state dict, so models trained on one-hot frames load as before
+            self.onehot_table = torch.cat([torch.eye(n_index), torch.zeros(1, n_index)], dim=0)
+            self._device_tables = dict()
+        else:
+            self.embed = nn.Embedding(n_index + 1, embed_dim, padding_idx=n_index)
+
+    def forward(self, x):
+        size = x.size()
+        assert size[-3] == 1, '[IndexFrameEmbedding] index frames must have a single channel, received shape <{}>'.format(size)
+        n_pixel = size[-2] * size[-1]
+        idx = x.long().view(-1, n_pixel).clamp(max=self.n_index)
+        if self.onehot:
+            device = x.get_device() if x.is_cuda else -1
+            if device not in self._device_tables:
+                self._device_tables[device] = self.onehot_table.cuda(device) if device >= 0 else self.onehot_table
+            table = Variable(self._device_tables[device])
+            out = table.index_select(0, idx.view(-1)).view(-1, n_pixel, self.out_dim)
+        else:
+            out = self.embed(idx)   # [N, n_pixel, out_dim]
+        out = out.permute(0, 2, 1).contiguous()
+        return out.view(*(tuple(size[:-3]) + (self.out_dim, size[-2], size[-1])))
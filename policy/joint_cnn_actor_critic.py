@@ -185,12 +185,19 @@ class JointCNNPolicyCritic(torch.nn.Module):
             logp = F.log_softmax(logits)
         return logits, prob, logp
 
-    def forward(self, x, action=None, gumbel_noise=1.0, output_critic=True, target=None):
+    def forward(self, x, action=None, gumbel_noise=1.0, output_critic=True, target=None, critic_feature=None,
+                return_critic_feature=False):
         """
         compute the forward pass of the model.
         target: one-hot encoding of instructions, [batch, n_instruction]
+        critic_feature: the shared trunk feature returned by an earlier pass on the same batch with the same parameters,
+            when given, x and target are not used and only the critic is computed for <action>
+        return_critic_feature: when True (requires output_critic), return (critic, shared trunk feature)
         return logits and the softmax prob w./w.o. gumbel noise
         """
+        if critic_feature is not None:
+            assert action is not None, '[JointCNNPolicyCritic] <critic_feature> requires <action>'
+            return self._forward_critic(critic_feature, action)
         self.feat = feat = self._forward_feature(x)
         feat = feat.view(-1, self.feat_size)
         common.debugger.print("------>[P] Forward of Policy, Feature Norm = {}, Var = {}, Max = {}, Min = {}".format(
@@ -236,10 +243,14 @@ class JointCNNPolicyCritic(torch.nn.Module):
                 self.logp.append(_logp)
                 self.prob.append(_prob)
         if not output_critic:
+            assert not return_critic_feature, '[JointCNNPolicyCritic] <return_critic_feature> requires <output_critic>'
             return self.prob
         if action is None:
             action = self.prob
+        val = self._forward_critic(raw_feat, action)
+        return (val, raw_feat) if return_critic_feature else val
 
+    def _forward_critic(self, raw_feat, action):
         if isinstance(action, list):
             action = torch.cat(action, dim=-1)  # concatenate actions
 
@@ -7,6 +7,7 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.autograd import Variable
+from policy.index_embedding import IndexFrameEmbedding
 
 class DiscreteRNNPolicy(torch.nn.Module):
     def __init__(self, D_shape_in, D_out,
@@ -26,14 +27,24 @@ class DiscreteRNNPolicy(torch.nn.Module):
                  ##### ablation test options ######
                  no_skip_connect=False,   # only take the output of rnn to produce policy
                  pure_feed_forward=False,   # when True, convert to feedforward policy
+                 ######## index segmentation input ########
+                 index_input=False,   # when True, input frames are uint8 index frames of a single channel
+                 index_embed_dim=None,   # None: on-device one-hot expansion; o.w. a learned embedding
                  ):
         """
         D_shape_in: (n_channel, n_row, n_col)
         D_out: a int or a list of ints in length of degree of freedoms
         hiddens, kernel_sizes, strides: either an int or a list of ints with the same length
         aux_prediction: None or a list of ints indicating the number of extra prediction task
+        index_input: when True, D_shape_in[0] must be n_segmentation_mask, and x in forward() has a single channel
+            of segmentation indices, which is expanded on the device (see policy/index_embedding.py)
         """
         super(DiscreteRNNPolicy, self).__init__()
+        self.index_expansion = None
+        if index_input:
+            assert D_shape_in[0] == n_segmentation_mask, '[DiscreteRNNPolicy] index input requires <{}> channels!'.format(n_segmentation_mask)
+            self.index_expansion = IndexFrameEmbedding(n_segmentation_mask, index_embed_dim)
+            D_shape_in = (self.index_expansion.out_dim, D_shape_in[1], D_shape_in[2])
         if conv_hiddens is None: conv_hiddens = []
         if kernel_sizes is None: kernel_sizes = []
         if strides is None: strides = []
@@ -275,6 +286,9 @@ class DiscreteRNNPolicy(torch.nn.Module):
             else:
                 h = h.permute(1,0,2)
 
+        if self.index_expansion is not None:
+            x = self.index_expansion(x)
+
         assert x.size(2) == self.in_shape[0], '[RNNPolicy] Expected shape <{}>, Received Batched Shape <{}>'.format(self.in_shape, x.size())
 
         seq_len = x.size(1)
@@ -0,0 +1,224 @@
+import os, sys, time, json, threading
+from functools import wraps
+
+"""
+Span Profiler
+  --> profiler.span(name) (a context manager) or profiler.push(name) ... profiler.pop() times a stage of the code
+  --> spans nest, a stage is identified by its path, e.g., 'update/train/backward'
+  --> disabled by default: span() returns a shared no-op object and push()/pop() return at once,
+      so the instrumentation costs a function call and a flag check per stage
+  --> enable() keeps per-stage stats: count, total, max and a latency histogram with log2 buckets (from 1us),
+      report() prints them with approximate P50/P90/P99 (the upper bound of the bucket)
+  --> enable(trace=True) also records every span as a complete event of the Chrome trace format,
+      export_chrome_trace() writes the events to a json file for chrome://tracing or Perfetto
+  --> enable(cuda_sync=True) calls torch.cuda.synchronize() at the end of every span, so that the asynchronous
+      GPU work is charged to the stage that launched it (slower, only for profiling)
+NOTE:
+  --> the state is per process, the spans of each thread nest independently
+  --> standard stage names: render, env_step, preprocess, inference, replay_sample, update, train,
+      backward, optimizer, target_update, zmq_send, zmq_recv, mask, plan, motion
+"""
+
+n_hist_buckets = 32  # bucket 0: < 1us, bucket i: [2^(i-1), 2^i) us, the last bucket takes everything above
+
+_enabled = False
+_trace = False
+_cuda_sync = False
+_max_events = 1000000
+_n_dropped = 0
+_lock = threading.Lock()
+_local = threading.local()
+_stats = dict()  # path -> [count, total, max, histogram]
+_events = []     # (path, start, duration, thread id)
+_t0 = time.perf_counter()
+
+
+def enable(trace=False, cuda_sync=False, max_events=1000000):
+    global _enabled, _trace, _cuda_sync, _max_events
+    _trace = trace
+    _cuda_sync = cuda_sync
+    _max_events = max_events
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    global _n_dropped
+    with _lock:
+        _stats.clear()
+        del _events[:]
+        _n_dropped = 0
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Span(object):
+    __slots__ = ['name']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        push(self.name)
+        return self
+
+    def __exit__(self, *args):
+        pop()
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(name):
+    if not _enabled:
+        return _null_span
+    return _Span(name)
+
+
+def profile(name):
+    """
+    decorator, times every call of the function as a span
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            push(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                pop()
+        return wrapper
+    return decorator
+
+
+def push(name):
+    if not _enabled:
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    path = name if len(stack) == 0 else stack[-1][0] + '/' + name
+    stack.append((path, time.perf_counter()))
+
+
+def pop():
+    if not _enabled:
+        return
+    stack = getattr(_local, 'stack', None)
+    if not stack:
+        return  # enabled in the middle of a span
+    path, ts = stack.pop()
+    if _cuda_sync:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    _record(path, ts, time.perf_counter() - ts)
+
+
+def _record(path, ts, dur):
+    global _n_dropped
+    b = min(int(dur * 1e6).bit_length(), n_hist_buckets - 1)
+    with _lock:
+        s = _stats.get(path)
+        if s is None:
+            s = _stats[path] = [0, 0.0, 0.0, [0] * n_hist_buckets]
+        s[0] += 1
+        s[1] += dur
+        if dur > s[2]: s[2] = dur
+        s[3][b] += 1
+        if _trace:
+            if len(_events) < _max_events:
+                _events.append((path, ts, dur, threading.get_ident()))
+            else:
+                _n_dropped += 1
+
+
+def _percentile(hist, count, q):
+    k = q * count
+    accu = 0
+    for i, n in enumerate(hist):
+        accu += n
+        if accu >= k:
+            return (2 ** i) * 1e-6
+    return (2 ** (len(hist) - 1)) * 1e-6
+
+
+def stats():
+    """
+    return dict: path -> dict(count, total, mean, max, p50, p90, p99), times in seconds
+    """
+    with _lock:
+        items = [(path, s[0], s[1], s[2], list(s[3])) for path, s in _stats.items()]
+    ret = dict()
+    for path, n, total, mx, hist in items:
+        ret[path] = dict(count=n, total=total, mean=total / n, max=mx,
+                         p50=min(mx, _percentile(hist, n, 0.5)),
+                         p90=min(mx, _percentile(hist, n, 0.9)),
+                         p99=min(mx, _percentile(hist, n, 0.99)))
+    return ret
+
+
+def total(name):
+    """
+    total time (in seconds) of all the spans whose name (the last component of the path) is <name>
+    """
+    with _lock:
+        return sum([s[1] for path, s in _stats.items() if path.split('/')[-1] == name])
+
+
+def count(name):
+    with _lock:
+        return sum([s[0] for path, s in _stats.items() if path.split('/')[-1] == name])
+
+
+def report(logger=None):
+    """
+    print the stats of every stage as a tree, does nothing when the profiler is disabled
+    """
+    if not _enabled:
+        return
+    _print = print if logger is None else logger.print
+    all_stats = stats()
+    _print('[Profiler] Stage Latency (n, total, mean, P50, P90, P99, max) ...')
+    for path in sorted(all_stats.keys()):
+        s = all_stats[path]
+        depth = path.count('/')
+        _print('  %s%-*s n = %d, total = %.3f min, mean = %.3fms, P50 = %.3fms, P90 = %.3fms, P99 = %.3fms, max = %.3fms'
+               % ('  ' * depth, max(1, 24 - 2 * depth), path.split('/')[-1], s['count'], s['total'] / 60,
+                  s['mean'] * 1e3, s['p50'] * 1e3, s['p90'] * 1e3, s['p99'] * 1e3, s['max'] * 1e3))
+    if _n_dropped > 0:
+        _print('  ---> %d trace events dropped (max_events = %d)' % (_n_dropped, _max_events))
+
+
+def export_chrome_trace(filename):
+    """
+    write the recorded spans to <filename> in the Chrome trace format (json)
+    """
+    with _lock:
+        events = list(_events)
+    pid = os.getpid()
+    trace = [dict(name=path.split('/')[-1], cat=path.split('/')[0], ph='X',
+                  ts=(ts - _t0) * 1e6, dur=dur * 1e6, pid=pid, tid=tid, args=dict(path=path))
+             for path, ts, dur, tid in events]
+    try:
+        with open(filename, 'w') as f:
+            json.dump(dict(traceEvents=trace, displayTimeUnit='ms'), f)
+    except Exception as e:
+        print('[Profiler] fail to export trace <{}>! Err = {}... Skipped ...'.format(filename, e), file=sys.stderr)
@@ -16,6 +16,9 @@ TERM="mask"
 
 required="4:253,5:436"
 
+# number of worker processes for sharded evaluation (--backup-rate is ignored when > 1)
+n_proc=1
+
 for exp_len in $all_exp_len
 do
     for ep_len in $all_ep_len
@@ -27,7 +30,7 @@ do
             --only-eval-room-target \
             --planner-obs-noise $noise \
             --motion mixture --mixture-motion-dict $MODEL_DIR \
-            --max-episode-len $ep_len --n-exp-steps $exp_len --max-iters $max_iters \
+            --max-episode-len $ep_len --n-exp-steps $exp_len --max-iters $max_iters --n-eval-proc $n_proc \
             --segmentation-input color --depth-input \
             --rnn-units 256 --rnn-layers 1 --rnn-cell lstm --batch-norm \
             --store-history \
@@ -44,7 +47,7 @@ do
             --only-eval-room-target \
             --planner-obs-noise $noise \
             --motion mixture --mixture-motion-dict $MODEL_DIR \
-            --max-episode-len $ep_len --n-exp-steps $exp_len --plan-dist-iters $required \
+            --max-episode-len $ep_len --n-exp-steps $exp_len --plan-dist-iters $required --n-eval-proc $n_proc \
             --segmentation-input color --depth-input \
             --rnn-units 256 --rnn-layers 1 --rnn-cell lstm --batch-norm \
             --store-history \
@@ -14,6 +14,9 @@ seed="7"
 
 required="4:253,5:436"
 
+# number of worker processes for sharded evaluation (--backup-rate is ignored when > 1)
+n_proc=1
+
 for exp_len in $all_exp_len
 do
     for ep_len in $all_ep_len
@@ -25,7 +28,7 @@ do
             --terminate-measure mask \
             --only-eval-room-target \
             --motion mixture --mixture-motion-dict $MODEL_DIR \
-            --max-episode-len $ep_len --n-exp-steps $exp_len --max-iters $max_iters \
+            --max-episode-len $ep_len --n-exp-steps $exp_len --max-iters $max_iters --n-eval-proc $n_proc \
             --segmentation-input color --depth-input \
             --rnn-units 256 --rnn-layers 1 --rnn-cell lstm --batch-norm \
             --store-history \
@@ -42,7 +45,7 @@ do
             --terminate-measure mask \
             --only-eval-room-target \
             --motion mixture --mixture-motion-dict $MODEL_DIR \
-            --max-episode-len $ep_len --n-exp-steps $exp_len --plan-dist-iters $required \
+            --max-episode-len $ep_len --n-exp-steps $exp_len --plan-dist-iters $required --n-eval-proc $n_proc \
             --segmentation-input color --depth-input \
             --rnn-units 256 --rnn-layers 1 --rnn-cell lstm --batch-norm \
             --store-history \
@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import profiler
+
+"""
+LRU Render Cache
+  --> with discrete actions and discrete angles, a rendered frame is a function of (house, location, yaw, mode)
+  --> RenderCache wraps env.render() of the task returned by common.create_env() and serves
+      frames from a bounded in-process LRU cache
+  --> key_mode:
+        'exact': the location is the continuous position rounded to 1e-3 (default)
+        'grid': the location is the grid cell of the agent, a frame is only cached and served when the agent
+                is at the center of its cell (within 1e-3), other locations are rendered without the cache
+  --> a cache is owned by a single process (e.g., one ZMQ simulator), so no locking is needed
+"""
+
+
+class RenderCache(object):
+    def __init__(self, env, max_size=10000, key_mode='exact'):
+        """
+        env: the House3D environment, i.e., task.env
+        max_size: maximum number of cached frames
+        """
+        assert key_mode in ['grid', 'exact'], '[RenderCache] invalid key_mode <{}>'.format(key_mode)
+        self.env = env
+        self.max_size = max_size
+        self.key_mode = key_mode
+        self._render_func = env.render
+        self._cache = OrderedDict()
+        self.n_hit = 0
+        self.n_miss = 0
+        self.n_bypass = 0  # 'grid' mode: renders off the cell centers
+        self.render_time = 0.0
+        env.render = self.render
+
+    def _get_key(self, mode, kwargs):
+        """
+        return None when the frame must not be cached
+        """
+        info = self.env.info
+        if self.key_mode == 'grid':
+            loc = tuple(info['grid'])
+            cx, cy = self.env.house.to_coor(loc[0], loc[1], True)
+            if (abs(info['loc'][0] - cx) > 1e-3) or (abs(info['loc'][1] - cy) > 1e-3):
+                return None
+        else:
+            loc = (round(info['loc'][0], 3), round(info['loc'][1], 3))
+        yaw = int(round(info['yaw'])) % 360
+        return (self.env.house._id, loc, yaw, mode, tuple(sorted(kwargs.items())))
+
+    def render(self, mode='rgb', **kwargs):
+        key = self._get_key(mode, kwargs)
+        if key is None:
+            self.n_bypass += 1
+            with profiler.span('render'):
+                return np.array(self._render_func(mode=mode, **kwargs), copy=True)
+        if key in self._cache:
+            self.n_hit += 1
+            self._cache.move_to_end(key)
+            return self._cache[key].copy()
+        self.n_miss += 1
+        ts = time.time()
+        with profiler.span('render'):
+            frame = np.array(self._render_func(mode=mode, **kwargs), copy=True)  # the renderer may return a view of its buffer
+        self.render_time += time.time() - ts
+        self._cache[key] = frame
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return frame.copy()
+
+    def clear(self):
+        self._cache.clear()
+
+    def hit_rate(self):
+        n_total = self.n_hit + self.n_miss
+        return self.n_hit / n_total if n_total > 0 else 0
+
+    def saved_time(self):
+        # estimated render time saved by cache hits
+        if self.n_miss == 0:
+            return 0
+        return self.n_hit * self.render_time / self.n_miss
+
+    def stats_string(self):
+        return '[RenderCache] size = %d / %d, hit rate = %.4f (%d / %d), bypassed = %d, render time = %.2fs, saved time ~ %.2fs' \
+               % (len(self._cache), self.max_size, self.hit_rate(), self.n_hit, self.n_hit + self.n_miss, self.n_bypass,
+                  self.render_time, self.saved_time())
@@ -0,0 +1,87 @@
+import numpy as np
+import torch
+
+"""
+Discounted Returns and GAE
+  --> all the functions work on [batch, T] tensors on any device and return tensors of the same type
+  --> the backward recursion y_t = x_t + d_t * y_{t+1} is evaluated as a reverse scan:
+        y_t = sum_{k >= t} (prod_{t <= j < k} d_j) * x_k + (prod_{t <= j < T} d_j) * y_T
+      the products come from one cumprod over a [batch, T, T] matrix, so there is no per-step loop in python
+  --> sequences longer than <scan_block> are scanned in blocks from the end to bound the memory
+NOTE:
+  --> masks are *continuation* masks (1 - done): m_t = 0 cuts the bootstrap from step t + 1
+"""
+
+scan_block = 128
+
+
+def _scan_block(x, discounts, bootstrap):
+    batch, T = x.size()
+    upper = x.new(T, T).fill_(1).triu()  # upper[t, j] = 1 if j >= t
+    # D[b, t, j] = d[b, j] if j >= t else 1
+    D = discounts.unsqueeze(1).expand(batch, T, T) * upper.unsqueeze(0).expand(batch, T, T) \
+        + (1 - upper).unsqueeze(0).expand(batch, T, T)
+    P = torch.cumprod(D, 2)  # P[b, t, k] = prod_{t <= j <= k} d[b, j] for k >= t, 1 for k < t
+    # W[b, t, k] = prod_{t <= j < k} d[b, j] for k >= t, 0 for k < t
+    W = torch.cat([x.new(batch, T, 1).fill_(1), P], dim=2)
+    W = W * torch.cat([upper, x.new(T, 1).fill_(1)], dim=1).unsqueeze(0).expand(batch, T, T + 1)
+    y = (W[:, :, :T] * x.unsqueeze(1).expand(batch, T, T)).sum(2).view(batch, T)
+    if bootstrap is not None:
+        y = y + W[:, :, T].contiguous().view(batch, T) * bootstrap.contiguous().view(batch, 1).expand(batch, T)
+    return y
+
+
+def discount_scan(x, discounts, bootstrap=None):
+    """
+    y_t = x_t + discounts_t * y_{t+1}, y_T = bootstrap
+    x, discounts: [batch, T]
+    bootstrap: [batch] or None (zero)
+    return y: [batch, T]
+    """
+    assert x.dim() == 2 and x.size() == discounts.size(), \
+        '[returns.discount_scan] x and discounts must be [batch, T] tensors of the same size'
+    T = x.size(1)
+    if T <= scan_block:
+        return _scan_block(x, discounts, bootstrap)
+    blocks = []
+    for lo in range((T - 1) // scan_block * scan_block, -1, -scan_block):
+        hi = min(lo + scan_block, T)
+        y = _scan_block(x[:, lo:hi].contiguous(), discounts[:, lo:hi].contiguous(), bootstrap)
+        bootstrap = y[:, 0]
+        blocks.append(y)
+    blocks.reverse()
+    return torch.cat(blocks, dim=1)
+
+
+def discounted_returns(rewards, masks, gamma, bootstrap=None):
+    """
+    R_t = r_t + gamma * m_t * R_{t+1}, R_T = bootstrap (e.g., the value of the last observation)
+    rewards, masks: [batch, T]
+    """
+    return discount_scan(rewards, masks * gamma, bootstrap)
+
+
+def gae(rewards, values, next_value, masks, gamma, lam):
+    """
+    generalized advantage estimation
+      delta_t = r_t + gamma * m_t * V_{t+1} - V_t
+      A_t = delta_t + gamma * lam * m_t * A_{t+1}
+    rewards, values, masks: [batch, T]
+    next_value: [batch], the value of the observation after the last step
+    return advantages A: [batch, T]
+    """
+    batch, T = values.size()
+    nxt_values = torch.cat([values[:, 1:], next_value.contiguous().view(batch, 1)], dim=1)
+    deltas = rewards + nxt_values * masks * gamma - values
+    return discount_scan(deltas, masks * (gamma * lam))
+
+
+def discount_with_dones(rewards, dones, gamma):
+    """
+    numpy version for 1-D sequences, the reward of a done step is dropped as well:
+      R_t = (r_t + gamma * R_{t+1}) * (1 - done_t)
+    return np.array of R
+    """
+    keep = 1.0 - torch.from_numpy(np.asarray(dones, dtype=np.float64)).view(1, -1)
+    rew = torch.from_numpy(np.asarray(rewards, dtype=np.float64)).view(1, -1)
+    return discount_scan(rew * keep, keep * gamma).view(-1).numpy()
@@ -0,0 +1,291 @@
+import sys, os, time
+from collections import deque
+
+import numpy as np
+
+from House3D.house import ALLOWED_TARGET_ROOM_TYPES, ALLOWED_OBJECT_TARGET_TYPES
+from atlas_env import AtlasRoomNavTask, combined_target_list, combined_target_index
+
+"""
+Synthetic Stand-In Environment
+  --> SyntheticHouse procedurally generates a grid house from a seed (the house index):
+      n_rx x n_ry rectangular rooms separated by 1-cell walls, doors from a random spanning tree plus a few loops,
+      a kitchen in every house, and a few target objects placed inside the rooms
+  --> the house has the same interface as atlas_env.AtlasHouse, so SyntheticRoomNavTask re-uses the whole
+      AtlasRoomNavTask (reset/step/info/get_feature_mask/_render_panoramic ...), including its continuous
+      movement model, and additionally provides get_optimal_plan() and the target mask signal
+  --> the lattice nodes are the cell centers of the house grid (grid_det = spacing), a cell is walkable iff it is
+      inside a room or a door
+  --> frames are uint8 noise of the configured resolution served from a small shared bank,
+      feature masks are computed from the geometry: the current room, the rooms behind visible doors
+      and the visible objects in the current room (field of view = synthetic_fov degrees)
+  --> NO House3D assets, config.json or renderer are needed, only the House3D python package for the target lists
+NOTE:
+  --> this is a stand-in for testing and benchmarking (see benchmark.py), the frames carry NO visual information
+"""
+
+synthetic_fov = 90
+synthetic_object_sight = 3   # in lattice cells
+synthetic_bank_size = 64
+_noise_bank = dict()
+
+
+def _get_noise_bank(resolution, n_chn):
+    key = (resolution, n_chn)
+    if key not in _noise_bank:
+        rng = np.random.RandomState(n_chn)
+        w, h = resolution
+        _noise_bank[key] = rng.randint(256, size=(synthetic_bank_size, h, w, n_chn)).astype(np.uint8)
+    return _noise_bank[key]
+
+
+class _FrameBank(object):
+    """
+    frames[node, yaw] of a synthetic house, a view into the shared noise bank
+    """
+    def __init__(self, bank, node_room, n_yaw, offset):
+        self.bank = bank
+        self.node_room = node_room
+        self.n_yaw = n_yaw
+        self.offset = offset
+
+    def __getitem__(self, idx):
+        node, yaw_ind = idx
+        k = ((self.offset + self.node_room[node]) * self.n_yaw + yaw_ind) * 7 + node
+        return self.bank[k % len(self.bank)]
+
+
+def _grid_bfs(room_map, sources):
+    # 4-neighbour BFS over walkable cells (room_map >= 0) from a list of source cells, -1 if unreachable
+    dist = np.ones(room_map.shape, dtype=np.int32) * -1
+    que = deque()
+    for i, j in sources:
+        dist[i, j] = 0
+        que.append((i, j))
+    n, m = room_map.shape
+    while len(que) > 0:
+        i, j = que.popleft()
+        for ni, nj in [(i + 1, j), (i - 1, j), (i, j + 1), (i, j - 1)]:
+            if (ni >= 0) and (nj >= 0) and (ni < n) and (nj < m) and (room_map[ni, nj] >= 0) and (dist[ni, nj] < 0):
+                dist[ni, nj] = dist[i, j] + 1
+                que.append((ni, nj))
+    return dist
+
+
+class SyntheticHouse(object):
+    def __init__(self, seed, resolution=(120, 90), n_yaw=12, spacing=0.5, rot_sensitivity=30):
+        rng = np.random.RandomState(seed)
+        self._id = 'synthetic_%d' % seed
+        self.n_yaw = n_yaw
+        self.spacing = spacing
+        self.coor_lo = 0
+
+        # layout
+        n_rx, n_ry = rng.randint(2, 4, size=2)
+        widths = rng.randint(3, 7, size=n_rx)
+        heights = rng.randint(3, 7, size=n_ry)
+        x_lo = 1 + np.concatenate([[0], np.cumsum(widths + 1)[:-1]])
+        y_lo = 1 + np.concatenate([[0], np.cumsum(heights + 1)[:-1]])
+        room_map = np.ones((np.sum(widths) + n_rx + 1, np.sum(heights) + n_ry + 1), dtype=np.int32) * -1
+        rooms = []
+        for a in range(n_rx):
+            for b in range(n_ry):
+                room_map[x_lo[a]:x_lo[a] + widths[a], y_lo[b]:y_lo[b] + heights[b]] = len(rooms)
+                rooms.append((a, b))
+        n_room = len(rooms)
+
+        # doors
+        edges = []
+        for r, (a, b) in enumerate(rooms):
+            if a + 1 < n_rx: edges.append((r, r + n_ry))
+            if b + 1 < n_ry: edges.append((r, r + 1))
+        rng.shuffle(edges)
+        parent = list(range(n_room))
+        def _find(x):
+            while parent[x] != x:
+                x = parent[x]
+            return x
+        self.doors = []
+        self.room_graph = [[] for _ in range(n_room)]
+        for r1, r2 in edges:
+            if _find(r1) == _find(r2) and (rng.rand() > 0.25):
+                continue
+            parent[_find(r1)] = _find(r2)
+            a, b = rooms[r1]
+            if rooms[r2][0] != a:   # neighbours along x
+                i, j = x_lo[a] + widths[a], rng.randint(y_lo[b], y_lo[b] + heights[b])
+            else:
+                i, j = rng.randint(x_lo[a], x_lo[a] + widths[a]), y_lo[b] + heights[b]
+            room_map[i, j] = r1
+            self.doors.append((i, j, r1, r2))
+            self.room_graph[r1].append(r2)
+            self.room_graph[r2].append(r1)
+
+        # room types and objects
+        other_types = [t for t in ALLOWED_TARGET_ROOM_TYPES if t not in ['kitchen', 'outdoor']]
+        types = ['kitchen'] + [str(t) for t in rng.choice(other_types, n_room - 1, replace=(n_room - 1 > len(other_types)))]
+        rng.shuffle(types)
+        if ('outdoor' in ALLOWED_TARGET_ROOM_TYPES) and (types[-1] != 'kitchen') and (rng.rand() < 0.3):
+            types[-1] = 'outdoor'
+        self.room_types = types
+        n_obj = min(len(ALLOWED_OBJECT_TARGET_TYPES), rng.randint(n_room, 2 * n_room + 1))
+        self.objects = []
+        for t in rng.choice(ALLOWED_OBJECT_TARGET_TYPES, n_obj, replace=False):
+            r = rng.randint(n_room)
+            a, b = rooms[r]
+            i, j = rng.randint(x_lo[a], x_lo[a] + widths[a]), rng.randint(y_lo[b], y_lo[b] + heights[b])
+            self.objects.append((str(t), i, j, r))
+
+        # lattice
+        self.room_map = room_map
+        self.nodes = np.argwhere(room_map >= 0)
+        self.n_node = len(self.nodes)
+        self.lattice = np.ones(room_map.shape, dtype=np.int32) * -1
+        self.lattice[self.nodes[:, 0], self.nodes[:, 1]] = np.arange(self.n_node)
+        self.grids = self.nodes.astype(np.int32)
+        self.movable = (room_map >= 0).astype(np.uint8)
+        self.grid_det = spacing
+        self.L_lo = self.coor_lo - spacing / 2   # node (i, j) is the center of grid (i, j)
+        self.node_room = room_map[self.nodes[:, 0], self.nodes[:, 1]]
+        self.all_desired_roomTypes = [t for t in ALLOWED_TARGET_ROOM_TYPES if t in types]
+        self.all_desired_targetObj = [t for t in ALLOWED_OBJECT_TARGET_TYPES if t in [o[0] for o in self.objects]]
+        self.targets = self.all_desired_roomTypes + self.all_desired_targetObj
+        self.target_index = dict([(t, k) for k, t in enumerate(self.targets)])
+
+        # visibility
+        angles = np.arange(n_yaw) * 2 * np.pi / n_yaw
+        dirs = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        def _in_view(points):
+            # [n_node, n_yaw, n_points] of bool, and the distance [n_node, n_points]
+            vec = np.array(points, dtype=np.float32)[None, :, :] - self.nodes[:, None, :]
+            d = np.sqrt(np.sum(vec ** 2, axis=2))
+            cos_ang = np.einsum('nmk,yk->nym', vec, dirs) / np.maximum(d, 1e-8)[:, None, :]
+            return (cos_ang >= np.cos(np.deg2rad(synthetic_fov / 2))) | (d[:, None, :] < 0.5), d
+        self.mask = mask = np.zeros((self.n_node, n_yaw, len(combined_target_list)), dtype=np.uint8)
+        self.insight = insight = np.zeros((self.n_node, n_yaw, len(self.targets)), dtype=np.uint8)
+        for r, t in enumerate(types):
+            in_room = (self.node_room == r)
+            mask[in_room, :, combined_target_index[t]] = 1
+            insight[in_room, :, self.target_index[t]] = 1
+        view, _ = _in_view([(i, j) for i, j, _, _ in self.doors])
+        for k, (_, _, r1, r2) in enumerate(self.doors):
+            for r_in, r_out in [(r1, r2), (r2, r1)]:
+                vis = view[:, :, k] & (self.node_room == r_in)[:, None]
+                mask[:, :, combined_target_index[types[r_out]]] |= vis.astype(np.uint8)
+        view, d = _in_view([(i, j) for _, i, j, _ in self.objects])
+        for k, (t, _, _, r) in enumerate(self.objects):
+            vis = view[:, :, k] & (self.node_room == r)[:, None]
+            mask[:, :, combined_target_index[t]] |= vis.astype(np.uint8)
+            insight[:, :, self.target_index[t]] |= (vis & (d[:, None, k] <= synthetic_object_sight)).astype(np.uint8)
+
+        # distances (in lattice cells)
+        self.dist = np.zeros((len(self.targets), self.n_node), dtype=np.int32)
+        for k in range(len(self.targets)):
+            src = self.nodes[np.any(insight[:, :, k] > 0, axis=1)]
+            self.dist[k] = _grid_bfs(room_map, src)[self.nodes[:, 0], self.nodes[:, 1]]
+        self.room_dist = np.zeros((n_room, self.n_node), dtype=np.int32)
+        for r in range(n_room):
+            src = self.nodes[self.node_room == r]
+            self.room_dist[r] = _grid_bfs(room_map, src)[self.nodes[:, 0], self.nodes[:, 1]]
+
+        # frames
+        self.frames = dict()
+        for key, n_chn in [('rgb', 3), ('depth', 1), ('semantic', 3)]:
+            self.frames[key] = _FrameBank(_get_noise_bank(resolution, n_chn), self.node_room, n_yaw, seed * 31)
+
+        self.meta = dict(house_id=self._id, n_node=self.n_node, n_yaw=n_yaw, spacing=spacing,
+                         coor_lo=self.coor_lo, grid_per_step=1,
+                         move_sensitivity=spacing, rot_sensitivity=rot_sensitivity,
+                         all_desired_roomTypes=self.all_desired_roomTypes,
+                         all_desired_targetObj=self.all_desired_targetObj,
+                         targets=self.targets)
+
+    def to_coor(self, node):
+        i, j = self.nodes[node]
+        return self.coor_lo + i * self.spacing, self.coor_lo + j * self.spacing
+
+    def to_grid(self, x, y):
+        return int((x - self.L_lo) // self.grid_det), int((y - self.L_lo) // self.grid_det)
+
+    def targetDist(self, target, gx, gy):
+        if target not in self.target_index:
+            return -1
+        node = self.lattice[gx, gy] if self.lattice[gx, gy] >= 0 else \
+            np.argmin(np.sum(np.abs(self.grids - np.array([gx, gy])), axis=1))
+        return self.dist[self.target_index[target], node]
+
+
+class SyntheticRoomNavTask(AtlasRoomNavTask):
+    def __init__(self, house_seeds, resolution=(120, 90),
+                 segment_input=False, joint_visual_signal=False, depth_signal=False, target_mask_signal=False,
+                 max_steps=-1, success_measure='see', reward_type='none', reward_silence=0,
+                 include_object_target=False, include_outdoor_target=True,
+                 hardness=None, max_birthplace_steps=None, min_birth_grid_dist=0,
+                 n_yaw=12, move_sensitivity=0.5, rot_sensitivity=30):
+        """
+        house_seeds: a list of house indices, each index generates a different SyntheticHouse
+        resolution: (width, height) of the frames, i.e., common.resolution
+        """
+        ts = time.time()
+        if success_measure != 'see':
+            print('[SyntheticRoomNavTask] Warning: success measure <{}> is not supported, use <see> instead!'.format(success_measure))
+            success_measure = 'see'
+        if (reward_type != 'none') or (reward_silence != 0):
+            print('[SyntheticRoomNavTask] Warning: reward type <{}> with silence {} is not supported, use <none> instead!'.format(reward_type, reward_silence))
+            reward_type, reward_silence = 'none', 0
+        houses = [SyntheticHouse(s, resolution, n_yaw=n_yaw, spacing=move_sensitivity, rot_sensitivity=rot_sensitivity)
+                  for s in house_seeds]
+        super(SyntheticRoomNavTask, self).__init__(houses,
+                                                   segment_input=segment_input,
+                                                   joint_visual_signal=joint_visual_signal,
+                                                   depth_signal=depth_signal,
+                                                   max_steps=max_steps, success_measure=success_measure,
+                                                   reward_type=reward_type, reward_silence=reward_silence,
+                                                   include_object_target=include_object_target,
+                                                   include_outdoor_target=include_outdoor_target,
+                                                   hardness=hardness, max_birthplace_steps=max_birthplace_steps,
+                                                   min_birth_grid_dist=min_birth_grid_dist)
+        self.target_mask_signal = target_mask_signal
+        self.init_time = time.time() - ts
+
+    def _gen_obs(self, node=None, yaw_ind=None):
+        obs = super(SyntheticRoomNavTask, self)._gen_obs(node, yaw_ind)
+        if self.target_mask_signal:
+            if node is None: node = self._node
+            if yaw_ind is None: yaw_ind = self._yaw_ind
+            flag = (self._target is not None) and (self.house.insight[node, yaw_ind, self.house.target_index[self._target]] > 0)
+            tar_mask = np.ones(obs.shape[:2] + (1,), dtype=np.uint8) * (255 if flag else 0)
+            obs = np.concatenate([obs, tar_mask], axis=-1)
+        return obs
+
+    def get_optimal_plan(self):
+        """
+        return a list of (room_type or object, steps) along the shortest room path to the current target
+          the first entry is the current room
+        """
+        house = self.house
+        curr = house.node_room[self._node]
+        if self._target in house.all_desired_roomTypes:
+            goals = [r for r, t in enumerate(house.room_types) if t == self._target]
+        else:
+            goals = [r for t, _, _, r in house.objects if t == self._target]
+        goal = goals[int(np.argmin([house.room_dist[r, self._node] for r in goals]))]
+        # BFS over the room graph
+        prev = {curr: None}
+        que = deque([curr])
+        while len(que) > 0:
+            r = que.popleft()
+            if r == goal: break
+            for q in house.room_graph[r]:
+                if q not in prev:
+                    prev[q] = r
+                    que.append(q)
+        path = []
+        r = goal
+        while r is not None:
+            path.append(r)
+            r = prev[r]
+        plan = [(house.room_types[r], int(house.room_dist[r, self._node])) for r in reversed(path)]
+        if self._target not in house.all_desired_roomTypes:
+            plan.append((self._target, int(self._target_dist())))
+        return plan
@@ -1,6 +1,8 @@
 from headers import *
 import common
 import utils
+import profiler
+import checkpoint
 
 import os, sys, time, pickle, json, argparse
 import numpy as np
@@ -60,7 +62,8 @@ def train(args=None,
                             render_device=args['render_gpu'],
                             cacheAllTarget=args['multi_target'],
                             use_discrete_action=('dpg' not in algo),
-                            include_object_target=include_object_target)
+                            include_object_target=include_object_target,
+                            synthetic_env=args.get('synthetic_env', False))
     trainer = common.create_trainer(algo, model_name, args)
     logger = utils.MyLogger(log_dir, True)
     if multi_target:
@@ -103,19 +106,22 @@ def train(args=None,
     best_res = -1e50
     elap = time.time()
     update_times = 0
+    profile_trace = args['profile_trace'] if 'profile_trace' in args else None
     print('Starting iterations...')
     try:
         while(len(episode_rewards) <= iters):
             idx = trainer.process_observation(obs)
             # get action
-            if scheduler is not None:
-                noise_level = scheduler.value(len(episode_rewards) - 1)
-                action = trainer.action(noise_level)
-            else:
-                action = trainer.action()
+            with profiler.span('inference'):
+                if scheduler is not None:
+                    noise_level = scheduler.value(len(episode_rewards) - 1)
+                    action = trainer.action(noise_level)
+                else:
+                    action = trainer.action()
             #proc_action = [np.exp(a) for a in action]
             # environment step
-            obs, rew, done, info = env.step(action)
+            with profiler.span('env_step'):
+                obs, rew, done, info = env.step(action)
             assert not np.any(np.isnan(obs)), 'nan detected in the observation!'
             obs = obs.transpose([1, 0, 2])
             episode_step += 1
@@ -129,13 +135,14 @@ def train(args=None,
 
             if done or terminal:
                 trainer.reset_agent()
-                if multi_target:
-                    obs = env.reset()
-                    target_room = env.info['target_room']
-                    trainer.set_target(target_room)
-                    episode_targets.append(target_room)
-                else:
-                    obs = env.reset(target='kitchen')
+                with profiler.span('env_reset'):
+                    if multi_target:
+                        obs = env.reset()
+                        target_room = env.info['target_room']
+                        trainer.set_target(target_room)
+                        episode_targets.append(target_room)
+                    else:
+                        obs = env.reset(target='kitchen')
                 assert not np.any(np.isnan(obs)), 'nan detected in the observation!'
                 obs = obs.transpose([1, 0, 2])
                 episode_step = 0
@@ -146,7 +153,8 @@ def train(args=None,
 
             # update all trainers
             trainer.preupdate()
-            stats = trainer.update()
+            with profiler.span('update'):
+                stats = trainer.update()
             if stats is not None:
                 update_times += 1
                 if common.debugger is not None:
@@ -173,6 +181,9 @@ def train(args=None,
                         logger.print('  >> %s = %.4f' % (k, stats[k]))
                 logger.print('  >> Reward  = %.4f' % np.mean(episode_rewards[-eval_range:]))
                 logger.print('  >> Success Rate  = %.4f' % np.mean(episode_success[-eval_range:]))
+                logger.log('train', step=update_times, n_episode=len(episode_rewards), n_sample=t,
+                           avg_rew=np.mean(episode_rewards[-eval_range:]), avg_succ=np.mean(episode_success[-eval_range:]),
+                           elapsed=time.time() - elap, **(stats or dict()))
                 if multi_target:
                     ep_rew = episode_rewards[-eval_range:]
                     ep_suc = episode_success[-eval_range:]
@@ -190,15 +201,16 @@ def train(args=None,
                     for k in tar_stats.keys():
                         n, r, s, l = tar_stats[k]
                         logger.print('  --> Multi-Room<%s> Freq = %.4f, Rew = %.4f, Succ = %.4f (AvgLen = %.3f)' % (k, n / total_n, r / n, s / n, l / n))
-                print('----> Data Loading Time = %.4f min' % (time_counter[-1] / 60))
-                print('----> GPU Data Transfer Time = %.4f min' % (time_counter[0] / 60))
-                print('----> Training Time = %.4f min' % (time_counter[1] / 60))
-                print('----> Target Net Update Time = %.4f min' % (time_counter[2] / 60))
+                profiler.report(logger)
+                if profiler.is_enabled() and (update_times > 0):
+                    logger.print('----> Updates/s = %.3f' % (update_times / profiler.total('update')))
 
             t += 1
     except KeyboardInterrupt:
         print('Keyboard Interrupt!!!!!!')
     trainer.save(save_dir, "final")
+    if profile_trace is not None:
+        profiler.export_chrome_trace(profile_trace)
     with open(save_dir+'/final_training_stats.pkl', 'wb') as f:
         pickle.dump([episode_rewards, episode_success, episode_targets, episode_length], f)
 
@@ -238,6 +250,11 @@ def parse_args():
     parser.set_defaults(object_target=False)
     parser.add_argument("--render-gpu", type=int,
                         help="An integer indicating the gpu_id for render. Default by choosing the first GPU in all the accessible devices.")
+    parser.add_argument("--synthetic-env", dest='synthetic_env', action='store_true',
+                        help="when set, train in the synthetic stand-in environment (see synthetic_env.py), no House3D assets needed")
+    parser.set_defaults(synthetic_env=False)
+    parser.add_argument("--house-init-workers", type=int, default=0,
+                        help="when > 1, a multi-house environment is built by this many worker processes (see common.create_houses_parallel); default serial")
     # Core training parameters
     parser.add_argument("--algo", choices=['ddpg','pg', 'rdpg', 'ddpg_joint', 'ddpg_alter', 'ddpg_eagle',
                                            'a2c', 'qac', 'dqn'], default="ddpg", help="algorithm")
@@ -253,6 +270,13 @@ def parse_args():
     parser.add_argument("--max-iters", type=int, default=int(2e6), help="maximum number of training episodes")
     parser.add_argument("--target-net-update-rate", type=float, help="update rate for target networks")
     parser.add_argument("--target-net-update-freq", type=int, help="[Only For DQN] update (copy) frequency for target network. This will De-effect --target-net-update-rate")
+    parser.add_argument("--grad-clip-global", dest='grad_clip_global', action='store_true',
+                        help="when set, clip the gradients by their global norm instead of the norm of each parameter")
+    parser.set_defaults(grad_clip_global=False)
+    parser.add_argument("--reuse-trunk-feature", dest='reuse_trunk_feature', action='store_true',
+                        help="[ddpg_joint] run the shared trunk of the joint model once per batch in each update, "
+                             "the critic loss reuses the trunk feature of the policy loss, gradients are unchanged")
+    parser.set_defaults(reuse_trunk_feature=False)
     parser.add_argument("--batch-norm", action='store_true', dest='use_batch_norm',
                         help="Whether to use batch normalization in the policy network. default=False.")
     parser.set_defaults(use_batch_norm=False)
@@ -298,11 +322,23 @@ def parse_args():
     parser.add_argument("--save-dir", type=str, default="./_model_", help="directory in which training state and model should be saved")
     parser.add_argument("--log-dir", type=str, default="./log", help="directory in which logs training stats")
     parser.add_argument("--save-rate", type=int, default=1000, help="save model once every time this many episodes are completed")
+    parser.add_argument("--keep-checkpoints", type=int, default=1,
+                        help="keep the last this many checkpoints of every saved model (as <file>.1, <file>.2, ...)")
     parser.add_argument("--report-rate", type=int, default=50, help="report training stats once every time this many training steps are performed")
     parser.add_argument("--warmstart", type=str, help="model to recover from. can be either a directory or a file.")
     parser.add_argument("--debug", action="store_true", dest="debug", help="log all the computation details")
     parser.add_argument("--no-debug", action="store_false", dest="debug", help="turn off debug logs")
     parser.set_defaults(debug=False)
+    parser.add_argument("--debug-log-freq", type=int, default=1, help="with --debug, log the parameter stats once every this many updates")
+    # Profiling
+    parser.add_argument("--profile", dest='profile', action='store_true',
+                        help="time the stages of training (env, inference, replay sample, backward, optimizer ...) "
+                             "and report their latency stats together with the training stats")
+    parser.add_argument("--profile-trace", type=str,
+                        help="[implies --profile] write every timed span to this file in the Chrome trace format")
+    parser.add_argument("--profile-cuda-sync", dest='profile_cuda_sync', action='store_true',
+                        help="[with --profile] synchronize cuda at the end of every span, so GPU time is charged to the right stage")
+    parser.set_defaults(profile=False, profile_cuda_sync=False)
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -312,6 +348,7 @@ if __name__ == '__main__':
     print('>> Environment Set = <%s>, Total %d Houses!' % (cmd_args.env_set, len(common.all_houseIDs)))
 
     common.ensure_object_targets(cmd_args.object_target)
+    common.house_init_workers = cmd_args.house_init_workers
 
     if cmd_args.seed is not None:
         np.random.seed(cmd_args.seed)
@@ -360,6 +397,13 @@ if __name__ == '__main__':
 
     args['target_net_update_rate']=cmd_args.target_net_update_rate
     args['target_net_update_freq']=cmd_args.target_net_update_freq
+    args['grad_clip_global']=cmd_args.grad_clip_global
+    args['reuse_trunk_feature']=cmd_args.reuse_trunk_feature
+    args['debug_log_freq']=cmd_args.debug_log_freq
+    args['profile_trace']=cmd_args.profile_trace
+    checkpoint.configure(keep_last=cmd_args.keep_checkpoints)
+    if cmd_args.profile or (cmd_args.profile_trace is not None):
+        profiler.enable(trace=(cmd_args.profile_trace is not None), cuda_sync=cmd_args.profile_cuda_sync)
 
     if cmd_args.hardness is not None:
         args['hardness'] = cmd_args.hardness
@@ -382,6 +426,7 @@ if __name__ == '__main__':
         args['render_gpu'] = all_gpus[cmd_args.render_gpu]
     else:
         args['render_gpu'] = None
+    args['synthetic_env'] = cmd_args.synthetic_env
 
     args['action_gating'] = cmd_args.action_gating   # gating in ddpg network
     args['residual_critic'] = cmd_args.residual_critic  # resnet for critic (classical ddpg)
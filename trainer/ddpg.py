@@ -1,5 +1,7 @@
 from headers import *
 import utils
+import profiler
+import checkpoint
 from utils import *
 from replay_buffer import *
 import common
@@ -15,14 +17,6 @@ from torch.autograd import Variable
 import time
 
 
-def make_update_exp(vals, target_vals, rate=1e-3):
-    target_dict = target_vals.state_dict()
-    val_dict = vals.state_dict()
-    for k in target_dict.keys():
-        target_dict[k] = target_dict[k] * (1 - rate) + rate * val_dict[k]
-    target_vals.load_state_dict(target_dict)
-
-
 def create_replay_buffer(action_shape, action_type, args):
     if 'dist_sample' not in args:
         return ReplayBuffer(
@@ -77,9 +71,12 @@ class DDPGTrainer(AgentTrainer):
             self.p_optim = optim.RMSprop(self.p.parameters(), lr=self.lrate, weight_decay=args['weight_decay'])
             self.q_optim = optim.RMSprop(self.q.parameters(), lr=self.critic_lrate, weight_decay=args['critic_weight_decay'])
         self.target_update_rate = args['target_net_update_rate'] or 1e-3
+        self.target_updater = TargetNetUpdater([self.p, self.q], [self.target_p, self.target_q], rate=self.target_update_rate)
         self.replay_buffer = replay_buffer or create_replay_buffer([self.act_dim], np.float32, args)
         self.max_episode_len = args['episode_len']
         self.grad_norm_clip = args['grad_clip']
+        self.grad_clip_global = args['grad_clip_global'] if 'grad_clip_global' in args else False
+        self.telemetry = utils.ParamTelemetry(args['debug_log_freq'] if 'debug_log_freq' in args else 1)
         self.sample_counter = 0
 
     def action(self, gumbel_noise=None):
@@ -115,87 +112,82 @@ class DDPGTrainer(AgentTrainer):
             return None
         self.sample_counter = 0
         self.train()
-        tt = time.time()
-
-        obs, full_act, rew, obs_next, done = \
-            self.replay_buffer.sample(self.batch_size)
-        #act = split_batched_array(full_act, self.act_shape)
-        time_counter[-1] += time.time() - tt
-        tt = time.time()
-
-        # convert to variables
-        obs_n = self._process_frames(obs)
-        obs_next_n = self._process_frames(obs_next, volatile=True)
-        full_act_n = Variable(torch.from_numpy(full_act)).type(FloatTensor)
-        rew_n = Variable(torch.from_numpy(rew), volatile=True).type(FloatTensor)
-        done_n = Variable(torch.from_numpy(done), volatile=True).type(FloatTensor)
-
-        time_counter[0] += time.time() - tt
-        tt = time.time()
-
-        # train q network
-        common.debugger.print('Grad Stats of Q Update ...', False)
-        target_act_next = self.target_p(obs_next_n)
-        target_q_next = self.target_q(obs_next_n, target_act_next)
-        target_q = rew_n + self.gamma * (1.0 - done_n) * target_q_next
-        target_q.volatile = False
-        current_q = self.q(obs_n, full_act_n)
-        q_norm = (current_q * current_q).mean().squeeze()  # l2 norm
-        q_loss = F.smooth_l1_loss(current_q, target_q) + self.args['critic_penalty']*q_norm  # huber
-
-        common.debugger.print('>> Q_Loss = {}'.format(q_loss.data.mean()), False)
-
-        self.q_optim.zero_grad()
-        q_loss.backward()
-
-        common.debugger.print('Stats of Q Network (*before* clip and opt)....', False)
-        utils.log_parameter_stats(common.debugger, self.q)
-
-        if self.grad_norm_clip is not None:
-            #nn.utils.clip_grad_norm(self.q.parameters(), self.grad_norm_clip)
-            utils.clip_grad_norm(self.q.parameters(), self.grad_norm_clip)
-        self.q_optim.step()
-
-        # train p network
-        new_act_n = self.p(obs_n)  # NOTE: maybe use <gumbel_noise=None> ?
-        q_val = self.q(obs_n, new_act_n)
-        p_loss = -q_val.mean().squeeze()
-        p_ent = self.p.entropy().mean().squeeze()
-        if self.args['ent_penalty'] is not None:
-            p_loss -= self.args['ent_penalty'] * p_ent  # encourage exploration
-
-        common.debugger.print('>> P_Loss = {}'.format(p_loss.data.mean()), False)
-
-        self.p_optim.zero_grad()
-        self.q_optim.zero_grad()  # important!! clear the grad in Q
-        p_loss.backward()
-
-        if self.grad_norm_clip is not None:
-            #nn.utils.clip_grad_norm(self.p.parameters(), self.grad_norm_clip)
-            utils.clip_grad_norm(self.p.parameters(), self.grad_norm_clip)
-        self.p_optim.step()
-
-        common.debugger.print('Stats of Q Network (in the phase of P-Update)....', False)
-        utils.log_parameter_stats(common.debugger, self.q)
-        common.debugger.print('Stats of P Network (after clip and opt)....', False)
-        utils.log_parameter_stats(common.debugger, self.p)
-
-
-        time_counter[1] += time.time() -tt
-        tt =time.time()
-
-
-        # update target networks
-        make_update_exp(self.p, self.target_p, rate=self.target_update_rate)
-        make_update_exp(self.q, self.target_q, rate=self.target_update_rate)
-
-        common.debugger.print('Stats of Q Target Network (After Update)....', False)
-        utils.log_parameter_stats(common.debugger, self.target_q)
-        common.debugger.print('Stats of P Target Network (After Update)....', False)
-        utils.log_parameter_stats(common.debugger, self.target_p)
-
-
-        time_counter[2] += time.time()-tt
+        self.telemetry.begin(common.debugger)
+        with profiler.span('replay_sample'):
+            obs, full_act, rew, obs_next, done = \
+                self.replay_buffer.sample(self.batch_size)
+            #act = split_batched_array(full_act, self.act_shape)
+        with profiler.span('preprocess'):
+            # convert to variables
+            obs_n = self._process_frames(obs)
+            obs_next_n = self._process_frames(obs_next, volatile=True)
+            full_act_n = Variable(torch.from_numpy(full_act)).type(FloatTensor)
+            rew_n = Variable(torch.from_numpy(rew), volatile=True).type(FloatTensor)
+            done_n = Variable(torch.from_numpy(done), volatile=True).type(FloatTensor)
+
+        with profiler.span('train'):
+            # train q network
+            self.telemetry.print('Grad Stats of Q Update ...')
+            target_act_next = self.target_p(obs_next_n)
+            target_q_next = self.target_q(obs_next_n, target_act_next)
+            target_q = rew_n + self.gamma * (1.0 - done_n) * target_q_next
+            target_q.volatile = False
+            current_q = self.q(obs_n, full_act_n)
+            q_norm = (current_q * current_q).mean().squeeze()  # l2 norm
+            q_loss = F.smooth_l1_loss(current_q, target_q) + self.args['critic_penalty']*q_norm  # huber
+
+            self.telemetry.print_mean('>> Q_Loss = {}', q_loss.data)
+
+            self.q_optim.zero_grad()
+            with profiler.span('backward'):
+                q_loss.backward()
+
+            self.telemetry.print('Stats of Q Network (*before* clip and opt)....')
+            self.telemetry.log_parameter_stats(self.q)
+
+            if self.grad_norm_clip is not None:
+                #nn.utils.clip_grad_norm(self.q.parameters(), self.grad_norm_clip)
+                utils.clip_grad_norm(self.q.parameters(), self.grad_norm_clip, global_norm=self.grad_clip_global)
+            with profiler.span('optimizer'):
+                self.q_optim.step()
+
+            # train p network
+            new_act_n = self.p(obs_n)  # NOTE: maybe use <gumbel_noise=None> ?
+            q_val = self.q(obs_n, new_act_n)
+            p_loss = -q_val.mean().squeeze()
+            p_ent = self.p.entropy().mean().squeeze()
+            if self.args['ent_penalty'] is not None:
+                p_loss -= self.args['ent_penalty'] * p_ent  # encourage exploration
+
+            self.telemetry.print_mean('>> P_Loss = {}', p_loss.data)
+
+            self.p_optim.zero_grad()
+            self.q_optim.zero_grad()  # important!! clear the grad in Q
+            with profiler.span('backward'):
+                p_loss.backward()
+
+            if self.grad_norm_clip is not None:
+                #nn.utils.clip_grad_norm(self.p.parameters(), self.grad_norm_clip)
+                utils.clip_grad_norm(self.p.parameters(), self.grad_norm_clip, global_norm=self.grad_clip_global)
+            with profiler.span('optimizer'):
+                self.p_optim.step()
+
+            self.telemetry.print('Stats of Q Network (in the phase of P-Update)....')
+            self.telemetry.log_parameter_stats(self.q)
+            self.telemetry.print('Stats of P Network (after clip and opt)....')
+            self.telemetry.log_parameter_stats(self.p)
+
+        with profiler.span('target_update'):
+            # update target networks
+            self.target_updater.update()
+
+            self.telemetry.print('Stats of Q Target Network (After Update)....')
+            self.telemetry.log_parameter_stats(self.target_q)
+            self.telemetry.print('Stats of P Target Network (After Update)....')
+            self.telemetry.log_parameter_stats(self.target_p)
+
+
+            self.telemetry.flush()
 
         return dict(policy_loss=p_loss.data.cpu().numpy()[0],
                     policy_entropy=p_ent.data.cpu().numpy()[0],
@@ -219,7 +211,7 @@ class DDPGTrainer(AgentTrainer):
         filename = save_dir + prefix + "_" + self.name + version + '.pkl'
         all_data = [self.p.state_dict(), self.target_p.state_dict(),
                     self.q.state_dict(), self.target_q.state_dict()]
-        torch.save(all_data, filename)
+        checkpoint.save(all_data, filename)
 
     def load(self, save_dir, version="", prefix="DDPG"):
         if os.path.isfile(save_dir) or (version is None):
@@ -230,6 +222,7 @@ class DDPGTrainer(AgentTrainer):
             if save_dir[-1] != '/':
                 save_dir += '/'
             filename = save_dir + prefix + "_" + self.name + version + '.pkl'
+        checkpoint.wait(filename)
         all_data = torch.load(filename)
         self.p.load_state_dict(all_data[0])
         self.target_p.load_state_dict(all_data[1])
@@ -1,5 +1,7 @@
 from headers import *
 import utils
+import profiler
+import checkpoint
 from utils import *
 from replay_buffer import *
 import common
@@ -16,14 +18,6 @@ import time
 
 default_q_loss_coef = 100.0
 
-def make_update_exp(vals, target_vals, rate=1e-3):
-    target_dict = target_vals.state_dict()
-    val_dict = vals.state_dict()
-    for k in target_dict.keys():
-        target_dict[k] = target_dict[k] * (1 - rate) + rate * val_dict[k]
-    target_vals.load_state_dict(target_dict)
-
-
 def create_replay_buffer(action_shape, action_type, args):
     if 'dist_sample' not in args:
         return ReplayBuffer(
@@ -75,12 +69,16 @@ class JointDDPGTrainer(AgentTrainer):
         else:
             self.optim = optim.RMSprop(self.net.parameters(), lr=self.lrate, weight_decay=args['weight_decay'])
         self.target_update_rate = args['target_net_update_rate'] or 1e-3
+        self.target_updater = TargetNetUpdater(self.net, self.target_net, rate=self.target_update_rate)
         self.replay_buffer = replay_buffer or create_replay_buffer([self.act_dim], np.float32, args)
         if self.multi_target:
             self.target_buffer = np.zeros(args['replay_buffer_size'], dtype=np.uint8)
             self._target = 0
         self.max_episode_len = args['episode_len']
         self.grad_norm_clip = args['grad_clip']
+        self.grad_clip_global = args['grad_clip_global'] if 'grad_clip_global' in args else False
+        self.telemetry = utils.ParamTelemetry(args['debug_log_freq'] if 'debug_log_freq' in args else 1)
+        self.reuse_trunk_feature = args['reuse_trunk_feature'] if 'reuse_trunk_feature' in args else False
         self.sample_counter = 0
 
     def action(self, gumbel_noise=None):
@@ -127,76 +125,77 @@ class JointDDPGTrainer(AgentTrainer):
             return None
         self.sample_counter = 0
         self.train()
-        tt = time.time()
-
-        obs, full_act, rew, obs_next, done = \
-            self.replay_buffer.sample(self.batch_size)
-        if self.multi_target:
-            target_idx = self.target_buffer[self.replay_buffer._idxes]
-            targets = np.zeros((self.batch_size, common.n_target_instructions), dtype=np.uint8)
-            targets[list(range(self.batch_size)), target_idx] = 1
-        #act = split_batched_array(full_act, self.act_shape)
-        time_counter[-1] += time.time() - tt
-        tt = time.time()
-
-        # convert to variables
-        obs_n = self._process_frames(obs)
-        obs_next_n = self._process_frames(obs_next, volatile=True)
-        full_act_n = Variable(torch.from_numpy(full_act)).type(FloatTensor)
-        rew_n = Variable(torch.from_numpy(rew), volatile=True).type(FloatTensor)
-        done_n = Variable(torch.from_numpy(done), volatile=True).type(FloatTensor)
-        if self.multi_target:
-            target_n = Variable(torch.from_numpy(targets).type(FloatTensor))
-        else:
-            target_n = None
-
-        time_counter[0] += time.time() - tt
-        tt = time.time()
-
-        self.optim.zero_grad()
-
-        # train p network
-        q_val = self.net(obs_n, action=None, output_critic=True, target=target_n)
-        p_loss = -q_val.mean().squeeze()
-        p_ent = self.net.entropy().mean().squeeze()
-        if self.args['ent_penalty'] is not None:
-            p_loss -= self.args['ent_penalty'] * p_ent  # encourage exploration
-        common.debugger.print('>> P_Loss = {}'.format(p_loss.data.mean()), False)
-        p_loss.backward()
-        self.net.clear_critic_specific_grad()  # we do not need to compute q_grad for actor!!!
-
-        # train q network
-        common.debugger.print('Grad Stats of Q Update ...', False)
-        target_q_next = self.target_net(obs_next_n, output_critic=True, target=target_n)
-        target_q = rew_n + self.gamma * (1.0 - done_n) * target_q_next
-        target_q.volatile = False
-        current_q = self.net(obs_n, action=full_act_n, output_critic=True, target=target_n)
-        q_norm = (current_q * current_q).mean().squeeze()  # l2 norm
-        q_loss = F.smooth_l1_loss(current_q, target_q) + self.args['critic_penalty']*q_norm  # huber
-        common.debugger.print('>> Q_Loss = {}'.format(q_loss.data.mean()), False)
-        q_loss = q_loss * self.q_loss_coef
-        q_loss.backward()
-
-        # total_loss = q_loss + p_loss
-        # grad clip
-        if self.grad_norm_clip is not None:
-            utils.clip_grad_norm(self.net.parameters(), self.grad_norm_clip)
-        self.optim.step()
-
-        common.debugger.print('Stats of P Network (after clip and opt)....', False)
-        utils.log_parameter_stats(common.debugger, self.net)
-
-        time_counter[1] += time.time() -tt
-        tt =time.time()
-
-        # update target networks
-        make_update_exp(self.net, self.target_net, rate=self.target_update_rate)
-
-        common.debugger.print('Stats of Target Network (After Update)....', False)
-        utils.log_parameter_stats(common.debugger, self.target_net)
-
-
-        time_counter[2] += time.time()-tt
+        self.telemetry.begin(common.debugger)
+        with profiler.span('replay_sample'):
+            obs, full_act, rew, obs_next, done = \
+                self.replay_buffer.sample(self.batch_size)
+            if self.multi_target:
+                target_idx = self.target_buffer[self.replay_buffer._idxes]
+                targets = np.zeros((self.batch_size, common.n_target_instructions), dtype=np.uint8)
+                targets[list(range(self.batch_size)), target_idx] = 1
+            #act = split_batched_array(full_act, self.act_shape)
+        with profiler.span('preprocess'):
+            # convert to variables
+            obs_n = self._process_frames(obs)
+            obs_next_n = self._process_frames(obs_next, volatile=True)
+            full_act_n = Variable(torch.from_numpy(full_act)).type(FloatTensor)
+            rew_n = Variable(torch.from_numpy(rew), volatile=True).type(FloatTensor)
+            done_n = Variable(torch.from_numpy(done), volatile=True).type(FloatTensor)
+            if self.multi_target:
+                target_n = Variable(torch.from_numpy(targets).type(FloatTensor))
+            else:
+                target_n = None
+
+        with profiler.span('train'):
+            self.optim.zero_grad()
+
+            # train p network
+            if self.reuse_trunk_feature:
+                q_val, critic_feat = self.net(obs_n, action=None, output_critic=True, target=target_n, return_critic_feature=True)
+            else:
+                q_val, critic_feat = self.net(obs_n, action=None, output_critic=True, target=target_n), None
+            p_loss = -q_val.mean().squeeze()
+            p_ent = self.net.entropy().mean().squeeze()
+            if self.args['ent_penalty'] is not None:
+                p_loss -= self.args['ent_penalty'] * p_ent  # encourage exploration
+            self.telemetry.print_mean('>> P_Loss = {}', p_loss.data)
+            with profiler.span('backward'):
+                p_loss.backward(retain_graph=self.reuse_trunk_feature)
+            self.net.clear_critic_specific_grad()  # we do not need to compute q_grad for actor!!!
+
+            # train q network
+            self.telemetry.print('Grad Stats of Q Update ...')
+            target_q_next = self.target_net(obs_next_n, output_critic=True, target=target_n)
+            target_q = rew_n + self.gamma * (1.0 - done_n) * target_q_next
+            target_q.volatile = False
+            # no optimizer step since the P update, so its trunk feature is computed with the same parameters
+            current_q = self.net(obs_n, action=full_act_n, output_critic=True, target=target_n, critic_feature=critic_feat)
+            q_norm = (current_q * current_q).mean().squeeze()  # l2 norm
+            q_loss = F.smooth_l1_loss(current_q, target_q) + self.args['critic_penalty']*q_norm  # huber
+            self.telemetry.print_mean('>> Q_Loss = {}', q_loss.data)
+            q_loss = q_loss * self.q_loss_coef
+            with profiler.span('backward'):
+                q_loss.backward()
+
+            # total_loss = q_loss + p_loss
+            # grad clip
+            if self.grad_norm_clip is not None:
+                utils.clip_grad_norm(self.net.parameters(), self.grad_norm_clip, global_norm=self.grad_clip_global)
+            with profiler.span('optimizer'):
+                self.optim.step()
+
+            self.telemetry.print('Stats of P Network (after clip and opt)....')
+            self.telemetry.log_parameter_stats(self.net)
+
+        with profiler.span('target_update'):
+            # update target networks
+            self.target_updater.update()
+
+            self.telemetry.print('Stats of Target Network (After Update)....')
+            self.telemetry.log_parameter_stats(self.target_net)
+
+
+            self.telemetry.flush()
 
         return dict(policy_loss=p_loss.data.cpu().numpy()[0],
                     policy_entropy=p_ent.data.cpu().numpy()[0],
@@ -216,7 +215,7 @@ class JointDDPGTrainer(AgentTrainer):
             save_dir += '/'
         filename = save_dir + prefix + "_" + self.name + version + '.pkl'
         all_data = [self.net.state_dict(), self.target_net.state_dict()]
-        torch.save(all_data, filename)
+        checkpoint.save(all_data, filename)
 
     def load(self, save_dir, version="", prefix="JointDDPG"):
         if os.path.isfile(save_dir) or (version is None):
@@ -227,6 +226,7 @@ class JointDDPGTrainer(AgentTrainer):
             if save_dir[-1] != '/':
                 save_dir += '/'
             filename = save_dir + prefix + "_" + self.name + version + '.pkl'
+        checkpoint.wait(filename)
         all_data = torch.load(filename)
         self.net.load_state_dict(all_data[0])
         self.target_net.load_state_dict(all_data[1])
@@ -1,5 +1,6 @@
 from headers import *
 import utils
+import profiler
 from utils import *
 from replay_buffer import *
 from trainer.qac import *
@@ -25,7 +26,8 @@ class DQNTrainer(QACTrainer):
         if self.multi_target:
             self.target_buffer = np.zeros(args['replay_buffer_size'], dtype=np.uint8)
         self.target_net_update_freq = args['target_net_update_freq'] if 'target_net_update_freq' in args else None
-        self._update_counter = 0
+        if self.target_net_update_freq is not None:
+            self.target_updater = TargetNetUpdater(self.net, self.target_net, update_freq=self.target_net_update_freq)
 
     def set_target(self, target):
         self._target = common.target_instruction_dict[target]
@@ -62,79 +64,69 @@ class DQNTrainer(QACTrainer):
         if (self.sample_counter < self.args['update_freq']) or \
            not self.replay_buffer.can_sample(self.batch_size * min(self.args['update_freq'], 20)):
             return None
-        self._update_counter += 1
         self.sample_counter = 0
         self.train()
-        tt = time.time()
-
-        obs, act, rew, obs_next, done = \
-            self.replay_buffer.sample(self.batch_size)
-        if self.multi_target:
-            target_idx = self.target_buffer[self.replay_buffer._idxes]
-            targets = np.zeros((self.batch_size, common.n_target_instructions), dtype=np.uint8)
-            targets[list(range(self.batch_size)), target_idx] = 1
-        #act = split_batched_array(full_act, self.act_shape)
-        time_counter[-1] += time.time() - tt
-        tt = time.time()
-
-        # convert to variables
-        obs_n = self._process_frames(obs)
-        obs_next_n = self._process_frames(obs_next, volatile=True)
-        act_n = Variable(torch.from_numpy(act)).type(LongTensor)
-        rew_n = Variable(torch.from_numpy(rew), volatile=True).type(FloatTensor)
-        done_n = Variable(torch.from_numpy(done), volatile=True).type(FloatTensor)
-        if self.multi_target:
-            target_n = Variable(torch.from_numpy(targets).type(FloatTensor))
-        else:
-            target_n = None
-
-        time_counter[0] += time.time() - tt
-        tt = time.time()
-
-        # compute critic loss
-        target_q_val_next = self.target_net(obs_next_n, only_q_value=True, target=target_n)
-        # double Q learning
-        target_act_next = torch.max(self.net(obs_next_n, only_q_value=True, target=target_n), dim=1, keepdim=True)[1]
-        target_q_next = torch.gather(target_q_val_next, 1, target_act_next).squeeze()
-        target_q = rew_n + self.gamma * (1.0 - done_n) * target_q_next
-        target_q.volatile=False
-        current_q_val = self.net(obs_n, only_q_value=True, target=target_n)
-        current_q = torch.gather(current_q_val, 1, act_n.view(-1, 1)).squeeze()
-        q_norm = (current_q * current_q).mean().squeeze()
-        q_loss = F.smooth_l1_loss(current_q, target_q)
-
-        common.debugger.print('>> Q_Loss = {}'.format(q_loss.data.mean()), False)
-        common.debugger.print('>> Q_Norm = {}'.format(q_norm.data.mean()), False)
-
-        total_loss = q_loss.mean()
-        if self.args['critic_penalty'] > 1e-10:
-            total_loss += self.args['critic_penalty']*q_norm
-
-        # compute gradient
-        self.optim.zero_grad()
-        #autograd.backward([total_loss, current_act], [torch.ones(1), None])
-        total_loss.backward()
-        if self.grad_norm_clip is not None:
-            #nn.utils.clip_grad_norm(self.q.parameters(), self.grad_norm_clip)
-            utils.clip_grad_norm(self.net.parameters(), self.grad_norm_clip)
-        self.optim.step()
-        common.debugger.print('Stats of Model (*after* clip and opt)....', False)
-        utils.log_parameter_stats(common.debugger, self.net)
-
-        time_counter[1] += time.time() -tt
-        tt =time.time()
-
-        # update target networks
-        if self.target_net_update_freq is not None:
-            if self._update_counter == self.target_net_update_freq:
-                self._update_counter = 0
-                self.target_net.load_state_dict(self.net.state_dict())
-        else:
-            make_update_exp(self.net, self.target_net, rate=self.target_update_rate)
-        common.debugger.print('Stats of Target Network (After Update)....', False)
-        utils.log_parameter_stats(common.debugger, self.target_net)
+        self.telemetry.begin(common.debugger)
+        with profiler.span('replay_sample'):
+            obs, act, rew, obs_next, done = \
+                self.replay_buffer.sample(self.batch_size)
+            if self.multi_target:
+                target_idx = self.target_buffer[self.replay_buffer._idxes]
+                targets = np.zeros((self.batch_size, common.n_target_instructions), dtype=np.uint8)
+                targets[list(range(self.batch_size)), target_idx] = 1
+            #act = split_batched_array(full_act, self.act_shape)
+        with profiler.span('preprocess'):
+            # convert to variables
+            obs_n = self._process_frames(obs)
+            obs_next_n = self._process_frames(obs_next, volatile=True)
+            act_n = Variable(torch.from_numpy(act)).type(LongTensor)
+            rew_n = Variable(torch.from_numpy(rew), volatile=True).type(FloatTensor)
+            done_n = Variable(torch.from_numpy(done), volatile=True).type(FloatTensor)
+            if self.multi_target:
+                target_n = Variable(torch.from_numpy(targets).type(FloatTensor))
+            else:
+                target_n = None
 
-        time_counter[2] += time.time()-tt
+        with profiler.span('train'):
+            # compute critic loss
+            target_q_val_next = self.target_net(obs_next_n, only_q_value=True, target=target_n)
+            # double Q learning
+            target_act_next = torch.max(self.net(obs_next_n, only_q_value=True, target=target_n), dim=1, keepdim=True)[1]
+            target_q_next = torch.gather(target_q_val_next, 1, target_act_next).squeeze()
+            target_q = rew_n + self.gamma * (1.0 - done_n) * target_q_next
+            target_q.volatile=False
+            current_q_val = self.net(obs_n, only_q_value=True, target=target_n)
+            current_q = torch.gather(current_q_val, 1, act_n.view(-1, 1)).squeeze()
+            q_norm = (current_q * current_q).mean().squeeze()
+            q_loss = F.smooth_l1_loss(current_q, target_q)
+
+            self.telemetry.print_mean('>> Q_Loss = {}', q_loss.data)
+            self.telemetry.print_mean('>> Q_Norm = {}', q_norm.data)
+
+            total_loss = q_loss.mean()
+            if self.args['critic_penalty'] > 1e-10:
+                total_loss += self.args['critic_penalty']*q_norm
+
+            # compute gradient
+            self.optim.zero_grad()
+            #autograd.backward([total_loss, current_act], [torch.ones(1), None])
+            with profiler.span('backward'):
+                total_loss.backward()
+            if self.grad_norm_clip is not None:
+                #nn.utils.clip_grad_norm(self.q.parameters(), self.grad_norm_clip)
+                utils.clip_grad_norm(self.net.parameters(), self.grad_norm_clip, global_norm=self.grad_clip_global)
+            with profiler.span('optimizer'):
+                self.optim.step()
+            self.telemetry.print('Stats of Model (*after* clip and opt)....')
+            self.telemetry.log_parameter_stats(self.net)
+
+        with profiler.span('target_update'):
+            # update target networks
+            self.target_updater.update()
+            self.telemetry.print('Stats of Target Network (After Update)....')
+            self.telemetry.log_parameter_stats(self.target_net)
+
+            self.telemetry.flush()
 
         return dict(critic_norm=q_norm.data.cpu().numpy()[0],
                     critic_loss=q_loss.data.cpu().numpy()[0])
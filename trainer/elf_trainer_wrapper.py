@@ -8,6 +8,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 import torch.autograd as autograd
 from headers import *
+import profiler
 
 if "Apple" in sys.version:
     # own mac PC
@@ -117,9 +118,7 @@ class ELFTrainer(AgentTrainer):
             if info is not None:
                 for k in info:
                     self.logger.print('  >> %s = %.4f' % (k, info[k]))
-            print('----> Data Loading Time = %.4f min' % (time_counter[0] / 60))
-            print('----> Training Time = %.4f min' % (time_counter[1] / 60))
-            print('----> Target Net Update Time = %.4f min' % (time_counter[2] / 60))
+            profiler.report(self.logger)
 
             if (self.update_counter % self.save_rate == 0):
                 self.save(self.save_dir)
@@ -1,5 +1,6 @@
 from headers import *
 from utils import *
+import returns
 from replay_buffer import *
 import numpy as np
 import random
@@ -67,7 +68,7 @@ class PolicyGradientTrainer(AgentTrainer):
 
         obs, full_act, rew, _, done = self.replay_buffer.sample(-1)
         act = split_batched_array(full_act, self.act_shape)
-        ret = np.stack(discount_with_dones(rew, done, self.gamma))
+        ret = returns.discount_with_dones(rew, done, self.gamma)
         ret_batch = Variable(torch.from_numpy((ret - np.mean(ret)) / np.std(ret)).type(FloatTensor), requires_grad=False)  # return
 
         # training
@@ -80,7 +81,7 @@ class PolicyGradientTrainer(AgentTrainer):
         self.optimizer.zero_grad()
         loss.backward()
         if self.grad_norm_clip is not None:
-            torch.nn.utils.clip_grad_norm(self.policy.parameters(), self.grad_norm_clip)
+            clip_grad_norm(self.policy.parameters(), self.grad_norm_clip, global_norm=True)
         self.optimizer.step()
         ent = self.policy.entropy().mean()
         ent_val = ent.view(-1).data.cpu().numpy()[0]
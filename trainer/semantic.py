@@ -4,6 +4,7 @@ import common
 import zmq_trainer.zmq_util
 import random
 import utils
+import profiler
 import time
 import torch
 import torch.nn as nn
@@ -43,15 +44,18 @@ class SemanticTrainer(AgentTrainer):
         else:
             self.optim = optim.RMSprop(self.policy.parameters(), lr=self.lrate, weight_decay=args['weight_decay'])
         self.grad_norm_clip = args['grad_clip'] if 'grad_clip' in args else None
+        self.grad_clip_global = args['grad_clip_global'] if 'grad_clip_global' in args else False
 
     def _create_gpu_tensor(self, frames, return_variable=True, volatile=False):
         # convert to tensor
         gpu_tensor = torch.from_numpy(frames).type(ByteTensor)
         if self.stack_frame:  # shape: [batch_size, stack_frame, n, m, channel]
-            gpu_tensor = gpu_tensor.permute(0, 1, 4, 2, 3).type(FloatTensor)
+            gpu_tensor = gpu_tensor.permute(0, 1, 4, 2, 3)
         else:
-            gpu_tensor = gpu_tensor.permute(0,3,1,2).type(FloatTensor)
+            gpu_tensor = gpu_tensor.permute(0,3,1,2)
+        # index frames stay uint8, they are expanded in the classifier (see policy/index_embedding.py)
         if self.args['segment_input'] != 'index':
+            gpu_tensor = gpu_tensor.type(FloatTensor)
             if self.args['depth_input'] or ('attentive' in self.args['model_name']):
                 gpu_tensor /= 256.0  # special hack here for depth info
             else:
@@ -96,88 +100,85 @@ class SemanticTrainer(AgentTrainer):
         :param obs: [batch, n, m, channel] or [batch, stack_frame, n, m, channel]
         :param label: [batch, n_class] (sigmoid) or [batch] (softmax)
         """
-        tt = time.time()
-        # convert data to Variables
-        batch_size = obs.shape[0]
-        obs = self._create_gpu_tensor(obs, return_variable=True)  # [batch, channel, n, m]
-
-        # create label tensor
-        if self.multi_label:
-            t_label = torch.from_numpy(np.array(label)).type(FloatTensor)
-        else:
-            t_label = torch.from_numpy(np.array(label)).type(LongTensor)
-        label = Variable(t_label)
+        with profiler.span('preprocess'):
+            # convert data to Variables
+            batch_size = obs.shape[0]
+            obs = self._create_gpu_tensor(obs, return_variable=True)  # [batch, channel, n, m]
 
-        time_counter[0] += time.time() - tt
+            # create label tensor
+            if self.multi_label:
+                t_label = torch.from_numpy(np.array(label)).type(FloatTensor)
+            else:
+                t_label = torch.from_numpy(np.array(label)).type(LongTensor)
+            label = Variable(t_label)
 
-        tt = time.time()
+        with profiler.span('train'):
+            if self.accu_grad_steps == 0:  # clear grad
+                self.optim.zero_grad()
 
-        if self.accu_grad_steps == 0:  # clear grad
-            self.optim.zero_grad()
+            # forward pass
+            # logits: [batch, n_class]
+            logits = self.policy(obs, return_logits=True)
 
-        # forward pass
-        # logits: [batch, n_class]
-        logits = self.policy(obs, return_logits=True)
+            # compute loss
+            if self.multi_label:
+                loss = torch.mean(F.binary_cross_entropy_with_logits(logits, label))
+            else:
+                loss = torch.mean(F.cross_entropy(logits, label))
+
+            # entropy penalty
+            L_ent = torch.mean(self.policy.entropy(logits=logits))
+            if self.args['entropy_penalty'] is not None:
+                loss -= self.args['entropy_penalty'] * L_ent
+
+            # L^2 penalty
+            L_norm = torch.mean(torch.sum(logits * logits, dim=-1))
+            if self.args['logits_penalty'] is not None:
+                loss += self.args['logits_penalty'] * L_norm
+
+            # compute accuracy
+            if self.multi_label:
+                max_idx = (logits.data > 0.5).type(FloatTensor)
+                total_sample = batch_size * self.out_dim
+            else:
+                _, max_idx = torch.max(logits.data, dim=-1, keepdim=False)
+                total_sample = batch_size
+            L_accu = torch.sum((max_idx == t_label).type(FloatTensor)) / batch_size
+
+            ret_dict = dict(loss=loss.data.cpu().numpy()[0],
+                            entropy=L_ent.data.cpu().numpy()[0],
+                            logits_norm=L_norm.data.cpu().numpy()[0],
+                            accuracy=L_accu)
+
+            # backprop
+            if self.grad_batch > 1:
+                loss = loss / float(self.grad_batch)
+            with profiler.span('backward'):
+                loss.backward()
+
+            # accumulative stats
+            if self.accu_grad_steps == 0:
+                self.accu_ret_dict = ret_dict
+            else:
+                for k in ret_dict:
+                    self.accu_ret_dict[k] += ret_dict[k]
 
-        # compute loss
-        if self.multi_label:
-            loss = torch.mean(F.binary_cross_entropy_with_logits(logits, label))
-        else:
-            loss = torch.mean(F.cross_entropy(logits, label))
-
-        # entropy penalty
-        L_ent = torch.mean(self.policy.entropy(logits=logits))
-        if self.args['entropy_penalty'] is not None:
-            loss -= self.args['entropy_penalty'] * L_ent
-
-        # L^2 penalty
-        L_norm = torch.mean(torch.sum(logits * logits, dim=-1))
-        if self.args['logits_penalty'] is not None:
-            loss += self.args['logits_penalty'] * L_norm
-
-        # compute accuracy
-        if self.multi_label:
-            max_idx = (logits.data > 0.5).type(FloatTensor)
-            total_sample = batch_size * self.out_dim
-        else:
-            _, max_idx = torch.max(logits.data, dim=-1, keepdim=False)
-            total_sample = batch_size
-        L_accu = torch.sum((max_idx == t_label).type(FloatTensor)) / batch_size
-
-        ret_dict = dict(loss=loss.data.cpu().numpy()[0],
-                        entropy=L_ent.data.cpu().numpy()[0],
-                        logits_norm=L_norm.data.cpu().numpy()[0],
-                        accuracy=L_accu)
-
-        # backprop
-        if self.grad_batch > 1:
-            loss = loss / float(self.grad_batch)
-        loss.backward()
-
-        # accumulative stats
-        if self.accu_grad_steps == 0:
-            self.accu_ret_dict = ret_dict
-        else:
-            for k in ret_dict:
-                self.accu_ret_dict[k] += ret_dict[k]
-
-        self.accu_grad_steps += 1
-        if self.accu_grad_steps < self.grad_batch:  # do not update parameter now
-            time_counter[1] += time.time() - tt
-            return None
-
-        # update stats
-        for k in self.accu_ret_dict:
-            self.accu_ret_dict[k] /= self.grad_batch
-        ret_dict = self.accu_ret_dict
-        self.accu_grad_steps = 0
+            self.accu_grad_steps += 1
+            if self.accu_grad_steps < self.grad_batch:  # do not update parameter now
+                return None
+
+            # update stats
+            for k in self.accu_ret_dict:
+                self.accu_ret_dict[k] /= self.grad_batch
+            ret_dict = self.accu_ret_dict
+            self.accu_grad_steps = 0
 
-        # grad clip
-        if self.grad_norm_clip is not None:
-            utils.clip_grad_norm(self.policy.parameters(), self.grad_norm_clip)
-        self.optim.step()
+            # grad clip
+            if self.grad_norm_clip is not None:
+                utils.clip_grad_norm(self.policy.parameters(), self.grad_norm_clip, global_norm=self.grad_clip_global)
+            with profiler.span('optimizer'):
+                self.optim.step()
 
-        time_counter[1] += time.time() - tt
         return ret_dict
 
     def is_rnn(self):
@@ -4,6 +4,7 @@ import common
 import zmq_trainer.zmq_util
 import random
 import utils
+import profiler
 import time
 import torch
 import torch.nn as nn
@@ -51,6 +52,7 @@ class SUPTrainer(AgentTrainer):
         else:
             self.optim = optim.RMSprop(self.policy.parameters(), lr=self.lrate, weight_decay=args['weight_decay'])
         self.grad_norm_clip = args['grad_clip'] if 'grad_clip' in args else None
+        self.grad_clip_global = args['grad_clip_global'] if 'grad_clip_global' in args else False
 
     def _create_feature_tensor(self, feature, return_variable=True, volatile=False):
         # feature: [batch, t_max, feature_dim]
@@ -124,96 +126,93 @@ class SUPTrainer(AgentTrainer):
         :param target: [batch] or None (when single-target)
         :param mask_input: (optional) [batch, seq_len, feat_dim]
         """
-        tt = time.time()
-        # convert data to Variables
-        batch_size = obs.shape[0]
-        seq_len = obs.shape[1]
-        total_samples = float(np.sum(length_mask))
-        obs = self._create_gpu_tensor(obs, return_variable=True)  # [batch, t_max, dims...]
-        if hidden is None:
-            hidden = self.policy.get_zero_state(batch=batch_size, return_variable=True, hidden_batch_first=self._is_multigpu)
-        if target is not None:
-            target = self._create_target_tensor(target, seq_len, return_variable=True)
-        if mask_input is not None:
-            mask_input = self._create_feature_tensor(mask_input, return_variable=True)
-        length_mask = self._create_feature_tensor(length_mask, return_variable=True)  #[batch, t_max]
-
-        # create action tensor
-        #act = Variable(torch.from_numpy(act).type(LongTensor))  # [batch, t_max]
-        act_n = torch.zeros(batch_size, seq_len, self.policy.out_dim).type(FloatTensor)
-        ids = torch.from_numpy(np.array(act)).type(LongTensor).view(batch_size, seq_len, 1)
-        act_n.scatter_(2, ids, 1.0)
-        act_n = Variable(act_n)
-
-        time_counter[0] += time.time() - tt
-
-        tt = time.time()
-
-        if self.accu_grad_steps == 0:  # clear grad
-            self.optim.zero_grad()
-
-        # forward pass
-        # logits: [batch, seq_len, n_act]
-        logits, _ = self.net(obs, hidden, return_value=False, sample_action=False,
-                             return_tensor=False, target=target,
-                             extra_input_feature=mask_input, return_logits=True, hidden_batch_first=self._is_multigpu)
-
-        # compute loss
-        #critic_loss = F.smooth_l1_loss(V, R)
-        block_size = batch_size * seq_len
-        act_size = logits.size(-1)
-        flat_logits = logits.view(block_size, act_size)
-        logp = torch.sum(F.log_softmax(flat_logits).view(batch_size, seq_len, act_size) * act_n, dim=-1) * length_mask
-        loss = -torch.sum(logp) / total_samples
-
-        # entropy penalty
-        L_ent = torch.sum(self.policy.entropy(logits=logits) * length_mask) / total_samples
-        if self.args['entropy_penalty'] is not None:
-            loss -= self.args['entropy_penalty'] * L_ent
-
-        # L^2 penalty
-        L_norm = torch.sum(torch.sum(logits * logits, dim=-1) * length_mask) / total_samples
-        if self.args['logits_penalty'] is not None:
-            loss += self.args['logits_penalty'] * L_norm
-
-        # compute accuracy
-        _, max_idx = torch.max(logits.data, dim=-1, keepdim=True)
-        L_accu = torch.sum((max_idx == ids).type(FloatTensor) * length_mask.data.view(batch_size, seq_len, 1)) / total_samples
-
-        ret_dict = dict(loss=loss.data.cpu().numpy()[0],
-                        entropy=L_ent.data.cpu().numpy()[0],
-                        logits_norm=L_norm.data.cpu().numpy()[0],
-                        accuracy=L_accu)
-
-        # backprop
-        if self.grad_batch > 1:
-            loss = loss / float(self.grad_batch)
-        loss.backward()
-
-        # accumulative stats
-        if self.accu_grad_steps == 0:
-            self.accu_ret_dict = ret_dict
-        else:
-            for k in ret_dict:
-                self.accu_ret_dict[k] += ret_dict[k]
-
-        self.accu_grad_steps += 1
-        if self.accu_grad_steps < self.grad_batch:  # do not update parameter now
-            time_counter[1] += time.time() - tt
-            return None
-
-        # update stats
-        for k in self.accu_ret_dict:
-            self.accu_ret_dict[k] /= self.grad_batch
-        ret_dict = self.accu_ret_dict
-        self.accu_grad_steps = 0
+        with profiler.span('preprocess'):
+            # convert data to Variables
+            batch_size = obs.shape[0]
+            seq_len = obs.shape[1]
+            total_samples = float(np.sum(length_mask))
+            obs = self._create_gpu_tensor(obs, return_variable=True)  # [batch, t_max, dims...]
+            if hidden is None:
+                hidden = self.policy.get_zero_state(batch=batch_size, return_variable=True, hidden_batch_first=self._is_multigpu)
+            if target is not None:
+                target = self._create_target_tensor(target, seq_len, return_variable=True)
+            if mask_input is not None:
+                mask_input = self._create_feature_tensor(mask_input, return_variable=True)
+            length_mask = self._create_feature_tensor(length_mask, return_variable=True)  #[batch, t_max]
+
+            # create action tensor
+            #act = Variable(torch.from_numpy(act).type(LongTensor))  # [batch, t_max]
+            act_n = torch.zeros(batch_size, seq_len, self.policy.out_dim).type(FloatTensor)
+            ids = torch.from_numpy(np.array(act)).type(LongTensor).view(batch_size, seq_len, 1)
+            act_n.scatter_(2, ids, 1.0)
+            act_n = Variable(act_n)
+
+        with profiler.span('train'):
+            if self.accu_grad_steps == 0:  # clear grad
+                self.optim.zero_grad()
+
+            # forward pass
+            # logits: [batch, seq_len, n_act]
+            logits, _ = self.net(obs, hidden, return_value=False, sample_action=False,
+                                 return_tensor=False, target=target,
+                                 extra_input_feature=mask_input, return_logits=True, hidden_batch_first=self._is_multigpu)
+
+            # compute loss
+            #critic_loss = F.smooth_l1_loss(V, R)
+            block_size = batch_size * seq_len
+            act_size = logits.size(-1)
+            flat_logits = logits.view(block_size, act_size)
+            logp = torch.sum(F.log_softmax(flat_logits).view(batch_size, seq_len, act_size) * act_n, dim=-1) * length_mask
+            loss = -torch.sum(logp) / total_samples
+
+            # entropy penalty
+            L_ent = torch.sum(self.policy.entropy(logits=logits) * length_mask) / total_samples
+            if self.args['entropy_penalty'] is not None:
+                loss -= self.args['entropy_penalty'] * L_ent
+
+            # L^2 penalty
+            L_norm = torch.sum(torch.sum(logits * logits, dim=-1) * length_mask) / total_samples
+            if self.args['logits_penalty'] is not None:
+                loss += self.args['logits_penalty'] * L_norm
+
+            # compute accuracy
+            _, max_idx = torch.max(logits.data, dim=-1, keepdim=True)
+            L_accu = torch.sum((max_idx == ids).type(FloatTensor) * length_mask.data.view(batch_size, seq_len, 1)) / total_samples
+
+            ret_dict = dict(loss=loss.data.cpu().numpy()[0],
+                            entropy=L_ent.data.cpu().numpy()[0],
+                            logits_norm=L_norm.data.cpu().numpy()[0],
+                            accuracy=L_accu)
+
+            # backprop
+            if self.grad_batch > 1:
+                loss = loss / float(self.grad_batch)
+            with profiler.span('backward'):
+                loss.backward()
+
+            # accumulative stats
+            if self.accu_grad_steps == 0:
+                self.accu_ret_dict = ret_dict
+            else:
+                for k in ret_dict:
+                    self.accu_ret_dict[k] += ret_dict[k]
+
+            self.accu_grad_steps += 1
+            if self.accu_grad_steps < self.grad_batch:  # do not update parameter now
+                return None
+
+            # update stats
+            for k in self.accu_ret_dict:
+                self.accu_ret_dict[k] /= self.grad_batch
+            ret_dict = self.accu_ret_dict
+            self.accu_grad_steps = 0
 
-        # grad clip
-        if self.grad_norm_clip is not None:
-            utils.clip_grad_norm(self.policy.parameters(), self.grad_norm_clip)
-        self.optim.step()
+            # grad clip
+            if self.grad_norm_clip is not None:
+                utils.clip_grad_norm(self.policy.parameters(), self.grad_norm_clip, global_norm=self.grad_clip_global)
+            with profiler.span('optimizer'):
+                self.optim.step()
 
-        time_counter[1] += time.time() - tt
         return ret_dict
 
     def is_rnn(self):
@@ -5,16 +5,13 @@ import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import returns
+import metrics
 
 ####### Util Functions ############
 def discount_with_dones(rewards, dones, gamma):
-    discounted = []
-    r = 0
-    for reward, done in zip(rewards[::-1], dones[::-1]):
-        r = reward + gamma*r
-        r = r*(1.-done)
-        discounted.append(r)
-    return discounted[::-1]
+    # see returns.discount_with_dones
+    return list(returns.discount_with_dones(rewards, dones, gamma))
 
 
 def split_batched_array(action, shape):
@@ -38,14 +35,124 @@ def sample_n_unique(sampling_f, n):
     return list(res)
 
 
-def clip_grad_norm(parameters, max_norm):
-    parameters = list(filter(lambda p: p.grad is not None, parameters))
+def _flat_norm(x):
+    # the L2 norm as a 1-element tensor on the device (x.norm() would read it back to the host)
+    return x.contiguous().view(-1).norm(2, 0).view(1)
+
+
+def clip_grad_norm(parameters, max_norm, global_norm=False):
+    """
+    clip the gradients in place, without any host sync
+    global_norm=False: each gradient is clipped by its own norm
+    global_norm=True: all the gradients are scaled by max_norm / (total norm), as torch.nn.utils.clip_grad_norm
+    return the total norm of the gradients (before clipping) as a 1-element tensor, None if no gradients
+    """
+    grads = [p.grad.data for p in parameters if p.grad is not None]
+    if len(grads) == 0:
+        return None
     max_norm = float(max_norm)
-    for p in parameters:
-        param_norm = p.grad.data.norm()
-        clip_coef = max_norm / (param_norm + 1e-6)
-        if clip_coef < 1:
-            p.grad.data.mul_(clip_coef)
+    norms = torch.cat([_flat_norm(g) for g in grads])
+    total_norm = norms.pow(2).sum(0).sqrt().view(1)
+    if global_norm:
+        clip_coef = (total_norm + 1e-6).reciprocal().mul_(max_norm).clamp_(max=1.0)
+        for g in grads:
+            g.mul_(clip_coef.expand_as(g))
+    else:
+        clip_coefs = (norms + 1e-6).reciprocal().mul_(max_norm).clamp_(max=1.0)
+        for i, g in enumerate(grads):
+            g.mul_(clip_coefs[i:i+1].expand_as(g))
+    return total_norm
+
+
+############ Target Network Update ############
+def _is_float_tensor(t):
+    if hasattr(t, 'is_floating_point'):  # torch >= 0.4
+        return t.is_floating_point()
+    return type(t).__name__ in ['FloatTensor', 'DoubleTensor', 'HalfTensor']  # CPU or CUDA
+
+
+def _pair_target_tensors(nets, target_nets):
+    """
+    pair the parameters and buffers of the nets with those of the target nets by name
+    the tensors of state_dict() share the storage with the modules, so the pairs stay valid
+      as long as the modules are not moved (e.g., .cuda()) afterwards. load_state_dict() copies in place.
+    return two lists: (src, tar) of floating tensors for soft updates and of the other buffers for copies
+    """
+    if isinstance(nets, nn.Module): nets = [nets]
+    if isinstance(target_nets, nn.Module): target_nets = [target_nets]
+    assert len(nets) == len(target_nets), '[Error in <utils.TargetNetUpdater>] #nets must equal to #target_nets'
+    float_pairs, other_pairs = [], []
+    for net, target_net in zip(nets, target_nets):
+        src_dict = net.state_dict()
+        tar_dict = target_net.state_dict()
+        assert set(src_dict.keys()) == set(tar_dict.keys()), \
+            '[Error in <utils.TargetNetUpdater>] net and target net must have the same parameters'
+        for k, t in tar_dict.items():
+            s = src_dict[k]
+            assert s.size() == t.size(), '[Error in <utils.TargetNetUpdater>] size mismatch of <{}>'.format(k)
+            if _is_float_tensor(t):
+                float_pairs.append((s, t))
+            else:
+                other_pairs.append((s, t))
+    return float_pairs, other_pairs
+
+
+class TargetNetUpdater(object):
+    def __init__(self, nets, target_nets, rate=1e-3, update_freq=None):
+        """
+        in-place update of target networks, target <- (1 - rate) * target + rate * net
+        nets, target_nets: a module or a list of modules
+        update_freq: when not None, the target nets are hard copied every <update_freq> calls of update()
+          and <rate> is ignored
+        """
+        self.nets = nets
+        self.target_nets = target_nets
+        self.rate = rate
+        self.update_freq = update_freq
+        self._counter = 0
+        self._float_pairs = self._other_pairs = None
+
+    def _get_pairs(self):
+        # paired lazily, so the modules can still be moved to GPU before the first update
+        if self._float_pairs is None:
+            self._float_pairs, self._other_pairs = _pair_target_tensors(self.nets, self.target_nets)
+        return self._float_pairs, self._other_pairs
+
+    def soft_update(self, rate=None):
+        rate = self.rate if rate is None else rate
+        float_pairs, other_pairs = self._get_pairs()
+        for s, t in float_pairs:
+            t.mul_(1 - rate).add_(rate, s)
+        for s, t in other_pairs:
+            t.copy_(s)
+
+    def hard_update(self):
+        float_pairs, other_pairs = self._get_pairs()
+        for s, t in float_pairs + other_pairs:
+            t.copy_(s)
+
+    def update(self):
+        """
+        called once per training step
+        return True when the target nets are changed
+        """
+        if self.update_freq is None:
+            self.soft_update()
+            return True
+        self._counter += 1
+        if self._counter >= self.update_freq:
+            self._counter = 0
+            self.hard_update()
+            return True
+        return False
+
+
+def make_update_exp(vals, target_vals, rate=1e-3):
+    """
+    one-off soft update of target_vals, in place
+    trainers updating every step should keep a TargetNetUpdater to avoid pairing the tensors each time
+    """
+    TargetNetUpdater(vals, target_vals, rate=rate).soft_update()
 
 
 ############ Weight Initialization ############
@@ -159,29 +266,44 @@ class LinearSchedule(object):
 
 ######## Logging Utils ############
 class MyLogger:
-    def __init__(self, logdir, clear_file = False, filename = None, keep_file_handler = False):
+    def __init__(self, logdir, clear_file = False, filename = None, keep_file_handler = False, max_bytes = None):
+        """
+        text messages go to <logdir>/<filename> (default progress.txt), typed records of log() go to
+        <logdir>/<filename without extension>_metrics.jsonl, both written in batches by a background thread
+        (see metrics.py), keep_file_handler is kept for compatibility
+        """
         import os
         if not os.path.exists(logdir):
             os.makedirs(logdir)
         self.fname = logdir + '/' + (filename or 'progress.txt')
+        self.metrics_fname = os.path.splitext(self.fname)[0] + '_metrics.jsonl'
         if clear_file:
-            try:
-                os.remove(self.fname)
-            except OSError:
-                pass
-        self._f_ptr = None if not keep_file_handler else open(self.fname, 'w')
+            for f in [self.fname, self.metrics_fname]:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+        self._writer = metrics.AsyncWriter(self.fname, max_bytes=max_bytes)
+        self._max_bytes = max_bytes
+        self._metrics = None
 
     def print(self, str, to_screen = True):
         if to_screen:
             print(str)
-        try:
-            if self._f_ptr is not None:
-                print(str, file=self._f_ptr)
-            else:
-                with open(self.fname, 'a') as f:
-                    print(str, file=f)
-        except Exception as e:
-            print('Exception Caught! msg = {}'.format(e))
+        self._writer.write('{}\n'.format(str))
+
+    def log(self, kind, step = None, **values):
+        """
+        typed record, e.g., logger.log('eval', step=it, avg_rew=r, succ_rate=s)
+        """
+        if self._metrics is None:
+            self._metrics = metrics.MetricsSink(self.metrics_fname, max_bytes=self._max_bytes)
+        self._metrics.log(kind, step, **values)
+
+    def flush(self):
+        self._writer.flush()
+        if self._metrics is not None:
+            self._metrics.flush()
 
 
 class FakeLogger:
@@ -191,6 +313,19 @@ class FakeLogger:
     def print(self, *args, **dict_args):
         pass
 
+    def log(self, *args, **dict_args):
+        pass
+
+    def flush(self):
+        pass
+
+
+def scalar_items(d):
+    """
+    the entries of dict <d> with a scalar value, e.g., to log an episode stats dict as a typed record
+    """
+    return dict([(k, v) for k, v in d.items() if isinstance(v, (int, float, str, bool, np.number))])
+
 
 def log_var_stats(logger, v):
     logger.print('  -> Param<{}>, '.format(v.size())+\
@@ -204,26 +339,98 @@ def log_var_stats(logger, v):
             g.data.norm(), g.data.mean(), g.data.var(), g.data.min(), g.data.max()
         ), False)
 
+def _logged_layers(p):
+    # the layers reported by log_parameter_stats, as (title, layer)
+    for attr, name in [('conv_layers', 'Conv Layer'), ('bc_layers', 'Batch Norm Layer'), ('linear_layers', 'Linear Layer')]:
+        if hasattr(p, attr):
+            for i, layer in enumerate(getattr(p, attr)):
+                if layer is None: continue
+                yield '>> {}#{} <{}>'.format(name, i, layer), layer
+
+
 def log_parameter_stats(logger, p):
     if (logger is None) or isinstance(logger, FakeLogger):
         return
     assert isinstance(p, nn.Module), '[Error in <utils.log_parameter_stats>] policy must be an instance of <nn.Module>'
     assert hasattr(logger, 'print'), '[Error in <utils.log_parameter_stats>] logger must have method <print>'
-    if hasattr(p,'conv_layers'):
-        for i,conv in enumerate(p.conv_layers):
-            if conv is None: continue
-            logger.print('>> Conv Layer#{} <{}>'.format(i,conv),False)
-            for v in conv.parameters():
-                log_var_stats(logger, v)
-    if hasattr(p,'bc_layers'):
-        for i,bc in enumerate(p.bc_layers):
-            if bc is None: continue
-            logger.print('>> Batch Norm Layer#{} <{}>'.format(i,bc),False)
-            for v in bc.parameters():
-                log_var_stats(logger, v)
-    if hasattr(p,'linear_layers'):
-        for i,lr in enumerate(p.linear_layers):
-            if lr is None: continue
-            logger.print('>> Linear Layer#{} <{}>'.format(i,lr),False)
-            for v in lr.parameters():
-                log_var_stats(logger, v)
+    for title, layer in _logged_layers(p):
+        logger.print(title, False)
+        for v in layer.parameters():
+            log_var_stats(logger, v)
+
+
+def _device_stats(x):
+    # [norm, mean, var, min, max] as a 5-element tensor on the device
+    x = x.contiguous().view(-1)
+    return torch.cat([x.norm(2, 0).view(1), x.mean(0).view(1), x.var(0).view(1),
+                      x.min(0)[0].view(1), x.max(0)[0].view(1)])
+
+
+class ParamTelemetry(object):
+    def __init__(self, sample_every=1):
+        """
+        sampled version of log_parameter_stats for the update loop of the trainers
+          --> begin(logger) starts an update, only every <sample_every>-th update is recorded
+          --> statistics are computed on the device and buffered, flush() reads them back
+              in one transfer and prints everything in order
+          --> on the other updates (or with FakeLogger) all the calls are no-ops
+        """
+        self.sample_every = max(1, sample_every or 1)
+        self.active = False
+        self._logger = None
+        self._counter = 0
+        self._entries = []  # (text, None), (format, value tensor) or (size, [val stats, grad stats])
+
+    def begin(self, logger):
+        self.flush()
+        self.active = (logger is not None) and not isinstance(logger, FakeLogger) \
+                      and (self._counter % self.sample_every == 0)
+        self._logger = logger if self.active else None
+        self._counter += 1
+
+    def print(self, msg):
+        if self.active:
+            self._entries.append((msg, None))
+
+    def print_mean(self, fmt, t):
+        """
+        fmt: format string of the mean of tensor t, e.g. '>> Q_Loss = {}'
+        """
+        if self.active:
+            self._entries.append((fmt, [t.contiguous().view(-1).mean(0).view(1)]))
+
+    def log_parameter_stats(self, p):
+        if not self.active:
+            return
+        assert isinstance(p, nn.Module), '[Error in <utils.ParamTelemetry>] policy must be an instance of <nn.Module>'
+        for title, layer in _logged_layers(p):
+            self._entries.append((title, None))
+            for v in layer.parameters():
+                stats = [_device_stats(v.data)]
+                if v.grad is not None:
+                    stats.append(_device_stats(v.grad.data))
+                self._entries.append((v.size(), stats))
+
+    def flush(self):
+        if len(self._entries) == 0:
+            return
+        tensors = [t for _, stats in self._entries if stats is not None for t in stats]
+        values = torch.cat(tensors).cpu().numpy() if len(tensors) > 0 else None
+        pos = 0
+        for key, stats in self._entries:
+            if stats is None:
+                self._logger.print(key, False)
+            elif isinstance(key, str):
+                self._logger.print(key.format(values[pos]), False)
+                pos += 1
+            else:
+                v = values[pos: pos + 5]
+                self._logger.print('  -> Param<{}>, '.format(key) +
+                                   'Val Stats = [norm = %.7f, mean = %.7f, var = %.7f, min = %.7f, max = %.7f]' % tuple(v), False)
+                if len(stats) == 1:
+                    self._logger.print('              >> Grad Stats = None', False)
+                else:
+                    g = values[pos + 5: pos + 10]
+                    self._logger.print('              >> Grad Stats = [norm = %.7f, mean = %.7f, var = %.7f, min = %.7f, max = %.7f]' % tuple(g), False)
+                pos += 5 * len(stats)
+        self._entries = []
@@ -1,6 +1,9 @@
 from headers import *
 import common
 import utils
+import profiler
+import checkpoint
+import birthplace_index
 
 import threading
 
@@ -11,7 +14,8 @@ from zmq_trainer.zmqsimulator import SimulatorProcess, SimulatorMaster, ensure_p
 
 from policy.rnn_discrete_actor_critic import DiscreteRNNPolicy
 
-import os, sys, time, pickle, json, argparse
+import os, sys, time, pickle, json, argparse, gc
+import multiprocessing as mp
 import numpy as np
 import random
 import torch
@@ -66,7 +70,9 @@ def create_policy(model_name, args, observation_shape, n_action):
                               aux_prediction=(common.n_aux_predictions if args['aux_task'] else None),
                               no_skip_connect=(args['no_skip_connect'] if 'no_skip_connect' in args else False),
                               pure_feed_forward=(args['feed_forward'] if 'feed_forward' in args else False),
-                              extra_feature_dim=(len(common.all_target_instructions) if ('mask_feature' in args) and args['mask_feature'] else None)
+                              extra_feature_dim=(len(common.all_target_instructions) if ('mask_feature' in args) and args['mask_feature'] else None),
+                              index_input=(args['segment_input'] == 'index'),
+                              index_embed_dim=(args['index_embed_dim'] if 'index_embed_dim' in args else None)
                               )
     if common.use_cuda:
         if 'train_gpu' in args:
@@ -133,9 +139,53 @@ def create_zmq_config(args):
     config['mask_feature_dim'] = len(common.all_target_instructions) if ('mask_feature' in args) and args['mask_feature'] else None
     config['cache_supervision'] = args['cache_supervision']
     config['outdoor_target'] = args['outdoor_target']
+    config['render_cache_size'] = args['render_cache_size']
+    config['render_cache_key'] = args['render_cache_key']
+    config['atlas_dir'] = args['atlas_dir']
+    config['synthetic_env'] = args['synthetic_env']
+    config['house_store_dir'] = args['house_store_dir']
+    config['birthplace_index_dir'] = args['birthplace_index_dir']
     return config
 
 
+def preload_simulator_houses(args):
+    """
+    preload the houses of all the simulators in the master process before forking
+      --> simulators inherit the imported modules and the houses copy-on-write,
+          renderer contexts are still created in each simulator after the fork
+      --> must be called before any CUDA context is created in the master
+    """
+    if args['synthetic_env'] or (args['atlas_dir'] is not None):
+        print('[Preload] No houses to preload for synthetic or atlas environments! Skip!')
+        return
+    assert mp.get_start_method() == 'fork', '[Preload] simulators must be forked to inherit the preloaded houses!'
+    if args['house_store_dir'] is not None:
+        common.set_house_store(args['house_store_dir'])
+    n_house = min(args['n_house'], args['n_proc'])
+    common.preload_houses(list(range(n_house)),
+                          genRoomTypeMap=args['aux_task'],
+                          cacheAllTarget=(args['multi_target'] or args['cache_supervision']),
+                          includeOutdoor=args['outdoor_target'])
+    if hasattr(gc, 'freeze'):   # python >= 3.7, keep gc from touching (and copying) the inherited objects
+        gc.collect()
+        gc.freeze()
+
+
+def check_birthplace_index(args):
+    """
+    the simulators load the birthplace index read-only, so every house must be indexed before forking them
+    """
+    n_house = min(args['n_house'], args['n_proc'])
+    if args['synthetic_env']:
+        house_ids = ['synthetic_%d' % k for k in range(n_house)]
+    else:
+        house_ids = common.all_houseIDs[:n_house]
+    missing = birthplace_index.missing_houses(args['birthplace_index_dir'], house_ids)
+    assert len(missing) == 0, \
+        '[BirthplaceIndex] {} houses are not indexed in <{}>, e.g., <{}>! Build the index with build_birthplace_index.py'.format(
+            len(missing), args['birthplace_index_dir'], missing[0])
+
+
 def train(args=None, warmstart=None):
 
     # Process Observation Shape
@@ -152,9 +202,16 @@ def train(args=None, warmstart=None):
     name2 = 'ipc://@whatever' + args['job_name'] + '2'
     n_proc = args['n_proc']
     config = create_zmq_config(args)
+    if args['birthplace_index_dir'] is not None:
+        check_birthplace_index(args)
+    if args['preload_houses']:
+        preload_simulator_houses(args)
     procs = [ZMQSimulator(k, name, name2, config) for k in range(n_proc)]
     [k.start() for k in procs]
     ensure_proc_terminate(procs)
+    if args['profile'] or (args['profile_trace'] is not None):
+        # enabled after the simulators are forked, only the master process is profiled
+        profiler.enable(trace=(args['profile_trace'] is not None), cuda_sync=args['profile_cuda_sync'])
 
     trainer = create_zmq_trainer(args['algo'], model='rnn', args=args)
     if warmstart is not None:
@@ -176,9 +233,9 @@ def train(args=None, warmstart=None):
         send_thread.start()
         master.recv_loop()
         print('Done!')
-        trainer.save(args['save_dir'], version='final')
+        master.save_all(version='final')
     except KeyboardInterrupt:
-        trainer.save_all(args['save_dir'], version='interrupt')
+        master.save_all(version='interrupt')
         raise
 
 
@@ -215,6 +272,8 @@ def parse_args():
     parser.add_argument("--target-mask-input", dest='target_mask_input', action='store_true',
                         help="whether to include target mask 0/1 signal as part of the input signal")
     parser.set_defaults(target_mask_input=False)
+    parser.add_argument("--index-embed-dim", type=int,
+                        help="[only with --segmentation-input index] when set, index frames are expanded by a learned embedding of this dimension instead of one-hot")
     parser.add_argument("--resolution", choices=['normal', 'low', 'tiny', 'high', 'square', 'square_low'],
                         dest='resolution_level', default='normal',
                         help="resolution of visual input, default normal=[120 * 90]")
@@ -248,6 +307,25 @@ def parse_args():
                         help="[ZMQ] an integer or a ','-split list of integers, indicating the gpu-id of renderers")
     parser.add_argument("--n-proc", type=int, default=32,
                         help="[ZMQ] number of processes for simulation, all houses will be uniformly assigned over the processes")
+    parser.add_argument("--render-cache-size", type=int, default=0,
+                        help="[ZMQ] when positive, each simulator caches this many rendered frames in a LRU cache")
+    parser.add_argument("--render-cache-key", choices=['grid', 'exact'], default='exact',
+                        help="[ZMQ] how the agent location is keyed in the render cache")
+    parser.add_argument("--atlas-dir", type=str,
+                        help="[ZMQ] when set, simulators serve pre-rendered frames from this atlas folder (see build_atlas.py) without any renderer, "
+                             "requires --reward-type none and --success-measure see")
+    parser.add_argument("--synthetic-env", dest='synthetic_env', action='store_true',
+                        help="[ZMQ] when set, simulators run the synthetic stand-in environment (see synthetic_env.py), no House3D assets needed")
+    parser.set_defaults(synthetic_env=False)
+    parser.add_argument("--house-store-dir", type=str,
+                        help="[ZMQ] when set, house maps are built once into this folder and all simulators attach to them read-only (see house_store.py)")
+    parser.add_argument("--birthplace-index-dir", type=str,
+                        help="[ZMQ] when set, simulators draw (curriculum) birthplaces from the per-house birthplace index in this folder, built beforehand by build_birthplace_index.py")
+    parser.add_argument("--preload-houses", dest='preload_houses', action='store_true',
+                        help="[ZMQ] when set, the master loads all the houses before forking the simulators, which inherit them copy-on-write")
+    parser.set_defaults(preload_houses=False)
+    parser.add_argument("--house-init-workers", type=int, default=0,
+                        help="[ZMQ] when > 1, the master preloads the houses (--preload-houses) with this many worker processes; default serial")
     parser.add_argument("--t-max", type=int, default=20,
                         help="[ZMQ] number of time steps for backprop in each training batch")
     parser.add_argument("--batch-size", type=int, default=32,
@@ -265,9 +343,13 @@ def parse_args():
     parser.add_argument('--weight-decay', type=float, help="weight decay for policy")
     parser.add_argument("--gamma", type=float, help="discount")
     parser.add_argument("--grad-clip", type=float, default=5.0, help="gradient clipping")
+    parser.add_argument("--grad-clip-global", dest='grad_clip_global', action='store_true',
+                        help="when set, clip the gradients by their global norm instead of the norm of each parameter")
+    parser.set_defaults(grad_clip_global=False)
     parser.add_argument("--adv-norm", dest='adv_norm', action='store_true',
                         help="perform advantage normalization (per-minibatch, not the full gradient batch)")
     parser.set_defaults(adv_norm=False)
+    parser.add_argument("--gae-lambda", type=float, help="if set [lambda], use GAE(lambda) advantages instead of R - V")
     parser.add_argument("--rew-clip", type=int, help="if set [r], clip reward to [-r, r]")
     parser.add_argument("--max-iters", type=int, default=int(1e6), help="maximum number of training episodes")
     parser.add_argument("--batch-norm", action='store_true', dest='use_batch_norm',
@@ -319,6 +401,8 @@ def parse_args():
     parser.add_argument("--save-dir", type=str, default="./_model_", help="directory in which training state and model should be saved")
     parser.add_argument("--log-dir", type=str, default="./log", help="directory in which logs training stats")
     parser.add_argument("--save-rate", type=int, default=1000, help="save model once every time this many training iters are completed")
+    parser.add_argument("--keep-checkpoints", type=int, default=1,
+                        help="keep the last this many checkpoints of every saved model (as <file>.1, <file>.2, ...)")
     parser.add_argument("--report-rate", type=int, default=10,
                         help="report training stats once every time this many training steps are performed")
     parser.add_argument("--eval-rate", type=int, default=1000,
@@ -328,11 +412,22 @@ def parse_args():
     ###################################################
     # Logging Option
     parser.add_argument("--append-file-handler", dest='append_file', action='store_true',
-                        help="[Logging] When set, the logger will be close when a log message is output and reopen in the next time.")
+                        help="[Logging] Deprecated, no effect: the logger always appends in batches from a background thread.")
     parser.set_defaults(append_file=False)
     parser.add_argument("--only-fetch-model-dict", dest='only_fetch_model_dict', action='store_true',
                         help="[Logging] When set, train() will not be performed.")
     parser.set_defaults(only_fetch_model_dict=False)
+
+    ###################################################
+    # Profiling
+    parser.add_argument("--profile", dest='profile', action='store_true',
+                        help="time the stages of the master (zmq send/recv, inference, preprocess, backward, optimizer ...) "
+                             "and report their latency stats in the evaluation stats")
+    parser.add_argument("--profile-trace", type=str,
+                        help="[implies --profile] write every timed span to this file in the Chrome trace format")
+    parser.add_argument("--profile-cuda-sync", dest='profile_cuda_sync', action='store_true',
+                        help="[with --profile] synchronize cuda at the end of every span, so GPU time is charged to the right stage")
+    parser.set_defaults(profile=False, profile_cuda_sync=False)
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -340,6 +435,7 @@ if __name__ == '__main__':
 
     common.set_house_IDs(cmd_args.env_set, ensure_kitchen=(not cmd_args.multi_target))
     print('>> Environment Set = <%s>, Total %d Houses!' % (cmd_args.env_set, len(common.all_houseIDs)))
+    common.house_init_workers = cmd_args.house_init_workers
 
     common.ensure_object_targets(cmd_args.object_target)
 
@@ -374,6 +470,7 @@ if __name__ == '__main__':
         cmd_args.grad_batch = 1
 
     args = cmd_args.__dict__
+    checkpoint.configure(keep_last=cmd_args.keep_checkpoints)
 
     if any([args[k] is not None for k in args.keys() if 'rew_shape' in k]):
         common.set_reward_shaping_params(args)
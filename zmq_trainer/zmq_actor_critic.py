@@ -4,6 +4,8 @@ import common
 import zmq_trainer.zmq_util
 import random
 import utils
+import profiler
+import returns
 import time
 import torch
 import torch.nn as nn
@@ -59,7 +61,9 @@ class ZMQA3CTrainer(AgentTrainer):
         else:
             self.optim = optim.RMSprop(self.policy.parameters(), lr=self.lrate, weight_decay=args['weight_decay'])
         self.grad_norm_clip = args['grad_clip'] if 'grad_clip' in args else None
+        self.grad_clip_global = args['grad_clip_global'] if 'grad_clip_global' in args else False
         self.adv_norm = args['adv_norm'] if 'adv_norm' in args else False
+        self.gae_lambda = args['gae_lambda'] if 'gae_lambda' in args else None
         self.rew_clip = args['rew_clip'] if 'rew_clip' in args else None
         self._hidden = None
         self._normal_execution = True
@@ -96,8 +100,10 @@ class ZMQA3CTrainer(AgentTrainer):
                     frames[i][j] = torch.from_numpy(frames[i][j]).type(ByteTensor)
         """
         tensor = [torch.stack(dat, dim=0) for dat in frames]
-        gpu_tensor = torch.stack(tensor, dim=0).permute(0, 1, 4, 2, 3).type(FloatTensor)  # [batch, ....]
+        gpu_tensor = torch.stack(tensor, dim=0).permute(0, 1, 4, 2, 3)  # [batch, ....]
+        # index frames stay uint8, they are expanded in the policy (see policy/index_embedding.py)
         if self.args['segment_input'] != 'index':
+            gpu_tensor = gpu_tensor.type(FloatTensor)
             if self.args['depth_input'] or ('attentive' in self.args['model_name']):
                 gpu_tensor /= 256.0  # special hack here for depth info
             else:
@@ -179,166 +185,159 @@ class ZMQA3CTrainer(AgentTrainer):
         :param target: [batch, seq_len, n_instruction] or None (when single-target)
         :param supervision_mask: timesteps marked with supervised learning loss [batch, seq_len] or None (pure RL)
         """
-        tt = time.time()
+        with profiler.span('preprocess'):
+            # reward clipping
+            if self.rew_clip is not None: rew = np.clip(rew, -self.rew_clip, self.rew_clip)
+
+            # convert data to Variables
+            obs = self._create_gpu_tensor(obs, return_variable=True)  # [batch, t_max+1, dims...]
+            init_hidden = self._create_gpu_hidden(init_hidden, return_variable=True)  # [layers, batch, units]
+            if target is not None:
+                target = self._create_target_tensor(target, return_variable=True)
+            if mask_input is not None:
+                mask_input = self._create_feature_tensor(mask_input, return_variable=True)
+            act = Variable(torch.from_numpy(act).type(LongTensor))  # [batch, t_max]
+            mask = 1.0 - torch.from_numpy(done).type(FloatTensor) # [batch, t_max]
+            mask_var = Variable(mask)
+            sup_mask = None if supervision_mask is None else torch.from_numpy(supervision_mask).type(ByteTensor)  # [batch, t_max]
 
-        # reward clipping
-        if self.rew_clip is not None: rew = np.clip(rew, -self.rew_clip, self.rew_clip)
-
-        # convert data to Variables
-        obs = self._create_gpu_tensor(obs, return_variable=True)  # [batch, t_max+1, dims...]
-        init_hidden = self._create_gpu_hidden(init_hidden, return_variable=True)  # [layers, batch, units]
-        if target is not None:
-            target = self._create_target_tensor(target, return_variable=True)
-        if mask_input is not None:
-            mask_input = self._create_feature_tensor(mask_input, return_variable=True)
-        act = Variable(torch.from_numpy(act).type(LongTensor))  # [batch, t_max]
-        mask = 1.0 - torch.from_numpy(done).type(FloatTensor) # [batch, t_max]
-        mask_var = Variable(mask)
-        sup_mask = None if supervision_mask is None else torch.from_numpy(supervision_mask).type(ByteTensor)  # [batch, t_max]
-
-        time_counter[0] += time.time() - tt
 
         batch_size = self.batch_size
         t_max = self.t_max
         gamma = self.gamma
 
-        tt = time.time()
-
-        if self.accu_grad_steps == 0:  # clear grad
-            self.optim.zero_grad()
-
-        # forward pass
-        logits = []
-        logprobs = []
-        values = []
-        t_obs_slices = torch.chunk(obs, t_max + 1, dim=1)
-        obs_slices = [t.contiguous() for t in t_obs_slices]
-        if target is not None:
-            t_target_slices = torch.chunk(target, t_max + 1, dim=1)
-            target_slices = [t.contiguous() for t in t_target_slices]
-        if mask_input is not None:
-            t_mask_input_slices = torch.chunk(mask_input, t_max + 1, dim=1)
-            mask_input_slices = [m.contiguous() for m in t_mask_input_slices]
-        cur_h = init_hidden
-        for t in range(t_max):
-            #cur_obs = obs[:, t:t+1, ...].contiguous()
-            cur_obs = obs_slices[t]
-            t_target = None if target is None else target_slices[t]
-            t_mask = None if mask_input is None else mask_input_slices[t]
-            cur_logp, cur_val, nxt_h = self.policy(cur_obs, cur_h,
-                                                   target=t_target,
-                                                   extra_input_feature=t_mask)
-            cur_h = self.policy.mark_hidden_states(nxt_h, mask_var[:, t:t+1])
-            values.append(cur_val)
-            logprobs.append(cur_logp)
-            logits.append(self.policy.logits)
-        #cur_obs = obs[:, t_max:t_max + 1, ...].contiguous()
-        cur_obs = obs_slices[-1]
-        t_target = None if target is None else target_slices[-1]
-        t_mask = None if mask_input is None else mask_input_slices[-1]
-        nxt_val = self.policy(cur_obs, cur_h,
-                              only_value=True, return_tensor=True,
-                              target=t_target, extra_input_feature=t_mask)
-        V = torch.cat(values, dim=1)  # [batch, t_max]
-        P = torch.cat(logprobs, dim=1)  # [batch, t_max, n_act]
-        L = torch.cat(logits, dim=1)
-        p_ent = torch.mean(self.policy.entropy(L))  # compute entropy
-        #L_norm = torch.mean(torch.norm(L, dim=-1))
-        L_norm = torch.mean(torch.sum(L * L, dim=-1))   # L^2 penalty
-
-        # estimate accumulative rewards
-        rew = torch.from_numpy(rew).type(FloatTensor)  # [batch, t_max]
-        R = []
-        cur_R = nxt_val.squeeze()  # [batch]
-        for t in range(t_max-1, -1, -1):
-            cur_mask = mask[:, t]
-            cur_R = rew[:, t] + gamma * cur_R * cur_mask
-            R.append(cur_R)
-        R.reverse()
-        R = Variable(torch.stack(R, dim=1))  # [batch, t_max]
-
-        # estimate advantage
-        A_dat = R.data - V.data  # stop gradient here
-        std_val = None
-        if self.adv_norm:   # perform advantage normalization
-            std_val = max(A_dat.std(), 0.1)
-            A_dat = (A_dat - A_dat.mean()) / (std_val + 1e-10)
-        if sup_mask is not None:  # supervision
-            A_dat[sup_mask > 0] = 1.0    # change A * log P(a) to log P(supervised_a), act has been modified in zmq_util
-        A = Variable(A_dat)
-        # [optional]  A = Variable(rew) - V
-
-        # compute loss
-        #critic_loss = F.smooth_l1_loss(V, R)
-        critic_loss = torch.mean((R - V) ** 2)
-        pg_loss = -torch.mean(self.policy.logprob(act, P) * A)
-        if self.args['entropy_penalty'] is not None:
-            pg_loss -= self.args['entropy_penalty'] * p_ent  # encourage exploration
-        loss = self.q_loss_coef * critic_loss + pg_loss
-        if self.logit_loss_coef is not None:
-            loss += self.logit_loss_coef * L_norm
-
-        # backprop
-        if self.grad_batch > 1:
-            loss = loss / float(self.grad_batch)
-        loss.backward()
-
-        ret_dict = dict(pg_loss=pg_loss.data.cpu().numpy()[0],
-                        policy_entropy=p_ent.data.cpu().numpy()[0],
-                        critic_loss=critic_loss.data.cpu().numpy()[0],
-                        logits_norm=L_norm.data.cpu().numpy()[0])
-        if std_val is not None:
-            ret_dict['adv_norm'] = std_val
-
-        if self.accu_grad_steps == 0:
-            self.accu_ret_dict = ret_dict
-        else:
-            for k in ret_dict:
-                self.accu_ret_dict[k] += ret_dict[k]
-
-        self.accu_grad_steps += 1
-        if self.accu_grad_steps < self.grad_batch:  # do not update parameter now
-            time_counter[1] += time.time() - tt
-            return None
-
-        # update parameters
-        for k in self.accu_ret_dict:
-            self.accu_ret_dict[k] /= self.grad_batch
-        ret_dict = self.accu_ret_dict
-        self.accu_grad_steps = 0
-
-        # grad clip
-        if self.grad_norm_clip is not None:
-            utils.clip_grad_norm(self.policy.parameters(), self.grad_norm_clip)
-        self.optim.step()
-
-        if return_kl_divergence:
+        with profiler.span('train'):
+            if self.accu_grad_steps == 0:  # clear grad
+                self.optim.zero_grad()
+
+            # forward pass
+            logits = []
+            logprobs = []
+            values = []
+            t_obs_slices = torch.chunk(obs, t_max + 1, dim=1)
+            obs_slices = [t.contiguous() for t in t_obs_slices]
+            if target is not None:
+                t_target_slices = torch.chunk(target, t_max + 1, dim=1)
+                target_slices = [t.contiguous() for t in t_target_slices]
+            if mask_input is not None:
+                t_mask_input_slices = torch.chunk(mask_input, t_max + 1, dim=1)
+                mask_input_slices = [m.contiguous() for m in t_mask_input_slices]
             cur_h = init_hidden
-            new_logprobs = []
             for t in range(t_max):
-                # cur_obs = obs[:, t:t+1, ...].contiguous()
+                #cur_obs = obs[:, t:t+1, ...].contiguous()
                 cur_obs = obs_slices[t]
-                t_target = target_slices[t] if self.multi_target else None
+                t_target = None if target is None else target_slices[t]
                 t_mask = None if mask_input is None else mask_input_slices[t]
-                cur_logp, nxt_h = self.policy(cur_obs, cur_h, return_value=False,
-                                              target=t_target, extra_input_feature=t_mask)
-                cur_h = self.policy.mark_hidden_states(nxt_h, mask_var[:, t:t + 1])
-                new_logprobs.append(cur_logp)
-            new_P = torch.cat(new_logprobs, dim=1)
-            kl = self.policy.kl_divergence(new_P, P).mean().data.cpu()[0]
-            ret_dict['KL(P_new||P_old)'] = kl
-
-            if kl > flag_max_kl_diff:
-                self.lrate /= flag_lrate_coef
-                self.optim.__dict__['param_groups'][0]['lr']=self.lrate
-                ret_dict['!!![NOTE]:'] = ('------>>>> KL is too large (%.6f), decrease lrate to %.5f' % (kl, self.lrate))
-            elif (kl < flag_min_kl_diff) and (self.lrate < flag_max_lrate):
-                self.lrate *= flag_lrate_coef
-                self.optim.__dict__['param_groups'][0]['lr'] = self.lrate
-                ret_dict['!!![NOTE]:'] = ('------>>>> KL is too small (%.6f), increase lrate to %.5f' % (kl, self.lrate))
-
-
-        time_counter[1] += time.time() - tt
+                cur_logp, cur_val, nxt_h = self.policy(cur_obs, cur_h,
+                                                       target=t_target,
+                                                       extra_input_feature=t_mask)
+                cur_h = self.policy.mark_hidden_states(nxt_h, mask_var[:, t:t+1])
+                values.append(cur_val)
+                logprobs.append(cur_logp)
+                logits.append(self.policy.logits)
+            #cur_obs = obs[:, t_max:t_max + 1, ...].contiguous()
+            cur_obs = obs_slices[-1]
+            t_target = None if target is None else target_slices[-1]
+            t_mask = None if mask_input is None else mask_input_slices[-1]
+            nxt_val = self.policy(cur_obs, cur_h,
+                                  only_value=True, return_tensor=True,
+                                  target=t_target, extra_input_feature=t_mask)
+            V = torch.cat(values, dim=1)  # [batch, t_max]
+            P = torch.cat(logprobs, dim=1)  # [batch, t_max, n_act]
+            L = torch.cat(logits, dim=1)
+            p_ent = torch.mean(self.policy.entropy(L))  # compute entropy
+            #L_norm = torch.mean(torch.norm(L, dim=-1))
+            L_norm = torch.mean(torch.sum(L * L, dim=-1))   # L^2 penalty
+
+            # estimate accumulative rewards
+            rew = torch.from_numpy(rew).type(FloatTensor)  # [batch, t_max]
+            R = Variable(returns.discounted_returns(rew, mask, gamma, bootstrap=nxt_val))  # [batch, t_max]
+
+            # estimate advantage
+            if self.gae_lambda is None:
+                A_dat = R.data - V.data  # stop gradient here
+            else:
+                A_dat = returns.gae(rew, V.data, nxt_val, mask, gamma, self.gae_lambda)
+            std_val = None
+            if self.adv_norm:   # perform advantage normalization
+                std_val = max(A_dat.std(), 0.1)
+                A_dat = (A_dat - A_dat.mean()) / (std_val + 1e-10)
+            if sup_mask is not None:  # supervision
+                A_dat[sup_mask > 0] = 1.0    # change A * log P(a) to log P(supervised_a), act has been modified in zmq_util
+            A = Variable(A_dat)
+            # [optional]  A = Variable(rew) - V
+
+            # compute loss
+            #critic_loss = F.smooth_l1_loss(V, R)
+            critic_loss = torch.mean((R - V) ** 2)
+            pg_loss = -torch.mean(self.policy.logprob(act, P) * A)
+            if self.args['entropy_penalty'] is not None:
+                pg_loss -= self.args['entropy_penalty'] * p_ent  # encourage exploration
+            loss = self.q_loss_coef * critic_loss + pg_loss
+            if self.logit_loss_coef is not None:
+                loss += self.logit_loss_coef * L_norm
+
+            # backprop
+            if self.grad_batch > 1:
+                loss = loss / float(self.grad_batch)
+            with profiler.span('backward'):
+                loss.backward()
+
+            ret_dict = dict(pg_loss=pg_loss.data.cpu().numpy()[0],
+                            policy_entropy=p_ent.data.cpu().numpy()[0],
+                            critic_loss=critic_loss.data.cpu().numpy()[0],
+                            logits_norm=L_norm.data.cpu().numpy()[0])
+            if std_val is not None:
+                ret_dict['adv_norm'] = std_val
+
+            if self.accu_grad_steps == 0:
+                self.accu_ret_dict = ret_dict
+            else:
+                for k in ret_dict:
+                    self.accu_ret_dict[k] += ret_dict[k]
+
+            self.accu_grad_steps += 1
+            if self.accu_grad_steps < self.grad_batch:  # do not update parameter now
+                return None
+
+            # update parameters
+            for k in self.accu_ret_dict:
+                self.accu_ret_dict[k] /= self.grad_batch
+            ret_dict = self.accu_ret_dict
+            self.accu_grad_steps = 0
+
+            # grad clip
+            if self.grad_norm_clip is not None:
+                utils.clip_grad_norm(self.policy.parameters(), self.grad_norm_clip, global_norm=self.grad_clip_global)
+            with profiler.span('optimizer'):
+                self.optim.step()
+
+            if return_kl_divergence:
+                cur_h = init_hidden
+                new_logprobs = []
+                for t in range(t_max):
+                    # cur_obs = obs[:, t:t+1, ...].contiguous()
+                    cur_obs = obs_slices[t]
+                    t_target = target_slices[t] if self.multi_target else None
+                    t_mask = None if mask_input is None else mask_input_slices[t]
+                    cur_logp, nxt_h = self.policy(cur_obs, cur_h, return_value=False,
+                                                  target=t_target, extra_input_feature=t_mask)
+                    cur_h = self.policy.mark_hidden_states(nxt_h, mask_var[:, t:t + 1])
+                    new_logprobs.append(cur_logp)
+                new_P = torch.cat(new_logprobs, dim=1)
+                kl = self.policy.kl_divergence(new_P, P).mean().data.cpu()[0]
+                ret_dict['KL(P_new||P_old)'] = kl
+
+                if kl > flag_max_kl_diff:
+                    self.lrate /= flag_lrate_coef
+                    self.optim.__dict__['param_groups'][0]['lr']=self.lrate
+                    ret_dict['!!![NOTE]:'] = ('------>>>> KL is too large (%.6f), decrease lrate to %.5f' % (kl, self.lrate))
+                elif (kl < flag_min_kl_diff) and (self.lrate < flag_max_lrate):
+                    self.lrate *= flag_lrate_coef
+                    self.optim.__dict__['param_groups'][0]['lr'] = self.lrate
+                    ret_dict['!!![NOTE]:'] = ('------>>>> KL is too small (%.6f), increase lrate to %.5f' % (kl, self.lrate))
+
+
         return ret_dict
 
     def is_rnn(self):
@@ -4,6 +4,8 @@ import common
 import zmq_trainer.zmq_util
 import random
 import utils
+import profiler
+import returns
 import time
 import torch
 import torch.nn as nn
@@ -95,136 +97,130 @@ class ZMQAuxTaskTrainer(ZMQA3CTrainer):
         :param aux_target: 0/1 label matrix [batch, seq_len, n_aux_pred] or None (not updating the aux-loss)
         """
         assert(aux_target is not None), 'AuxTrainer must be given <aux_target>'
-        tt = time.time()
+        with profiler.span('preprocess'):
+            # reward clipping
+            rew = np.clip(rew, -1, 1)
 
-        # reward clipping
-        rew = np.clip(rew, -1, 1)
-
-        # convert data to Variables
-        obs = self._create_gpu_tensor(obs, return_variable=True)  # [batch, t_max+1, dims...]
-        init_hidden = self._create_gpu_hidden(init_hidden, return_variable=True)  # [layers, batch, units]
-        if target is not None:
-            target = self._create_target_tensor(target, return_variable=True)
-        aux_target = self._create_aux_target_tensor(aux_target)
-        act = Variable(torch.from_numpy(act).type(LongTensor))  # [batch, t_max]
-        mask = 1.0 - torch.from_numpy(done).type(FloatTensor) # [batch, t_max]
-        mask_var = Variable(mask)
+            # convert data to Variables
+            obs = self._create_gpu_tensor(obs, return_variable=True)  # [batch, t_max+1, dims...]
+            init_hidden = self._create_gpu_hidden(init_hidden, return_variable=True)  # [layers, batch, units]
+            if target is not None:
+                target = self._create_target_tensor(target, return_variable=True)
+            aux_target = self._create_aux_target_tensor(aux_target)
+            act = Variable(torch.from_numpy(act).type(LongTensor))  # [batch, t_max]
+            mask = 1.0 - torch.from_numpy(done).type(FloatTensor) # [batch, t_max]
+            mask_var = Variable(mask)
 
-        time_counter[0] += time.time() - tt
 
         batch_size = self.batch_size
         t_max = self.t_max
         gamma = self.gamma
 
-        tt = time.time()
-
-        self.optim.zero_grad()
-
-        # forward pass
-        logits = []
-        logprobs = []
-        values = []
-        aux_preds = []
-        obs = obs
-        t_obs_slices = torch.chunk(obs, t_max + 1, dim=1)
-        obs_slices = [t.contiguous() for t in t_obs_slices]
-        if target is not None:
-            t_target_slices = torch.chunk(target, t_max + 1, dim=1)
-            target_slices = [t.contiguous() for t in t_target_slices]
-        cur_h = init_hidden
-        for t in range(t_max):
-            #cur_obs = obs[:, t:t+1, ...].contiguous()
-            cur_obs = obs_slices[t]
+        with profiler.span('train'):
+            self.optim.zero_grad()
+
+            # forward pass
+            logits = []
+            logprobs = []
+            values = []
+            aux_preds = []
+            obs = obs
+            t_obs_slices = torch.chunk(obs, t_max + 1, dim=1)
+            obs_slices = [t.contiguous() for t in t_obs_slices]
             if target is not None:
-                ret_vals = self.policy(cur_obs, cur_h, target=target_slices[t],
-                                       compute_aux_pred=True, return_aux_logprob=self.use_supervised_loss)
-            else:
-                ret_vals = self.policy(cur_obs, cur_h,
-                                       compute_aux_pred=True, return_aux_logprob=self.use_supervised_loss)
-            cur_logp, cur_val, nxt_h, aux_p = ret_vals
-            cur_h = self.policy.mark_hidden_states(nxt_h, mask_var[:, t:t+1])
-            values.append(cur_val)
-            logprobs.append(cur_logp)
-            logits.append(self.policy.logits)
-            aux_preds.append(aux_p)
-        #cur_obs = obs[:, t_max:t_max + 1, ...].contiguous()
-        cur_obs = obs_slices[-1]
-        if target is not None:
-            nxt_val = self.policy(cur_obs, cur_h, only_value=True, return_tensor=True, target=target_slices[-1])
-        else:
-            nxt_val = self.policy(cur_obs, cur_h, only_value=True, return_tensor=True)
-        V = torch.cat(values, dim=1)  # [batch, t_max]
-        P = torch.cat(logprobs, dim=1)  # [batch, t_max, n_act]
-        L = torch.cat(logits, dim=1)
-        p_ent = torch.mean(self.policy.entropy(L))  # compute entropy
-        Aux_P = torch.cat(aux_preds, dim=1)  # [batch, t_max, n_aux_pred]
-
-        # estimate accumulative rewards
-        rew = torch.from_numpy(rew).type(FloatTensor)  # [batch, t_max]
-        R = []
-        cur_R = nxt_val.squeeze()  # [batch]
-        for t in range(t_max-1, -1, -1):
-            cur_mask = mask[:, t]
-            cur_R = rew[:, t] + gamma * cur_R * cur_mask
-            R.append(cur_R)
-        R.reverse()
-        R = Variable(torch.stack(R, dim=1))  # [batch, t_max]
-
-        # estimate advantage
-        A = Variable(R.data - V.data)  # stop gradient here
-        # [optional]  A = Variable(rew) - V
-
-        # compute loss
-        #critic_loss = F.smooth_l1_loss(V, R)
-        critic_loss = torch.mean((R - V) ** 2)
-        pg_loss = -torch.mean(self.policy.logprob(act, P) * A)
-        if self.args['entropy_penalty'] is not None:
-            pg_loss -= self.args['entropy_penalty'] * p_ent  # encourage exploration
-
-        # aux task loss
-        aux_loss = -(Aux_P * aux_target).sum(dim=-1).mean()
-
-        loss = self.q_loss_coef * critic_loss + pg_loss + self.aux_loss_coef * aux_loss
-
-        # backprop
-        loss.backward()
-
-        # grad clip
-        if self.grad_norm_clip is not None:
-            utils.clip_grad_norm(self.policy.parameters(), self.grad_norm_clip)
-        self.optim.step()
-
-        ret_dict = dict(pg_loss=pg_loss.data.cpu().numpy()[0],
-                        aux_task_loss=aux_loss.data.cpu().numpy()[0],
-                        policy_entropy=p_ent.data.cpu().numpy()[0],
-                        critic_loss=critic_loss.data.cpu().numpy()[0])
-
-        if return_kl_divergence:
+                t_target_slices = torch.chunk(target, t_max + 1, dim=1)
+                target_slices = [t.contiguous() for t in t_target_slices]
             cur_h = init_hidden
-            new_logprobs = []
             for t in range(t_max):
-                # cur_obs = obs[:, t:t+1, ...].contiguous()
+                #cur_obs = obs[:, t:t+1, ...].contiguous()
                 cur_obs = obs_slices[t]
-                if self.multi_target:
-                    cur_target = target_slices[t]
+                if target is not None:
+                    ret_vals = self.policy(cur_obs, cur_h, target=target_slices[t],
+                                           compute_aux_pred=True, return_aux_logprob=self.use_supervised_loss)
                 else:
-                    cur_target = None
-                cur_logp, nxt_h = self.policy(cur_obs, cur_h, return_value=False, target=cur_target)
-                cur_h = self.policy.mark_hidden_states(nxt_h, mask_var[:, t:t + 1])
-                new_logprobs.append(cur_logp)
-            new_P = torch.cat(new_logprobs, dim=1)
-            kl = self.policy.kl_divergence(new_P, P).mean().data.cpu()[0]
-            ret_dict['KL(P_new||P_old)'] = kl
-
-            if kl > flag_max_kl_diff:
-                self.lrate /= flag_lrate_coef
-                self.optim.__dict__['param_groups'][0]['lr']=self.lrate
-                ret_dict['!!![NOTE]:'] = ('------>>>> KL is too large (%.6f), decrease lrate to %.5f' % (kl, self.lrate))
-            elif (kl < flag_min_kl_diff) and (self.lrate < flag_max_lrate):
-                self.lrate *= flag_lrate_coef
-                self.optim.__dict__['param_groups'][0]['lr'] = self.lrate
-                ret_dict['!!![NOTE]:'] = ('------>>>> KL is too small (%.6f), increase lrate to %.5f' % (kl, self.lrate))
-
-
-        time_counter[1] += time.time() - tt
+                    ret_vals = self.policy(cur_obs, cur_h,
+                                           compute_aux_pred=True, return_aux_logprob=self.use_supervised_loss)
+                cur_logp, cur_val, nxt_h, aux_p = ret_vals
+                cur_h = self.policy.mark_hidden_states(nxt_h, mask_var[:, t:t+1])
+                values.append(cur_val)
+                logprobs.append(cur_logp)
+                logits.append(self.policy.logits)
+                aux_preds.append(aux_p)
+            #cur_obs = obs[:, t_max:t_max + 1, ...].contiguous()
+            cur_obs = obs_slices[-1]
+            if target is not None:
+                nxt_val = self.policy(cur_obs, cur_h, only_value=True, return_tensor=True, target=target_slices[-1])
+            else:
+                nxt_val = self.policy(cur_obs, cur_h, only_value=True, return_tensor=True)
+            V = torch.cat(values, dim=1)  # [batch, t_max]
+            P = torch.cat(logprobs, dim=1)  # [batch, t_max, n_act]
+            L = torch.cat(logits, dim=1)
+            p_ent = torch.mean(self.policy.entropy(L))  # compute entropy
+            Aux_P = torch.cat(aux_preds, dim=1)  # [batch, t_max, n_aux_pred]
+
+            # estimate accumulative rewards
+            rew = torch.from_numpy(rew).type(FloatTensor)  # [batch, t_max]
+            R = Variable(returns.discounted_returns(rew, mask, gamma, bootstrap=nxt_val))  # [batch, t_max]
+
+            # estimate advantage
+            if self.gae_lambda is None:
+                A = Variable(R.data - V.data)  # stop gradient here
+            else:
+                A = Variable(returns.gae(rew, V.data, nxt_val, mask, gamma, self.gae_lambda))
+            # [optional]  A = Variable(rew) - V
+
+            # compute loss
+            #critic_loss = F.smooth_l1_loss(V, R)
+            critic_loss = torch.mean((R - V) ** 2)
+            pg_loss = -torch.mean(self.policy.logprob(act, P) * A)
+            if self.args['entropy_penalty'] is not None:
+                pg_loss -= self.args['entropy_penalty'] * p_ent  # encourage exploration
+
+            # aux task loss
+            aux_loss = -(Aux_P * aux_target).sum(dim=-1).mean()
+
+            loss = self.q_loss_coef * critic_loss + pg_loss + self.aux_loss_coef * aux_loss
+
+            # backprop
+            with profiler.span('backward'):
+                loss.backward()
+
+            # grad clip
+            if self.grad_norm_clip is not None:
+                utils.clip_grad_norm(self.policy.parameters(), self.grad_norm_clip, global_norm=self.grad_clip_global)
+            with profiler.span('optimizer'):
+                self.optim.step()
+
+            ret_dict = dict(pg_loss=pg_loss.data.cpu().numpy()[0],
+                            aux_task_loss=aux_loss.data.cpu().numpy()[0],
+                            policy_entropy=p_ent.data.cpu().numpy()[0],
+                            critic_loss=critic_loss.data.cpu().numpy()[0])
+
+            if return_kl_divergence:
+                cur_h = init_hidden
+                new_logprobs = []
+                for t in range(t_max):
+                    # cur_obs = obs[:, t:t+1, ...].contiguous()
+                    cur_obs = obs_slices[t]
+                    if self.multi_target:
+                        cur_target = target_slices[t]
+                    else:
+                        cur_target = None
+                    cur_logp, nxt_h = self.policy(cur_obs, cur_h, return_value=False, target=cur_target)
+                    cur_h = self.policy.mark_hidden_states(nxt_h, mask_var[:, t:t + 1])
+                    new_logprobs.append(cur_logp)
+                new_P = torch.cat(new_logprobs, dim=1)
+                kl = self.policy.kl_divergence(new_P, P).mean().data.cpu()[0]
+                ret_dict['KL(P_new||P_old)'] = kl
+
+                if kl > flag_max_kl_diff:
+                    self.lrate /= flag_lrate_coef
+                    self.optim.__dict__['param_groups'][0]['lr']=self.lrate
+                    ret_dict['!!![NOTE]:'] = ('------>>>> KL is too large (%.6f), decrease lrate to %.5f' % (kl, self.lrate))
+                elif (kl < flag_min_kl_diff) and (self.lrate < flag_max_lrate):
+                    self.lrate *= flag_lrate_coef
+                    self.optim.__dict__['param_groups'][0]['lr'] = self.lrate
+                    ret_dict['!!![NOTE]:'] = ('------>>>> KL is too small (%.6f), increase lrate to %.5f' % (kl, self.lrate))
+
+
         return ret_dict
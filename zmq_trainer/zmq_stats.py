@@ -0,0 +1,76 @@
+import numpy as np
+
+"""
+Fixed-Capacity Training Statistics
+  --> RingStats keeps the last <capacity> records of a fixed set of numeric keys in a numpy ring buffer
+      together with running sums, so adding a record and reading a windowed mean are both O(1)
+  --> with <group_key> (e.g., 'target'), running counts and sums are kept per group as well
+  --> the running sums are recomputed from the buffer once per wrap-around to bound the float drift
+  --> the full history goes to append-only metrics logs (see metrics.py) instead of python lists
+"""
+
+
+class RingStats(object):
+    def __init__(self, keys, capacity=1000, group_key=None):
+        assert capacity > 0, '[RingStats] capacity must be positive'
+        self.keys = list(keys)
+        self.capacity = capacity
+        self.group_key = group_key
+        self._buf = np.zeros((capacity, len(self.keys)), dtype=np.float64)
+        self._sum = np.zeros(len(self.keys), dtype=np.float64)
+        self._group = np.zeros(capacity, dtype=np.int64) if group_key is not None else None
+        self._group_cnt = dict()
+        self._group_sum = dict()
+        self._pos = 0
+        self.size = 0   # number of records in the window
+        self.total = 0  # number of records ever added
+
+    def add(self, **values):
+        vals = np.array([float(values[k]) for k in self.keys], dtype=np.float64)
+        i = self._pos
+        if self.size == self.capacity:  # evict the oldest record
+            self._sum -= self._buf[i]
+            if self.group_key is not None:
+                g = int(self._group[i])
+                self._group_cnt[g] -= 1
+                if self._group_cnt[g] == 0:
+                    del self._group_cnt[g]
+                    del self._group_sum[g]
+                else:
+                    self._group_sum[g] -= self._buf[i]
+        else:
+            self.size += 1
+        self._buf[i] = vals
+        self._sum += vals
+        if self.group_key is not None:
+            g = int(values[self.group_key])
+            self._group[i] = g
+            if g not in self._group_cnt:
+                self._group_cnt[g] = 0
+                self._group_sum[g] = np.zeros(len(self.keys), dtype=np.float64)
+            self._group_cnt[g] += 1
+            self._group_sum[g] += vals
+        self.total += 1
+        self._pos = (i + 1) % self.capacity
+        if self._pos == 0:
+            self._resum()
+
+    def _resum(self):
+        self._sum = self._buf[:self.size].sum(0)
+        for g in self._group_sum.keys():
+            self._group_sum[g] = self._buf[:self.size][self._group[:self.size] == g].sum(0)
+
+    def mean(self, key):
+        if self.size == 0:
+            return 0.0
+        return float(self._sum[self.keys.index(key)] / self.size)
+
+    def group_stats(self):
+        """
+        return dict: group -> (fraction of the window, dict: key -> mean within the group)
+        """
+        ret = dict()
+        for g in sorted(self._group_cnt.keys()):
+            n = self._group_cnt[g]
+            ret[g] = (n / self.size, dict(zip(self.keys, (self._group_sum[g] / n).tolist())))
+        return ret
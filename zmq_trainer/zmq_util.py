@@ -8,9 +8,14 @@ import os
 import json
 import utils
 import common
+import profiler
+import metrics
+from birthplace_index import BirthplaceIndex
 from zmq_trainer.zmqsimulator import SimulatorProcess, SimulatorMaster, ensure_proc_terminate
+from zmq_trainer.zmq_stats import RingStats
 
 n_episode_evaluation = 1000
+render_cache_report_rate = 500  # episodes
 
 class ZMQHouseEnvironment:
     def __init__(self, k=0, task_name='roomnav', false_rate=0.0,
@@ -23,7 +28,9 @@ class ZMQHouseEnvironment:
                  cache_supervision=False,
                  include_outdoor_target=True,
                  mask_feature_dim=None,
-                 max_steps=-1, device=0):
+                 max_steps=-1, device=0,
+                 render_cache_size=0, render_cache_key='exact', atlas_dir=None, synthetic_env=False,
+                 house_store_dir=None, birthplace_index_dir=None):
         assert k >= 0
         init_birthplace = max_birthplace_steps if curriculum_schedule is None else curriculum_schedule[0]
         self.env = common.create_env(k, task_name=task_name, false_rate=false_rate,
@@ -41,11 +48,24 @@ class ZMQHouseEnvironment:
                                      #curriculum_schedule=curriculum_schedule,
                                      cache_supervision=cache_supervision,
                                      include_outdoor_target=include_outdoor_target,
-                                     min_birthplace_grids=min_birthplace_grids)
-        self.obs = self.env.reset() if multi_target else self.env.reset(target='kitchen')
+                                     min_birthplace_grids=min_birthplace_grids,
+                                     render_cache_size=render_cache_size,
+                                     render_cache_key=render_cache_key,
+                                     atlas_dir=atlas_dir,
+                                     synthetic_env=synthetic_env,
+                                     house_store_dir=house_store_dir)
+        self._episode_cnt = 0
         self.done = False
         self.multi_target = multi_target
         self.fixed_target = fixed_target
+        # curriculum birthplaces are drawn from the birthplace index (see birthplace_index.py)
+        #   the index is built offline (build_birthplace_index.py) and only loaded here
+        self._birthplace_index = None
+        self._max_birthplace = init_birthplace
+        if birthplace_index_dir is not None:
+            self._birthplace_index = BirthplaceIndex(birthplace_index_dir, max_birthplace_steps=max_birthplace_steps,
+                                                     read_only=True)
+        self.obs = self._reset(None) if multi_target else self._reset('kitchen')
         self.aux_task = aux_task
         self.supervision = cache_supervision
         self.mask_feature_dim = mask_feature_dim
@@ -56,6 +76,17 @@ class ZMQHouseEnvironment:
             assert False, 'Aux Room Prediction Currently Not Supported!'
         self._target = common.target_instruction_dict[self.env.get_current_target()]
 
+    def _reset(self, target):
+        if self._birthplace_index is not None:
+            targets = self._birthplace_index.targets(self.env)
+            if target is None:
+                target = random.choice(targets)
+            if target in targets:
+                obs = self._birthplace_index.reset_task(self.env, target, max_optsteps=self._max_birthplace)
+                if obs is not None:
+                    return obs
+        return self.env.reset(target=target)
+
     def _get_mask_feature(self):
         if self.mask_feature_dim is None:
             return None
@@ -77,15 +108,19 @@ class ZMQHouseEnvironment:
         if isinstance(_act, list) or isinstance(_act, tuple):
             act, nxt_birthplace = _act
             self.env.reset_hardness(self.env.hardness, max_birthplace_steps=nxt_birthplace)
+            self._max_birthplace = nxt_birthplace
         else:
             act = _act
         obs, rew, done, info = self.env.step(act)
         if done:
+            self._episode_cnt += 1
+            if (getattr(self.env, '_render_cache', None) is not None) and (self._episode_cnt % render_cache_report_rate == 0):
+                print(self.env._render_cache.stats_string())
             if self.multi_target:
-                obs = self.env.reset(target=self.fixed_target)
+                obs = self._reset(self.fixed_target)
                 self._target = common.target_instruction_dict[self.env.get_current_target()]
             else:
-                obs = self.env.reset(target=self.env.get_current_target())
+                obs = self._reset(self.env.get_current_target())
             if self.supervision: info = self.env.info
         if self.supervision: self._sup_act = info['supervision']
         if self.mask_feature_dim is not None:
@@ -115,7 +150,10 @@ class ZMQSimulator(SimulatorProcess):
                                    (('cache_supervision' in config) and config['cache_supervision']),
                                    config['outdoor_target'],
                                    config['mask_feature_dim'],
-                                   config['max_episode_len'], device)
+                                   config['max_episode_len'], device,
+                                   config.get('render_cache_size', 0), config.get('render_cache_key', 'exact'),
+                                   config.get('atlas_dir', None), config.get('synthetic_env', False),
+                                   config.get('house_store_dir', None), config.get('birthplace_index_dir', None))
 
 
 class ZMQMaster(SimulatorMaster):
@@ -140,13 +178,9 @@ class ZMQMaster(SimulatorMaster):
         self.accu_stats = dict()
         self.batch_step = 0
         self.start_time = time.time()
-        self.episode_stats = dict(len=[], rew=[], succ=[])
-        self.update_stats = dict(lrate=[])
         self.best_avg_reward = -1e50
         self.best_succ_rate = 0.0
         self.multi_target = config['multi_target']
-        if self.multi_target:
-            self.episode_stats['target'] = []
         self.supervision = config['cache_supervision'] if 'cache_supervision' in config else False
         if self.supervision:
             self.curr_sup_act = dict()
@@ -155,9 +189,17 @@ class ZMQMaster(SimulatorMaster):
             self.curr_mask_feat = dict()
         self.aux_task = config['aux_task']
         if self.aux_task:
-            self.episode_stats['aux_task_rew'] = []
-            self.episode_stats['aux_task_err'] = []
             self.curr_aux_mask = dict()
+        # windowed episode stats over the last <n_episode_evaluation> episodes, full history in append-only logs
+        episode_keys = ['rew', 'len', 'succ']
+        if self.aux_task:
+            episode_keys += ['aux_task_rew', 'aux_task_err']
+        self.episode_stats = RingStats(episode_keys, capacity=n_episode_evaluation,
+                                       group_key='target' if self.multi_target else None)
+        self.episode_log = metrics.MetricsSink(os.path.join(config['log_dir'], trainer.name + '_epis_stats.jsonl'))
+        self.update_log = metrics.MetricsSink(os.path.join(config['log_dir'], trainer.name + '_update_stats.jsonl'))
+        for f in [self.episode_log.filename, self.update_log.filename]:
+            if os.path.exists(f): os.remove(f)
         self.curriculum_schedule = config['curriculum_schedule']
         self.max_episode_len = config['max_episode_len']
         self.curr_birthplace = dict()
@@ -180,13 +222,14 @@ class ZMQMaster(SimulatorMaster):
             target = None
         mask_input = [[self.curr_mask_feat[id]] for id in batched_ids] if self.use_mask_feature else None
         self.trainer.eval()  # TODO: check this option
-        if self.aux_task:
-            action, next_hidden, aux_preds = self.trainer.action(states, hiddens, target=target, return_aux_pred=True)
-            aux_preds = aux_preds.squeeze().cpu().numpy()
-        else:
-            action, next_hidden = self.trainer.action(states, hiddens,
-                                                      target=target, mask_input=mask_input)
-        cpu_action = action.squeeze().cpu().numpy()
+        with profiler.span('inference'):
+            if self.aux_task:
+                action, next_hidden, aux_preds = self.trainer.action(states, hiddens, target=target, return_aux_pred=True)
+                aux_preds = aux_preds.squeeze().cpu().numpy()
+            else:
+                action, next_hidden = self.trainer.action(states, hiddens,
+                                                          target=target, mask_input=mask_input)
+            cpu_action = action.squeeze().cpu().numpy()
         for i,id in enumerate(batched_ids):
             self.cnt += 1
             if (self.scheduler is not None) and (random.random() > self.scheduler.value(self.cnt)):
@@ -234,12 +277,13 @@ class ZMQMaster(SimulatorMaster):
             if target is not None: target.append(dat['target'])
             if self.aux_task: aux_target.append(dat['aux_target'][:-1])
         self.trainer.train()
-        if self.aux_task:
-            stats = self.trainer.update(obs, hidden, act, rew, done,
-                                        target=target, aux_target=aux_target)
-        else:
-            stats = self.trainer.update(obs, hidden, act, rew, done, target=target,
-                                        supervision_mask=sup_mask, mask_input=mask_feat)
+        with profiler.span('update'):
+            if self.aux_task:
+                stats = self.trainer.update(obs, hidden, act, rew, done,
+                                            target=target, aux_target=aux_target)
+            else:
+                stats = self.trainer.update(obs, hidden, act, rew, done, target=target,
+                                            supervision_mask=sup_mask, mask_input=mask_feat)
         if stats is None:
             return False   # just accumulate gradient, no update performed
 
@@ -249,12 +293,10 @@ class ZMQMaster(SimulatorMaster):
             if (self.train_cnt % self.curriculum_schedule[2] == 0):
                 self.global_birthplace = min(self.max_birthplace_steps, self.global_birthplace + self.curriculum_schedule[1])
         # update stats
-        for key in stats.keys():
-            if key not in self.update_stats:
-                self.update_stats[key] = []
-            self.update_stats[key].append(stats[key])
-        if 'lrate' not in stats:
-            self.update_stats['lrate'].append(self.trainer.lrate)
+        record = dict(stats)
+        if 'lrate' not in record:
+            record['lrate'] = self.trainer.lrate
+        self.update_log.log('update', step=self.train_cnt, **record)
         if self.train_cnt % self.config['report_rate'] == 0:
             self.logger.print('Training Iter#%d ...' % self.train_cnt)
             keys = sorted(stats.keys())
@@ -274,8 +316,11 @@ class ZMQMaster(SimulatorMaster):
 
     def save_all(self, version=''):
         self.trainer.save(self.config['save_dir'], version=version)
-        self.trainer.save(self.config['log_dir'], version=version+'_epis_stats', target_dict_data=self.episode_stats)
-        self.trainer.save(self.config['log_dir'], version=version+'_update_stats', target_dict_data=self.update_stats)
+        self.episode_log.flush()
+        self.update_log.flush()
+        self.logger.flush()
+        if ('profile_trace' in self.config) and (self.config['profile_trace'] is not None):
+            profiler.export_chrome_trace(self.config['profile_trace'])  # once at the end, the trace can be large
 
     # TODO: TO handle Aux_Task [to output the accumulative reward and error for aux task]
     def _evaluate_stats(self):
@@ -283,41 +328,26 @@ class ZMQMaster(SimulatorMaster):
         self.logger.print("+++++++++++++++++++ Eval +++++++++++++++++++++++++++++++")
         self.logger.print("Running Stats <#Samles = {}>".format(self.comm_cnt))
         self.logger.print("> Time Elapsed = %.4f min"%(duration / 60))
-        self.logger.print(" -> #Episode = {}, #Updates = {}".format(len(self.episode_stats['rew']), self.train_cnt))
-        rew_stats = self.episode_stats['rew'][-n_episode_evaluation:]
-        len_stats = self.episode_stats['len'][-n_episode_evaluation:]
-        succ_stats = self.episode_stats['succ'][-n_episode_evaluation:]
-        if self.multi_target:
-            tar_stats = self.episode_stats['target'][-n_episode_evaluation:]
-        avg_rew = sum(rew_stats) / len(rew_stats)
-        avg_len = sum(len_stats) / len(len_stats)
-        avg_succ = sum(succ_stats) / len(succ_stats)
+        self.logger.print(" -> #Episode = {}, #Updates = {}".format(self.episode_stats.total, self.train_cnt))
+        avg_rew = self.episode_stats.mean('rew')
+        avg_len = self.episode_stats.mean('len')
+        avg_succ = self.episode_stats.mean('succ')
         self.logger.print("  > Avg Reward = %.6f, Avg Path Len = %.6f, Succ Rate = %.2f, Max-BirthPlace = %d" % (avg_rew, avg_len, avg_succ, self.global_birthplace))
+        self.logger.log('eval', step=self.train_cnt, n_episode=self.episode_stats.total, n_sample=self.comm_cnt,
+                        avg_rew=avg_rew, avg_len=avg_len, avg_succ=avg_succ, max_birthplace=self.global_birthplace,
+                        fps=self.comm_cnt * 1.0 / duration)
         if self.aux_task:
-            aux_rew_stats = self.episode_stats['aux_task_rew'][-n_episode_evaluation:]
-            aux_err_stats = self.episode_stats['aux_task_err'][-n_episode_evaluation:]
-            avg_aux_rew = sum(aux_rew_stats) / len(aux_rew_stats)
-            avg_aux_err = sum(aux_err_stats) / len(aux_err_stats)
+            avg_aux_rew = self.episode_stats.mean('aux_task_rew')
+            avg_aux_err = self.episode_stats.mean('aux_task_err')
             self.logger.print(
                 "  ---> Aux-Task Predictions: Avg Rew = %.3f,  Avg Err = %.3f" % (avg_aux_rew, avg_aux_err))
         if self.multi_target:
-            all_stats = dict()
-            for i, t in enumerate(tar_stats):
-                if t not in all_stats:
-                    all_stats[t] = [0.0, 0.0, 0.0, 0.0]
-                all_stats[t][0] += 1
-                all_stats[t][1] += rew_stats[i]
-                all_stats[t][2] += len_stats[i]
-                all_stats[t][3] += succ_stats[i]
-            m = len(rew_stats)
-            for t in all_stats.keys():
-                n, r, l, s = all_stats[t]
+            for t, (rate, avg) in self.episode_stats.group_stats().items():
                 self.logger.print("  ---> Mul-Target <%s> Rate = %.3f, Avg Rew = %.3f, Avg Len = %.3f, Succ Rate = %.3f"
-                                  % (common.all_target_instructions[t], n/m, r/n, l/n, s/n))
+                                  % (common.all_target_instructions[t], rate, avg['rew'], avg['len'], avg['succ']))
         self.logger.print("  >>>> Total FPS: %.5f"%(self.comm_cnt * 1.0 / duration))
-        self.logger.print('   ----> Data Loading Time = %.4f min' % (time_counter[0] / 60))
-        self.logger.print('   ----> Training Time = %.4f min' % (time_counter[1] / 60))
         self.logger.print('   ----> Update Time Per Iter = %.4f s' % (duration / self.train_cnt))
+        profiler.report(self.logger)
         # Best Model with Highest Success Rate
         if avg_succ > self.best_succ_rate:
             self.best_succ_rate = avg_succ
@@ -384,21 +414,23 @@ class ZMQMaster(SimulatorMaster):
             # accumulate running stats
             if reward > 5:  # magic number, since when we succeed we have a super large reward
                 self.accu_stats[ident]['succ'] = 1
-            self.episode_stats['rew'].append(self.accu_stats[ident]['rew'])
-            self.episode_stats['len'].append(self.accu_stats[ident]['len'])
-            self.episode_stats['succ'].append(self.accu_stats[ident]['succ'])
+            record = dict(rew=self.accu_stats[ident]['rew'],
+                          len=self.accu_stats[ident]['len'],
+                          succ=self.accu_stats[ident]['succ'])
             # reset stats
             self.accu_stats[ident]['rew'] = 0
             self.accu_stats[ident]['len'] = 1
             self.accu_stats[ident]['succ'] = 0
             if self.multi_target:
-                self.episode_stats['target'].append(self.accu_stats[ident]['target'])
+                record['target'] = self.accu_stats[ident]['target']
                 self.accu_stats[ident]['target'] = target
             if self.aux_task:
-                self.episode_stats['aux_task_err'].append(self.accu_stats[ident]['aux_task_err'] / self.episode_stats['len'][-1])
+                record['aux_task_err'] = self.accu_stats[ident]['aux_task_err'] / record['len']
                 self.accu_stats[ident]['aux_task_err'] = 0
-                self.episode_stats['aux_task_rew'].append(self.accu_stats[ident]['aux_task_rew'])
+                record['aux_task_rew'] = self.accu_stats[ident]['aux_task_rew']
                 self.accu_stats[ident]['aux_task_rew'] = 0
+            self.episode_stats.add(**record)
+            self.episode_log.log('episode', step=self.episode_stats.total, **record)
 
         if isinstance(state, np.ndarray): state = torch.from_numpy(state).type(ByteTensor)
         self.curr_state[ident] = state
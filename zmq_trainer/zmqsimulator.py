@@ -5,10 +5,11 @@
 import multiprocessing as mp
 import threading
 import atexit
-import os, sys
+import os, sys, time
 from abc import abstractmethod, ABCMeta
 from six.moves import queue
 import weakref
+import profiler
 import zmq
 import msgpack
 import msgpack_numpy
@@ -48,18 +49,21 @@ class SimulatorProcess(mp.Process):
         self.s2c = pipe_s2c
 
         self.config = config
+        self.launch_time = time.time()
 
     @abstractmethod
     def _build_player(self):
         pass
 
     def run(self):
+        ts = time.time()
         try:
             player = self._build_player()
             assert player is not None
         except Exception as e:
             print('[ERROR] <ZMQSimulator> Fail to create player for <{}>, Msg = {}'.format(self.identity, e), file=sys.stderr)
             raise e
+        build_time = time.time() - ts
         context = zmq.Context()
         c2s_socket = context.socket(zmq.PUSH)
         c2s_socket.setsockopt(zmq.IDENTITY, self.identity)
@@ -73,6 +77,7 @@ class SimulatorProcess(mp.Process):
 
         state = player.current_state()
         reward, isOver = 0, False
+        first_step = True
         while True:
             c2s_socket.send(dumps(
                 (self.identity, state, reward, isOver)),
@@ -80,6 +85,10 @@ class SimulatorProcess(mp.Process):
             action = loads(s2c_socket.recv(copy=False).bytes)
             reward, isOver = player.action(action)
             state = player.current_state()
+            if first_step:
+                first_step = False
+                print('[ZMQSimulator] <{}> time-to-first-step = %.3fs (fork = %.3fs, build player = %.3fs)'.format(self.name)
+                      % (time.time() - self.launch_time, ts - self.launch_time, build_time))
 
 
 class SimulatorMaster(object):
@@ -111,12 +120,14 @@ class SimulatorMaster(object):
     def send_loop(self):
         while True:
             msg = self.send_queue.get()
-            self.s2c_socket.send_multipart(msg, copy=False)
+            with profiler.span('zmq_send'):
+                self.s2c_socket.send_multipart(msg, copy=False)
 
     def recv_loop(self):
         try:
             while True:
-                msg = loads(self.c2s_socket.recv(copy=False).bytes)
+                with profiler.span('zmq_recv'):  # including the wait for the simulators
+                    msg = loads(self.c2s_socket.recv(copy=False).bytes)
                 ident, state, reward, isOver = msg
                 self.recv_message(ident, state, reward, isOver)
         except zmq.ContextTerminated: